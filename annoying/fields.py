@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, router, transaction, IntegrityError
 from django.db.models import OneToOneField
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models.fields.related import SingleRelatedObjectDescriptor
@@ -11,22 +11,77 @@ except ImportError:
 
 
 class AutoSingleRelatedObjectDescriptor(SingleRelatedObjectDescriptor):
+    """
+    Creates the related object the first time it's found missing, with a
+    single INSERT: the unique constraint on the one-to-one column decides
+    races, and the loser reads the winner's row. A missing object that
+    select_related() cached as None is created too, and prefetch_related()
+    creates all of the missing ones with one bulk insert.
+    """
     def __get__(self, instance, instance_type=None):
+        if instance is None:
+            return self
         try:
-            return super(AutoSingleRelatedObjectDescriptor, self).__get__(instance, instance_type)
+            rel_obj = super(AutoSingleRelatedObjectDescriptor, self).__get__(instance, instance_type)
         except self.related.model.DoesNotExist:
-            obj = self.related.model(**{self.related.field.name: instance})
-            obj.save()
-            # Don't return obj directly, otherwise it won't be added
-            # to Django's cache, and the first 2 calls to obj.relobj
-            # will return 2 different in-memory objects
-            return super(AutoSingleRelatedObjectDescriptor, self).__get__(instance, instance_type)
+            rel_obj = None
+        if rel_obj is None:
+            rel_obj = self.create(instance)
+            setattr(instance, self.cache_name, rel_obj)
+            setattr(rel_obj, self.related.field.get_cache_name(), instance)
+        return rel_obj
+
+    def create(self, instance):
+        db = router.db_for_write(self.related.model, instance=instance)
+        obj = self.related.model(**{self.related.field.name: instance})
+        sid = transaction.savepoint(using=db)
+        try:
+            obj.save(force_insert=True, using=db)
+            transaction.savepoint_commit(sid, using=db)
+            return obj
+        except IntegrityError:
+            # created by somebody else in the meantime
+            transaction.savepoint_rollback(sid, using=db)
+            return self.get_query_set(instance=instance).get(**{
+                '%s__pk' % self.related.field.name: instance._get_pk_val()})
+
+    def get_prefetch_query_set(self, instances):
+        queryset, rel_obj_attr, instance_attr, single, cache_name = \
+            super(AutoSingleRelatedObjectDescriptor, self).get_prefetch_query_set(instances)
+        rel_objs = list(queryset)
+        found = set(rel_obj_attr(rel_obj) for rel_obj in rel_objs)
+        missing = [instance for instance in instances
+                   if instance_attr(instance) not in found]
+        if missing:
+            rel_objs.extend(self.createMany(missing))
+        return rel_objs, rel_obj_attr, instance_attr, single, cache_name
+
+    def createMany(self, instances):
+        db = router.db_for_write(self.related.model, instance=instances[0])
+        field = self.related.field
+        objs = [self.related.model(**{field.name: instance})
+                for instance in instances]
+        sid = transaction.savepoint(using=db)
+        try:
+            self.related.model._base_manager.using(db).bulk_create(objs)
+            transaction.savepoint_commit(sid, using=db)
+        except IntegrityError:
+            # some of them were created in the meantime
+            transaction.savepoint_rollback(sid, using=db)
+            return [self.__get__(instance) for instance in instances]
+        if field.primary_key:
+            return objs
+        # bulk_create doesn't set automatic primary keys
+        return list(self.get_query_set(instance=instances[0]).filter(**{
+            '%s__pk__in' % field.name: [instance._get_pk_val()
+                                        for instance in instances]}))
 
 
 class AutoOneToOneField(OneToOneField):
     '''
     OneToOneField creates related object on first call if it doesnt exist yet.
-    Use it instead of original OneToOne field.
+    Use it instead of original OneToOne field. Works with select_related()
+    and prefetch_related() (see AutoSingleRelatedObjectDescriptor).
 
     example:
 
@@ -39,12 +94,68 @@ class AutoOneToOneField(OneToOneField):
         setattr(cls, related.get_accessor_name(), AutoSingleRelatedObjectDescriptor(related))
 
 
+class LazyJSONDescriptor(object):
+    """
+    Holds on to the string a JSONField was loaded (or set) with and decodes
+    it on first access only, caching the result. Until then the string is
+    what gets saved back, so rows whose JSON is never read don't pay for
+    json.loads or json.dumps. Once decoded, the string is still kept, so that
+    a value that was only read can be saved as it was loaded.
+    """
+    def __init__(self, field):
+        self.field = field
+        self.rawName = '_%s_json' % field.attname
+        self.decodedFromName = '_%s_decoded_from' % field.attname
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        data = instance.__dict__
+        if self.field.attname not in data:
+            try:
+                raw = data.pop(self.rawName)
+            except KeyError:
+                raise AttributeError(self.field.attname)
+            data[self.field.attname] = self.field.to_python(raw)
+            data[self.decodedFromName] = raw
+        return data[self.field.attname]
+
+    def __set__(self, instance, value):
+        data = instance.__dict__
+        data.pop(self.decodedFromName, None)
+        if isinstance(value, basestring):
+            data[self.rawName] = value
+            data.pop(self.field.attname, None)
+        else:
+            data[self.field.attname] = value
+            data.pop(self.rawName, None)
+
+    def getRaw(self, instance):
+        """
+        the string the field holds if it hasn't been decoded, else None
+        """
+        return instance.__dict__.get(self.rawName)
+
+    def getDecodedFrom(self, instance):
+        """
+        the string the field's value was decoded from, if it was decoded and
+        hasn't been assigned since, else None
+        """
+        return instance.__dict__.get(self.decodedFromName)
+
+
 class JSONField(models.TextField):
     """
     JSONField is a generic textfield that neatly serializes/unserializes
     JSON objects seamlessly.
     Django snippet #1478
 
+    The JSON is only decoded when the attribute is first read, and only
+    re-encoded on save if it changed since (see LazyJSONDescriptor). A value
+    that was read is compared to a fresh decoding of the string it came
+    from, so changing it to something equal in Python (1 to True or 1.0)
+    doesn't count as a change.
+
     example:
         class Page(models.Model):
             data = JSONField(blank=True, null=True)
@@ -55,7 +166,10 @@ class JSONField(models.TextField):
         page.save()
     """
 
-    __metaclass__ = models.SubfieldBase
+    def contribute_to_class(self, cls, name):
+        super(JSONField, self).contribute_to_class(cls, name)
+        self.descriptor = LazyJSONDescriptor(self)
+        setattr(cls, self.name, self.descriptor)
 
     def to_python(self, value):
         if value == "":
@@ -68,6 +182,18 @@ class JSONField(models.TextField):
             pass
         return value
 
+    def pre_save(self, model_instance, add):
+        raw = self.descriptor.getRaw(model_instance)
+        if raw is not None:
+            # never read, so it can't have changed
+            return raw
+        value = super(JSONField, self).pre_save(model_instance, add)
+        decodedFrom = self.descriptor.getDecodedFrom(model_instance)
+        if decodedFrom is not None and self.to_python(decodedFrom) == value:
+            # read, and maybe changed in place, but the same as loaded
+            return decodedFrom
+        return value
+
     def get_db_prep_save(self, value, *args, **kwargs):
         if value == "":
             return None
@@ -1,5 +1,173 @@
 from django.contrib import admin
+from django.contrib.admin import helpers
+from django.contrib.admin.views.main import ChangeList, PAGE_VAR
+from django.core.urlresolvers import reverse
+from django.template.response import TemplateResponse
+from django.utils import timezone
 from eatupBackendApp.models import AppUser, Event, Location, DumbLocation
+from eatupBackendApp.bulkDelete import deleteEvents, deleteLocations
+from eatupBackendApp.counters import countColumn
+
+Participation = Event.participants.through
+
+# the query string parameter with the primary key a keyset page starts after
+AFTER_VAR = 'after'
+
+### changelists ###
+
+class AtLeast(int):
+    '''
+    a count we only know the lower bound of, shown as "<count>+"
+    '''
+    def __unicode__(self):
+        return u"%d+" % self
+
+    def __str__(self):
+        return "%d+" % self
+
+
+class KeysetChangeList(ChangeList):
+    '''
+    a changelist that never counts the whole result: it reads one row more
+    than a page to know whether there is a next one, and when the list is
+    ordered by primary key the next page starts after the last key shown
+    (?after=<pk>) rather than at an OFFSET, so that deep pages cost the same
+    as the first
+
+    pages come as "first page" and "next page" links rather than numbered
+    ones, and the result count is only known up to the current page
+    '''
+    def __init__(self, request, *args, **kwargs):
+        try:
+            self.after = long(request.GET[AFTER_VAR])
+        except (KeyError, ValueError):
+            self.after = None
+        super(KeysetChangeList, self).__init__(request, *args, **kwargs)
+
+    def get_query_set(self, request):
+        # not a filter on a field
+        self.params.pop(AFTER_VAR, None)
+        return super(KeysetChangeList, self).get_query_set(request)
+
+    def getKeysetOrder(self):
+        '''(): string or None
+
+        '-pk' or 'pk' if the results are ordered by primary key alone
+        '''
+        pkNames = ('pk', self.lookup_opts.pk.name)
+        ordering = list(self.query_set.query.order_by)
+        if len(ordering) != 1:
+            return None
+        if ordering[0] in pkNames:
+            return 'pk'
+        if ordering[0][:1] == '-' and ordering[0][1:] in pkNames:
+            return '-pk'
+        return None
+
+    def get_results(self, request):
+        perPage = self.list_per_page
+        queryset = self.query_set
+        keysetOrder = self.getKeysetOrder()
+        if keysetOrder is None:
+            # ordered by a column: plain offsets, still without the count
+            start = self.page_num * perPage
+            rows = list(queryset[start:start + perPage + 1])
+        else:
+            if self.after is not None:
+                lookup = 'pk__lt' if keysetOrder == '-pk' else 'pk__gt'
+                queryset = queryset.filter(**{lookup: self.after})
+            rows = list(queryset[:perPage + 1])
+        hasNext = len(rows) > perPage
+        self.result_list = rows[:perPage]
+
+        shown = len(self.result_list)
+        if keysetOrder is None:
+            shown += self.page_num * perPage
+        # a count that's bigger than the page makes the admin offer to select
+        # all of the results, which actions then get as a queryset
+        self.result_count = AtLeast(shown + 1) if hasNext else shown
+        self.full_result_count = self.result_count
+        self.can_show_all = False
+        self.multi_page = False
+        self.paginator = None
+
+        self.next_page_url = None
+        if hasNext and keysetOrder is None:
+            self.next_page_url = self.get_query_string(
+                {PAGE_VAR: self.page_num + 1})
+        elif hasNext:
+            self.next_page_url = self.get_query_string(
+                {AFTER_VAR: self.result_list[-1].pk}, [PAGE_VAR])
+        self.first_page_url = None
+        if self.after is not None or self.page_num:
+            self.first_page_url = self.get_query_string(
+                remove=[AFTER_VAR, PAGE_VAR])
+
+
+def countDisplay(name, description):
+    '''(string, string): function
+
+    a list_display column showing the count selected as name
+    '''
+    def display(self, obj):
+        return getattr(obj, name)
+    display.short_description = description
+    display.admin_order_field = name
+    return display
+
+
+class FastChangeListAdmin(admin.ModelAdmin):
+    '''
+    a ModelAdmin for big tables: keyset pages (see KeysetChangeList), counts
+    of related rows as subqueries of the list's one query (countColumns maps
+    the names to select to (model, field name) pairs), and the foreign keys
+    shown joined in
+    '''
+    change_list_template = 'admin/eatupBackendApp/keyset_change_list.html'
+    list_select_related = True
+    list_per_page = 50
+    countColumns = {}
+    # whether the admin's own delete action is replaced by a set-based one
+    setBasedDelete = False
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def queryset(self, request):
+        queryset = super(FastChangeListAdmin, self).queryset(request)
+        if not self.countColumns:
+            return queryset
+        return queryset.extra(select=dict(
+            (name, countColumn(model, fieldName, self.model, queryset.db))
+            for name, (model, fieldName) in self.countColumns.iteritems()))
+
+    def confirmBulkDelete(self, request, queryset, action, description):
+        '''(HttpRequest, QuerySet, string, string): TemplateResponse
+
+        the page asking whether to go ahead with a bulk delete action, which
+        posts back to it with post=yes
+        '''
+        opts = self.model._meta
+        return TemplateResponse(request,
+            'admin/eatupBackendApp/confirm_bulk_delete.html', {
+                "title": "Are you sure?",
+                "description": description,
+                "count": queryset.count(),
+                "opts": opts,
+                "app_label": opts.app_label,
+                "action": action,
+                "selected": request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+                "select_across": request.POST.get('select_across', '0'),
+                "action_checkbox_name": helpers.ACTION_CHECKBOX_NAME,
+            }, current_app=self.admin_site.name)
+
+    def get_actions(self, request):
+        actions = super(FastChangeListAdmin, self).get_actions(request)
+        if self.setBasedDelete:
+            # it deletes through the collector, one row at a time
+            actions.pop('delete_selected', None)
+        return actions
+
 
 '''
 class EventLocationsInline(admin.StackedInline):
@@ -7,27 +175,87 @@ class EventLocationsInline(admin.StackedInline):
     extra = 0
 '''
 
-class EventDumbLocationsInline(admin.StackedInline):
-    model = DumbLocation
-    extra = 0
-    
-class EventAdmin(admin.ModelAdmin):
-    inlines = [EventDumbLocationsInline] #[EventLocationsInline]
-    list_display = ('eid', 'title', 'date_time')
-
-class AppUserAdmin(admin.ModelAdmin):
-    list_display = ('uid', 'last_name', 'first_name')
-  
-'''  
+class EventAdmin(FastChangeListAdmin):
+    #inlines = [EventLocationsInline]
+    # an inline would render a form for every one of an event's locations;
+    # the event page links to them on their own (paged) changelist instead
+    readonly_fields = ('locations_link',)
+    list_display = ('eid', 'title', 'date_time', 'host', 'participant_count',
+                    'location_count')
+    date_hierarchy = 'date_time'
+    search_fields = ('^title',)
+    ordering = ('-eid',)
+    # a select box of every user would be enormous
+    raw_id_fields = ('host', 'participants')
+    actions = ['delete_events', 'purge_past_events']
+    setBasedDelete = True
+
+    def locations_link(self, obj):
+        if obj.pk is None:
+            return "can be added once the event is saved"
+        url = "%s?eventHere__eid__exact=%d" % (
+            reverse('admin:eatupBackendApp_dumblocation_changelist'), obj.pk)
+        return '<a href="%s">%d locations</a>' % (url, obj.location_count)
+    locations_link.allow_tags = True
+    locations_link.short_description = "locations"
+
+    def delete_events(self, request, queryset):
+        if request.POST.get('post') != 'yes':
+            return self.confirmBulkDelete(request, queryset, 'delete_events',
+                                          "the selected events")
+        count = deleteEvents(queryset.values_list('eid', flat=True))
+        self.message_user(request, "Deleted %d events." % count)
+    delete_events.short_description = "Delete selected events"
+
+    def purge_past_events(self, request, queryset):
+        queryset = queryset.filter(date_time__lt=timezone.now())
+        if request.POST.get('post') != 'yes':
+            return self.confirmBulkDelete(request, queryset,
+                                          'purge_past_events',
+                                          "the selected events that are over")
+        count = deleteEvents(queryset.values_list('eid', flat=True))
+        self.message_user(request, "Purged %d past events." % count)
+    purge_past_events.short_description = "Purge selected events that are over"
+
+class AppUserAdmin(FastChangeListAdmin):
+    list_display = ('uid', 'last_name', 'first_name', 'num_events',
+                    'friend_count')
+    search_fields = ('^last_name', '^first_name')
+    ordering = ('uid',)
+    raw_id_fields = ('friends',)
+    # events taken part in aren't counted on the row
+    countColumns = {
+        'event_count': (Participation, 'appuser'),
+    }
+
+    num_events = countDisplay('event_count', "events")
+    # deleting users keeps the admin's delete action: it cascades to the
+    # events they host, their feeds and the friend graph through signals
+
+'''
 class LocationAdmin(admin.ModelAdmin):
     list_display = ('id', 'lat', 'lng', 'friendly_name', 'eventHere')
-'''  
-  
-class DumbLocationAdmin(admin.ModelAdmin):
-    list_display = ('id', 'friendly_name')
-  
+'''
+
+class DumbLocationAdmin(FastChangeListAdmin):
+    list_display = ('id', 'friendly_name', 'eventHere')
+    search_fields = ('^friendly_name',)
+    ordering = ('-id',)
+    raw_id_fields = ('eventHere',)
+    actions = ['delete_locations']
+    setBasedDelete = True
+
+    def delete_locations(self, request, queryset):
+        if request.POST.get('post') != 'yes':
+            return self.confirmBulkDelete(request, queryset,
+                                          'delete_locations',
+                                          "the selected locations")
+        count = deleteLocations(queryset.values_list('id', flat=True))
+        self.message_user(request, "Deleted %d locations." % count)
+    delete_locations.short_description = "Delete selected locations"
+
 # makes these models available on the admin console
 admin.site.register(Event, EventAdmin)
 admin.site.register(AppUser, AppUserAdmin)
 #admin.site.register(Location, LocationAdmin)
-admin.site.register(DumbLocation, DumbLocationAdmin)
\ No newline at end of file
+admin.site.register(DumbLocation, DumbLocationAdmin)
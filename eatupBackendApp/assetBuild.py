@@ -0,0 +1,341 @@
+from __future__ import with_statement
+
+import os, re, gzip, hashlib, multiprocessing
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from eatupBackendApp.staticServe import HASHED_NAME_REGEX
+
+# written into the root of the built directory; maps each source path to its
+# content-hashed output
+MANIFEST_NAME = 'assetManifest.json'
+MANIFEST_VERSION = 1
+
+HASH_LENGTH = 12
+
+BUILT_EXTENSIONS = ('.js', '.css')
+
+# anything ending in one of these is assumed to be minified already and is
+# only hashed and compressed
+PREMINIFIED_SUFFIXES = ('.min.js', '.min.css')
+
+IDENTIFIER_CHARS = set('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                       '0123456789_$\\')
+
+# a '/' following one of these characters (or one of REGEX_KEYWORDS) starts a
+# regular expression literal rather than a division
+REGEX_PRECEDERS = set('(,=:[!&|?{};+-*%<>~^')
+REGEX_KEYWORDS = ('return', 'typeof', 'case', 'do', 'else', 'in', 'instanceof',
+                  'new', 'delete', 'void', 'throw')
+
+# after one of these characters a line break can never end a statement, so it
+# is safe to drop
+NEWLINE_DROPPABLE_AFTER = set('{[(,;:=&|?*%<>!')
+
+### minifiers ###
+
+def _scanString(text, i):
+    '''(string, int): int
+
+    returns the index just past the string literal that starts at index i
+    '''
+    quote = text[i]
+    i += 1
+    while i < len(text):
+        c = text[i]
+        if c == '\\':
+            i += 2
+            continue
+        i += 1
+        if c == quote or (c == '\n' and quote != '`'):
+            break
+    return i
+
+def _scanRegex(text, i):
+    '''(string, int): int
+
+    returns the index just past the regular expression literal (including its
+    flags) that starts at index i
+    '''
+    i += 1
+    inClass = False
+    while i < len(text):
+        c = text[i]
+        if c == '\\':
+            i += 2
+            continue
+        i += 1
+        if c == '[':
+            inClass = True
+        elif c == ']':
+            inClass = False
+        elif c == '/' and not inClass:
+            break
+        elif c == '\n':
+            break
+    while i < len(text) and text[i] in IDENTIFIER_CHARS:
+        i += 1
+    return i
+
+def _lastWord(chunks):
+    # keywords are at most 10 characters long
+    tail = ''.join(chunks[-12:]).rstrip()
+    match = re.search(r'([A-Za-z0-9_$]+)$', tail)
+    return match.group(1) if match else ''
+
+def minifyJs(text):
+    '''(string): string
+
+    conservative javascript minifier: strips comments (except /*! license
+    comments) and collapses whitespace, keeping a line break wherever dropping
+    it could change automatic semicolon insertion
+    '''
+    out = []
+    # last emitted character, and last emitted non-whitespace character
+    last = ''
+    lastSignificant = ''
+    i = 0
+    length = len(text)
+    while i < length:
+        c = text[i]
+        if c in ' \t\r\n\f\v' or (c == '/' and text[i + 1:i + 2] in ('/', '*')
+                                  and not text.startswith('/*!', i)):
+            # swallow a run of whitespace and comments
+            sawNewline = False
+            while i < length:
+                c = text[i]
+                if c in ' \t\r\n\f\v':
+                    sawNewline = sawNewline or c == '\n'
+                    i += 1
+                elif text.startswith('//', i):
+                    end = text.find('\n', i)
+                    i = length if end == -1 else end
+                elif text.startswith('/*', i) and not text.startswith('/*!', i):
+                    end = text.find('*/', i + 2)
+                    block = text[i:length if end == -1 else end]
+                    sawNewline = sawNewline or '\n' in block
+                    i = length if end == -1 else end + 2
+                else:
+                    break
+            if not out or i >= length:
+                continue
+            nextChar = text[i]
+            if sawNewline and last not in NEWLINE_DROPPABLE_AFTER:
+                out.append('\n')
+                last = '\n'
+            elif (last in IDENTIFIER_CHARS and nextChar in IDENTIFIER_CHARS) \
+                    or (last in '+-' and nextChar == last):
+                out.append(' ')
+                last = ' '
+            continue
+        if c in '\'"`':
+            end = _scanString(text, i)
+            out.append(text[i:end])
+        elif text.startswith('/*!', i):
+            end = text.find('*/', i + 3)
+            end = length if end == -1 else end + 2
+            out.append(text[i:end])
+        elif c == '/' and (lastSignificant in REGEX_PRECEDERS
+                           or lastSignificant == ''
+                           or _lastWord(out) in REGEX_KEYWORDS):
+            end = _scanRegex(text, i)
+            out.append(text[i:end])
+        else:
+            end = i + 1
+            out.append(c)
+        last = lastSignificant = text[end - 1]
+        i = end
+    return ''.join(out).strip() + '\n'
+
+CSS_TIGHT_CHARS = set('{};,>')
+
+def minifyCss(text):
+    '''(string): string
+
+    strips comments (except /*! license comments) and redundant whitespace
+    from a stylesheet
+    '''
+    out = []
+    i = 0
+    length = len(text)
+    while i < length:
+        c = text[i]
+        if text.startswith('/*', i) and not text.startswith('/*!', i):
+            end = text.find('*/', i + 2)
+            i = length if end == -1 else end + 2
+            continue
+        if c in ' \t\r\n\f':
+            while i < length and text[i] in ' \t\r\n\f':
+                i += 1
+            prev = out[-1][-1] if out else ''
+            nextChar = text[i] if i < length else ''
+            # spaces before ':' are kept since "a :hover" differs from
+            # "a:hover"
+            if prev and nextChar and prev not in CSS_TIGHT_CHARS \
+                    and prev != ':' and nextChar not in CSS_TIGHT_CHARS:
+                out.append(' ')
+            continue
+        if c in '\'"':
+            end = _scanString(text, i)
+            out.append(text[i:end])
+            i = end
+            continue
+        if c == '}' and out and out[-1] == ';':
+            # drop the last declaration's optional semicolon
+            out.pop()
+        if c in CSS_TIGHT_CHARS and out and out[-1] == ' ':
+            out.pop()
+        out.append(c)
+        i += 1
+    return ''.join(out).strip() + '\n'
+
+### build steps ###
+
+def hashContents(contents):
+    return hashlib.md5(contents).hexdigest()
+
+def hashedName(relPath, outputHash):
+    '''(string, string): string
+
+    ex: hashedName('scripts/app.js', 'abc...') -> 'scripts/app.abc123456789.js'
+    '''
+    base, ext = os.path.splitext(relPath)
+    return '%s.%s%s' % (base, outputHash[:HASH_LENGTH], ext)
+
+def buildFile(job):
+    '''((string, string, string)): (string, dict)
+
+    minifies, hashes and gzips a single file; runs inside the worker pool, so
+    it takes and returns only picklable values
+    '''
+    root, relPath, sourceHash = job
+    sourcePath = os.path.join(root, relPath)
+    with open(sourcePath, 'rb') as f:
+        contents = f.read()
+    if relPath.endswith(PREMINIFIED_SUFFIXES):
+        output = contents
+    elif relPath.endswith('.js'):
+        output = minifyJs(contents)
+    else:
+        output = minifyCss(contents)
+    outputRelPath = hashedName(relPath, hashContents(output))
+    outputPath = os.path.join(root, outputRelPath)
+    with open(outputPath, 'wb') as f:
+        f.write(output)
+    # precompressed sidecar picked up by staticServe.serveStatic
+    gzipFile = gzip.GzipFile(outputPath + '.gz', 'wb', 9, mtime=0)
+    try:
+        gzipFile.write(output)
+    finally:
+        gzipFile.close()
+    sourceStat = os.stat(sourcePath)
+    return relPath, {
+        'source_hash': sourceHash,
+        'mtime': sourceStat.st_mtime,
+        'size': sourceStat.st_size,
+        'output': outputRelPath.replace(os.sep, '/'),
+    }
+
+def findSources(root):
+    for dirPath, dirNames, fileNames in os.walk(root):
+        dirNames[:] = [d for d in dirNames if not d.startswith('.')]
+        for fileName in fileNames:
+            if not fileName.endswith(BUILT_EXTENSIONS):
+                continue
+            if HASHED_NAME_REGEX.search(fileName):
+                continue
+            fullPath = os.path.join(dirPath, fileName)
+            yield os.path.relpath(fullPath, root).replace(os.sep, '/')
+
+def loadManifest(root):
+    try:
+        with open(os.path.join(root, MANIFEST_NAME), 'rb') as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest.get('files', {})
+
+def writeManifest(root, files):
+    manifestPath = os.path.join(root, MANIFEST_NAME)
+    tempPath = manifestPath + '.tmp'
+    with open(tempPath, 'wb') as f:
+        json.dump({'version': MANIFEST_VERSION, 'files': files}, f,
+                  indent=1, sort_keys=True)
+    # atomic replace, so readers never see a half-written manifest
+    os.rename(tempPath, manifestPath)
+
+def removeOutput(root, entry):
+    for path in (entry['output'], entry['output'] + '.gz'):
+        try:
+            os.remove(os.path.join(root, path))
+        except OSError:
+            pass
+
+def buildAssets(root, processes=None, force=False):
+    '''(string, int, bool): dict
+
+    incrementally builds every .js and .css file under root
+
+    a file is skipped without being read if its size and mtime match the
+    manifest, and skipped after hashing if only its mtime changed; everything
+    else is rebuilt in parallel across a process pool
+
+    returns a summary dict with the lists of 'built', 'unchanged' and
+    'removed' source paths
+    '''
+    oldFiles = {} if force else loadManifest(root)
+    newFiles = {}
+    jobs = []
+    unchanged = []
+    for relPath in findSources(root):
+        entry = oldFiles.get(relPath)
+        sourcePath = os.path.join(root, relPath)
+        sourceStat = os.stat(sourcePath)
+        outputExists = entry is not None and \
+            os.path.exists(os.path.join(root, entry['output']))
+        if outputExists and entry['size'] == sourceStat.st_size \
+                and entry['mtime'] == sourceStat.st_mtime:
+            newFiles[relPath] = entry
+            unchanged.append(relPath)
+            continue
+        with open(sourcePath, 'rb') as f:
+            sourceHash = hashContents(f.read())
+        if outputExists and entry['source_hash'] == sourceHash:
+            entry = dict(entry, mtime=sourceStat.st_mtime)
+            newFiles[relPath] = entry
+            unchanged.append(relPath)
+            continue
+        jobs.append((root, relPath, sourceHash))
+
+    if len(jobs) > 1 and processes != 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(buildFile, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        # not worth paying for process startup
+        results = map(buildFile, jobs)
+
+    for relPath, entry in results:
+        oldEntry = oldFiles.get(relPath)
+        if oldEntry is not None and oldEntry['output'] != entry['output']:
+            removeOutput(root, oldEntry)
+        newFiles[relPath] = entry
+
+    removed = [relPath for relPath in oldFiles if relPath not in newFiles]
+    for relPath in removed:
+        removeOutput(root, oldFiles[relPath])
+
+    if jobs or removed or force or len(newFiles) != len(oldFiles) or \
+            any(oldFiles.get(p) != e for p, e in newFiles.iteritems()):
+        writeManifest(root, newFiles)
+    return {
+        'built': [relPath for relPath, _ in results],
+        'unchanged': unchanged,
+        'removed': removed,
+    }
@@ -0,0 +1,38 @@
+from eatupBackendApp.models import Event, AppUser
+from eatupBackendApp.feed import chunks
+
+Participation = Event.participants.through
+Friendship = AppUser.friends.through
+
+# events per info/friendsattending/ request
+MAX_EVENTS = 200
+
+def friendsAttending(viewerUid, eventIds):
+    '''(int, int iterable): dict
+
+    maps every given event id that exists to (number of participants, sorted
+    uids of the viewer's friends among them)
+
+    the friends among the participants are found by the database, which
+    semi-joins the participants of the events with the viewer's rows of the
+    friends table (not the friend graph, which can lag behind the writes of
+    other processes): with the (event, appuser), (appuser, event) and
+    (from, to) indexes it can start from whichever side is smaller, so
+    neither the events' whole participant lists nor the viewer's whole
+    friend list are read; the totals come from the participant_count
+    counters
+    '''
+    attendance = {}
+    viewerFriends = (Friendship.objects.filter(from_appuser=viewerUid)
+                     .values('to_appuser'))
+    for chunk in chunks(eventIds):
+        for eventId, count in (Event.objects.filter(eid__in=chunk)
+                               .values_list('eid', 'participant_count')):
+            attendance[eventId] = (count, [])
+        for eventId, userId in (Participation.objects
+                                .filter(event__in=chunk,
+                                        appuser__in=viewerFriends)
+                                .order_by('event', 'appuser')
+                                .values_list('event_id', 'appuser_id')):
+            attendance[eventId][1].append(userId)
+    return attendance
@@ -0,0 +1,97 @@
+import time
+from django.db import connections
+from annoying.functions import get_config
+from eatupBackendApp import metrics, slowQueries
+
+# statement times for eatupBackendApp.metrics and the slow query log, on any
+# database backend: instrumentConnection is a connection_created handler
+# that puts an InstrumentedConnection around every new DB-API connection,
+# so the pooled backends (eatupBackendApp/backends) hand out connections
+# that are instrumented already, and even the cursor of the statement that
+# opened the connection is timed
+
+class InstrumentedConnection(object):
+    '''
+    a DB-API connection wrapper whose cursors are InstrumentedCursors
+    '''
+    def __init__(self, connection, wrapper):
+        object.__setattr__(self, 'connection', connection)
+        object.__setattr__(self, 'wrapper', wrapper)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.connection, name, value)
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self.connection.cursor(*args, **kwargs),
+                                  self.wrapper)
+
+class InstrumentedCursor(object):
+    '''
+    a cursor wrapper that times every statement for eatupBackendApp.metrics,
+    and hands those slower than settings.SLOW_QUERY_THRESHOLD to
+    eatupBackendApp.slowQueries
+    '''
+    def __init__(self, cursor, wrapper):
+        object.__setattr__(self, 'cursor', cursor)
+        object.__setattr__(self, 'wrapper', wrapper)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.cursor, name, value)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def finished(self, started, sql, params, many=False, failed=False):
+        seconds = time.time() - started
+        metrics.recordQuery(self.wrapper.alias, seconds)
+        threshold = get_config('SLOW_QUERY_THRESHOLD', None)
+        if not failed and threshold is not None and seconds >= threshold:
+            slowQueries.recordSlowQuery(self.currentWrapper(), sql, params,
+                                        seconds, many)
+
+    def currentWrapper(self):
+        '''(): DatabaseWrapper
+
+        the DatabaseWrapper running the statement: a pooled connection is
+        used by the thread that checked it out, through that thread's
+        wrapper, rather than the one that opened it
+        '''
+        alias = self.wrapper.alias
+        if alias in connections.databases:
+            return connections[alias]
+        # one made outside of settings.DATABASES
+        return self.wrapper
+
+    def execute(self, sql, params=()):
+        started = time.time()
+        try:
+            result = self.cursor.execute(sql, params)
+        except Exception:
+            self.finished(started, sql, params, failed=True)
+            raise
+        self.finished(started, sql, params)
+        return result
+
+    def executemany(self, sql, paramList):
+        started = time.time()
+        try:
+            result = self.cursor.executemany(sql, paramList)
+        except Exception:
+            self.finished(started, sql, paramList, many=True, failed=True)
+            raise
+        self.finished(started, sql, paramList, many=True)
+        return result
+
+def instrumentConnection(sender, connection, **kwargs):
+    '''
+    connection_created handler; times the statements of every new connection
+    '''
+    if not isinstance(connection.connection, InstrumentedConnection):
+        connection.connection = InstrumentedConnection(connection.connection,
+                                                       connection)
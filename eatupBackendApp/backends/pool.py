@@ -0,0 +1,258 @@
+from __future__ import with_statement
+
+import os, time, threading, logging
+
+logger = logging.getLogger(__name__)
+
+# defaults for the optional 'POOL' entry of a DATABASES setting
+DEFAULT_POOL_SETTINGS = {
+    # maximum number of connections (idle + checked out) per process
+    'MAX_SIZE': 4,
+    # connections older than this many seconds are closed instead of reused
+    'MAX_AGE': 600,
+    # connections that sat idle for longer than this many seconds are
+    # health-checked before being handed out again
+    'HEALTH_CHECK_INTERVAL': 1,
+    # how long to wait for a free connection when the pool is exhausted
+    'CHECKOUT_TIMEOUT': 10,
+}
+
+class PoolExhausted(Exception):
+    pass
+
+class ConnectionPool(object):
+    '''
+    bounded, thread-safe pool of raw DB-API connections for a single process
+
+    connections are created lazily through the function given to checkout(),
+    so the pool itself knows nothing about the database it talks to
+    '''
+    def __init__(self, maxSize=4, maxAge=600, healthCheckInterval=1,
+                 checkoutTimeout=10, isUsable=None):
+        self.maxSize = maxSize
+        self.maxAge = maxAge
+        self.healthCheckInterval = healthCheckInterval
+        self.checkoutTimeout = checkoutTimeout
+        self.isUsable = isUsable
+        self.pid = os.getpid()
+        self.condition = threading.Condition(threading.Lock())
+        # list of (connection, created at, returned at), most recently
+        # returned last
+        self.idle = []
+        # maps id(connection) -> created at, for checked out connections
+        self.checkedOut = {}
+        self.stats = {
+            'created': 0,
+            'reused': 0,
+            'checkouts': 0,
+            'expired': 0,
+            'failed_health_checks': 0,
+            'discarded': 0,
+            'waits': 0,
+        }
+
+    def _resetAfterFork(self):
+        # connections inherited from the parent belong to the parent; drop
+        # them without closing, which would tear down the parent's sessions
+        self.pid = os.getpid()
+        self.idle = []
+        self.checkedOut = {}
+
+    def _closeQuietly(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            logger.warning("error while closing pooled connection",
+                           exc_info=True)
+
+    def checkout(self, connect):
+        '''(() -> connection): connection
+
+        returns an idle connection if a healthy, unexpired one is available,
+        otherwise opens a new one with connect()
+        blocks for up to checkoutTimeout seconds if maxSize connections are
+        already checked out
+        '''
+        deadline = time.time() + self.checkoutTimeout
+        with self.condition:
+            if self.pid != os.getpid():
+                self._resetAfterFork()
+            self.stats['checkouts'] += 1
+            while True:
+                now = time.time()
+                while self.idle:
+                    connection, createdAt, returnedAt = self.idle.pop()
+                    if now - createdAt > self.maxAge:
+                        self.stats['expired'] += 1
+                        self._closeQuietly(connection)
+                        continue
+                    if self.isUsable is not None and \
+                            now - returnedAt > self.healthCheckInterval and \
+                            not self.isUsable(connection):
+                        self.stats['failed_health_checks'] += 1
+                        self._closeQuietly(connection)
+                        continue
+                    self.checkedOut[id(connection)] = createdAt
+                    self.stats['reused'] += 1
+                    return connection
+                if len(self.checkedOut) < self.maxSize:
+                    break
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise PoolExhausted("all %d connections are in use" %
+                                        self.maxSize)
+                self.stats['waits'] += 1
+                self.condition.wait(remaining)
+            # reserve the slot before connecting outside of the lock
+            reservation = object()
+            self.checkedOut[id(reservation)] = now
+
+        try:
+            connection = connect()
+        except:
+            with self.condition:
+                del self.checkedOut[id(reservation)]
+                self.condition.notify()
+            raise
+        with self.condition:
+            del self.checkedOut[id(reservation)]
+            self.checkedOut[id(connection)] = time.time()
+            self.stats['created'] += 1
+        return connection
+
+    def checkin(self, connection, discard=False):
+        '''(connection, bool): None
+
+        returns a connection to the pool, closing it instead if discard is
+        True or it has outlived maxAge
+        '''
+        with self.condition:
+            if self.pid != os.getpid():
+                self._resetAfterFork()
+                return
+            createdAt = self.checkedOut.pop(id(connection), None)
+            now = time.time()
+            if createdAt is None or discard:
+                self.stats['discarded'] += 1
+                self._closeQuietly(connection)
+            elif now - createdAt > self.maxAge:
+                self.stats['expired'] += 1
+                self._closeQuietly(connection)
+            else:
+                self.idle.append((connection, createdAt, now))
+            self.condition.notify()
+
+    def closeAll(self):
+        with self.condition:
+            for connection, createdAt, returnedAt in self.idle:
+                self._closeQuietly(connection)
+            self.idle = []
+
+    def getStats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats['idle'] = len(self.idle)
+            stats['in_use'] = len(self.checkedOut)
+            stats['max_size'] = self.maxSize
+        return stats
+
+### per-process registry of pools ###
+
+_poolsLock = threading.Lock()
+# maps (alias, backend, NAME, HOST, PORT, USER) -> ConnectionPool
+_pools = {}
+
+def getPool(alias, settingsDict, isUsable=None):
+    poolSettings = dict(DEFAULT_POOL_SETTINGS)
+    poolSettings.update(settingsDict.get('POOL') or {})
+    key = (alias, settingsDict['ENGINE'], settingsDict['NAME'],
+           settingsDict['HOST'], settingsDict['PORT'], settingsDict['USER'])
+    with _poolsLock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(
+                maxSize=poolSettings['MAX_SIZE'],
+                maxAge=poolSettings['MAX_AGE'],
+                healthCheckInterval=poolSettings['HEALTH_CHECK_INTERVAL'],
+                checkoutTimeout=poolSettings['CHECKOUT_TIMEOUT'],
+                isUsable=isUsable)
+            _pools[key] = pool
+    return pool
+
+def getAllPoolStats():
+    '''(): dict
+
+    returns the metrics of every pool in this process, keyed by
+    "<alias>:<database name>"
+    '''
+    with _poolsLock:
+        pools = _pools.items()
+    return dict(("%s:%s" % (key[0], key[2]), pool.getStats())
+                for key, pool in pools)
+
+class PooledDatabaseWrapperMixin(object):
+    '''
+    mix in before a backend's DatabaseWrapper so that close(), which Django
+    calls at the end of every request, returns the connection to a
+    process-wide pool instead of closing it, and the next _cursor() call
+    reuses it
+    '''
+    def getPool(self):
+        return getPool(self.alias, self.settings_dict,
+                       isUsable=self.isConnectionUsable)
+
+    def isConnectionUsable(self, connection):
+        try:
+            connection.cursor().execute("SELECT 1")
+        except Exception:
+            return False
+        return True
+
+    def isPoolable(self):
+        return True
+
+    def _openNewConnection(self):
+        # let the wrapped backend connect and initialize the connection
+        # (time zone, encoding, connection_created signal, ...)
+        self.connection = None
+        super(PooledDatabaseWrapperMixin, self)._cursor()
+        return self.connection
+
+    def _prepareReusedConnection(self):
+        pass
+
+    def _cursor(self):
+        if self.connection is None and self.isPoolable():
+            pool = self.getPool()
+            self.connection = pool.checkout(self._openNewConnection)
+            self._prepareReusedConnection()
+        return super(PooledDatabaseWrapperMixin, self)._cursor()
+
+    def _commit(self):
+        super(PooledDatabaseWrapperMixin, self)._commit()
+        # can't be imported before this backend has been loaded
+        from eatupBackendApp.transactionHooks import transactionEnded
+        transactionEnded(self.alias, True)
+
+    def _rollback(self):
+        super(PooledDatabaseWrapperMixin, self)._rollback()
+        from eatupBackendApp.transactionHooks import transactionEnded
+        transactionEnded(self.alias, False)
+
+    def close(self):
+        self.validate_thread_sharing()
+        if self.connection is None:
+            return
+        if not self.isPoolable():
+            return super(PooledDatabaseWrapperMixin, self).close()
+        connection = self.connection
+        self.connection = None
+        discard = False
+        try:
+            # never hand out a connection in the middle of a transaction
+            connection.rollback()
+        except Exception:
+            logger.warning("rollback failed, discarding pooled connection",
+                           exc_info=True)
+            discard = True
+        self.getPool().checkin(connection, discard=discard)
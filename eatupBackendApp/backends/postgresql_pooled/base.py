@@ -0,0 +1,24 @@
+"""
+postgresql_psycopg2 backend that keeps connections open across requests
+
+use 'eatupBackendApp.backends.postgresql_pooled' as the database ENGINE and
+configure the pool through an optional 'POOL' dict in the database settings
+(see eatupBackendApp.backends.pool.DEFAULT_POOL_SETTINGS)
+"""
+from django.db.backends.postgresql_psycopg2.base import *
+from django.db.backends.postgresql_psycopg2.base import (
+    DatabaseWrapper as PostgresDatabaseWrapper)
+from eatupBackendApp.backends.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, PostgresDatabaseWrapper):
+    def isConnectionUsable(self, connection):
+        if connection.closed:
+            return False
+        return super(DatabaseWrapper, self).isConnectionUsable(connection)
+
+    def _prepareReusedConnection(self):
+        # transaction management may have switched this wrapper between
+        # autocommit and read committed since the connection was last used
+        if self.connection.isolation_level != self.isolation_level:
+            self.connection.set_isolation_level(self.isolation_level)
@@ -0,0 +1,15 @@
+"""
+sqlite3 backend that keeps connections open across requests
+
+in-memory databases are never pooled, since closing (or sharing) their only
+connection would lose the data
+"""
+from django.db.backends.sqlite3.base import *
+from django.db.backends.sqlite3.base import (
+    DatabaseWrapper as SQLiteDatabaseWrapper)
+from eatupBackendApp.backends.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, SQLiteDatabaseWrapper):
+    def isPoolable(self):
+        return self.settings_dict['NAME'] != ":memory:"
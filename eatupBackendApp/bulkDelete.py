@@ -0,0 +1,73 @@
+from __future__ import with_statement
+
+from django.db import transaction
+from eatupBackendApp.models import (AppUser, Event, Location, DumbLocation,
+                                    FeedEntry)
+from eatupBackendApp.feed import chunks, deleteRows
+from eatupBackendApp.counters import recount
+from eatupBackendApp import sync, search
+
+Participation = Event.participants.through
+
+# every table with a foreign key to events, as (model, field name); their rows
+# go with the event
+EVENT_DEPENDENTS = [
+    (Participation, 'event'),
+    (FeedEntry, 'event'),
+    (DumbLocation, 'eventHere'),
+    (Location, 'eventHere'),
+]
+
+def deleteEvents(eventIds, using='default'):
+    '''(int iterable, string): int
+
+    deletes the given events and the rows that depend on them with a fixed
+    number of statements per CHUNK_SIZE events, rather than through django's
+    collector, which loads every row and sends signals for each; the change
+    log and the search index are told, like they are on a normal delete.
+    every chunk is committed on its own, so that the tables aren't locked
+    for the whole purge; the hosts' counters are recounted
+
+    returns how many events there were
+    '''
+    count = 0
+    for chunk in chunks(eventIds):
+        with transaction.commit_on_success(using=using):
+            rows = list(Event.objects.using(using).filter(eid__in=chunk)
+                        .values_list('eid', 'host_id'))
+            if not rows:
+                continue
+            chunk = [eventId for eventId, hostId in rows]
+            sync.removeEvents(chunk)
+            search.unindexEvents(chunk, using)
+            for model, fieldName in EVENT_DEPENDENTS:
+                deleteRows(model, fieldName, chunk, using)
+            deleteRows(Event, 'eid', chunk, using)
+            recount(AppUser, 'hosting_count',
+                    set(hostId for eventId, hostId in rows), using)
+        count += len(chunk)
+    return count
+
+def deleteLocations(locationIds, using='default'):
+    '''(int iterable, string): int
+
+    deletes the given locations in batches and tells the change log and the
+    location counters about the events they were at; returns how many there
+    were
+    '''
+    count = 0
+    for chunk in chunks(locationIds):
+        with transaction.commit_on_success(using=using):
+            rows = list(DumbLocation.objects.using(using)
+                        .filter(pk__in=chunk)
+                        .values_list('pk', 'eventHere_id'))
+            if not rows:
+                continue
+            deleteRows(DumbLocation, 'id', [pk for pk, eventId in rows],
+                       using)
+            eventIds = set(eventId for pk, eventId in rows
+                           if eventId is not None)
+            sync.touchEvents(eventIds)
+            recount(Event, 'location_count', eventIds, using)
+        count += len(rows)
+    return count
@@ -0,0 +1,347 @@
+from __future__ import with_statement
+
+import time, datetime, socket, asyncore, asynchat, urlparse, collections
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from django.db import connections, transaction, reset_queries
+from django.db.models import Q, Max, Min
+from django.utils import timezone
+from annoying.functions import get_config
+from eatupBackendApp.models import ChangeLogEntry
+
+# seconds a long poll waits for a change (settings.CHANGE_FEED_TIMEOUT), and
+# the most a client may ask for
+DEFAULT_TIMEOUT = 30
+MAX_TIMEOUT = 120
+
+# log entries returned per response
+MAX_CHANGES = 1000
+
+# seconds to keep looking for log ids that were skipped, in case the
+# transaction that took them commits after later ones
+GAP_TIMEOUT = 10
+
+# days the change log is kept (settings.CHANGE_LOG_DAYS)
+DEFAULT_LOG_DAYS = 7
+
+### reading the log ###
+
+def getHead(using='default'):
+    '''(string): int
+
+    the id of the newest log entry, which is where a new client starts
+    '''
+    return ChangeLogEntry.objects.using(using).aggregate(
+        head=Max('id'))['head'] or 0
+
+def getChangesSince(uid, cursor, using='default'):
+    '''(int, int, string): (int list, int, bool)
+
+    returns the ids of the events that changed for uid after the cursor, the
+    cursor to continue from, and whether the cursor is older than the log
+    (so that some changes can't be told any more)
+    '''
+    entries = list(ChangeLogEntry.objects.using(using)
+                   .filter(uid=uid, id__gt=cursor).order_by('id')
+                   .values_list('id', 'eid')[:MAX_CHANGES])
+    if len(entries) == MAX_CHANGES:
+        nextCursor = entries[-1][0]
+    else:
+        nextCursor = max(getHead(using), cursor)
+    oldest = ChangeLogEntry.objects.using(using).aggregate(
+        oldest=Min('id'))['oldest']
+    expired = oldest is not None and cursor < oldest - 1
+    return uniqueEventIds(entries), nextCursor, expired
+
+def uniqueEventIds(entries):
+    eventIds = []
+    seen = set()
+    for entryId, eventId in entries:
+        if eventId not in seen:
+            seen.add(eventId)
+            eventIds.append(eventId)
+    return eventIds
+
+def pruneChangeLog(now=None, using='default'):
+    '''(datetime, string): int
+
+    deletes log entries older than CHANGE_LOG_DAYS, returns how many
+    '''
+    cutoff = (now or timezone.now()) - datetime.timedelta(
+        days=get_config('CHANGE_LOG_DAYS', DEFAULT_LOG_DAYS))
+    # one statement rather than django's collector, which would load every
+    # row; there's nothing to cascade to. the newest entry always stays, so
+    # that sqlite never hands out its id again and old cursors stay valid
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    cursor = connection.cursor()
+    with transaction.commit_on_success(using=using):
+        cursor.execute("DELETE FROM %s WHERE %s < %%s AND %s < %%s" % (
+            quote(ChangeLogEntry._meta.db_table), quote('created_at'), 
+            quote('id')),
+            [connection.ops.value_to_db_datetime(cutoff), getHead(using)])
+    return cursor.rowcount
+
+def changesResponse(uid, eventIds, cursor, expired=False):
+    return {
+        "uid": uid,
+        "cursor": cursor,
+        "events": eventIds,
+        # start over with a full info/userevents/
+        "expired": expired
+    }
+
+### the sidecar ###
+
+class ChangeFeed(object):
+    '''
+    tails the change log for a long-poll server: one query per poll interval
+    picks up the new entries of every user, keeps the most recent bufferSize
+    of them in memory and wakes up the waiting clients they concern, so that
+    waiting clients cost no database work
+
+    notifications only tell a client which events to re-read; what changed
+    comes from the delta sync of info/userevents/, which doesn't depend on
+    them arriving
+    '''
+    def __init__(self, bufferSize=100000, using='default'):
+        self.using = using
+        self.head = getHead(using)
+        # entries up to here have been evicted from the buffer
+        self.bufferStart = self.head
+        self.recent = collections.deque()
+        self.recentByUser = {}
+        self.bufferSize = bufferSize
+        # uid -> set of waiters
+        self.waiters = {}
+        # id -> when it was found missing
+        self.gaps = {}
+
+    def poll(self):
+        '''(): int
+
+        reads the entries added since the last poll, wakes up the clients
+        waiting for them and returns how many there were
+        '''
+        now = time.time()
+        for entryId, seenAt in self.gaps.items():
+            if now - seenAt > GAP_TIMEOUT:
+                del self.gaps[entryId]
+        newEntries = Q(id__gt=self.head)
+        if self.gaps:
+            newEntries |= Q(id__in=sorted(self.gaps))
+        entries = list(ChangeLogEntry.objects.using(self.using)
+                       .filter(newEntries).order_by('id')
+                       .values_list('id', 'uid', 'eid')[:MAX_CHANGES * 10])
+        # don't sit in a transaction between polls, and don't pile up
+        # queries when DEBUG is on
+        transaction.commit_unless_managed(using=self.using)
+        reset_queries()
+        if not entries:
+            return 0
+        # entries that turned up in a gap are older than the cursors already
+        # handed out, so they are passed to the waiting clients directly
+        late = {}
+        for entry in entries:
+            entryId, uid, eventId = entry
+            if entryId > self.head:
+                # ids are handed out when rows are inserted, not when they're
+                # committed, so a skipped id may still show up
+                self.gaps.update((missingId, now) for missingId in
+                                 xrange(max(self.head + 1, entryId - 1000),
+                                        entryId))
+                self.head = entryId
+            else:
+                late.setdefault(uid, []).append(eventId)
+            self.gaps.pop(entryId, None)
+            self.remember(entry)
+        for uid in set(uid for entryId, uid, eventId in entries):
+            for waiter in list(self.waiters.get(uid, ())):
+                self.answer(waiter, late.get(uid, ()))
+        return len(entries)
+
+    def remember(self, entry):
+        entryId, uid, eventId = entry
+        self.recent.append(entry)
+        self.recentByUser.setdefault(uid, collections.deque()).append(
+            (entryId, eventId))
+        while len(self.recent) > self.bufferSize:
+            oldId, oldUid, oldEventId = self.recent.popleft()
+            userEntries = self.recentByUser[oldUid]
+            userEntries.popleft()
+            if not userEntries:
+                del self.recentByUser[oldUid]
+            self.bufferStart = max(self.bufferStart, oldId)
+
+    def changesFor(self, uid, cursor):
+        '''(int, int): (int list, int, bool)
+
+        like getChangesSince, from memory when the buffer goes back far
+        enough
+        '''
+        if cursor < self.bufferStart:
+            return getChangesSince(uid, cursor, self.using)
+        entries = [(entryId, eventId) for entryId, eventId in
+                   self.recentByUser.get(uid, ()) if entryId > cursor]
+        return uniqueEventIds(entries), max(self.head, cursor), False
+
+    def wait(self, waiter):
+        '''
+        answers the waiter at once if something changed for it since its
+        cursor, and otherwise parks it until something does or it times out
+        '''
+        if waiter.cursor is None:
+            waiter.respond(changesResponse(waiter.uid, [], self.head))
+            return
+        eventIds, cursor, expired = self.changesFor(waiter.uid, waiter.cursor)
+        if eventIds or expired:
+            waiter.respond(changesResponse(waiter.uid, eventIds, cursor,
+                                           expired))
+        else:
+            self.waiters.setdefault(waiter.uid, set()).add(waiter)
+
+    def answer(self, waiter, lateEventIds=()):
+        self.forget(waiter)
+        eventIds, cursor, expired = self.changesFor(waiter.uid, waiter.cursor)
+        eventIds = uniqueEventIds((None, eventId) for eventId in
+                                  list(eventIds) + list(lateEventIds))
+        waiter.respond(changesResponse(waiter.uid, eventIds, cursor, expired))
+
+    def forget(self, waiter):
+        waiters = self.waiters.get(waiter.uid)
+        if waiters is not None:
+            waiters.discard(waiter)
+            if not waiters:
+                del self.waiters[waiter.uid]
+
+    def expire(self, now):
+        for waiters in self.waiters.values():
+            for waiter in list(waiters):
+                if waiter.deadline <= now:
+                    self.answer(waiter)
+
+    def numWaiting(self):
+        return sum(len(waiters) for waiters in self.waiters.itervalues())
+
+
+class LongPollHandler(asynchat.async_chat):
+    '''
+    one client connection: reads a GET request for
+    /changes/?uid=<uid>&cursor=<cursor>&timeout=<seconds>, then waits on the
+    feed and answers with JSON
+    '''
+    MAX_REQUEST_SIZE = 8192
+
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock, map=server.socketMap)
+        self.server = server
+        self.feed = server.feed
+        self.received = []
+        self.receivedSize = 0
+        self.set_terminator('\r\n\r\n')
+        self.uid = None
+        self.cursor = None
+        self.deadline = None
+        self.answered = False
+
+    def collect_incoming_data(self, data):
+        self.receivedSize += len(data)
+        if self.receivedSize > self.MAX_REQUEST_SIZE:
+            self.close()
+        else:
+            self.received.append(data)
+
+    def found_terminator(self):
+        # the rest of the request (a body) is ignored
+        self.set_terminator(None)
+        requestLine = ''.join(self.received).split('\r\n', 1)[0]
+        error = self.parseRequest(requestLine)
+        if error is not None:
+            self.respond(error)
+        else:
+            self.feed.wait(self)
+
+    def parseRequest(self, requestLine):
+        '''(string): dict or None
+
+        reads the parameters from the request line, returns an error dict if
+        they're unusable
+        '''
+        parts = requestLine.split()
+        if len(parts) != 3 or parts[0] != 'GET':
+            return {'error': 'bad request'}
+        target = urlparse.urlsplit(parts[1])
+        if target.path.rstrip('/') != '/changes':
+            return {'error': 'not found'}
+        params = urlparse.parse_qs(target.query)
+        try:
+            self.uid = long(params['uid'][0])
+            if 'cursor' in params:
+                self.cursor = long(params['cursor'][0])
+            timeout = float(params.get('timeout', [self.server.timeout])[0])
+        except (KeyError, ValueError):
+            return {'error': 'invalid arguments'}
+        self.deadline = time.time() + max(0, min(timeout, MAX_TIMEOUT))
+        return None
+
+    def respond(self, data):
+        if self.answered:
+            return
+        self.answered = True
+        body = json.dumps(data)
+        self.push("HTTP/1.0 200 OK\r\n"
+                  "Content-Type: application/json\r\n"
+                  "Content-Length: %d\r\n"
+                  "Cache-Control: no-cache\r\n"
+                  "Connection: close\r\n\r\n%s" % (len(body), body))
+        self.close_when_done()
+
+    def handle_close(self):
+        # the client gave up
+        self.feed.forget(self)
+        self.close()
+
+
+class ChangeFeedServer(asyncore.dispatcher):
+    '''
+    single-threaded long-poll server in front of a ChangeFeed
+    '''
+    def __init__(self, host, port, feed, timeout=None, pollInterval=0.5):
+        self.socketMap = {}
+        asyncore.dispatcher.__init__(self, map=self.socketMap)
+        self.feed = feed
+        self.timeout = timeout if timeout is not None else \
+            get_config('CHANGE_FEED_TIMEOUT', DEFAULT_TIMEOUT)
+        self.pollInterval = pollInterval
+        self.lastPoll = 0
+        self.running = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            LongPollHandler(pair[0], self)
+
+    def serveOnce(self):
+        '''
+        handles socket events for up to one poll interval, then polls the log
+        and times out the clients whose deadline passed
+        '''
+        asyncore.loop(timeout=self.pollInterval, use_poll=True,
+                      map=self.socketMap, count=1)
+        now = time.time()
+        # however busy the sockets are, the log is read once per interval
+        if now - self.lastPoll >= self.pollInterval:
+            self.lastPoll = now
+            self.feed.poll()
+        self.feed.expire(now)
+
+    def serveForever(self):
+        self.running = True
+        while self.running:
+            self.serveOnce()
@@ -0,0 +1,262 @@
+import threading
+from django.db import connections, transaction
+from django.db.models import F
+from django.db.models.signals import (m2m_changed, post_init, post_save,
+                                      pre_delete, post_delete)
+from django.core.signals import request_finished
+from eatupBackendApp.models import AppUser, Event, DumbLocation
+from eatupBackendApp.feed import chunks, eventIdsOfUsers
+
+Participation = Event.participants.through
+Friendship = AppUser.friends.through
+
+# every counter column, as (model, counter name, counted model, name of the
+# counted model's foreign key to model)
+COUNTERS = [
+    (Event, 'participant_count', Participation, 'event'),
+    (Event, 'location_count', DumbLocation, 'eventHere'),
+    (AppUser, 'hosting_count', Event, 'host'),
+    (AppUser, 'friend_count', Friendship, 'from_appuser'),
+]
+
+def countColumn(model, fieldName, parent, using='default'):
+    '''(Model class, string, Model class, string): string
+
+    SQL for a correlated subquery counting the rows of model whose fieldName
+    points at the current row of parent, answered from the index on
+    fieldName; for QuerySet.extra(select=...)
+    '''
+    quote = connections[using].ops.quote_name
+    return "SELECT COUNT(*) FROM %s WHERE %s.%s = %s.%s" % (
+        quote(model._meta.db_table), quote(model._meta.db_table),
+        quote(model._meta.get_field(fieldName).column),
+        quote(parent._meta.db_table), quote(parent._meta.pk.column))
+
+def getCounter(model, counterName):
+    for counter in COUNTERS:
+        if counter[0] is model and counter[1] == counterName:
+            return counter
+    raise KeyError("%s.%s isn't a counter" % (model.__name__, counterName))
+
+### writing ###
+
+def increment(model, counterName, ids, delta=1, using='default'):
+    '''(Model class, string, iterable, int, string): None
+
+    adds delta to the counter of the given rows in the database, an UPDATE
+    per CHUNK_SIZE of them
+    '''
+    if not delta:
+        return
+    for chunk in chunks(ids):
+        model.objects.using(using).filter(pk__in=chunk).update(
+            **{counterName: F(counterName) + delta})
+
+def recount(model, counterName, ids=None, using='default'):
+    '''(Model class, string, iterable, string): int
+
+    sets the counter of the given rows (of every row by default) to the
+    number of rows it counts, with an UPDATE per CHUNK_SIZE ids, and returns
+    how many were wrong; for changes where the difference isn't known
+    '''
+    model, counterName, counted, fieldName = getCounter(model, counterName)
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    column = quote(model._meta.get_field(counterName).column)
+    count = countColumn(counted, fieldName, model, using)
+    sql = "UPDATE %s SET %s = (%s) WHERE %s <> (%s)" % (
+        quote(model._meta.db_table), column, count, column, count)
+    if ids is None:
+        batches = [(sql, [])]
+    else:
+        batches = [(sql + " AND %s IN (%s)" % (
+                        quote(model._meta.pk.column),
+                        ", ".join(["%s"] * len(chunk))), chunk)
+                   for chunk in chunks(ids)]
+    cursor = connection.cursor()
+    fixed = 0
+    for batchSql, params in batches:
+        cursor.execute(batchSql, params)
+        fixed += cursor.rowcount
+    transaction.commit_unless_managed(using=using)
+    return fixed
+
+def recomputeCounters(using='default', log=None):
+    '''(string, (string -> None)): int
+
+    recounts every counter of every row, which repairs them after writes
+    that went around the signal handlers below; returns how many counters
+    were wrong
+    '''
+    log = log or (lambda message: None)
+    fixed = 0
+    for model, counterName, counted, fieldName in COUNTERS:
+        count = recount(model, counterName, using=using)
+        if count:
+            log("fixed %s.%s of %d rows" % (model.__name__, counterName,
+                                            count))
+        fixed += count
+    return fixed
+
+### signal handlers ###
+
+def participantsChanged(sender, instance, action, pk_set, using, **kwargs):
+    # like in eatupBackendApp.feed, instance is either an event or a user.
+    # django only adds the rows that weren't there, so additions are
+    # increments; removals recount, since pk_set may have ids that weren't
+    fromEvent = isinstance(instance, Event)
+    if action == 'post_add':
+        if fromEvent:
+            increment(Event, 'participant_count', [instance.pk], len(pk_set),
+                      using)
+            instance.participant_count += len(pk_set)
+        else:
+            increment(Event, 'participant_count', pk_set, 1, using)
+    elif action == 'pre_clear':
+        if not fromEvent:
+            instance._counterEventIds = eventIdsOfUsers([instance.pk])
+    elif action == 'post_remove':
+        recount(Event, 'participant_count',
+                [instance.pk] if fromEvent else pk_set, using)
+    elif action == 'post_clear':
+        if fromEvent:
+            recount(Event, 'participant_count', [instance.pk], using)
+            instance.participant_count = 0
+        else:
+            recount(Event, 'participant_count',
+                    getattr(instance, '_counterEventIds', ()), using)
+
+def friendsChanged(sender, instance, action, pk_set, using, **kwargs):
+    # django writes the other direction of a friendship after post_add and
+    # post_remove are sent, so the friends' counters can't be recounted here;
+    # each of them gains or loses one
+    if action in ('pre_remove', 'pre_clear'):
+        friends = Friendship.objects.using(using).filter(from_appuser=instance)
+        if action == 'pre_remove':
+            friends = friends.filter(to_appuser__in=pk_set)
+        instance._counterFriendIds = list(friends.values_list('to_appuser_id',
+                                                              flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if action == 'post_add':
+            changed, delta = pk_set, 1
+        else:
+            changed, delta = getattr(instance, '_counterFriendIds', []), -1
+        if changed:
+            increment(AppUser, 'friend_count', [instance.pk],
+                      delta * len(changed), using)
+            # a friendship with oneself is a single row
+            increment(AppUser, 'friend_count',
+                      set(changed) - set([instance.pk]), delta, using)
+            instance.friend_count += delta * len(changed)
+
+def rememberForeignKey(instance, name):
+    # the value it had when loaded or last saved, to tell a move on save
+    setattr(instance, '_counter_%s' % name, getattr(instance, name))
+
+def foreignKeyMoved(model, counterName, instance, name, created, using):
+    '''
+    moves instance from the counter of the row its foreign key name pointed
+    at to that of the row it points at now
+    '''
+    after = getattr(instance, name)
+    if created:
+        before = None
+    else:
+        # instances loaded with deferred fields aren't seen by post_init
+        before = getattr(instance, '_counter_%s' % name, after)
+    if before != after:
+        if before is not None:
+            increment(model, counterName, [before], -1, using)
+        if after is not None:
+            increment(model, counterName, [after], 1, using)
+    rememberForeignKey(instance, name)
+
+def eventLoaded(sender, instance, **kwargs):
+    rememberForeignKey(instance, 'host_id')
+
+def eventSaved(sender, instance, created, raw=False, using='default',
+               **kwargs):
+    if not raw:
+        foreignKeyMoved(AppUser, 'hosting_count', instance, 'host_id', created,
+                        using)
+
+def locationLoaded(sender, instance, **kwargs):
+    rememberForeignKey(instance, 'eventHere_id')
+
+def locationSaved(sender, instance, created, raw=False, using='default',
+                  **kwargs):
+    if not raw:
+        foreignKeyMoved(Event, 'location_count', instance, 'eventHere_id',
+                        created, using)
+
+# like in eatupBackendApp.sync, the events deleted together (the events of a
+# deleted user) are taken off their hosts' counters together, when the first
+# of them is done, and the deleted events' locations are left alone
+_deletions = threading.local()
+
+def getDeletions():
+    if not hasattr(_deletions, 'pending'):
+        # eid -> host uid
+        _deletions.pending = {}
+        _deletions.done = set()
+    return _deletions
+
+def forgetDeletions(**kwargs):
+    deletions = getDeletions()
+    deletions.pending.clear()
+    deletions.done.clear()
+
+def eventDeleting(sender, instance, **kwargs):
+    deletions = getDeletions()
+    if not deletions.pending:
+        deletions.done.clear()
+    deletions.pending[instance.pk] = instance.host_id
+
+def eventDeleted(sender, instance, using='default', **kwargs):
+    deletions = getDeletions()
+    if instance.pk not in deletions.pending:
+        return
+    eventsOfHosts = {}
+    for eventId, hostId in deletions.pending.iteritems():
+        eventsOfHosts[hostId] = eventsOfHosts.get(hostId, 0) + 1
+    for hostId, count in eventsOfHosts.iteritems():
+        increment(AppUser, 'hosting_count', [hostId], -count, using)
+    deletions.done.update(deletions.pending)
+    deletions.pending.clear()
+
+def locationDeleted(sender, instance, using='default', **kwargs):
+    eventId = getattr(instance, '_counter_eventHere_id', instance.eventHere_id)
+    if eventId is None:
+        return
+    deletions = getDeletions()
+    if eventId in deletions.pending or eventId in deletions.done:
+        return
+    increment(Event, 'location_count', [eventId], -1, using)
+
+def userDeleting(sender, instance, **kwargs):
+    # the cascade deletes their participations and friendships without
+    # sending m2m_changed
+    instance._counterEventIds = eventIdsOfUsers([instance.pk])
+    instance._counterFriendIds = list(Friendship.objects
+                                      .filter(to_appuser=instance)
+                                      .values_list('from_appuser_id',
+                                                   flat=True))
+
+def userDeleted(sender, instance, using='default', **kwargs):
+    recount(Event, 'participant_count',
+            getattr(instance, '_counterEventIds', ()), using)
+    recount(AppUser, 'friend_count',
+            getattr(instance, '_counterFriendIds', ()), using)
+
+m2m_changed.connect(participantsChanged, sender=Participation)
+m2m_changed.connect(friendsChanged, sender=Friendship)
+post_init.connect(eventLoaded, sender=Event)
+post_save.connect(eventSaved, sender=Event)
+pre_delete.connect(eventDeleting, sender=Event)
+post_delete.connect(eventDeleted, sender=Event)
+post_init.connect(locationLoaded, sender=DumbLocation)
+post_save.connect(locationSaved, sender=DumbLocation)
+post_delete.connect(locationDeleted, sender=DumbLocation)
+pre_delete.connect(userDeleting, sender=AppUser)
+post_delete.connect(userDeleted, sender=AppUser)
+request_finished.connect(forgetDeletions)
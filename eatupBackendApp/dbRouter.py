@@ -0,0 +1,102 @@
+from __future__ import with_statement
+
+import threading, itertools
+# routers are imported while django.db itself is being set up, so nothing
+# that imports django.db (like annoying.functions) can be used here
+from django.conf import settings
+
+# request-scoped routing state, set up by ReplicaPinningMiddleware
+_requestState = threading.local()
+
+# in-flight requests per replica alias in this process, for the
+# least-connections strategy
+_replicaLoadLock = threading.Lock()
+_replicaLoad = {}
+_roundRobinCounter = itertools.count()
+
+def getReplicaAliases():
+    return list(getattr(settings, 'DATABASE_REPLICAS', []))
+
+def chooseReplica(replicas):
+    '''(string list): string
+
+    picks a replica alias according to settings.DATABASE_REPLICA_SELECTION,
+    either 'round-robin' (the default) or 'least-connections'
+    '''
+    strategy = getattr(settings, 'DATABASE_REPLICA_SELECTION', 'round-robin')
+    with _replicaLoadLock:
+        if strategy == 'least-connections':
+            replica = min(replicas, key=lambda alias: _replicaLoad.get(alias, 0))
+        else:
+            replica = replicas[_roundRobinCounter.next() % len(replicas)]
+        _replicaLoad[replica] = _replicaLoad.get(replica, 0) + 1
+    return replica
+
+def releaseReplica(replica):
+    with _replicaLoadLock:
+        _replicaLoad[replica] = max(_replicaLoad.get(replica, 0) - 1, 0)
+
+def startRequest(readFromReplicas):
+    _requestState.readFromReplicas = readFromReplicas
+    _requestState.pinnedToPrimary = False
+    _requestState.replica = None
+
+def endRequest():
+    replica = getattr(_requestState, 'replica', None)
+    if replica is not None:
+        releaseReplica(replica)
+    startRequest(False)
+
+def pinToPrimary():
+    _requestState.pinnedToPrimary = True
+
+
+class ReadReplicaRouter(object):
+    '''
+    sends reads to a replica when the current request allows it (see
+    ReplicaPinningMiddleware) and everything else to 'default'
+
+    once a request writes, it stays pinned to the primary so that it reads
+    its own writes; a request sticks to the same replica for all its reads
+    '''
+    def db_for_read(self, model, **hints):
+        if not getattr(_requestState, 'readFromReplicas', False) or \
+                getattr(_requestState, 'pinnedToPrimary', False):
+            return 'default'
+        if _requestState.replica is None:
+            replicas = getReplicaAliases()
+            if not replicas:
+                return 'default'
+            _requestState.replica = chooseReplica(replicas)
+        return _requestState.replica
+
+    def db_for_write(self, model, **hints):
+        pinToPrimary()
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+    def allow_syncdb(self, db, model):
+        # replicas get their schema through replication
+        return db == 'default'
+
+
+class ReplicaPinningMiddleware(object):
+    '''
+    lets read-only endpoints (by default everything under info/) read from
+    replicas; all other requests only ever touch the primary
+    '''
+    def process_request(self, request):
+        prefixes = getattr(settings, 'DATABASE_REPLICA_READ_PREFIXES', 
+                           ('/info/',))
+        startRequest(any(request.path.startswith(prefix)
+                         for prefix in prefixes))
+
+    def process_response(self, request, response):
+        endRequest()
+        return response
+
+    def process_exception(self, request, exception):
+        endRequest()
@@ -0,0 +1,385 @@
+import calendar, datetime
+from django.db.models import Count, Q
+from django.db.models.sql.subqueries import DeleteQuery
+from django.db.models.sql.where import AND, Constraint
+from django.db.models.signals import m2m_changed, post_save, pre_delete, \
+    post_delete
+from django.utils.timezone import utc
+from annoying.functions import get_config
+from eatupBackendApp.models import AppUser, Event, FeedEntry, PulledFeedUser
+
+Participation = Event.participants.through
+Friendship = AppUser.friends.through
+
+# participants with more friends than this (settings.FEED_FANOUT_LIMIT) are
+# not fanned out on write; their events are merged into feeds on read
+DEFAULT_FANOUT_LIMIT = 1000
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# ids per IN (...) list; sqlite allows at most 999 parameters per query
+CHUNK_SIZE = 500
+
+def chunks(ids, size=CHUNK_SIZE):
+    ids = list(ids)
+    for start in xrange(0, len(ids), size):
+        yield ids[start:start + size]
+
+def deleteRows(model, fieldName, ids, using='default'):
+    '''(Model class, string, list, string): None
+
+    DELETE ... WHERE <field> IN (ids), a statement per CHUNK_SIZE ids,
+    without loading or signalling the rows
+    '''
+    field = model._meta.get_field(fieldName)
+    for chunk in chunks(ids):
+        query = DeleteQuery(model)
+        where = query.where_class()
+        where.add((Constraint(None, field.column, field), 'in', chunk), AND)
+        query.do_query(model._meta.db_table, where, using)
+
+### fan-out on write ###
+
+def refreshEventFeeds(eventIds, friendshipChange=None, using='default'):
+    '''(int iterable, (int, int set, bool), string): None
+
+    brings the feed entries of the given events in line with who takes part
+    in them and who those participants' friends are: adds the missing
+    entries, removes the stale ones and keeps PulledFeedUser up to date
+
+    runs a fixed number of queries per CHUNK_SIZE events
+
+    friendshipChange is (user id, other user ids, added) while friendships
+    between the user and the others are being added or removed; django
+    sends m2m_changed for symmetrical relations before it has added or 
+    removed the mirrored rows, so only one direction can be trusted yet
+    '''
+    limit = get_config('FEED_FANOUT_LIMIT', DEFAULT_FANOUT_LIMIT)
+    for chunk in chunks(set(eventIds)):
+        refreshEventChunk(chunk, limit, friendshipChange, using)
+
+def refreshEventChunk(eventIds, limit, friendshipChange=None,
+                      using='default'):
+    dates = dict(Event.objects.using(using).filter(eid__in=eventIds)
+                 .values_list('eid', 'date_time'))
+    participations = Participation.objects.using(using).filter(
+        event__in=eventIds)
+    participantsByEvent = {}
+    for eventId, userId in participations.values_list('event_id',
+                                                      'appuser_id'):
+        participantsByEvent.setdefault(eventId, []).append(userId)
+    participantIds = set(userId for userIds in participantsByEvent.values()
+                         for userId in userIds)
+    if not participantIds:
+        deleteRows(FeedEntry, 'event', eventIds, using)
+        return
+
+    # count friends first, so that the friend lists of users over the limit
+    # are never loaded
+    participantQuery = participations.values('appuser')
+    friendships = Friendship.objects.using(using)
+    friendCounts = dict(friendships
+                        .filter(from_appuser__in=participantQuery)
+                        .values_list('from_appuser')
+                        .annotate(Count('to_appuser')))
+    if friendshipChange is not None:
+        # count the rows from the others to the user as they will be
+        changedId, otherIds, added = friendshipChange
+        for otherId in (friendships
+                        .filter(from_appuser__in=participantQuery,
+                                to_appuser=changedId)
+                        .values_list('from_appuser_id', flat=True)):
+            if otherId in otherIds:
+                friendCounts[otherId] -= 1
+        for otherId in otherIds & participantIds:
+            friendCounts[otherId] = (friendCounts.get(otherId, 0) + 
+                                     (1 if added else 0))
+    pulledIds = set(userId for userId, count in friendCounts.iteritems()
+                    if count > limit)
+    updatePulledUsers(participantQuery, pulledIds, using)
+
+    friendsOf = {}
+    for userId, friendId in (friendships
+                             .filter(from_appuser__in=participantQuery)
+                             .exclude(from_appuser__in=pulledIds)
+                             .values_list('from_appuser_id',
+                                          'to_appuser_id')):
+        friendsOf.setdefault(userId, set()).add(friendId)
+    if friendshipChange is not None:
+        changedId, otherIds, added = friendshipChange
+        if added:
+            # the rows from the others to the user may not exist yet
+            for otherId in otherIds:
+                if otherId in participantIds and otherId not in pulledIds:
+                    friendsOf.setdefault(otherId, set()).add(changedId)
+        else:
+            # and the rows from the others to the user may still exist
+            for otherId in otherIds:
+                friendsOf.get(otherId, set()).discard(changedId)
+
+    wanted = set()
+    for eventId, userIds in participantsByEvent.iteritems():
+        for userId in userIds:
+            for friendId in friendsOf.get(userId, ()):
+                wanted.add((friendId, eventId))
+
+    existing = dict(((userId, eventId), pk) for pk, userId, eventId in
+                    FeedEntry.objects.using(using).filter(event__in=eventIds)
+                    .values_list('pk', 'user_id', 'event_id'))
+    stale = [pk for key, pk in existing.iteritems() if key not in wanted]
+    deleteRows(FeedEntry, 'id', stale, using)
+    FeedEntry.objects.using(using).bulk_create([
+        FeedEntry(user_id=userId, event_id=eventId, date_time=dates[eventId])
+        for userId, eventId in sorted(wanted)
+        if (userId, eventId) not in existing])
+
+def updatePulledUsers(userQuery, pulledIds, using='default'):
+    pulledUsers = PulledFeedUser.objects.using(using)
+    existingIds = set(pulledUsers.filter(user__in=userQuery)
+                      .values_list('user_id', flat=True))
+    if existingIds - pulledIds:
+        pulledUsers.filter(user__in=existingIds - pulledIds).delete()
+    if pulledIds - existingIds:
+        pulledUsers.bulk_create([
+            PulledFeedUser(user_id=userId)
+            for userId in sorted(pulledIds - existingIds)])
+
+def refreshFriendshipFeeds(userId, otherIds, added):
+    '''(int, int iterable, bool): None
+
+    brings the feeds in line with friendships between the user and the
+    others that were just added (or removed); rather than refreshing every
+    event of the others, only what such a change can affect is: the others'
+    entries for the user's events, the user's own feed, and the events of
+    anybody whose friend count crossed FEED_FANOUT_LIMIT
+
+    runs a fixed number of queries per CHUNK_SIZE others and events
+    '''
+    limit = get_config('FEED_FANOUT_LIMIT', DEFAULT_FANOUT_LIMIT)
+    otherIds = set(otherIds)
+    friendshipChange = (userId, otherIds, added)
+    crossedIds = crossedFanoutLimit(userId, otherIds, added, limit)
+    refreshEventFeeds(eventIdsOfUsers(crossedIds), friendshipChange)
+    if userId not in crossedIds:
+        # otherwise its events were just refreshed for everybody
+        refreshUserEntries(eventIdsOfUsers([userId]), otherIds,
+                           friendshipChange)
+    rebuildUserFeed(userId)
+
+def crossedFanoutLimit(userId, otherIds, added, limit):
+    '''(int, int set, bool, int): int list
+
+    the user and the others whose friends became too many to fan out to, or
+    stopped being, now that the friendships between them changed
+    '''
+    crossedIds = []
+    for chunk in chunks(set(otherIds) | set([userId])):
+        # the rows from the others back to the user may or may not be 
+        # written yet
+        counts = dict(Friendship.objects.filter(from_appuser__in=chunk)
+                      .exclude(~Q(from_appuser=userId), to_appuser=userId)
+                      .values_list('from_appuser')
+                      .annotate(Count('to_appuser')))
+        pulledIds = set(PulledFeedUser.objects.filter(user__in=chunk)
+                        .values_list('user_id', flat=True))
+        for chunkId in chunk:
+            count = counts.get(chunkId, 0)
+            if chunkId != userId and added:
+                count += 1
+            if (count > limit) != (chunkId in pulledIds):
+                crossedIds.append(chunkId)
+    return crossedIds
+
+def refreshUserEntries(eventIds, userIds, friendshipChange):
+    '''(int iterable, int iterable, (int, int set, bool)): None
+
+    like refreshEventFeeds, but only for the entries of the given users, 
+    whose friendships with a participant are what changed, and taking the
+    fan-out limit the participants already have (PulledFeedUser) as is
+    '''
+    changedId, otherIds, added = friendshipChange
+    for eventChunk in chunks(set(eventIds)):
+        dates = dict(Event.objects.filter(eid__in=eventChunk)
+                     .values_list('eid', 'date_time'))
+        participations = Participation.objects.filter(event__in=eventChunk)
+        participantQuery = participations.values('appuser')
+        pulledIds = set(PulledFeedUser.objects
+                        .filter(user__in=participantQuery)
+                        .values_list('user_id', flat=True))
+        eventsOf = {}
+        for eventId, participantId in participations.values_list(
+                'event_id', 'appuser_id'):
+            if participantId not in pulledIds:
+                eventsOf.setdefault(participantId, set()).add(eventId)
+        for userChunk in chunks(set(userIds)):
+            friendPairs = set(Friendship.objects
+                              .filter(from_appuser__in=userChunk,
+                                      to_appuser__in=participantQuery)
+                              .values_list('from_appuser_id',
+                                           'to_appuser_id'))
+            # the rows from the others to the changed user can't be trusted
+            for otherId in otherIds & set(userChunk):
+                if added:
+                    friendPairs.add((otherId, changedId))
+                else:
+                    friendPairs.discard((otherId, changedId))
+            wanted = set((userId, eventId) for userId, friendId in friendPairs
+                         for eventId in eventsOf.get(friendId, ()))
+            existing = dict(((userId, eventId), pk) for pk, userId, eventId in
+                            FeedEntry.objects.filter(event__in=eventChunk,
+                                                     user__in=userChunk)
+                            .values_list('pk', 'user_id', 'event_id'))
+            deleteRows(FeedEntry, 'id', [pk for key, pk in existing.iteritems()
+                                         if key not in wanted])
+            FeedEntry.objects.bulk_create([
+                FeedEntry(user_id=userId, event_id=eventId, 
+                          date_time=dates[eventId])
+                for userId, eventId in sorted(wanted) 
+                if (userId, eventId) not in existing])
+
+def rebuildUserFeed(userId):
+    '''(int): None
+
+    brings the feed entries of one user in line with the events their 
+    friends take part in; a fixed number of queries per CHUNK_SIZE friends
+    and events
+    '''
+    friendIds = set(Friendship.objects.filter(from_appuser=userId)
+                    .values_list('to_appuser_id', flat=True))
+    for chunk in chunks(friendIds):
+        friendIds.difference_update(PulledFeedUser.objects
+                                    .filter(user__in=chunk)
+                                    .values_list('user_id', flat=True))
+    dates = {}
+    for chunk in chunks(eventIdsOfUsers(friendIds)):
+        dates.update(Event.objects.filter(eid__in=chunk)
+                     .values_list('eid', 'date_time'))
+    existing = dict(FeedEntry.objects.filter(user=userId)
+                    .values_list('event_id', 'pk'))
+    deleteRows(FeedEntry, 'id', [pk for eventId, pk in existing.iteritems() 
+                                 if eventId not in dates])
+    FeedEntry.objects.bulk_create([
+        FeedEntry(user_id=userId, event_id=eventId, date_time=dates[eventId])
+        for eventId in sorted(dates) if eventId not in existing])
+
+def eventIdsOfUsers(userIds):
+    eventIds = set()
+    for chunk in chunks(userIds):
+        eventIds.update(Participation.objects.filter(appuser__in=chunk)
+                        .values_list('event_id', flat=True).distinct())
+    return list(eventIds)
+
+### signal handlers ###
+
+def participantsChanged(sender, instance, action, pk_set, **kwargs):
+    # event.participants and user.participating share the same table, so
+    # instance is either the event or the user whose relations changed
+    fromEvent = isinstance(instance, Event)
+    if action == 'pre_clear':
+        if not fromEvent:
+            instance._feedEventIds = eventIdsOfUsers([instance.pk])
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if fromEvent:
+            refreshEventFeeds([instance.pk])
+        elif action == 'post_clear':
+            refreshEventFeeds(getattr(instance, '_feedEventIds', ()))
+        else:
+            refreshEventFeeds(pk_set)
+
+def friendsChanged(sender, instance, action, pk_set, **kwargs):
+    if action == 'pre_clear':
+        instance._feedFriendIds = list(Friendship.objects
+                                       .filter(from_appuser=instance)
+                                       .values_list('to_appuser_id',
+                                                    flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if action == 'post_clear':
+            userIds = getattr(instance, '_feedFriendIds', [])
+        else:
+            userIds = pk_set
+        refreshFriendshipFeeds(instance.pk, userIds, action == 'post_add')
+
+def eventSaved(sender, instance, created, **kwargs):
+    if not created:
+        FeedEntry.objects.filter(event=instance).update(
+            date_time=instance.date_time)
+
+def userDeleting(sender, instance, **kwargs):
+    instance._feedEventIds = eventIdsOfUsers([instance.pk])
+
+def userDeleted(sender, instance, **kwargs):
+    # deleting a user deletes their participations and friendships without
+    # sending m2m_changed, so their friends' feeds are fixed up here
+    refreshEventFeeds(getattr(instance, '_feedEventIds', ()))
+
+m2m_changed.connect(participantsChanged, sender=Participation)
+m2m_changed.connect(friendsChanged, sender=Friendship)
+post_save.connect(eventSaved, sender=Event)
+pre_delete.connect(userDeleting, sender=AppUser)
+post_delete.connect(userDeleted, sender=AppUser)
+
+### reading ###
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=utc)
+
+def formatCursor(dateTime, eventId):
+    # microseconds rather than a javascript timestamp, which would lose the
+    # ties it's there to break
+    delta = dateTime - EPOCH
+    return "%d,%d" % ((delta.days * 86400 + delta.seconds) * 1000000 +
+                      delta.microseconds, eventId)
+
+def parseCursor(cursor):
+    '''(string): (datetime, int) or None
+
+    the date_time and eid of the last event of a page, as
+    "<microseconds since the epoch>,<eid>"
+    '''
+    try:
+        microseconds, eventId = cursor.split(',')
+        return (EPOCH + datetime.timedelta(microseconds=int(microseconds)),
+                int(eventId))
+    except (ValueError, OverflowError):
+        return None
+
+def getFeedEventIds(user, since, limit=DEFAULT_PAGE_SIZE, after=None):
+    '''(AppUser, datetime, int, (datetime, int)): (int list, string)
+
+    returns the ids of the first limit events that friends of user take part
+    in, ordered by (date_time, eid), either at or after since or, for the
+    next pages, after the (date_time, eid) of the last event of the previous
+    one; and the cursor of the next page, None on the last one
+    '''
+    if after is None:
+        entryFilter = eventFilter = Q(date_time__gte=since)
+    else:
+        # the range scan still starts at the date_time; only the events tied
+        # with the last one are filtered out by id
+        afterTime, afterId = after
+        entryFilter = Q(date_time__gte=afterTime) & (
+            Q(date_time__gt=afterTime) | Q(event__gt=afterId))
+        eventFilter = Q(date_time__gte=afterTime) & (
+            Q(date_time__gt=afterTime) | Q(eid__gt=afterId))
+    # one range scan of the (user, date_time, event) index; a row more than
+    # the page tells whether there is a next one
+    entries = list(FeedEntry.objects.filter(entryFilter, user=user)
+                   .order_by('date_time', 'event')
+                   .values_list('date_time', 'event_id')[:limit + 1])
+    # plus the events of friends too popular to fan out to everybody
+    pulledEntries = list(Event.objects
+                         .filter(eventFilter,
+                                 participants__friends=user,
+                                 participants__pulledFeed__isnull=False)
+                         .order_by('date_time', 'eid')
+                         .values_list('date_time', 'eid')
+                         .distinct()[:limit + 1])
+    page = []
+    seen = set()
+    for dateTime, eventId in sorted(entries + pulledEntries):
+        if eventId not in seen:
+            seen.add(eventId)
+            page.append((dateTime, eventId))
+    # with limit or fewer events, neither list was cut short
+    nextCursor = formatCursor(*page[limit - 1]) if len(page) > limit else None
+    return [eventId for dateTime, eventId in page[:limit]], nextCursor
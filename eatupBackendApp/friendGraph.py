@@ -0,0 +1,369 @@
+from __future__ import with_statement
+
+import time, bisect, threading, heapq
+from array import array
+from django.db.models.signals import m2m_changed, pre_delete
+from annoying.functions import get_config
+from eatupBackendApp.models import AppUser
+from eatupBackendApp.metrics import recordCacheLookup
+from eatupBackendApp.transactionHooks import afterCommit
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+Friendship = AppUser.friends.through
+
+# rebuild the graph once the overlay holds this fraction of its edges
+DEFAULT_COMPACT_RATIO = 0.05
+# and from the database after this many seconds (settings.FRIEND_GRAPH_MAX_AGE),
+# to pick up changes made by other processes
+DEFAULT_MAX_AGE = 300
+
+DEFAULT_SUGGESTIONS = 10
+MAX_SUGGESTIONS = 100
+
+class FriendGraph(object):
+    '''
+    read-mostly, compact friend graph in compressed sparse row form:
+
+    - uids: sorted array of every user id that has friends
+    - offsets: the friends of uids[i] are neighbors[offsets[i]:offsets[i+1]]
+    - neighbors: indices into uids, sorted within each row
+
+    which takes 8 bytes per user plus 8 bytes per directed edge (16 per
+    friendship); changes since the arrays were built live in a small
+    overlay of added and removed edges, until compact() folds them in
+    '''
+    def __init__(self, uids, offsets, neighbors):
+        self.uids = uids
+        self.offsets = offsets
+        self.neighbors = neighbors
+        # uid -> set of uids
+        self.added = {}
+        self.removed = {}
+        self.overlaySize = 0
+        self._numpyArrays = None
+
+    @classmethod
+    def fromEdges(cls, edges):
+        '''((int, int) iterable): FriendGraph
+
+        builds the graph from directed (uid, friend uid) pairs; symmetrical
+        friendships are expected to appear in both directions, like they are
+        stored in the friends table
+        '''
+        sources = array('l')
+        targets = array('l')
+        for source, target in edges:
+            sources.append(source)
+            targets.append(target)
+        uids = array('l', sorted(set(sources) | set(targets)))
+        indexOf = dict((uid, i) for i, uid in enumerate(uids))
+
+        offsets = array('l', [0]) * (len(uids) + 1)
+        for source in sources:
+            offsets[indexOf[source] + 1] += 1
+        for i in xrange(len(uids)):
+            offsets[i + 1] += offsets[i]
+
+        # fill every row, then sort each row in place
+        neighbors = array('l', [0]) * len(sources)
+        fill = array('l', offsets)
+        for source, target in zip(sources, targets):
+            row = indexOf[source]
+            neighbors[fill[row]] = indexOf[target]
+            fill[row] += 1
+        del sources, targets, fill, indexOf
+        for i in xrange(len(uids)):
+            start, end = offsets[i], offsets[i + 1]
+            if end - start > 1:
+                neighbors[start:end] = array('l',
+                                             sorted(neighbors[start:end]))
+        return cls(uids, offsets, neighbors)
+
+    @classmethod
+    def fromDatabase(cls, using='default'):
+        rows = (Friendship.objects.using(using)
+                .values_list('from_appuser_id', 'to_appuser_id').iterator())
+        return cls.fromEdges(rows)
+
+    ### lookups ###
+
+    def indexOf(self, uid):
+        i = bisect.bisect_left(self.uids, uid)
+        if i < len(self.uids) and self.uids[i] == uid:
+            return i
+        return None
+
+    def baseFriendIndices(self, uid):
+        i = self.indexOf(uid)
+        if i is None:
+            return array('l')
+        return self.neighbors[self.offsets[i]:self.offsets[i + 1]]
+
+    def friendsOf(self, uid):
+        '''(int): int set
+
+        the uids of uid's friends, including changes in the overlay
+        '''
+        uids = self.uids
+        friends = set(uids[i] for i in self.baseFriendIndices(uid))
+        friends -= self.removed.get(uid, set())
+        friends |= self.added.get(uid, set())
+        return friends
+
+    def numEdges(self):
+        return len(self.neighbors) // 2
+
+    def memoryUsage(self):
+        '''(): int
+
+        approximate bytes used by the arrays and the overlay
+        '''
+        arrays = sum(a.buffer_info()[1] * a.itemsize
+                     for a in (self.uids, self.offsets, self.neighbors))
+        # a set entry costs roughly 3 words once the set is resized
+        return arrays + self.overlaySize * 24 * 2
+
+    ### incremental updates ###
+
+    def addFriendship(self, a, b):
+        self._changeEdge(a, b, self.added, self.removed)
+        self._changeEdge(b, a, self.added, self.removed)
+
+    def removeFriendship(self, a, b):
+        self._changeEdge(a, b, self.removed, self.added)
+        self._changeEdge(b, a, self.removed, self.added)
+
+    def _changeEdge(self, a, b, into, outOf):
+        if b in outOf.get(a, ()):
+            # undo an earlier change instead
+            outOf[a].discard(b)
+            self.overlaySize -= 1
+            return
+        i, j = self.indexOf(a), self.indexOf(b)
+        inBase = i is not None and j is not None and \
+            self._baseHasEdge(i, j)
+        # adding an edge the base has, or removing one it doesn't, is a no-op
+        if (into is self.added) == inBase:
+            return
+        if b not in into.setdefault(a, set()):
+            into[a].add(b)
+            self.overlaySize += 1
+
+    def _baseHasEdge(self, i, j):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        k = bisect.bisect_left(self.neighbors, j, start, end)
+        return k < end and self.neighbors[k] == j
+
+    def needsCompaction(self, ratio=DEFAULT_COMPACT_RATIO):
+        return self.overlaySize > max(len(self.neighbors) * ratio, 1000)
+
+    def compact(self):
+        '''(): FriendGraph
+
+        returns a new graph with the overlay folded into the arrays
+        '''
+        def edges():
+            uids = self.uids
+            for i, uid in enumerate(uids):
+                removed = self.removed.get(uid, ())
+                for j in self.neighbors[self.offsets[i]:self.offsets[i + 1]]:
+                    if uids[j] not in removed:
+                        yield uid, uids[j]
+            for uid, friends in self.added.iteritems():
+                for friend in friends:
+                    yield uid, friend
+        return FriendGraph.fromEdges(edges())
+
+    ### two-hop counting ###
+
+    def _getNumpyArrays(self):
+        # views of the arrays, not copies
+        if self._numpyArrays is None:
+            self._numpyArrays = tuple(numpy.frombuffer(a, dtype=numpy.int_)
+                                      for a in (self.uids, self.offsets,
+                                                self.neighbors))
+        return self._numpyArrays
+
+    def _countTwoHopNumpy(self, friendIndices):
+        '''(int list): (numpy array, numpy array)
+
+        counts how often every index appears among the neighbors of the
+        given rows; returns the distinct indices (ascending, which is also
+        uid order) and their counts, without a python-level loop
+        '''
+        offsets, neighbors = self._getNumpyArrays()[1:]
+        rows = numpy.array(friendIndices, dtype=numpy.int_)
+        starts = offsets[rows]
+        lengths = offsets[rows + 1] - starts
+        total = int(lengths.sum())
+        if not total:
+            empty = numpy.zeros(0, dtype=numpy.int_)
+            return empty, empty
+        # position k of the concatenated rows lies in row r at
+        # starts[r] + k - (number of positions in the rows before r)
+        shifts = numpy.repeat(starts - numpy.cumsum(lengths) + lengths,
+                              lengths)
+        positions = shifts + numpy.arange(total)
+        return numpy.unique(neighbors[positions], return_counts=True)
+
+    def _touchesOverlay(self, uid, friends):
+        return any(user in self.added or user in self.removed
+                   for user in [uid] + list(friends))
+
+    def mutualFriendCounts(self, uid, useNumpy=True):
+        '''(int, bool): dict
+
+        maps every friend of a friend of uid, who isn't uid or already one
+        of uid's friends, to the number of friends they have in common
+        '''
+        friends = self.friendsOf(uid)
+        friendIndices = [i for i in (self.indexOf(friend) for friend in friends)
+                         if i is not None]
+        uids = self.uids
+        if numpy is not None and useNumpy and friendIndices:
+            indices, hits = self._countTwoHopNumpy(friendIndices)
+            counts = dict(zip(self._getNumpyArrays()[0][indices].tolist(),
+                              hits.tolist()))
+        else:
+            counts = {}
+            neighbors, offsets = self.neighbors, self.offsets
+            for i in friendIndices:
+                for j in neighbors[offsets[i]:offsets[i + 1]]:
+                    counts[uids[j]] = counts.get(uids[j], 0) + 1
+
+        # the arrays don't know about the overlay; correct for it
+        for friend in friends:
+            for other in self.removed.get(friend, ()):
+                counts[other] = counts.get(other, 0) - 1
+            for other in self.added.get(friend, ()):
+                counts[other] = counts.get(other, 0) + 1
+
+        counts.pop(uid, None)
+        for friend in friends:
+            counts.pop(friend, None)
+        return dict((other, n) for other, n in counts.iteritems() if n > 0)
+
+    def suggestions(self, uid, limit=DEFAULT_SUGGESTIONS, useNumpy=True):
+        '''(int, int, bool): (int, int) list
+
+        the limit people uid is most likely to know, as (uid, number of
+        mutual friends), most mutual friends first, then by uid
+        '''
+        friends = self.friendsOf(uid)
+        if not friends:
+            return []
+        if numpy is not None and useNumpy and \
+                not self._touchesOverlay(uid, friends):
+            # rank entirely in numpy; only the winners become python objects
+            friendIndices = [self.indexOf(friend) for friend in friends]
+            indices, hits = self._countTwoHopNumpy(friendIndices)
+            keep = ~numpy.in1d(indices, friendIndices + [self.indexOf(uid)])
+            indices, hits = indices[keep], hits[keep]
+            # a stable sort keeps equal counts in uid order
+            best = numpy.argsort(-hits, kind='mergesort')[:limit]
+            return zip(self._getNumpyArrays()[0][indices[best]].tolist(),
+                       hits[best].tolist())
+        counts = self.mutualFriendCounts(uid, useNumpy)
+        return heapq.nsmallest(limit, counts.iteritems(),
+                               key=lambda (other, n): (-n, other))
+
+### per-process graph, kept up to date by signals ###
+
+_graphLock = threading.RLock()
+_graph = None
+_graphBuiltAt = 0
+# how many times the graph was read from the database, so that changes
+# waiting on a transaction can tell whether it was read while they waited
+_graphGeneration = 0
+
+def getGraph():
+    '''(): FriendGraph
+
+    returns this process' friend graph, (re)building it from the database
+    when it's missing or older than settings.FRIEND_GRAPH_MAX_AGE
+    '''
+    global _graph, _graphBuiltAt, _graphGeneration
+    maxAge = get_config('FRIEND_GRAPH_MAX_AGE', DEFAULT_MAX_AGE)
+    with _graphLock:
+        stale = _graph is None or time.time() - _graphBuiltAt > maxAge
+        recordCacheLookup('friend_graph', not stale)
+        if stale:
+            _graph = FriendGraph.fromDatabase()
+            _graphBuiltAt = time.time()
+            _graphGeneration += 1
+        elif _graph.needsCompaction():
+            _graph = _graph.compact()
+        return _graph
+
+def resetGraph():
+    global _graph
+    with _graphLock:
+        _graph = None
+
+def queueChanges(changes, using):
+    '''((int, int, bool) list, string): None
+
+    applies the (uid, uid, added) friendship changes to the graph once the
+    transaction they were written in commits (see
+    eatupBackendApp/transactionHooks.py), so that a rolled back one never
+    shows up in it
+    '''
+    generation = _graphGeneration
+
+    def readMeanwhile():
+        # the graph was read from the database while the transaction was
+        # open; it may have the changes or not, so it's read again
+        if _graphGeneration != generation:
+            resetGraph()
+            return True
+        return False
+
+    def onCommit():
+        with _graphLock:
+            if _graph is None or readMeanwhile():
+                return
+            for a, b, added in changes:
+                if added:
+                    _graph.addFriendship(a, b)
+                else:
+                    _graph.removeFriendship(a, b)
+
+    def onRollback():
+        with _graphLock:
+            readMeanwhile()
+
+    # not knowing whether the changes are in the database, the graph is read
+    # again
+    afterCommit(onCommit, onRollback, using, onUnknown=resetGraph)
+
+def friendIdsInDatabase(uid, using):
+    # rather than the graph's, which lacks changes still waiting on the
+    # transaction
+    return list(Friendship.objects.using(using).filter(from_appuser=uid)
+                .values_list('to_appuser_id', flat=True))
+
+def friendsChanged(sender, instance, action, pk_set, using='default',
+                   **kwargs):
+    if action == 'pre_clear':
+        instance._graphFriendIds = (friendIdsInDatabase(instance.pk, using)
+                                    if _graph is not None else ())
+    elif action == 'post_add':
+        queueChanges([(instance.pk, other, True) for other in pk_set], using)
+    elif action == 'post_remove':
+        queueChanges([(instance.pk, other, False) for other in pk_set], using)
+    elif action == 'post_clear':
+        queueChanges([(instance.pk, other, False) for other in
+                      getattr(instance, '_graphFriendIds', ())], using)
+
+def userDeleting(sender, instance, using='default', **kwargs):
+    # the cascade deletes friendships without sending m2m_changed
+    friendIds = (friendIdsInDatabase(instance.pk, using)
+                 if _graph is not None else ())
+    queueChanges([(instance.pk, other, False) for other in friendIds], using)
+
+m2m_changed.connect(friendsChanged, sender=Friendship)
+pre_delete.connect(userDeleting, sender=AppUser)
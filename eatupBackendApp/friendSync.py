@@ -0,0 +1,79 @@
+from django.db.models import Q
+from django.db.models.signals import m2m_changed
+from eatupBackendApp.models import AppUser
+from eatupBackendApp.feed import chunks, deleteRows
+from eatupBackendApp.counters import recount
+
+Friendship = AppUser.friends.through
+
+def existingUids(uids):
+    '''(long iterable): long set
+
+    the given uids that belong to users, a query per CHUNK_SIZE of them
+    '''
+    found = set()
+    for chunk in chunks(set(uids)):
+        found.update(AppUser.objects.filter(uid__in=chunk)
+                     .values_list('uid', flat=True))
+    return found
+
+def setFriends(user, friendIds):
+    '''(AppUser, long iterable): (long set, long set, long set)
+
+    makes user's friends exactly the given users (uids of users that don't
+    exist are left out), and returns the uids of the friends it ends up 
+    with, of those that were added and of those that were removed
+
+    only the difference with the current friendships is written, as bulk
+    inserts and deletes of both rows of every friendship, so this runs a
+    fixed number of queries per CHUNK_SIZE friends however big the list is;
+    m2m_changed is sent like user.friends.add() and remove() would, which
+    keeps the feeds, the friend graph and the friend counters up to date
+    '''
+    wanted = existingUids(friendIds)
+    wanted.discard(user.pk)
+
+    # both directions, in case an older write left one of them behind
+    outgoing, incoming = {}, {}
+    for pk, fromId, toId in (Friendship.objects
+                             .filter(Q(from_appuser=user) | Q(to_appuser=user))
+                             .values_list('pk', 'from_appuser_id',
+                                          'to_appuser_id')):
+        if fromId == user.pk:
+            outgoing[toId] = pk
+        if toId == user.pk:
+            incoming[fromId] = pk
+    current = set(outgoing)
+    added = wanted - current
+    removed = current - wanted
+
+    sendFriendsChanged('pre_remove', user, removed)
+    deleteRows(Friendship, 'id', sorted(
+        [outgoing[uid] for uid in removed] +
+        [incoming[uid] for uid in removed if uid in incoming] +
+        # rows left behind in one direction only
+        [incoming[uid] for uid in set(incoming) - current - wanted]))
+    sendFriendsChanged('post_remove', user, removed)
+
+    sendFriendsChanged('pre_add', user, added)
+    rows = []
+    for uid in sorted(added):
+        rows.append(Friendship(from_appuser_id=user.pk, to_appuser_id=uid))
+        if uid not in incoming:
+            rows.append(Friendship(from_appuser_id=uid,
+                                   to_appuser_id=user.pk))
+    rows.extend(Friendship(from_appuser_id=uid, to_appuser_id=user.pk)
+                for uid in sorted(wanted - added - set(incoming)))
+    Friendship.objects.bulk_create(rows)
+    sendFriendsChanged('post_add', user, added)
+    # the counters of the other side of rows that were left behind, or are
+    # repaired, don't change the way the signals assume
+    recount(AppUser, 'friend_count', set(incoming) ^ current)
+    return wanted, added, removed
+
+def sendFriendsChanged(action, user, uids):
+    # what django's related manager sends for user.friends
+    if uids:
+        m2m_changed.send(sender=Friendship, action=action, instance=user,
+                         reverse=False, model=AppUser, pk_set=set(uids),
+                         using=Friendship.objects.db)
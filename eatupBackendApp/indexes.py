@@ -0,0 +1,295 @@
+from __future__ import with_statement
+
+from django.db import connections, transaction
+from django.utils import timezone
+from eatupBackendApp.models import (AppUser, Event, DumbLocation, FeedEntry,
+                                    EventChange, ChangeLogEntry)
+
+class IndexSpec(object):
+    '''
+    an index we want on a model's table, over the columns of the given fields
+    (in order)
+
+    an index is considered present if any index on the table starts with the
+    same columns, whatever its name, so the ones django creates for foreign
+    keys and unique_together count
+    '''
+    def __init__(self, name, model, fieldNames, reason=""):
+        self.name = name
+        self.model = model
+        self.fieldNames = fieldNames
+        self.reason = reason
+
+    @property
+    def table(self):
+        return self.model._meta.db_table
+
+    @property
+    def columns(self):
+        return tuple(self.model._meta.get_field(fieldName).column
+                     for fieldName in self.fieldNames)
+
+    def createSql(self, connection, online=False):
+        quote = connection.ops.quote_name
+        concurrently = "CONCURRENTLY " if online else ""
+        return "CREATE INDEX %s%s ON %s (%s)" % (
+            concurrently, quote(self.name), quote(self.table),
+            ", ".join(quote(column) for column in self.columns))
+
+    def __repr__(self):
+        return "<IndexSpec %s on %s(%s)>" % (self.name, self.table,
+                                             ", ".join(self.columns))
+
+Participation = Event.participants.through
+Friendship = AppUser.friends.through
+
+# the indexes the hot queries of the views need
+INDEXES = [
+    IndexSpec('eatup_participant_user_event', Participation,
+              ('appuser', 'event'),
+              "a user's events (info/userevents, prefetching participating), "
+              "answered from the index alone"),
+    IndexSpec('eatup_participant_event_user', Participation,
+              ('event', 'appuser'),
+              "an event's participants"),
+    IndexSpec('eatup_event_date_time', Event, ('date_time',),
+              "events ordered or filtered by time"),
+    IndexSpec('eatup_event_host_date_time', Event, ('host', 'date_time'),
+              "the events a user hosts, by time"),
+    IndexSpec('eatup_dumblocation_event', DumbLocation, ('eventHere',),
+              "an event's locations, and the orphan cleanup in edit/event"),
+    IndexSpec('eatup_friends_from_to', Friendship,
+              ('from_appuser', 'to_appuser'),
+              "a user's friends"),
+    IndexSpec('eatup_friends_to_from', Friendship,
+              ('to_appuser', 'from_appuser'),
+              "the reverse side of friendships, used when clearing friends"),
+    IndexSpec('eatup_feedentry_user_date_time_event', FeedEntry, 
+              ('user', 'date_time', 'event'),
+              "a page of a user's feed (info/feed) as one range scan, in "
+              "the order of its cursor"),
+    IndexSpec('eatup_eventchange_user_changed_at', EventChange,
+              ('user', 'changed_at'),
+              "a delta sync (info/userevents?since=) as one range scan"),
+    IndexSpec('eatup_eventchange_eid', EventChange, ('eid',),
+              "the change log rows of an event, stamped on every change"),
+    IndexSpec('eatup_changelogentry_uid_id', ChangeLogEntry, ('uid', 'id'),
+              "a user's changes after a cursor (changes/)"),
+    IndexSpec('eatup_changelogentry_created_at', ChangeLogEntry, 
+              ('created_at',),
+              "pruning old log entries"),
+]
+
+### schema introspection ###
+
+def getSqliteIndexes(connection, cursor, table):
+    indexes = {}
+    cursor.execute("PRAGMA index_list(%s)" % connection.ops.quote_name(table))
+    for row in cursor.fetchall():
+        # (seq, name, unique, ...)
+        name = row[1]
+        cursor.execute("PRAGMA index_info(%s)" % 
+                       connection.ops.quote_name(name))
+        # (seqno, cid, column name)
+        indexes[name] = tuple(column for seqno, cid, column in
+                              sorted(cursor.fetchall()))
+    # an INTEGER PRIMARY KEY is the table's rowid and has no index entry
+    return indexes
+
+def getPostgresIndexes(cursor, table):
+    cursor.execute("""
+        SELECT c.relname, i.indkey
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_class t ON t.oid = i.indrelid
+        WHERE t.relname = %s AND i.indisvalid""", [table])
+    rows = cursor.fetchall()
+    cursor.execute("""
+        SELECT a.attnum, a.attname
+        FROM pg_attribute a
+        JOIN pg_class t ON t.oid = a.attrelid
+        WHERE t.relname = %s AND a.attnum > 0""", [table])
+    columnNames = dict(cursor.fetchall())
+    indexes = {}
+    for name, indkey in rows:
+        # indkey is an int2vector, which psycopg2 hands back as "1 2"
+        if isinstance(indkey, basestring):
+            indkey = [int(attnum) for attnum in indkey.split()]
+        indexes[name] = tuple(columnNames.get(attnum, '?')
+                              for attnum in indkey)
+    return indexes
+
+def getMysqlIndexes(cursor, table):
+    cursor.execute("SHOW INDEX FROM %s" % table)
+    columnsByIndex = {}
+    for row in cursor.fetchall():
+        # (table, non_unique, key_name, seq_in_index, column_name, ...)
+        columnsByIndex.setdefault(row[2], []).append((row[3], row[4]))
+    return dict((name, tuple(column for seq, column in sorted(columns)))
+                for name, columns in columnsByIndex.iteritems())
+
+def getExistingIndexes(connection, table):
+    '''(DatabaseWrapper, string): dict
+
+    maps the name of every index on table to its tuple of column names
+    '''
+    cursor = connection.cursor()
+    if connection.vendor == 'sqlite':
+        return getSqliteIndexes(connection, cursor, table)
+    elif connection.vendor == 'postgresql':
+        return getPostgresIndexes(cursor, table)
+    elif connection.vendor == 'mysql':
+        return getMysqlIndexes(cursor, connection.ops.quote_name(table))
+    raise NotImplementedError("index introspection isn't supported for %s" %
+                              connection.vendor)
+
+def findCoveringIndex(spec, existingIndexes):
+    for name, columns in existingIndexes.iteritems():
+        if columns[:len(spec.columns)] == spec.columns:
+            return name
+    return None
+
+def checkIndexes(using='default', specs=None):
+    '''(string, IndexSpec list): (IndexSpec, string) list
+
+    pairs every spec with the name of the existing index that covers it, or
+    None if it is missing
+    '''
+    connection = connections[using]
+    existingByTable = {}
+    results = []
+    for spec in (specs or INDEXES):
+        if spec.table not in existingByTable:
+            existingByTable[spec.table] = getExistingIndexes(connection,
+                                                             spec.table)
+        results.append((spec, findCoveringIndex(spec,
+                                                existingByTable[spec.table])))
+    return results
+
+### index creation ###
+
+def createIndex(spec, using='default'):
+    '''(IndexSpec, string): string
+
+    creates the index, without blocking writes to the table where the
+    database can (CREATE INDEX CONCURRENTLY on postgres; mysql's InnoDB
+    builds indexes online by default), and returns the SQL that was run
+    '''
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        return createIndexConcurrently(spec, connection)
+    sql = spec.createSql(connection)
+    with transaction.commit_on_success(using=using):
+        connection.cursor().execute(sql)
+    return sql
+
+def createIndexConcurrently(spec, connection):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+    from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+    sql = spec.createSql(connection, online=True)
+    cursor = connection.cursor()
+    connection.connection.commit()
+    previousLevel = connection.connection.isolation_level
+    connection.connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    try:
+        cursor.execute(sql)
+    finally:
+        connection.connection.set_isolation_level(previousLevel)
+    return sql
+
+def createMissingIndexes(using='default', specs=None):
+    '''(string, IndexSpec list): string list
+
+    creates every index of the set that has no covering index yet and
+    returns the SQL that was run
+    '''
+    return [createIndex(spec, using)
+            for spec, existing in checkIndexes(using, specs)
+            if existing is None]
+
+def createIndexesAfterSyncdb(sender, created_models=(), verbosity=1,
+                             db='default', **kwargs):
+    '''
+    post_syncdb handler; gives newly created tables their indexes
+    '''
+    createdTables = set(model._meta.db_table for model in created_models)
+    specs = [spec for spec in INDEXES if spec.table in createdTables]
+    if not specs:
+        return
+    for sql in createMissingIndexes(using=db, specs=specs):
+        if verbosity >= 2:
+            print "Creating index: %s" % sql
+
+### query plans ###
+
+def getHotQueries(using='default'):
+    '''(string): (string, QuerySet) list
+
+    the queries behind the views, on the given database, with ids taken from
+    its data
+    '''
+    users = AppUser.objects.using(using)
+    events = Event.objects.using(using)
+    user = users.order_by('pk')[:1]
+    event = events.order_by('pk')[:1]
+    uid = user[0].pk if user else 0
+    eid = event[0].pk if event else 0
+    return [
+        ("info/userevents: a user's events",
+         events.filter(participants__uid=uid)),
+        ("prefetch: participants of events",
+         users.filter(participating__eid__in=[eid])),
+        ("prefetch: participating of users",
+         events.filter(participants__uid__in=[uid])),
+        ("prefetch: friends of users",
+         users.filter(friends__uid__in=[uid])),
+        ("prefetch: locations of events",
+         DumbLocation.objects.using(using).filter(eventHere__in=[eid])),
+        ("prefetch: events hosted by users",
+         events.filter(host__in=[uid])),
+        ("info/feed: a page of a user's feed",
+         FeedEntry.objects.using(using)
+         .filter(user=uid, date_time__gte=timezone.now())
+         .order_by('date_time', 'event')
+         .values_list('date_time', 'event_id')[:51]),
+        ("info/userevents?since=: a user's changed events",
+         EventChange.objects.using(using)
+         .filter(user=uid, changed_at__gt=timezone.now())
+         .order_by('changed_at').values_list('eid', 'removed')),
+        ("upcoming events by time",
+         events.filter(date_time__gte=timezone.now()).order_by(
+             'date_time')[:20]),
+    ]
+
+def explainQuery(queryset, using='default'):
+    '''(QuerySet, string): string
+
+    returns the database's plan for the queryset's SQL
+    '''
+    connection = connections[using]
+    sql, params = queryset.query.get_compiler(using=using).as_sql()
+    if connection.vendor == 'sqlite':
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN "
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    rows = cursor.fetchall()
+    if connection.vendor == 'sqlite':
+        # (id, parent, notused, detail)
+        return "\n".join(row[-1] for row in rows)
+    return "\n".join(" ".join(unicode(column) for column in row)
+                     for row in rows)
+
+def hasFullScan(plan):
+    '''(string): bool
+
+    whether a plan from explainQuery reads a whole table: "SCAN <table>"
+    without an index in sqlite, or "Seq Scan" in postgres
+    '''
+    for line in plan.splitlines():
+        line = line.strip().upper()
+        if 'SEQ SCAN' in line or \
+                (line.startswith('SCAN') and 'USING' not in line):
+            return True
+    return False
@@ -0,0 +1,199 @@
+import calendar
+from collections import namedtuple
+from django.db import models
+from eatupBackendApp.models import jsonValue
+from eatupBackendApp.feed import chunks
+
+# a read-only path for the info/ views: rows are read with values_list() into
+# namedtuples (one class per model, made from its fields) and turned into the
+# same dictionaries getDictForJson gives, without building model instances,
+# their _state, prefetch caches and related managers, or sending post_init
+
+_specs = {}
+
+def getSpec(model):
+    '''(JsonableModel class): RowSpec'''
+    spec = _specs.get(model)
+    if spec is None:
+        spec = _specs[model] = RowSpec(model)
+    return spec
+
+# values that jsonValue gives back as they are (text only for fields that are
+# written as their unicode); found by their exact class, which is quicker
+# than is_protected_type
+PASSED_THROUGH = (int, long, float, bool, type(None))
+
+def makeConverter(field):
+    '''(Field): function
+
+    a function of (value, row) giving jsonValue(field, value, row), with the
+    common cases short-cut
+    '''
+    passedThrough = set(PASSED_THROUGH)
+    if (field.__class__.value_to_string.im_func is
+            models.Field.value_to_string.im_func):
+        passedThrough.add(unicode)
+    def convert(value, row):
+        if value.__class__ in passedThrough:
+            return value
+        return jsonValue(field, value, row)
+    return convert
+
+class Relation(object):
+    '''
+    a to-many relation getDictForJson embeds, and the query of the rows it
+    relates to some rows of its model: a many-to-many field through its
+    intermediary table, or the foreign key of a reverse one
+    '''
+    def __init__(self, model, name):
+        self.name = name
+        for field in model._meta.local_many_to_many:
+            if field.name == name:
+                self.model = field.rel.through
+                self.ownerField = field.m2m_field_name()
+                self.prefix = field.m2m_reverse_field_name() + '__'
+                self.relatedModel = field.rel.to
+                return
+        for related in model._meta.get_all_related_objects():
+            if related.get_accessor_name() == name:
+                self.model = related.model
+                self.ownerField = related.field.name
+                self.prefix = ''
+                self.relatedModel = related.model
+                return
+        raise ValueError("%s has no to-many relation %s" % (
+            model.__name__, name))
+
+    def load(self, ownerIds, using):
+        '''(int list, string): {int: namedtuple list}
+
+        the inline rows related to each of the given rows, in the order they
+        were related in
+        '''
+        spec = getSpec(self.relatedModel)
+        columns = [self.prefix + column for column in spec.columns]
+        makeRow = spec.inlineRow._make
+        related = {}
+        for chunk in chunks(ownerIds):
+            values = (self.model._default_manager.using(using)
+                      .filter(**{self.ownerField + '__in': chunk})
+                      .order_by('pk')
+                      .values_list(self.ownerField, *columns))
+            for value in values:
+                related.setdefault(value[0], []).append(makeRow(value[1:]))
+        return related
+
+
+class RowSpec(object):
+    '''
+    how a JsonableModel's rows are read as namedtuples and serialized: its
+    rows hold every local field by attname and then, for the ones that aren't
+    inline, the rows of every relation in allToManyFields
+    '''
+    def __init__(self, model):
+        self.model = model
+        meta = model._meta
+        if getattr(model, 'imageFields', None):
+            raise NotImplementedError("%s has image fields" % model.__name__)
+        allToManyFields = getattr(model, 'allToManyFields', set())
+        for field in meta.local_many_to_many:
+            if field.name not in allToManyFields:
+                raise NotImplementedError("%s.%s isn't embedded" % (
+                    model.__name__, field.name))
+
+        self.columns = [field.attname for field in meta.local_fields]
+        self.pkIndex = self.columns.index(meta.pk.attname)
+        # (json name, index, converter) of every field getDictForJson shows
+        self.fields = [(field.name, index, makeConverter(field))
+                       for index, field in enumerate(meta.local_fields)
+                       if not field.primary_key]
+        self.rawTimeFields = [
+            ("%s_raw" % field.name, index)
+            for index, field in enumerate(meta.local_fields)
+            if field.name in getattr(model, 'rawTimeFields', set())]
+        self.idName = getattr(model, 'idName', None)
+        self.relations = [Relation(model, name)
+                          for name in sorted(allToManyFields)]
+
+        self.inlineRow = namedtuple(model.__name__ + 'InlineRow',
+                                    self.columns)
+        self.row = namedtuple(model.__name__ + 'Row', self.columns + [
+            relation.name for relation in self.relations])
+
+    def fetch(self, queryset):
+        '''(QuerySet): namedtuple list
+
+        the rows of the queryset (of this spec's model), in its order, with
+        their relations; a query for the rows and one per relation (and per
+        CHUNK_SIZE rows)
+        '''
+        values = list(queryset.values_list(*self.columns))
+        if not values:
+            return []
+        ownerIds = [value[self.pkIndex] for value in values]
+        relatedRows = [relation.load(ownerIds, queryset.db)
+                       for relation in self.relations]
+        makeRow = self.row._make
+        rows = []
+        for value in values:
+            ownerId = value[self.pkIndex]
+            rows.append(makeRow(value + tuple(
+                related.get(ownerId, []) for related in relatedRows)))
+        return rows
+
+    def toJson(self, row, inline=False):
+        '''(namedtuple, bool): dict
+
+        what getDictForJson(inline) gives for the model instance of the row
+        '''
+        jsonDict = {}
+        for name, index, convert in self.fields:
+            jsonDict[name] = convert(row[index], row)
+        if not inline:
+            offset = len(self.columns)
+            for i, relation in enumerate(self.relations):
+                toJson = getSpec(relation.relatedModel).toJson
+                jsonDict[relation.name] = [toJson(related, inline=True)
+                                           for related in row[offset + i]]
+        for rawName, index in self.rawTimeFields:
+            # javascript timestamps are in milliseconds
+            jsonDict[rawName] = calendar.timegm(
+                row[index].utctimetuple()) * 1000
+        if self.idName is not None:
+            jsonDict[self.idName] = row[self.pkIndex]
+        return jsonDict
+
+
+def getJsonDicts(queryset):
+    '''(QuerySet): dict list
+
+    getDictForJson() of every object of the queryset, in its order, read as
+    rows
+    '''
+    spec = getSpec(queryset.model)
+    return [spec.toJson(row) for row in spec.fetch(queryset)]
+
+def getJsonDictsInBulk(model, ids, using=None):
+    '''(JsonableModel class, list, string): dict list
+
+    getDictForJson() of the objects with the given primary keys, in their
+    order, read from the database using (the router's choice if None); ids
+    that don't exist are skipped
+    '''
+    spec = getSpec(model)
+    rows = {}
+    for chunk in chunks(ids):
+        for row in spec.fetch(model.objects.using(using)
+                              .filter(pk__in=chunk)):
+            rows[row[spec.pkIndex]] = row
+    return [spec.toJson(rows[pk]) for pk in ids if pk in rows]
+
+def getJsonDict(model, pk):
+    '''(JsonableModel class, <primary key type>): dict or None
+
+    getDictForJson() of the object with the given primary key, None if there
+    isn't one
+    '''
+    spec = getSpec(model)
+    rows = spec.fetch(model.objects.filter(pk=pk))
+    return spec.toJson(rows[0]) if rows else None
@@ -3,8 +3,11 @@ try:
     import json
 except ImportError:
     import simplejson as json
-    
+
+import time
+from functools import wraps
 from django.http import HttpResponse
+from eatupBackendApp import metrics
 
 class json_response(object):
     def __init__(self, login_required = False, ajax_required = False):
@@ -12,7 +15,9 @@ class json_response(object):
         self.ajax_required = ajax_required
     def __call__(self, func):
         class_args = self
-        def decorator(request, *args, **kwargs):
+        viewName = metrics.getViewName(func)
+
+        def respond(request, *args, **kwargs):
             if class_args.login_required and not request.user.is_authenticated():
                 objects = {
                     "status": "error",
@@ -25,18 +30,36 @@ class json_response(object):
                 }
             else:
                 objects = func(request, *args, **kwargs)
-            
+
             if isinstance(objects, HttpResponse):
-                return objects
+                return objects, objects
             try:
                 data = json.dumps(objects)
                 if 'callback' in request.REQUEST:
                     # a jsonp response!
                     data = '%s(%s);' % (request.REQUEST['callback'], data)
-                    return HttpResponse(data, "text/javascript")
+                    return objects, HttpResponse(data, "text/javascript")
             except:
                 print "json dump error, returning single string"
                 data = json.dumps(str(objects))
-            return HttpResponse(data, "application/json")
-        
-        return decorator
\ No newline at end of file
+            return objects, HttpResponse(data, "application/json")
+
+        @wraps(func)
+        def decorator(request, *args, **kwargs):
+            # every view's latency, database time, response size and errors
+            # go to eatupBackendApp.metrics
+            started = time.time()
+            dbStarted = metrics.getDbSeconds()
+            try:
+                objects, response = respond(request, *args, **kwargs)
+            except Exception as e:
+                metrics.recordView(viewName, time.time() - started,
+                                   metrics.getDbSeconds() - dbStarted, None,
+                                   e.__class__.__name__)
+                raise
+            metrics.recordView(viewName, time.time() - started,
+                               metrics.getDbSeconds() - dbStarted, response,
+                               metrics.errorKindOf(objects))
+            return response
+
+        return decorator
@@ -0,0 +1,321 @@
+from __future__ import with_statement
+
+import time, random, datetime, threading, urllib, urllib2, platform
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from django.test.client import Client
+from eatupBackendApp.models import AppUser, Event, ChangeLogEntry
+from eatupBackendApp.synthData import BASE_UID, EVENT_TITLES
+
+# uids handed out to users created during a load test
+LOADTEST_UID_OFFSET = 50000000000
+
+def percentile(sortedValues, fraction):
+    if not sortedValues:
+        return 0.0
+    index = min(int(round(fraction * (len(sortedValues) - 1))),
+                len(sortedValues) - 1)
+    return sortedValues[index]
+
+def summarizeLatencies(latencies, errors, elapsed):
+    '''(float list, int, float): dict
+
+    turns the latencies (in seconds) of one route into the numbers we report,
+    in milliseconds
+    '''
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': errors,
+        'rps': count / elapsed if elapsed > 0 else 0.0,
+        'mean_ms': sum(latencies) * 1000 / count if count else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+### request targets ###
+
+class ClientTarget(object):
+    '''
+    sends requests through django's test client, in this process and against
+    the configured database
+    '''
+    def __init__(self):
+        self.client = Client()
+
+    def get(self, path, params):
+        response = self.client.get(path, params)
+        return response.status_code, response.content
+
+
+class HttpTarget(object):
+    '''
+    sends requests to a running server, eg. http://127.0.0.1:8000
+    '''
+    def __init__(self, baseUrl):
+        self.baseUrl = baseUrl.rstrip('/')
+
+    def get(self, path, params):
+        url = "%s%s?%s" % (self.baseUrl, path, urllib.urlencode(params, True))
+        try:
+            response = urllib2.urlopen(url, timeout=30)
+            return response.getcode(), response.read()
+        except urllib2.HTTPError as e:
+            return e.code, e.read()
+
+### scenarios ###
+
+class Scenario(object):
+    '''
+    picks the ids every route is exercised with; the ids of the users and
+    events the create/* routes make are fed to the edit/* and delete/* routes
+
+    the generated dataset is sampled once up front, so choosing ids costs no
+    queries during the run
+    '''
+    def __init__(self, seed=0, sampleSize=10000):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.uids = list(AppUser.objects.order_by('?')
+                         .values_list('uid', flat=True)[:sampleSize])
+        self.eids = list(Event.objects.order_by('?')
+                         .values_list('eid', flat=True)[:sampleSize])
+        # (uid, id) of change log entries; changes/ is asked for what came
+        # after the entry before one of them, so that it has news to return
+        self.changes = list(ChangeLogEntry.objects.order_by('?')
+                            .values_list('uid', 'id')[:sampleSize])
+        if not self.uids or not self.eids:
+            raise ValueError("the database has no users or events; "
+                             "run `manage.py gendata` first")
+        # javascript timestamp of a month ago
+        self.since = (int(time.time()) - 30 * 24 * 60 * 60) * 1000
+        self.createdUids = []
+        self.createdEids = []
+        self.nextUid = BASE_UID + LOADTEST_UID_OFFSET + \
+            self.rng.randrange(10 ** 9)
+
+    def randomUid(self):
+        return self.rng.choice(self.uids)
+
+    def randomEid(self):
+        return self.rng.choice(self.eids)
+
+    def params(self, route):
+        '''(string): (string, dict)
+
+        returns the path and query parameters of the next request to route
+        '''
+        with self.lock:
+            return getattr(self, 'params_' + route.replace('/', '_'))()
+
+    def recordResponse(self, route, content):
+        try:
+            data = json.loads(content)
+        except ValueError:
+            return
+        with self.lock:
+            if route == 'create/user' and 'uid' in data:
+                self.createdUids.append(data['uid'])
+            elif route == 'create/event' and 'eid' in data:
+                self.createdEids.append(data['eid'])
+
+    def timestamp(self):
+        dateTime = datetime.datetime(2013, 1, 1) + \
+            datetime.timedelta(minutes=self.rng.randint(0, 365 * 24 * 60))
+        return str(int(time.mktime(dateTime.timetuple())) * 1000)
+
+    def params_info_user(self):
+        return '/info/user/', {'uid': self.randomUid()}
+
+    def params_info_event(self):
+        return '/info/event/', {'eid': self.randomEid()}
+
+    def params_info_userevents(self):
+        return '/info/userevents/', {'uid': self.randomUid()}
+
+    def params_info_feed(self):
+        # from the start of the generated events' range, so that feeds aren't
+        # empty
+        return '/info/feed/', {'uid': self.randomUid(),
+                               'since': str(self.since)}
+
+    def params_info_suggestions(self):
+        return '/info/suggestions/', {'uid': self.randomUid()}
+
+    def params_info_friendsattending(self):
+        # one screen of event cards
+        return '/info/friendsattending/', {
+            'uid': self.randomUid(),
+            'eids[]': [self.randomEid() for i in xrange(20)]}
+
+    def params_info_search(self):
+        # a word of a generated title, cut off as if still being typed
+        word = self.rng.choice(" ".join(EVENT_TITLES).split())
+        typed = self.rng.randint(min(3, len(word)), len(word))
+        return '/info/search/', {'q': word[:typed]}
+
+    def params_changes(self):
+        if not self.changes:
+            return '/changes/', {'uid': self.randomUid(), 'cursor': 0}
+        uid, entryId = self.rng.choice(self.changes)
+        return '/changes/', {'uid': uid, 'cursor': entryId - 1}
+
+    def params_create_user(self):
+        self.nextUid += 1
+        return '/create/user/', {
+            'uid': self.nextUid, 'first_name': 'Load', 'last_name': 'Test',
+            'friends[]': [self.randomUid() for i in xrange(5)]}
+
+    def params_create_event(self):
+        return '/create/event/', {
+            'host': self.randomUid(), 'title': 'Load test',
+            'description': 'created by loadtest',
+            'date_time_raw': self.timestamp(),
+            'participants[]': [self.randomUid() for i in xrange(5)],
+            'locations[]': ['Somewhere', 'Somewhere else']}
+
+    def params_edit_user(self):
+        uids = self.createdUids or self.uids
+        return '/edit/user/', {'uid': self.rng.choice(uids),
+                               'first_name': 'Edited'}
+
+    def params_sync_friends(self):
+        uids = self.createdUids or self.uids
+        return '/sync/friends/', {
+            'uid': self.rng.choice(uids),
+            'friends[]': [self.randomUid() for i in xrange(200)]}
+
+    def params_edit_event(self):
+        eids = self.createdEids or self.eids
+        return '/edit/event/', {
+            'eid': self.rng.choice(eids), 'title': 'Edited',
+            'participants[]': [self.randomUid() for i in xrange(5)]}
+
+    # deletes only remove what this run created, so that repeated runs see
+    # the same dataset
+    def params_delete_user(self):
+        uid = self.createdUids.pop() if self.createdUids else 0
+        return '/delete/user/', {'uid': uid}
+
+    def params_delete_event(self):
+        eid = self.createdEids.pop() if self.createdEids else 0
+        return '/delete/event/', {'eid': eid}
+
+# every app route in urls.py; creates run before edits and deletes so that
+# those have rows of their own to work on
+ROUTES = ['info/user', 'info/event', 'info/userevents', 'info/feed',
+          'info/suggestions', 'info/friendsattending', 'info/search',
+          'changes',
+          'create/user', 'create/event',
+          'edit/user', 'edit/event', 'sync/friends',
+          'delete/user', 'delete/event']
+
+def isError(statusCode, content):
+    if statusCode != 200:
+        return True
+    try:
+        return 'error' in json.loads(content)
+    except ValueError:
+        return True
+
+def runRoute(route, scenario, makeTarget, numRequests, concurrency=1):
+    '''(string, Scenario, (() -> target), int, int): dict
+
+    sends numRequests requests to route from concurrency threads, each with
+    its own target, and returns the route's latency summary
+    '''
+    latencies = []
+    errors = [0]
+    remaining = [numRequests]
+    resultsLock = threading.Lock()
+
+    def loop():
+        target = makeTarget()
+        while True:
+            with resultsLock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            path, params = scenario.params(route)
+            startTime = time.time()
+            statusCode, content = target.get(path, params)
+            latency = time.time() - startTime
+            scenario.recordResponse(route, content)
+            with resultsLock:
+                if isError(statusCode, content):
+                    errors[0] += 1
+                else:
+                    latencies.append(latency)
+
+    startTime = time.time()
+    if concurrency <= 1:
+        loop()
+    else:
+        threads = [threading.Thread(target=loop) for i in xrange(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return summarizeLatencies(latencies, errors[0], time.time() - startTime)
+
+def runLoadTest(routes=None, numRequests=200, baseUrl=None, concurrency=1,
+                seed=0, log=None):
+    '''(string list, int, string, int, int, (string -> None)): dict
+
+    drives every route (ROUTES by default) in turn, through the test client
+    or, if baseUrl is given, a running server, and returns a JSON-friendly
+    report of throughput and latency percentiles per route
+    '''
+    routes = routes or ROUTES
+    log = log or (lambda message: None)
+    scenario = Scenario(seed=seed)
+    if baseUrl:
+        makeTarget = lambda: HttpTarget(baseUrl)
+    else:
+        makeTarget = ClientTarget
+        # the test client runs views in this thread; concurrent requests
+        # would share one database connection
+        concurrency = 1
+
+    report = {
+        'started': datetime.datetime.utcnow().isoformat() + 'Z',
+        'config': {
+            'target': baseUrl or 'test-client',
+            'requests_per_route': numRequests,
+            'concurrency': concurrency,
+            'seed': seed,
+            'python': platform.python_version(),
+        },
+        'dataset': {
+            'users': AppUser.objects.count(),
+            'events': Event.objects.count(),
+        },
+        'routes': {},
+    }
+    for route in routes:
+        log("%s..." % route)
+        report['routes'][route] = runRoute(route, scenario, makeTarget,
+                                           numRequests, concurrency)
+    return report
+
+def compareReports(previous, current):
+    '''(dict, dict): dict
+
+    maps every route in both reports to the relative change of its
+    throughput and p50/p99 latencies (0.1 == 10% higher)
+    '''
+    changes = {}
+    for route, stats in current['routes'].iteritems():
+        before = previous.get('routes', {}).get(route)
+        if before is None:
+            continue
+        changes[route] = dict(
+            (key, (stats[key] - before[key]) / before[key] if before[key]
+             else 0.0)
+            for key in ('rps', 'p50_ms', 'p99_ms'))
+    return changes
@@ -0,0 +1,9 @@
+from django.db.models.signals import post_syncdb
+import eatupBackendApp.models
+from eatupBackendApp.indexes import createIndexesAfterSyncdb
+from eatupBackendApp.search import createSearchIndexAfterSyncdb
+
+# syncdb only creates the indexes django knows about; add ours to new tables
+post_syncdb.connect(createIndexesAfterSyncdb, sender=eatupBackendApp.models)
+post_syncdb.connect(createSearchIndexAfterSyncdb, 
+                    sender=eatupBackendApp.models)
@@ -0,0 +1,60 @@
+import time, random
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from eatupBackendApp import friendGraph
+from eatupBackendApp.friendGraph import FriendGraph
+from eatupBackendApp.synthData import powerLawFriendships
+from eatupBackendApp.loadTest import percentile
+
+
+def symmetricEdges(edges):
+    for a, b in edges:
+        yield a, b
+        yield b, a
+
+class Command(BaseCommand):
+    '''
+    times friend suggestions on a synthetic power-law friend graph held in
+    memory (nothing touches the database), with numpy and with the pure
+    python fallback, and reports how much memory the graph takes
+    '''
+    help = "Benchmarks the in-memory friend graph behind info/suggestions/"
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', dest='users', default=100000),
+        make_option('--friends', type='int', dest='friends', default=20,
+                    help="average number of friends per user; the defaults "
+                         "give about 1M friendships"),
+        make_option('--lookups', type='int', dest='lookups', default=500,
+                    help="suggestion lookups to time per variant"),
+        make_option('--seed', type='int', dest='seed', default=0),
+    )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        self.stdout.write("building graph of %d users...\n" % options['users'])
+        edges = powerLawFriendships(options['users'], options['friends'], rng)
+        startTime = time.time()
+        graph = FriendGraph.fromEdges(symmetricEdges(edges))
+        buildTime = time.time() - startTime
+        del edges
+        self.stdout.write("%d friendships, built in %.1fs, %.1f MB\n" % (
+            graph.numEdges(), buildTime, graph.memoryUsage() / 1048576.0))
+
+        uids = [rng.choice(graph.uids) for i in xrange(options['lookups'])]
+        variants = [('python', False)]
+        if friendGraph.numpy is not None:
+            variants.insert(0, ('numpy', True))
+        else:
+            self.stdout.write("numpy isn't installed; timing the pure python "
+                              "fallback only\n")
+        for label, useNumpy in variants:
+            latencies = []
+            for uid in uids:
+                lookupStart = time.time()
+                graph.suggestions(uid, useNumpy=useNumpy)
+                latencies.append(time.time() - lookupStart)
+            latencies.sort()
+            self.stdout.write(
+                "%-7s p50 %.2fms  p99 %.2fms  max %.2fms\n" % (
+                    label, percentile(latencies, 0.5) * 1000,
+                    percentile(latencies, 0.99) * 1000, latencies[-1] * 1000))
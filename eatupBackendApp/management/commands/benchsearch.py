@@ -0,0 +1,156 @@
+import os, time, random, bisect, shutil, sqlite3, tempfile
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from eatupBackendApp.search import (parseTerms, sqliteCreateSql, sqliteMatch,
+                                    sqliteSearchSql, DEFAULT_PAGE_SIZE)
+from eatupBackendApp.loadTest import percentile
+
+CONSONANTS = 'bcdfghjklmnprstvwz'
+VOWELS = 'aeiou'
+
+def makeVocabulary(size, rng):
+    '''(int, Random): string list
+
+    size made-up words of 2 to 4 syllables, in random order, which is their
+    rank
+    '''
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(CONSONANTS) + rng.choice(VOWELS)
+                          for i in xrange(rng.randint(2, 4))))
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+class ZipfWords(object):
+    '''
+    draws words with probability proportional to 1/rank, like the words of
+    real text
+    '''
+    def __init__(self, words, rng):
+        self.words = words
+        self.rng = rng
+        self.cumulative = []
+        total = 0.0
+        for rank in xrange(1, len(words) + 1):
+            total += 1.0 / rank
+            self.cumulative.append(total)
+
+    def draw(self, count):
+        total = self.cumulative[-1]
+        return " ".join(self.words[bisect.bisect(self.cumulative,
+                                                 self.rng.random() * total)]
+                        for i in xrange(count))
+
+def setupDatabase(path, numEvents, words):
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE event (eid INTEGER PRIMARY KEY, "
+                       "title TEXT, description TEXT)")
+    connection.executemany(
+        "INSERT INTO event (eid, title, description) VALUES (?, ?, ?)",
+        ((eventId, words.draw(words.rng.randint(2, 6)),
+          words.draw(words.rng.randint(5, 40)))
+         for eventId in xrange(1, numEvents + 1)))
+    connection.commit()
+    return connection
+
+def makeQueries(words, count, rng):
+    '''(string list, int, Random): string list
+
+    searches of one or two of words, as people type them, the last one
+    unfinished
+    '''
+    queries = []
+    for i in xrange(count):
+        text = " ".join(rng.choice(words) for j in xrange(rng.randint(1, 2)))
+        queries.append(text[:max(3, len(text) - rng.randint(0, 2))])
+    return queries
+
+# a LIKE can't use an index; every word is looked for anywhere in the text
+LIKE_SQL = ("SELECT eid FROM event WHERE %s LIMIT ?" % " AND ".join(
+    ["(title LIKE ? OR description LIKE ?)"] * 2))
+
+def likeParams(query):
+    params = []
+    for term in (parseTerms(query) * 2)[:2]:
+        params += ['%' + term + '%'] * 2
+    return params + [DEFAULT_PAGE_SIZE + 1]
+
+def timeQueries(connection, sql, queries, makeParams):
+    latencies = []
+    for query in queries:
+        startTime = time.time()
+        connection.execute(sql, makeParams(query)).fetchall()
+        latencies.append(time.time() - startTime)
+    return latencies
+
+
+class Command(BaseCommand):
+    '''
+    builds a synthetic events table in a temporary sqlite database, with
+    titles and descriptions drawn from a Zipf-distributed vocabulary, indexes
+    it the way eatupBackendApp.search does, and times the first page of
+    searches through the index against LIKE scans of the table
+    '''
+    help = "Benchmarks the full-text event search behind info/search/"
+    option_list = BaseCommand.option_list + (
+        make_option('--events', type='int', dest='events', default=1000000),
+        make_option('--words', type='int', dest='words', default=20000,
+                    help="size of the vocabulary"),
+        make_option('--queries', type='int', dest='queries', default=200,
+                    help="searches to time per variant"),
+        make_option('--scans', type='int', dest='scans', default=20,
+                    help="LIKE scans to time; each reads the whole table"),
+        make_option('--seed', type='int', dest='seed', default=0),
+    )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        words = ZipfWords(makeVocabulary(options['words'], rng), rng)
+        tempDir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempDir, 'bench.db')
+            self.stdout.write("building %d events...\n" % options['events'])
+            connection = setupDatabase(path, options['events'], words)
+            tableBytes = os.path.getsize(path)
+
+            startTime = time.time()
+            connection.execute(sqliteCreateSql('event_search'))
+            connection.execute("INSERT INTO event_search (rowid, title, "
+                               "description) SELECT eid, title, description "
+                               "FROM event")
+            connection.execute("INSERT INTO event_search (event_search) "
+                               "VALUES ('optimize')")
+            connection.commit()
+            self.stdout.write(
+                "indexed in %.1fs; table %.1f MB, index %.1f MB\n" % (
+                    time.time() - startTime, tableBytes / 1048576.0,
+                    (os.path.getsize(path) - tableBytes) / 1048576.0))
+
+            # common words are in a good part of the events, so their matches
+            # take long to rank but a LIKE finds a page of them right away;
+            # rare ones are the reverse
+            searchSql = sqliteSearchSql('event_search', False).replace('%s',
+                                                                       '?')
+            numWords = len(words.words)
+            for label, ranks in (('common', (0, numWords // 100)),
+                                 ('rare', (numWords // 10, numWords))):
+                queries = makeQueries(words.words[ranks[0]:ranks[1]],
+                                      options['queries'], rng)
+                latencies = timeQueries(
+                    connection, searchSql, queries,
+                    lambda query: (sqliteMatch(parseTerms(query)),
+                                   DEFAULT_PAGE_SIZE + 1))
+                self.report('fts5', label, latencies)
+                latencies = timeQueries(connection, LIKE_SQL,
+                                        queries[:options['scans']], likeParams)
+                self.report('like', label, latencies)
+            connection.close()
+        finally:
+            shutil.rmtree(tempDir)
+
+    def report(self, label, wordsLabel, latencies):
+        latencies.sort()
+        self.stdout.write("%-5s %-7s p50 %8.2fms  p99 %8.2fms  max %8.2fms\n" % (
+            label, wordsLabel, percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000, latencies[-1] * 1000))
@@ -0,0 +1,120 @@
+import os, time, random, shutil, sqlite3, tempfile, multiprocessing
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from eatupBackendApp.sqliteTuning import (tuneConnection, getTuning, 
+                                          runWithRetry)
+
+ROWS = 20000
+
+def setupDatabase(path):
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE event (id INTEGER PRIMARY KEY, "
+                       "title TEXT, num_votes INTEGER)")
+    connection.executemany("INSERT INTO event (title, num_votes) VALUES (?, ?)",
+                           (("event %d" % i, 0) for i in xrange(ROWS)))
+    connection.commit()
+    connection.close()
+
+def worker(args):
+    '''
+    body of one benchmark process; returns (operations, retries, failures,
+    latencies)
+    '''
+    path, role, tuning, deadline, seed = args
+    rng = random.Random(seed)
+    connection = sqlite3.connect(path)
+    if tuning is not None:
+        tuneConnection(connection, tuning)
+    counts = {'retries': 0}
+    def onRetry(error):
+        counts['retries'] += 1
+
+    def read():
+        eventId = rng.randint(1, ROWS)
+        connection.execute("SELECT title, num_votes FROM event WHERE id >= ? "
+                           "LIMIT 20", (eventId,)).fetchall()
+        # end the implicit read transaction, like django does per request
+        connection.commit()
+
+    def write():
+        try:
+            # read-then-write, the pattern our edit views follow
+            eventId = rng.randint(1, ROWS)
+            connection.execute("SELECT num_votes FROM event WHERE id = ?",
+                               (eventId,)).fetchone()
+            connection.execute("UPDATE event SET num_votes = num_votes + 1 "
+                               "WHERE id = ?", (eventId,))
+            connection.execute("INSERT INTO event (title, num_votes) "
+                               "VALUES (?, 0)", ("new event",))
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+
+    operation = read if role == 'reader' else write
+    operations = failures = 0
+    latencies = []
+    attempts = tuning['RETRY_ATTEMPTS'] if tuning is not None else 1
+    baseDelay = tuning['RETRY_BASE_DELAY'] if tuning is not None else 0
+    while time.time() < deadline:
+        startTime = time.time()
+        try:
+            runWithRetry(operation, attempts, baseDelay, onRetry=onRetry)
+            operations += 1
+            latencies.append(time.time() - startTime)
+        except sqlite3.OperationalError:
+            failures += 1
+    connection.close()
+    return role, operations, counts['retries'], failures, latencies
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks concurrent sqlite readers and writers with the default "
+            "pragmas and with settings.SQLITE_TUNING")
+    option_list = BaseCommand.option_list + (
+        make_option('--readers', type='int', dest='readers', default=6),
+        make_option('--writers', type='int', dest='writers', default=2),
+        make_option('--duration', type='float', dest='duration', default=5.0,
+                    help="seconds per configuration"),
+    )
+
+    def runConfiguration(self, name, tuning, options):
+        tempDir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempDir, 'bench.db')
+            setupDatabase(path)
+            deadline = time.time() + options['duration']
+            roles = (['reader'] * options['readers'] + 
+                     ['writer'] * options['writers'])
+            pool = multiprocessing.Pool(len(roles))
+            try:
+                results = pool.map(worker, [
+                    (path, role, tuning, deadline, i)
+                    for i, role in enumerate(roles)])
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(tempDir)
+
+        for role in ('reader', 'writer'):
+            roleResults = [r for r in results if r[0] == role]
+            operations = sum(r[1] for r in roleResults)
+            latencies = [l for r in roleResults for l in r[4]]
+            self.stdout.write("%-8s %-7s %9.1f ops/s %7d retries %7d failed "
+                              "p99 %7.1f ms\n" % (
+                name, role + 's', operations / options['duration'],
+                sum(r[2] for r in roleResults), sum(r[3] for r in roleResults),
+                percentile(latencies, 0.99) * 1000))
+
+    def handle(self, *args, **options):
+        # "before" is what a plain sqlite3.connect() gives django: rollback
+        # journal, synchronous=FULL and the default 5 second busy timeout
+        self.runConfiguration('default', None, options)
+        self.runConfiguration('tuned', getTuning(), options)
@@ -0,0 +1,45 @@
+import os, time
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from eatupBackendApp.assetBuild import buildAssets
+
+
+class Command(BaseCommand):
+    '''
+    minifies, content-hashes and gzips every .js and .css file under
+    STATIC_ROOT (run it after collectstatic); unchanged files are skipped
+    using the manifest written by the previous build
+    '''
+    args = '[root]'
+    help = ("Incrementally builds minified, content-hashed static assets "
+            "(defaults to STATIC_ROOT)")
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes', default=None,
+                    help="size of the build process pool "
+                         "(defaults to the number of cores)"),
+        make_option('--force', action='store_true', dest='force',
+                    default=False, 
+                    help="rebuild every file, ignoring the manifest"),
+    )
+    requires_model_validation = False
+
+    def handle(self, *args, **options):
+        root = args[0] if args else settings.STATIC_ROOT
+        if not os.path.isdir(root):
+            raise CommandError("%s is not a directory" % root)
+
+        startTime = time.time()
+        summary = buildAssets(root, processes=options['processes'],
+                              force=options['force'])
+        elapsed = time.time() - startTime
+
+        verbosity = int(options.get('verbosity', 1))
+        if verbosity >= 2:
+            for relPath in summary['built']:
+                self.stdout.write("built %s\n" % relPath)
+            for relPath in summary['removed']:
+                self.stdout.write("removed %s\n" % relPath)
+        self.stdout.write("%d built, %d unchanged, %d removed in %.3fs\n" % (
+            len(summary['built']), len(summary['unchanged']),
+            len(summary['removed']), elapsed))
@@ -0,0 +1,54 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from eatupBackendApp.indexes import (checkIndexes, createIndex, getHotQueries,
+                                     explainQuery, hasFullScan)
+
+
+class Command(BaseCommand):
+    '''
+    compares the live schema with the index set in eatupBackendApp.indexes;
+    with --apply, creates the missing indexes (online on postgres), and with 
+    --explain, prints the plans of the views' main queries
+    '''
+    help = ("Checks (and with --apply, creates) the indexes the views rely on; "
+            "exits with status 1 if any are missing")
+    option_list = BaseCommand.option_list + (
+        make_option('--apply', action='store_true', dest='apply',
+                    default=False, help="create the missing indexes"),
+        make_option('--explain', action='store_true', dest='explain',
+                    default=False,
+                    help="print query plans of the main view queries"),
+        make_option('--database', dest='database', default='default'),
+    )
+    requires_model_validation = False
+
+    def handle(self, *args, **options):
+        using = options['database']
+        missing = []
+        for spec, existing in checkIndexes(using):
+            if existing is None:
+                missing.append(spec)
+                status = "MISSING"
+            else:
+                status = "ok (%s)" % existing
+            self.stdout.write("%-30s %-42s %s\n" % (
+                spec.name, "%s(%s)" % (spec.table, ", ".join(spec.columns)),
+                status))
+
+        if missing and options['apply']:
+            for spec in missing:
+                self.stdout.write("%s\n" % createIndex(spec, using))
+            missing = [spec for spec, existing in checkIndexes(using)
+                       if existing is None]
+
+        if options['explain']:
+            for description, queryset in getHotQueries(using):
+                plan = explainQuery(queryset, using)
+                self.stdout.write("\n%s%s\n" % (
+                    description, " (FULL SCAN)" if hasFullScan(plan) else ""))
+                for line in plan.splitlines():
+                    self.stdout.write("    %s\n" % line)
+
+        if missing:
+            raise CommandError("%d index(es) missing; run with --apply to "
+                               "create them" % len(missing))
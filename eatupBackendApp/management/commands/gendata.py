@@ -0,0 +1,54 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from eatupBackendApp.synthData import generateDataset, deleteGeneratedData
+
+
+class Command(BaseCommand):
+    '''
+    fills the database with a reproducible synthetic dataset for benchmarks:
+    users with a power-law friend graph, and events with participants and
+    DumbLocations
+    '''
+    help = "Bulk-generates a seeded synthetic dataset for benchmarking"
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', dest='users', default=100000),
+        make_option('--friends', type='int', dest='friends', default=20,
+                    help="average number of friends per user"),
+        make_option('--events-per-user', type='float', dest='eventsPerUser',
+                    default=0.5),
+        make_option('--participants', type='int', dest='participants',
+                    default=6, help="average number of participants per event"),
+        make_option('--seed', type='int', dest='seed', default=0),
+        make_option('--database', dest='database', default='default'),
+        make_option('--no-feeds', action='store_false', dest='buildFeeds',
+                    default=True, 
+                    help="don't build the friends feeds (see rebuildfeeds)"),
+        make_option('--flush', action='store_true', dest='flush',
+                    default=False,
+                    help="delete previously generated data first"),
+    )
+
+    def handle(self, *args, **options):
+        if options['users'] <= 0:
+            raise CommandError("--users must be positive")
+        verbosity = int(options.get('verbosity', 1))
+        def log(message):
+            if verbosity >= 1:
+                self.stdout.write("%s\n" % message)
+
+        if options['flush']:
+            log("deleting previously generated data")
+            deleteGeneratedData(using=options['database'])
+
+        startTime = time.time()
+        counts = generateDataset(numUsers=options['users'],
+                                 avgFriends=options['friends'],
+                                 eventsPerUser=options['eventsPerUser'],
+                                 avgParticipants=options['participants'],
+                                 seed=options['seed'],
+                                 using=options['database'],
+                                 buildFeeds=options['buildFeeds'], log=log)
+        self.stdout.write("created %s in %.1fs\n" % (
+            ", ".join("%d %s" % (counts[name], name) for name in sorted(counts)),
+            time.time() - startTime))
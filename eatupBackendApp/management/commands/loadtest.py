@@ -0,0 +1,76 @@
+from __future__ import with_statement
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from eatupBackendApp.loadTest import ROUTES, runLoadTest, compareReports
+
+
+class Command(BaseCommand):
+    '''
+    drives every app route with synthetic requests (see gendata) and reports
+    throughput and p50/p95/p99 latency per route, optionally saving the
+    report as JSON and comparing it with an earlier one
+    '''
+    args = '[route ...]'
+    help = ("Load-tests the info/, create/, edit/ and delete/ routes through "
+            "the test client or against a running server")
+    option_list = BaseCommand.option_list + (
+        make_option('--requests', type='int', dest='requests', default=200,
+                    help="requests per route"),
+        make_option('--url', dest='url', default=None,
+                    help="base url of a running server, eg. "
+                         "http://127.0.0.1:8000 (default: test client)"),
+        make_option('--concurrency', type='int', dest='concurrency',
+                    default=1, help="client threads (only with --url)"),
+        make_option('--seed', type='int', dest='seed', default=0),
+        make_option('--output', dest='output', default=None,
+                    help="write the JSON report to this file"),
+        make_option('--compare', dest='compare', default=None,
+                    help="JSON report of an earlier run to compare with"),
+    )
+
+    def handle(self, *routes, **options):
+        for route in routes:
+            if route not in ROUTES:
+                raise CommandError("unknown route %s; choose from %s" % (
+                    route, ", ".join(ROUTES)))
+        previous = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)
+
+        verbosity = int(options.get('verbosity', 1))
+        def log(message):
+            if verbosity >= 2:
+                self.stdout.write("%s\n" % message)
+
+        try:
+            report = runLoadTest(routes=list(routes) or None,
+                                 numRequests=options['requests'],
+                                 baseUrl=options['url'],
+                                 concurrency=options['concurrency'],
+                                 seed=options['seed'], log=log)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        changes = compareReports(previous, report) if previous else {}
+        self.stdout.write("%-18s %8s %7s %8s %8s %8s %8s\n" % (
+            'route', 'req/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms',
+            'vs p50' if previous else ''))
+        for route in (routes or ROUTES):
+            stats = report['routes'][route]
+            change = ""
+            if route in changes:
+                change = "%+.0f%%" % (changes[route]['p50_ms'] * 100)
+            self.stdout.write("%-18s %8.1f %7d %8.2f %8.2f %8.2f %8s\n" % (
+                route, stats['rps'], stats['errors'], stats['p50_ms'],
+                stats['p95_ms'], stats['p99_ms'], change))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            self.stdout.write("report written to %s\n" % options['output'])
@@ -0,0 +1,44 @@
+from __future__ import with_statement
+
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from eatupBackendApp.profiling import getProfileDir, summarizeProfiles
+
+
+class Command(BaseCommand):
+    '''
+    merges the pstats files ProfilingMiddleware wrote into one collapsed
+    stack per line ("view;caller;callee microseconds"), which flamegraph.pl
+    and speedscope read, e.g.
+
+        manage.py profilesummary --view eatupBackendApp.views | flamegraph.pl
+    '''
+    help = "Summarizes the sampled view profiles as collapsed stacks"
+    option_list = BaseCommand.option_list + (
+        make_option('--dir', dest='directory', default=None,
+                    help="directory of the profiles (settings.PROFILE_DIR "
+                         "by default)"),
+        make_option('--view', dest='view', default=None,
+                    help="only the views whose dotted names start with this"),
+        make_option('--output', dest='output', default=None,
+                    help="file to write to instead of stdout"),
+    )
+
+    def handle(self, *args, **options):
+        directory = options['directory'] or getProfileDir()
+        if not directory:
+            raise CommandError("no profile directory: set PROFILE_DIR or "
+                               "pass --dir")
+        try:
+            stacks, count = summarizeProfiles(directory, options['view'])
+        except OSError as e:
+            raise CommandError(str(e))
+        lines = ["%s %d\n" % (stack, micros) for stack, micros in
+                 sorted(stacks.iteritems())]
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line)
+        self.stderr.write("%d stacks from %d profiles\n" % (len(lines), count))
@@ -0,0 +1,26 @@
+from __future__ import with_statement
+
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction, reset_queries
+from eatupBackendApp.models import Event, FeedEntry
+from eatupBackendApp.feed import refreshEventFeeds, chunks
+
+
+class Command(BaseCommand):
+    '''
+    recomputes every user's friends feed from the events, participants and
+    friendships in the database; run it once after adding the feed tables,
+    or after changing FEED_FANOUT_LIMIT
+    '''
+    help = "Rebuilds the materialized friends feeds behind info/feed/"
+
+    def handle(self, *args, **options):
+        startTime = time.time()
+        eventIds = list(Event.objects.values_list('eid', flat=True))
+        for chunk in chunks(eventIds, 5000):
+            with transaction.commit_on_success():
+                refreshEventFeeds(chunk)
+            reset_queries()
+        self.stdout.write("%d feed entries for %d events in %.1fs\n" % (
+            FeedEntry.objects.count(), len(eventIds), time.time() - startTime))
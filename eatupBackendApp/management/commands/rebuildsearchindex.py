@@ -0,0 +1,25 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from eatupBackendApp.search import isSupported, rebuildSearchIndex
+
+
+class Command(BaseCommand):
+    '''
+    builds the event search index (behind info/search/) again from the
+    events table, creating it if it's missing; for after events were written
+    around the signal handlers that keep it up to date
+    '''
+    help = "Rebuilds the full-text index of event titles and descriptions"
+    option_list = BaseCommand.option_list + (
+        make_option('--database', dest='database', default='default'),
+    )
+
+    def handle(self, *args, **options):
+        using = options['database']
+        if not isSupported(using):
+            raise CommandError("search isn't supported on this database")
+        startTime = time.time()
+        count = rebuildSearchIndex(using)
+        self.stdout.write("indexed %d events in %.1fs\n" % (
+            count, time.time() - startTime))
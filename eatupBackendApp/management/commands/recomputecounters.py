@@ -0,0 +1,26 @@
+from __future__ import with_statement
+
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from eatupBackendApp.counters import recomputeCounters
+
+
+class Command(BaseCommand):
+    '''
+    recounts the participant, location, hosting and friend counters of every
+    event and user, fixing the ones that drifted, e.g. after rows were
+    changed by hand or by a bulk write that sent no signals
+    '''
+    help = "Recounts the counter columns of events and users"
+    option_list = BaseCommand.option_list + (
+        make_option('--database', dest='database', default='default'),
+    )
+
+    def handle(self, *args, **options):
+        log = lambda message: self.stdout.write("%s\n" % message)
+        startTime = time.time()
+        with transaction.commit_on_success(using=options['database']):
+            fixed = recomputeCounters(options['database'], log=log)
+        log("%d counters fixed in %.1fs" % (fixed, time.time() - startTime))
@@ -0,0 +1,45 @@
+import signal
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from eatupBackendApp.changeFeed import ChangeFeed, ChangeFeedServer
+
+
+class Command(BaseCommand):
+    '''
+    runs the long-poll sidecar for changes/: a single-threaded server that
+    holds every waiting client's connection open and reads the change log
+    once per poll interval for all of them
+
+    route /changes/ to it ahead of the app servers; the app's own changes/
+    view answers the same requests without waiting
+    '''
+    help = "Serves long-polling /changes/ requests off the change log"
+    option_list = BaseCommand.option_list + (
+        make_option('--host', dest='host', default='0.0.0.0'),
+        make_option('--port', type='int', dest='port', default=8001),
+        make_option('--poll-interval', type='float', dest='pollInterval',
+                    default=0.5,
+                    help="seconds between reads of the change log"),
+        make_option('--buffer', type='int', dest='bufferSize',
+                    default=100000,
+                    help="log entries kept in memory for clients to catch "
+                         "up from"),
+        make_option('--database', dest='database', default='default'),
+    )
+
+    def handle(self, *args, **options):
+        feed = ChangeFeed(bufferSize=options['bufferSize'],
+                          using=options['database'])
+        server = ChangeFeedServer(options['host'], options['port'], feed,
+                                  pollInterval=options['pollInterval'])
+
+        def stop(signum, frame):
+            server.running = False
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        self.stdout.write("serving /changes/ on %s:%d from log entry %d\n" % (
+            options['host'], options['port'], feed.head))
+        server.serveForever()
+        self.stdout.write("stopped with %d clients waiting\n" %
+                          feed.numWaiting())
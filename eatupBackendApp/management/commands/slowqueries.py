@@ -0,0 +1,46 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from eatupBackendApp.slowQueries import getLogPath, summarizeSlowQueries
+
+
+class Command(BaseCommand):
+    '''
+    ranks the query shapes in the slow query log (and its rotated files) by
+    the total time they took, with the views and lines that ran them and
+    their plan
+    '''
+    help = "Summarizes the slow query log, slowest query shapes first"
+    option_list = BaseCommand.option_list + (
+        make_option('--log', dest='log', default=None,
+                    help="the slow query log (settings.SLOW_QUERY_LOG by "
+                         "default)"),
+        make_option('--limit', dest='limit', type='int', default=10,
+                    help="how many query shapes to show"),
+    )
+
+    def handle(self, *args, **options):
+        path = options['log'] or getLogPath()
+        if not path:
+            raise CommandError("no slow query log: set SLOW_QUERY_LOG or "
+                               "pass --log")
+        try:
+            summaries, count = summarizeSlowQueries(path)
+        except (EnvironmentError, KeyError) as e:
+            raise CommandError(str(e))
+        for rank, summary in enumerate(summaries[:options['limit']]):
+            self.stdout.write(
+                "%d. %.3fs in %d queries (%.3fs max, %.3fs average)\n" % (
+                    rank + 1, summary['seconds'], summary['count'],
+                    summary['max_seconds'], summary['avg_seconds']))
+            self.stdout.write("   %s\n" % summary['shape'])
+            for title in ('views', 'sites'):
+                self.stdout.write("   %s: %s\n" % (title, ", ".join(
+                    "%s (%d)" % (name, times)
+                    for name, times in summary[title].most_common(3))))
+            if summary['plan']:
+                self.stdout.write("   plan:\n")
+                for line in summary['plan']:
+                    self.stdout.write("     %s\n" % line)
+            self.stdout.write("\n")
+        self.stderr.write("%d query shapes from %d slow queries\n" % (
+            len(summaries), count))
@@ -0,0 +1,34 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from eatupBackendApp.schema import upgradeSchema
+from eatupBackendApp.sync import pruneTombstones
+from eatupBackendApp.changeFeed import pruneChangeLog
+
+
+class Command(BaseCommand):
+    '''
+    adds the tables, columns and indexes newer versions of the app need to
+    an existing database, which syncdb won't do, and backfills them
+    '''
+    help = "Adds missing tables, columns and indexes to an existing database"
+    option_list = BaseCommand.option_list + (
+        make_option('--database', dest='database', default='default'),
+        make_option('--prune', action='store_true', dest='prune',
+                    default=False,
+                    help="also delete tombstones older than "
+                         "SYNC_TOMBSTONE_DAYS and change log entries older "
+                         "than CHANGE_LOG_DAYS"),
+    )
+
+    def handle(self, *args, **options):
+        log = lambda message: self.stdout.write("%s\n" % message)
+        try:
+            upgradeSchema(options['database'], log=log)
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['prune']:
+            count = pruneTombstones(using=options['database'])
+            log("pruned %d tombstones" % count)
+            count = pruneChangeLog(using=options['database'])
+            log("pruned %d change log entries" % count)
+        log("schema is up to date")
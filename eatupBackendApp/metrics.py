@@ -0,0 +1,580 @@
+from __future__ import with_statement
+
+import os, mmap, errno, fcntl, struct, bisect, logging, threading
+from collections import OrderedDict
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from annoying.functions import get_config
+
+logger = logging.getLogger(__name__)
+
+# seconds
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+# bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+EXPOSITION_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def getViewName(viewFunc):
+    return "%s.%s" % (getattr(viewFunc, '__module__', '?'),
+                      getattr(viewFunc, '__name__',
+                              viewFunc.__class__.__name__))
+
+def formatValue(value):
+    '''(float): string
+
+    a sample value or bucket bound the way the Prometheus text format spells
+    it
+    '''
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+### values of this process ###
+
+class InMemoryValues(object):
+    '''
+    the values of this process' samples, when settings.METRICS_DIR isn't set
+    and nothing else can see them
+    '''
+    def __init__(self):
+        self.values = {}
+
+    def add(self, key, amount):
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def set(self, key, value):
+        self.values[key] = float(value)
+
+    def items(self):
+        return self.values.items()
+
+
+# a values file starts with the number of bytes of it in use, followed by
+# entries of a key length, the key as JSON padded to 8 bytes, and the value
+HEADER = struct.Struct('<Q')
+KEY_LENGTH = struct.Struct('<I')
+VALUE = struct.Struct('<d')
+INITIAL_FILE_SIZE = 64 * 1024
+
+def padded(length):
+    return (length + 7) & ~7
+
+def encodeKey(key):
+    kind, name, labelNames, labelValues, field = key
+    return json.dumps([kind, name, labelNames, labelValues, field])
+
+def decodeKey(data):
+    kind, name, labelNames, labelValues, field = json.loads(data)
+    return (kind, name, tuple(labelNames), tuple(labelValues), field)
+
+def readEntries(data, used):
+    '''(buffer, int): (tuple, int) list
+
+    the keys in the first used bytes of a values file, with the offsets of
+    their values
+    '''
+    entries = []
+    position = HEADER.size
+    while position + KEY_LENGTH.size <= used:
+        keyLength = KEY_LENGTH.unpack_from(data, position)[0]
+        start = position + KEY_LENGTH.size
+        valuePosition = position + padded(KEY_LENGTH.size + keyLength)
+        entries.append((decodeKey(data[start:start + keyLength]),
+                        valuePosition))
+        position = valuePosition + VALUE.size
+    return entries
+
+def readValuesFile(path):
+    '''(string): (tuple, float) list
+
+    the samples in a values file, as one process last wrote them
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        return []
+    used = min(HEADER.unpack_from(data, 0)[0], len(data))
+    return [(key, VALUE.unpack_from(data, position)[0])
+            for key, position in readEntries(data, used)]
+
+
+class MmapValues(object):
+    '''
+    the values of this process' samples, in a file of its own that it keeps
+    memory-mapped, so that any process can read every worker's numbers from
+    settings.METRICS_DIR
+
+    only this process writes the file; an entry is complete before the header
+    counts it in, so readers never see half of one
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        self.size = max(os.fstat(self.fd).st_size, INITIAL_FILE_SIZE)
+        os.ftruncate(self.fd, self.size)
+        self.map = mmap.mmap(self.fd, self.size)
+        # a file left by an earlier process with the same pid is carried on,
+        # but its gauges were that process' and start over
+        self.used = HEADER.unpack_from(self.map, 0)[0] or HEADER.size
+        self.positions = dict(readEntries(self.map, self.used))
+        for key, position in self.positions.iteritems():
+            if key[0] == 'gauge':
+                VALUE.pack_into(self.map, position, 0.0)
+
+    def grow(self, needed):
+        self.map.close()
+        self.size = max(self.size * 2, padded(self.used + needed))
+        os.ftruncate(self.fd, self.size)
+        self.map = mmap.mmap(self.fd, self.size)
+
+    def position(self, key):
+        position = self.positions.get(key)
+        if position is not None:
+            return position
+        data = encodeKey(key)
+        valueOffset = padded(KEY_LENGTH.size + len(data))
+        if self.used + valueOffset + VALUE.size > self.size:
+            self.grow(valueOffset + VALUE.size)
+        start = self.used
+        KEY_LENGTH.pack_into(self.map, start, len(data))
+        self.map[start + KEY_LENGTH.size:start + KEY_LENGTH.size + len(data)] \
+            = data
+        position = start + valueOffset
+        VALUE.pack_into(self.map, position, 0.0)
+        self.used = position + VALUE.size
+        HEADER.pack_into(self.map, 0, self.used)
+        self.positions[key] = position
+        return position
+
+    def add(self, key, amount):
+        position = self.position(key)
+        VALUE.pack_into(self.map, position,
+                        VALUE.unpack_from(self.map, position)[0] + amount)
+
+    def set(self, key, value):
+        VALUE.pack_into(self.map, self.position(key), float(value))
+
+    def items(self):
+        return [(key, VALUE.unpack_from(self.map, position)[0])
+                for key, position in self.positions.iteritems()]
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+VALUES_PREFIX = 'metrics_'
+VALUES_SUFFIX = '.db'
+# the counters and histograms of processes that have exited, added up
+ARCHIVE_FILENAME = 'metrics_archive.db'
+# taken shared by a process opening its values file, and exclusively to
+# archive the files of exited processes
+LOCK_FILENAME = 'metrics.lock'
+
+def getMetricsDir():
+    return get_config('METRICS_DIR', None)
+
+def valuesFilename(pid):
+    return "%s%d%s" % (VALUES_PREFIX, pid, VALUES_SUFFIX)
+
+def pidOfFilename(filename):
+    if not (filename.startswith(VALUES_PREFIX) and
+            filename.endswith(VALUES_SUFFIX)):
+        return None
+    try:
+        return int(filename[len(VALUES_PREFIX):-len(VALUES_SUFFIX)])
+    except ValueError:
+        return None
+
+def isAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+class DirectoryLock(object):
+    '''
+    a lock on settings.METRICS_DIR, shared by default, for a with statement
+    '''
+    def __init__(self, directory, exclusive=False):
+        self.path = os.path.join(directory, LOCK_FILENAME)
+        self.operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+
+    def __enter__(self):
+        self.lock = open(self.path, 'a')
+        fcntl.flock(self.lock.fileno(), self.operation)
+
+    def __exit__(self, *excInfo):
+        # closing releases it
+        self.lock.close()
+
+def archiveExitedProcesses(directory):
+    '''(string): None
+
+    adds the counters and histograms in the values files of processes that
+    have exited to the archive file, and deletes their files (and gauges);
+    with the directory locked exclusively, so that a process reusing one of
+    those pids can't open its file meanwhile
+    '''
+    archive = None
+    try:
+        for filename in os.listdir(directory):
+            pid = pidOfFilename(filename)
+            if pid is None or isAlive(pid):
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                samples = readValuesFile(path)
+            except (EnvironmentError, ValueError, struct.error):
+                continue
+            if archive is None:
+                archive = MmapValues(os.path.join(directory, ARCHIVE_FILENAME))
+            for key, value in samples:
+                if key[0] != 'gauge':
+                    archive.add(key, value)
+            os.remove(path)
+    finally:
+        if archive is not None:
+            archive.close()
+
+_valuesLock = threading.Lock()
+# ((pid, METRICS_DIR), values); a forked child starts over rather than write
+# into the parent's values
+_values = [None, None]
+
+def getValues():
+    # with _valuesLock held
+    pid = os.getpid()
+    directory = getMetricsDir()
+    if _values[0] != (pid, directory):
+        if _values[0] and _values[0][0] == pid and \
+                isinstance(_values[1], MmapValues):
+            _values[1].close()
+        values = None
+        if directory:
+            try:
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                with DirectoryLock(directory):
+                    values = MmapValues(os.path.join(directory,
+                                                     valuesFilename(pid)))
+            except EnvironmentError:
+                # metrics must not fail requests
+                logger.warning("can't share metrics through %s", directory,
+                               exc_info=True)
+        _values[0], _values[1] = (pid, directory), values or InMemoryValues()
+    return _values[1]
+
+def resetValues():
+    '''
+    forgets this process' values, and deletes their file; for tests
+    '''
+    with _valuesLock:
+        values = _values[1]
+        if _values[0] and _values[0][0] == os.getpid() and \
+                isinstance(values, MmapValues):
+            values.close()
+            try:
+                os.remove(values.path)
+            except OSError:
+                pass
+        _values[0], _values[1] = None, None
+
+def clearMetricsDir():
+    '''
+    deletes the values files and the archive in settings.METRICS_DIR; the
+    pre-forking server calls it before it starts its workers, so that the
+    numbers of an earlier run aren't added in
+    '''
+    directory = getMetricsDir()
+    if not directory or not os.path.isdir(directory):
+        return
+    for filename in os.listdir(directory):
+        if pidOfFilename(filename) is not None or \
+                filename == ARCHIVE_FILENAME:
+            try:
+                os.remove(os.path.join(directory, filename))
+            except OSError:
+                pass
+
+### metrics ###
+
+# name -> metric, for their help text and buckets
+_metrics = OrderedDict()
+
+class Metric(object):
+    '''
+    a named family of samples, one per combination of values of its labels,
+    given as a tuple in labelNames' order
+    '''
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelNames=()):
+        if name in _metrics:
+            raise ValueError("there already is a metric named %s" % name)
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labelNames)
+        _metrics[name] = self
+
+    def key(self, labelValues, field=''):
+        if len(labelValues) != len(self.labelNames):
+            raise ValueError("%s takes the labels %s" % (
+                self.name, ", ".join(self.labelNames)))
+        return (self.kind, self.name, self.labelNames, tuple(labelValues),
+                field)
+
+    def add(self, labelValues, amount):
+        key = self.key(labelValues)
+        with _valuesLock:
+            getValues().add(key, amount)
+
+
+class Counter(Metric):
+    '''
+    a total that only goes up; summed over processes
+    '''
+    kind = 'counter'
+
+    def inc(self, labelValues=(), amount=1):
+        if amount < 0:
+            raise ValueError("counters can't go down")
+        self.add(labelValues, amount)
+
+
+class Gauge(Metric):
+    '''
+    a value that goes up and down; every live process' is shown with a pid
+    label
+    '''
+    kind = 'gauge'
+
+    def inc(self, labelValues=(), amount=1):
+        self.add(labelValues, amount)
+
+    def set(self, value, labelValues=()):
+        key = self.key(labelValues)
+        with _valuesLock:
+            getValues().set(key, value)
+
+
+class Histogram(Metric):
+    '''
+    counts of observations at or under fixed bucket bounds, with their sum;
+    summed over processes
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelNames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelNames)
+        self.buckets = sorted(float(bound) for bound in buckets
+                              if bound != float('inf'))
+        self.bucketNames = [formatValue(bound) for bound in self.buckets] + \
+                           ['+Inf']
+
+    def observe(self, value, labelValues=()):
+        # every observation counts in one bucket; they're added up when shown
+        bucket = self.bucketNames[bisect.bisect_left(self.buckets, value)]
+        bucketKey = self.key(labelValues, bucket)
+        sumKey = self.key(labelValues, 'sum')
+        countKey = self.key(labelValues, 'count')
+        with _valuesLock:
+            values = getValues()
+            values.add(bucketKey, 1)
+            values.add(sumKey, value)
+            values.add(countKey, 1)
+
+### what the app measures ###
+
+VIEW_SECONDS = Histogram('eatup_view_seconds',
+    "Time spent in json_response views.", ('view',))
+VIEW_DB_SECONDS = Histogram('eatup_view_db_seconds',
+    "Time json_response views spent in SQL queries.", ('view',))
+VIEW_RESPONSE_BYTES = Histogram('eatup_view_response_bytes',
+    "Size of the responses of json_response views.", ('view',),
+    buckets=SIZE_BUCKETS)
+VIEW_ERRORS = Counter('eatup_view_errors_total',
+    "json_response views that answered with an error object (kind=error) or "
+    "raised (kind=<exception class>).", ('view', 'kind'))
+DB_QUERIES = Counter('eatup_db_queries_total',
+    "SQL statements run.", ('database',))
+DB_SECONDS = Counter('eatup_db_seconds_total',
+    "Time spent in SQL statements.",
+    ('database',))
+CACHE_LOOKUPS = Counter('eatup_cache_lookups_total',
+    "Lookups in in-process caches, by result (hit or miss).",
+    ('cache', 'result'))
+CACHE_BYTES = Gauge('eatup_cache_bytes',
+    "Bytes held by in-process caches.", ('cache',))
+
+def recordCacheLookup(cache, hit):
+    CACHE_LOOKUPS.inc((cache, 'hit' if hit else 'miss'))
+
+_dbTime = threading.local()
+
+def getDbSeconds():
+    '''(): float
+
+    the time this thread has spent in SQL statements, for differences
+    '''
+    return getattr(_dbTime, 'seconds', 0.0)
+
+def recordQuery(database, seconds):
+    _dbTime.seconds = getDbSeconds() + seconds
+    DB_QUERIES.inc((database,))
+    DB_SECONDS.inc((database,), seconds)
+
+def errorKindOf(objects):
+    '''(object): string or None
+
+    'error' for the error objects views answer with
+    '''
+    if isinstance(objects, dict) and ('error' in objects or
+                                      objects.get('status') == 'error'):
+        return 'error'
+    return None
+
+def recordView(viewName, seconds, dbSeconds, response, errorKind=None):
+    '''(string, float, float, HttpResponse, string): None
+
+    counts a view's answer; response is None when it raised
+    '''
+    VIEW_SECONDS.observe(seconds, (viewName,))
+    VIEW_DB_SECONDS.observe(dbSeconds, (viewName,))
+    # streamed responses can only be read once
+    if response is not None and \
+            not getattr(response, '_base_content_is_iter', False):
+        VIEW_RESPONSE_BYTES.observe(len(response.content), (viewName,))
+    if errorKind is not None:
+        VIEW_ERRORS.inc((viewName, errorKind))
+
+
+### exposition ###
+
+def collectSamples():
+    '''(): {tuple: float}
+
+    every process' samples: counters and histograms summed over the values
+    files in settings.METRICS_DIR and the archive of exited processes, gauges
+    of live processes with a pid label; only this process' without
+    METRICS_DIR
+
+    the values files of exited processes are archived first, so that there's
+    never more than a file per live process to read
+    '''
+    directory = getMetricsDir()
+    if not directory:
+        with _valuesLock:
+            return dict(getValues().items())
+    if not os.path.isdir(directory):
+        return {}
+    with DirectoryLock(directory, exclusive=True):
+        archiveExitedProcesses(directory)
+        return readSamples(directory)
+
+def readSamples(directory):
+    '''(string): {tuple: float}
+
+    the samples of the values files and the archive in directory
+    '''
+    totals = {}
+    for filename in os.listdir(directory):
+        pid = pidOfFilename(filename)
+        if pid is None and filename != ARCHIVE_FILENAME:
+            continue
+        try:
+            samples = readValuesFile(os.path.join(directory, filename))
+        except (EnvironmentError, ValueError, struct.error):
+            # removed while reading, or not a values file
+            continue
+        alive = None
+        for key, value in samples:
+            kind, name, labelNames, labelValues, field = key
+            if kind == 'gauge' and pid is not None:
+                if alive is None:
+                    alive = isAlive(pid)
+                if not alive:
+                    continue
+                key = (kind, name, labelNames + ('pid',),
+                       labelValues + (str(pid),), field)
+            totals[key] = totals.get(key, 0.0) + value
+    return totals
+
+def escapeLabelValue(value):
+    return unicode(value).replace('\\', '\\\\').replace('\n', '\\n') \
+                         .replace('"', '\\"')
+
+def formatLabels(labelNames, labelValues):
+    if not labelNames:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escapeLabelValue(value))
+                             for name, value in zip(labelNames, labelValues))
+
+def bucketOrder(bound):
+    return float(bound)
+
+def renderSamples(samples):
+    '''({tuple: float}): string
+
+    samples in the Prometheus text exposition format
+    '''
+    # name -> (kind, (label names, label values) -> {field: value})
+    families = {}
+    for (kind, name, labelNames, labelValues, field), value in \
+            samples.iteritems():
+        kind, series = families.setdefault(name, (kind, {}))
+        series.setdefault((labelNames, labelValues), {})[field] = value
+
+    lines = []
+    for name in sorted(families):
+        kind, series = families[name]
+        metric = _metrics.get(name)
+        if metric is not None:
+            lines.append('# HELP %s %s' % (name, metric.documentation
+                         .replace('\\', '\\\\').replace('\n', '\\n')))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for (labelNames, labelValues), fields in sorted(series.iteritems()):
+            if kind != 'histogram':
+                lines.append('%s%s %s' % (
+                    name, formatLabels(labelNames, labelValues),
+                    formatValue(fields.get('', 0.0))))
+                continue
+            bounds = set(field for field in fields
+                         if field not in ('sum', 'count'))
+            if isinstance(metric, Histogram):
+                bounds.update(metric.bucketNames)
+            cumulative = 0.0
+            for bound in sorted(bounds, key=bucketOrder):
+                cumulative += fields.get(bound, 0.0)
+                lines.append('%s_bucket%s %s' % (
+                    name, formatLabels(labelNames + ('le',),
+                                       labelValues + (bound,)),
+                    formatValue(cumulative)))
+            labels = formatLabels(labelNames, labelValues)
+            lines.append('%s_sum%s %s' % (name, labels,
+                                         formatValue(fields.get('sum', 0.0))))
+            lines.append('%s_count%s %s' % (
+                name, labels, formatValue(fields.get('count', 0.0))))
+    return u'\n'.join(lines) + u'\n'
+
+def showMetrics(request):
+    '''
+    every process' metrics for Prometheus; when settings.METRICS_TOKEN is set
+    the scraper has to send it as "Authorization: Bearer <token>"
+    '''
+    token = get_config('METRICS_TOKEN', '')
+    if token and not constant_time_compare(
+            request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer ' + token):
+        return HttpResponseForbidden()
+    return HttpResponse(renderSamples(collectSamples()).encode('utf-8'),
+                        content_type=EXPOSITION_CONTENT_TYPE)
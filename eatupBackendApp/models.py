@@ -6,9 +6,53 @@ try:
 except ImportError:
     import simplejson as json
 from django.forms.models import model_to_dict
-from django.core import serializers
-import calendar
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import is_protected_type
+import calendar, datetime, decimal
 from django.utils.timezone import is_aware
+from django.db.backends.signals import connection_created
+from eatupBackendApp.sqliteTuning import applySqlitePragmas
+from eatupBackendApp.backends.instrumentation import instrumentConnection
+
+_jsonEncoder = DjangoJSONEncoder()
+
+def jsonFieldValue(obj, field):
+    '''(models.Model, Field): JSON-friendly value
+
+    returns a field's value the way django's json serializer writes it:
+    numbers and None as is, dates and times as ISO 8601 strings, everything
+    else as a unicode string
+    '''
+    return jsonValue(field, field._get_val_from_obj(obj), obj)
+
+def jsonValue(field, value, obj):
+    '''(Field, object, object): JSON-friendly value
+
+    like jsonFieldValue, for a value already read from obj, which only needs
+    an attribute of the field's attname (eatupBackendApp.jsonRows passes rows)
+    '''
+    if not is_protected_type(value):
+        return field.value_to_string(obj)
+    if isinstance(value, (datetime.date, datetime.time, decimal.Decimal)):
+        return _jsonEncoder.default(value)
+    return value
+
+class CounterField(models.IntegerField):
+    '''
+    a count of related rows kept by eatupBackendApp.counters with database-side
+    increments: save() never writes it back (an UPDATE sets it to itself), so
+    that an instance loaded before a change can't undo it, and it isn't
+    editable in forms
+    '''
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('default', 0)
+        kwargs.setdefault('editable', False)
+        super(CounterField, self).__init__(*args, **kwargs)
+
+    def pre_save(self, modelInstance, add):
+        if add:
+            return super(CounterField, self).pre_save(modelInstance, add)
+        return models.F(self.attname)
 
 class JsonableModel(models.Model):
     class Meta:
@@ -21,19 +65,25 @@ class JsonableModel(models.Model):
         idName = getattr(self, 'idName', None)
         extraFieldNames = getattr(self, 'extraFieldNames', [])
         
-        # get default serialized json dictionary for object instance
-        # note that because the serializer requires an iterable and we only have
-        # a single instance, we must create a singleton tuple for serialization,
-        # then get it back through index[0]
-        jsonDict = json.loads(serializers.serialize('json', (self,)))[0]
-        assert 'fields' in jsonDict
-        
-        # replace with dictionary object's actual field names and their values
-        jsonDict = jsonDict['fields']
+        # build the same dictionary django's json serializer would give as
+        # 'fields', but straight from the instance: foreign keys become their
+        # raw ids (no query), and to-many fields are only read when they are 
+        # actually embedded below, which lets callers prefetch them
+        jsonDict = {}
+        for field in self._meta.local_fields:
+            if field.primary_key:
+                continue
+            jsonDict[field.name] = jsonFieldValue(self, field)
+        for field in self._meta.local_many_to_many:
+            if field.name in allToManyFields:
+                # filled in (or removed) below
+                jsonDict[field.name] = None
+            else:
+                jsonDict[field.name] = [related.pk for related in 
+                                        getattr(self, field.name).all()]
         
         # make sure to use .keys, since we'll be editing the dictionary as we go
         for fieldName in (jsonDict.keys() + extraFieldNames):
-            fieldVal = getattr(self, fieldName)
             # only show one level of recursion for any manyToMany or oneToMany
             # relations
             if fieldName in allToManyFields:
@@ -47,13 +97,14 @@ class JsonableModel(models.Model):
                     # d['participants'] = map(<...>, self.participants.all())
                     jsonDict[fieldName] = map(
                         lambda obj: obj.getDictForJson(inline=True), 
-                        fieldVal.all()
+                        getattr(self, fieldName).all()
                     )
             # replace image filenames with actual domain-relative urls
-            elif fieldName in imageFields and fieldVal:
-                jsonDict[fieldName] = fieldVal.url
+            elif fieldName in imageFields and getattr(self, fieldName):
+                jsonDict[fieldName] = getattr(self, fieldName).url
             #add a <fieldname>_raw field to the json dict with the raw timestamp
             elif fieldName in rawTimeFields:
+                fieldVal = getattr(self, fieldName)
                 rawFieldName = ("%s_raw" % fieldName)
                 assert rawFieldName not in jsonDict
                 # correct way to convert to UTC timestamp from here:
@@ -69,6 +120,19 @@ class JsonableModel(models.Model):
             jsonDict[idName] = self.pk
         return jsonDict
 
+    @classmethod
+    def jsonQuerySet(cls, queryset=None):
+        '''(QuerySet): QuerySet
+
+        returns the given queryset (all objects by default) with every to-many
+        relation that getDictForJson embeds prefetched, so that serializing
+        any number of its objects takes a fixed number of queries
+        '''
+        if queryset is None:
+            queryset = cls.objects.all()
+        allToManyFields = getattr(cls, 'allToManyFields', set())
+        return queryset.prefetch_related(*sorted(allToManyFields))
+
 class Event(JsonableModel):
     eid = models.AutoField(primary_key=True)
     title = models.CharField(max_length=128, blank=True)
@@ -78,6 +142,15 @@ class Event(JsonableModel):
     host = models.ForeignKey('AppUser', related_name="hosting")
     participants = models.ManyToManyField('AppUser', blank=True)
     
+    # null for rows from before these were tracked (see `manage.py 
+    # upgradeschema`)
+    created_at = models.DateTimeField(auto_now_add=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True, null=True)
+    
+    # see eatupBackendApp/counters.py
+    participant_count = CounterField()
+    location_count = CounterField()
+    
     extraFieldNames = ["locations"]
     allToManyFields = {'participants', 'locations'}
     
@@ -112,6 +185,10 @@ class AppUser(JsonableModel):
                                           
     friends = models.ManyToManyField('self', related_name="friends", blank=True) 
     
+    # see eatupBackendApp/counters.py
+    hosting_count = CounterField()
+    friend_count = CounterField()
+    
     extraFieldNames = ["hosting"]
     allToManyFields = {'participating', 'friends', "hosting"}
     #imageFields = {'prof_pic'}
@@ -141,5 +218,92 @@ class DumbLocation(JsonableModel):
     
     eventHere = models.ForeignKey(Event, related_name="locations", 
                                   null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True, null=True)
+    
     def __unicode__(self):
         return u"(id: %s) %s " % (self.id, self.friendly_name)
+
+
+# materialized "what are my friends doing" feed, maintained on write by
+# eatupBackendApp.feed: one row per (user, event) where a friend of the user
+# takes part in the event
+class FeedEntry(models.Model):
+    user = models.ForeignKey(AppUser, related_name="feedEntries")
+    event = models.ForeignKey(Event, related_name="feedEntries")
+    # copy of event.date_time, so that a feed page is one range scan of the
+    # (user, date_time) index
+    date_time = models.DateTimeField()
+    
+    class Meta:
+        unique_together = ('user', 'event')
+        verbose_name_plural = "feed entries"
+        
+    def __unicode__(self):
+        return u"%s: %s" % (self.user_id, self.event_id)
+
+# users with too many friends to fan their events out to; their friends'
+# feeds pick up their events when read instead
+class PulledFeedUser(models.Model):
+    user = models.OneToOneField(AppUser, primary_key=True, 
+                                related_name="pulledFeed")
+    
+    def __unicode__(self):
+        return u"%s" % self.user_id
+
+# what changed in the events of each user, for delta syncs of
+# info/userevents/, maintained by eatupBackendApp.sync: one row per (user, 
+# event) the user takes or took part in, stamped whenever anything the event's
+# json shows changes; rows of events the user left, or that were deleted, stay
+# behind as tombstones (removed=True) until they are pruned
+class EventChange(models.Model):
+    user = models.ForeignKey(AppUser, related_name="eventChanges")
+    # not a foreign key, so that tombstones outlive their events
+    eid = models.IntegerField()
+    changed_at = models.DateTimeField()
+    removed = models.BooleanField(default=False)
+    
+    class Meta:
+        unique_together = ('user', 'eid')
+        
+    def __unicode__(self):
+        return u"%s: %s%s at %s" % (self.user_id, self.eid, 
+                                    " (removed)" if self.removed else "",
+                                    self.changed_at)
+
+# append-only log of which user should hear about which event, written in the
+# same transaction as the change by eatupBackendApp.sync; the ids are the
+# cursors of the long-poll changes/ endpoint (see eatupBackendApp/changeFeed.py)
+class ChangeLogEntry(models.Model):
+    # plain values rather than foreign keys: the log is never rewritten when
+    # users or events go away
+    uid = models.BigIntegerField()
+    eid = models.IntegerField()
+    created_at = models.DateTimeField()
+    
+    class Meta:
+        verbose_name_plural = "change log entries"
+        
+    def __unicode__(self):
+        return u"#%s %s: %s" % (self.id, self.uid, self.eid)
+
+# tune every new sqlite connection (WAL journal, busy timeout, mmap, ...)
+connection_created.connect(applySqlitePragmas)
+
+# time every statement, for the metrics and the slow query log
+connection_created.connect(instrumentConnection)
+
+# keep the feed tables up to date (see eatupBackendApp/feed.py)
+import eatupBackendApp.feed
+
+# keep the in-memory friend graph up to date (see eatupBackendApp/friendGraph.py)
+import eatupBackendApp.friendGraph
+
+# keep the event change log up to date (see eatupBackendApp/sync.py)
+import eatupBackendApp.sync
+
+# keep the counter columns up to date (see eatupBackendApp/counters.py)
+import eatupBackendApp.counters
+
+# keep the event search index up to date (see eatupBackendApp/search.py)
+import eatupBackendApp.search
@@ -0,0 +1,230 @@
+import os, time, random, itertools, cProfile, pstats, sys
+from django.utils.crypto import constant_time_compare
+from annoying.functions import get_config
+from eatupBackendApp.queryStats import getViewName
+
+# requests with this header set to settings.PROFILE_HEADER_TOKEN are always
+# profiled
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+
+# bytes of profiles kept (settings.PROFILE_DIR_MAX_BYTES); the oldest go first
+DEFAULT_DIR_MAX_BYTES = 100 * 1024 * 1024
+
+PROFILE_SUFFIX = '.pstats'
+
+_sequence = itertools.count()
+
+def isSampled(request):
+    '''(HttpRequest): bool
+
+    whether to profile the request: a PROFILE_SAMPLE_RATE fraction of them,
+    and those that carry the PROFILE_HEADER_TOKEN
+    '''
+    token = request.META.get(PROFILE_HEADER)
+    if token is not None:
+        expected = get_config('PROFILE_HEADER_TOKEN', '')
+        if expected and constant_time_compare(token, expected):
+            return True
+    sampleRate = get_config('PROFILE_SAMPLE_RATE', 0.0)
+    return sampleRate > 0 and (sampleRate >= 1 or random.random() < sampleRate)
+
+### the profile directory ###
+
+def getProfileDir():
+    return get_config('PROFILE_DIR', None)
+
+def profileFilename(viewName):
+    # <view>.<milliseconds>.<pid>.<sequence>.pstats, so that they sort by
+    # time and processes and threads never write the same one
+    return "%s.%d.%d.%d%s" % (viewName, int(time.time() * 1000), os.getpid(),
+                              _sequence.next(), PROFILE_SUFFIX)
+
+def viewOfFilename(filename):
+    return filename[:-len(PROFILE_SUFFIX)].rsplit('.', 3)[0]
+
+def listProfiles(directory):
+    '''(string): (string, int, float) list
+
+    (path, size, modification time) of the profiles in directory, oldest
+    first
+    '''
+    profiles = []
+    for filename in os.listdir(directory):
+        if not filename.endswith(PROFILE_SUFFIX):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            info = os.stat(path)
+        except OSError:
+            # rotated away by another process
+            continue
+        profiles.append((path, info.st_size, info.st_mtime))
+    profiles.sort(key=lambda profile: (profile[2], profile[0]))
+    return profiles
+
+def saveProfile(profiler, viewName, directory, maxBytes):
+    '''(cProfile.Profile, string, string, int): string
+
+    writes the profiler's stats to a new file in directory, deletes the
+    oldest ones while they take more than maxBytes, and returns the new
+    file's name
+    '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filename = profileFilename(viewName)
+    path = os.path.join(directory, filename)
+    # renamed into place, so that readers never see half a file
+    profiler.dump_stats(path + '.tmp')
+    os.rename(path + '.tmp', path)
+
+    profiles = listProfiles(directory)
+    total = sum(size for path, size, mtime in profiles)
+    for oldPath, size, mtime in profiles[:-1]:
+        if total <= maxBytes:
+            break
+        try:
+            os.remove(oldPath)
+        except OSError:
+            pass
+        total -= size
+    return filename
+
+### middleware ###
+
+class ProfilingMiddleware(object):
+    '''
+    runs the views of sampled requests (see isSampled) under cProfile and
+    saves a pstats file per request in settings.PROFILE_DIR, named after the
+    view; `manage.py profilesummary` merges them
+
+    requests that aren't sampled cost a header lookup and a random number.
+    it should come last in MIDDLEWARE_CLASSES, since it calls the view itself
+    and the process_view of middleware after it is skipped
+    '''
+    def process_view(self, request, viewFunc, viewArgs, viewKwargs):
+        directory = getProfileDir()
+        if not directory or not isSampled(request):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            response = profiler.runcall(viewFunc, request, *viewArgs,
+                                        **viewKwargs)
+        finally:
+            try:
+                filename = saveProfile(
+                    profiler, getViewName(viewFunc), directory,
+                    get_config('PROFILE_DIR_MAX_BYTES', DEFAULT_DIR_MAX_BYTES))
+            except EnvironmentError:
+                # a full or read-only disk must not fail the request
+                filename = None
+        if filename is not None:
+            response['X-Profile-File'] = filename
+        return response
+
+### collapsed stacks ###
+
+# frames deeper than this, and calls that took less than MIN_EDGE_TIME seconds
+# under a stack, are cut off, to bound the walk of big call graphs
+MAX_STACK_DEPTH = 100
+MIN_EDGE_TIME = 1e-6
+
+def pathPrefixes():
+    '''(): string list
+
+    the directories of sys.path, longest first, for shortening file names
+    '''
+    return sorted((os.path.join(os.path.abspath(path), '')
+                   for path in sys.path if path),
+                  key=len, reverse=True)
+
+def frameName(func, prefixes):
+    '''((string, int, string), string list): string
+
+    "module/path.py:function:line" for a pstats function key, without the
+    sys.path prefix of the file
+    '''
+    filename, line, name = func
+    if filename == '~':
+        # a builtin
+        return name.replace(';', ',')
+    for prefix in prefixes:
+        if filename.startswith(prefix):
+            filename = filename[len(prefix):]
+            break
+    return ("%s:%s:%d" % (filename, name, line)).replace(';', ',')
+
+def collapseStats(stats, rootName=None):
+    '''(pstats.Stats, string): {string: int}
+
+    rebuilds call stacks from the caller/callee times pstats keeps, in the
+    "root;caller;callee" form flame graph tools read, mapped to the
+    microseconds spent in the last frame itself
+
+    pstats only knows the total time of every caller -> callee edge, so a
+    function's time is split between its stacks in proportion to the time
+    each caller spent calling it
+    '''
+    prefixes = pathPrefixes()
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.iteritems():
+        for caller, callerStats in callers.iteritems():
+            callees.setdefault(caller, []).append((func, callerStats[3]))
+    names = dict((func, frameName(func, prefixes)) for func in stats.stats)
+    stacks = {}
+
+    def walk(func, share, path, stack):
+        cc, nc, tt, ct, callers = stats.stats[func]
+        micros = int(round(tt * share * 1e6))
+        if micros > 0:
+            stacks[stack] = stacks.get(stack, 0) + micros
+        if len(path) >= MAX_STACK_DEPTH:
+            return
+        for callee, edgeTime in callees.get(func, ()):
+            if callee in path:
+                # recursion: the time is already in the outer call
+                continue
+            calleeTime = stats.stats[callee][3]
+            if calleeTime <= 0 or share * edgeTime < MIN_EDGE_TIME:
+                continue
+            # the part of the callee's time spent under this stack
+            calleeShare = min(1.0, share * edgeTime / calleeTime)
+            walk(callee, calleeShare, path | frozenset([callee]),
+                 stack + ';' + names[callee])
+
+    for func, (cc, nc, tt, ct, callers) in stats.stats.iteritems():
+        if not callers:
+            stack = names[func]
+            if rootName is not None:
+                stack = rootName + ';' + stack
+            walk(func, 1.0, frozenset([func]), stack)
+    return stacks
+
+def summarizeProfiles(directory, viewPrefix=None):
+    '''(string, string): ({string: int}, int)
+
+    merges the profiles in directory (of the views whose names start with
+    viewPrefix) into collapsed stacks rooted at their view's name, and
+    returns them with the number of profiles read
+    '''
+    byView = {}
+    for path, size, mtime in listProfiles(directory):
+        viewName = viewOfFilename(os.path.basename(path))
+        if viewPrefix is None or viewName.startswith(viewPrefix):
+            byView.setdefault(viewName, []).append(path)
+    stacks = {}
+    count = 0
+    for viewName, paths in sorted(byView.iteritems()):
+        merged = None
+        for path in paths:
+            try:
+                if merged is None:
+                    merged = pstats.Stats(path)
+                else:
+                    merged.add(path)
+            except (EnvironmentError, EOFError, ValueError):
+                # rotated away while reading, or not a profile
+                continue
+            count += 1
+        if merged is not None:
+            stacks.update(collapseStats(merged, viewName))
+    return stacks, count
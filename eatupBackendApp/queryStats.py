@@ -0,0 +1,168 @@
+from __future__ import with_statement
+
+import re, random, threading
+from collections import Counter
+from django.db import connections
+from django.contrib.admin.views.decorators import staff_member_required
+from annoying.functions import get_config
+from eatupBackendApp.json_response import json_response
+from eatupBackendApp.metrics import getViewName
+
+# a query shape that shows up at least this many times in one request is
+# reported as an N+1 pattern
+DEFAULT_NPLUSONE_THRESHOLD = 3
+
+# per view, only the most frequent query shapes are kept
+MAX_SHAPES_PER_VIEW = 25
+
+STRING_LITERAL_REGEX = re.compile(r"'(?:[^']|'')*'")
+NUMBER_REGEX = re.compile(r"\b-?\d+(?:\.\d+)?\b")
+IN_LIST_REGEX = re.compile(r"\bIN\s*\((?:\s*\?\s*,)*\s*\?\s*\)", re.IGNORECASE)
+WHITESPACE_REGEX = re.compile(r"\s+")
+# executemany() entries are recorded as "<n> times: <sql>"
+EXECUTEMANY_PREFIX_REGEX = re.compile(r"^(?:\d+|\?) times: ")
+
+def normalizeSql(sql):
+    '''(string): string
+
+    reduces a query to its shape by replacing literals with '?' and
+    collapsing IN lists, so that the same query run for different rows
+    normalizes to the same string
+
+    ex: normalizeSql("SELECT * FROM t WHERE id IN (1, 2) AND name = 'x'")
+        -> "SELECT * FROM t WHERE id IN (...) AND name = ?"
+    '''
+    sql = EXECUTEMANY_PREFIX_REGEX.sub('', sql)
+    sql = STRING_LITERAL_REGEX.sub('?', sql)
+    sql = NUMBER_REGEX.sub('?', sql)
+    sql = IN_LIST_REGEX.sub('IN (...)', sql)
+    return WHITESPACE_REGEX.sub(' ', sql).strip()
+
+def summarizeQueries(queries, threshold=DEFAULT_NPLUSONE_THRESHOLD):
+    '''(dict list, int): dict
+
+    summarizes a list of connection.queries entries into the query count,
+    total time in seconds, a Counter of query shapes and the shapes that
+    repeat often enough to be N+1 patterns
+    '''
+    shapes = Counter(normalizeSql(query['sql']) for query in queries)
+    return {
+        'count': len(queries),
+        'time': sum(float(query['time']) for query in queries),
+        'shapes': shapes,
+        'repeated': dict((shape, count) for shape, count in shapes.iteritems()
+                         if count >= threshold),
+    }
+
+### per-view aggregate statistics for this process ###
+
+_statsLock = threading.Lock()
+_viewStats = {}
+
+def recordRequest(viewName, summary):
+    with _statsLock:
+        stats = _viewStats.get(viewName)
+        if stats is None:
+            stats = _viewStats[viewName] = {
+                'requests': 0,
+                'queries': 0,
+                'sql_time': 0.0,
+                'max_queries': 0,
+                'nplusone_requests': 0,
+                'shapes': Counter(),
+            }
+        stats['requests'] += 1
+        stats['queries'] += summary['count']
+        stats['sql_time'] += summary['time']
+        stats['max_queries'] = max(stats['max_queries'], summary['count'])
+        if summary['repeated']:
+            stats['nplusone_requests'] += 1
+        stats['shapes'].update(summary['shapes'])
+        if len(stats['shapes']) > MAX_SHAPES_PER_VIEW * 2:
+            stats['shapes'] = Counter(dict(
+                stats['shapes'].most_common(MAX_SHAPES_PER_VIEW)))
+
+def getViewStats():
+    '''(): dict
+
+    returns a JSON-friendly copy of the per-view statistics
+    '''
+    with _statsLock:
+        output = {}
+        for viewName, stats in _viewStats.iteritems():
+            requests = stats['requests']
+            output[viewName] = {
+                'requests': requests,
+                'avg_queries': stats['queries'] / float(requests),
+                'max_queries': stats['max_queries'],
+                'avg_sql_ms': stats['sql_time'] * 1000 / requests,
+                'nplusone_requests': stats['nplusone_requests'],
+                'top_queries': [
+                    {'sql': shape, 'per_request': count / float(requests)}
+                    for shape, count in stats['shapes'].most_common(10)],
+            }
+        return output
+
+def resetViewStats():
+    with _statsLock:
+        _viewStats.clear()
+
+### middleware ###
+
+class QueryStatsMiddleware(object):
+    '''
+    records the number, total time and repeated shapes of the SQL queries run
+    by a sampled fraction of requests (settings.QUERY_STATS_SAMPLE_RATE),
+    adds X-Query-* summary headers to their responses and aggregates the
+    numbers per view for showQueryStats
+    '''
+    def process_request(self, request):
+        sampleRate = get_config('QUERY_STATS_SAMPLE_RATE', 0.0)
+        if sampleRate <= 0 or (sampleRate < 1 and random.random() >= sampleRate):
+            return None
+        # django only records queries on debug cursors
+        state = {}
+        for connection in connections.all():
+            state[connection.alias] = (connection.use_debug_cursor,
+                                       len(connection.queries))
+            connection.use_debug_cursor = True
+        request._queryStatsState = state
+        request._queryStatsView = None
+
+    def process_view(self, request, viewFunc, viewArgs, viewKwargs):
+        if hasattr(request, '_queryStatsState'):
+            request._queryStatsView = getViewName(viewFunc)
+
+    def process_response(self, request, response):
+        state = getattr(request, '_queryStatsState', None)
+        if state is None:
+            return response
+        del request._queryStatsState
+
+        queries = []
+        for connection in connections.all():
+            previousDebug, startIndex = state.get(connection.alias, (None, 0))
+            queries.extend(connection.queries[startIndex:])
+            connection.use_debug_cursor = previousDebug
+            if not get_config('DEBUG', False):
+                # don't let the recorded queries pile up between requests
+                connection.queries = []
+
+        summary = summarizeQueries(queries, get_config(
+            'QUERY_STATS_NPLUSONE_THRESHOLD', DEFAULT_NPLUSONE_THRESHOLD))
+        response['X-Query-Count'] = str(summary['count'])
+        response['X-Query-Time-Ms'] = "%.1f" % (summary['time'] * 1000)
+        if summary['repeated']:
+            response['X-Query-Repeated'] = str(sum(summary['repeated'].values()))
+        if request._queryStatsView is not None:
+            recordRequest(request._queryStatsView, summary)
+        return response
+
+### url-view functions ###
+
+@staff_member_required
+@json_response()
+def showQueryStats(request):
+    if request.REQUEST.get('reset'):
+        resetViewStats()
+    return getViewStats()
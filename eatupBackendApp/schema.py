@@ -0,0 +1,104 @@
+from __future__ import with_statement
+
+from django.db import connections, transaction, reset_queries
+from django.db.models import get_app, get_models
+from django.core.management import call_command
+from django.utils import timezone
+from eatupBackendApp.models import (Event, DumbLocation, EventChange,
+                                    CounterField)
+from eatupBackendApp.indexes import createMissingIndexes
+from eatupBackendApp.feed import chunks
+from eatupBackendApp.counters import recount
+from eatupBackendApp import sync, search
+
+def getMissingColumns(model, using='default'):
+    '''(Model class, string): Field list
+
+    the fields of model that have no column in its (existing) table
+    '''
+    connection = connections[using]
+    cursor = connection.cursor()
+    columns = set(row[0] for row in connection.introspection
+                  .get_table_description(cursor, model._meta.db_table))
+    return [field for field in model._meta.local_fields
+            if field.column not in columns]
+
+def addColumnSql(model, field, using='default'):
+    '''(Model class, Field, string): string
+
+    the ALTER TABLE adding field's column, which existing rows get NULL in,
+    or the field's default if it isn't nullable and that is a number
+    '''
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    if field.null:
+        constraint = "NULL"
+    elif isinstance(field.get_default(), (int, long, float)) and \
+            not isinstance(field.get_default(), bool):
+        constraint = "NOT NULL DEFAULT %r" % field.get_default()
+    else:
+        raise ValueError("can't add %s.%s to existing rows: it isn't "
+                         "nullable" % (model.__name__, field.name))
+    return "ALTER TABLE %s ADD COLUMN %s %s %s" % (
+        quote(model._meta.db_table), quote(field.column),
+        field.db_type(connection=connection), constraint)
+
+def upgradeSchema(using='default', log=None):
+    '''(string, (string -> None)): None
+
+    brings a database made by an older version of the app up to date, since
+    syncdb only creates missing tables: creates those, adds the missing
+    (nullable, or numbers with a default) columns to the existing ones and
+    then the missing indexes, and fills in what the new columns and tables
+    track
+
+    safe to run more than once
+    '''
+    log = log or (lambda message: None)
+    connection = connections[using]
+    existingTables = set(connection.introspection.table_names())
+    call_command('syncdb', database=using, interactive=False, verbosity=0)
+
+    addedCounters = []
+    for model in get_models(get_app('eatupBackendApp')):
+        if model._meta.db_table not in existingTables:
+            continue
+        missing = getMissingColumns(model, using)
+        if not missing:
+            continue
+        with transaction.commit_on_success(using=using):
+            cursor = connection.cursor()
+            for field in missing:
+                sql = addColumnSql(model, field, using)
+                log(sql)
+                cursor.execute(sql)
+                if isinstance(field, CounterField):
+                    addedCounters.append((model, field.name))
+
+    for sql in createMissingIndexes(using):
+        log(sql)
+    if search.isSupported(using) and not search.hasSearchIndex(using):
+        log(search.createSearchIndex(using))
+
+    # change tracking starts now for rows from before it existed
+    now = timezone.now()
+    with transaction.commit_on_success(using=using):
+        for model in (Event, DumbLocation):
+            count = model.objects.using(using).filter(
+                updated_at__isnull=True).update(updated_at=now)
+            if count:
+                log("stamped %d %s rows" % (count, model.__name__))
+
+    for model, counterName in addedCounters:
+        with transaction.commit_on_success(using=using):
+            count = recount(model, counterName, using=using)
+        log("counted %s.%s of %d rows" % (model.__name__, counterName, count))
+
+    if EventChange._meta.db_table not in existingTables:
+        eventIds = list(Event.objects.using(using).values_list('eid',
+                                                               flat=True))
+        log("filling the event change log for %d events" % len(eventIds))
+        for chunk in chunks(eventIds, 5000):
+            with transaction.commit_on_success(using=using):
+                sync.touchEvents(chunk, now)
+            reset_queries()
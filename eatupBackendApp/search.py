@@ -0,0 +1,322 @@
+from __future__ import with_statement
+
+import re, decimal, threading
+from django.core.signals import request_finished
+from django.db import connections, transaction
+from django.db.models.signals import (post_init, post_save, pre_delete,
+                                      post_delete)
+from eatupBackendApp.models import Event
+from eatupBackendApp.feed import chunks
+from eatupBackendApp.indexes import getExistingIndexes, createIndexConcurrently
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# words of a query after this many are ignored
+MAX_TERMS = 8
+TERM_REGEX = re.compile(r'\w+', re.UNICODE)
+MIN_PREFIX_LENGTH = 2
+
+# the full-text index of events' titles and descriptions: an FTS5 table on
+# sqlite, which the signal handlers below keep up to date, and a GIN index
+# over their tsvector on postgres, which the database keeps up to date itself
+SEARCH_INDEX = 'eatup_event_search'
+
+# how much more a word counts in the title than in the description
+SQLITE_TITLE_WEIGHT = 10.0
+POSTGRES_CONFIG = 'english'
+
+def isSupported(using='default'):
+    return connections[using].vendor in ('sqlite', 'postgresql')
+
+def parseTerms(query):
+    '''(string): string list
+
+    the words of a search, lowercased; anything else (quotes, operators) is
+    dropped, so that no query is a syntax error
+    '''
+    return TERM_REGEX.findall(query.lower())[:MAX_TERMS]
+
+def eventTable(connection):
+    return connection.ops.quote_name(Event._meta.db_table)
+
+### the index ###
+
+def postgresVector(connection):
+    # the same expression in the index and the queries, or the planner can't
+    # tell that the index answers them
+    quote = connection.ops.quote_name
+    return ("setweight(to_tsvector('%s', coalesce(%s, '')), 'A') || "
+            "setweight(to_tsvector('%s', coalesce(%s, '')), 'B')" % (
+                POSTGRES_CONFIG, quote('title'), POSTGRES_CONFIG,
+                quote('description')))
+
+
+class PostgresSearchIndex(object):
+    # for indexes.createIndexConcurrently
+    def createSql(self, connection, online=False):
+        return "CREATE INDEX %s%s ON %s USING gin ((%s))" % (
+            "CONCURRENTLY " if online else "",
+            connection.ops.quote_name(SEARCH_INDEX), eventTable(connection),
+            postgresVector(connection))
+
+
+def hasSearchIndex(using='default'):
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        return SEARCH_INDEX in connection.introspection.table_names()
+    return SEARCH_INDEX in getExistingIndexes(connection, Event._meta.db_table)
+
+def sqliteCreateSql(table):
+    # porter stems english words, so that "dinners" finds "dinner"; the
+    # prefix index has the first 2 and 3 letters of every word, so that the
+    # short unfinished words of search as you type don't scan every word
+    # that starts with them
+    return ("CREATE VIRTUAL TABLE %s USING fts5(title, description, "
+            "tokenize = 'porter unicode61', prefix = '2 3')" % table)
+
+def fillSqliteIndex(connection, eventIds=None):
+    sql = ("INSERT OR REPLACE INTO %s (rowid, title, description) "
+           "SELECT eid, title, description FROM %s" % (
+               connection.ops.quote_name(SEARCH_INDEX),
+               eventTable(connection)))
+    cursor = connection.cursor()
+    if eventIds is None:
+        cursor.execute(sql)
+        return
+    for chunk in chunks(eventIds):
+        cursor.execute(sql + " WHERE eid IN (%s)" % ", ".join(
+            ["%s"] * len(chunk)), chunk)
+
+def createSearchIndex(using='default'):
+    '''(string): string
+
+    creates the search index of every event, online on postgres, and returns
+    the SQL that made it
+    '''
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        return createIndexConcurrently(PostgresSearchIndex(), connection)
+    if connection.vendor != 'sqlite':
+        raise NotImplementedError("search isn't supported for %s" %
+                                  connection.vendor)
+    sql = sqliteCreateSql(connection.ops.quote_name(SEARCH_INDEX))
+    with transaction.commit_on_success(using=using):
+        connection.cursor().execute(sql)
+        fillSqliteIndex(connection)
+    return sql
+
+def rebuildSearchIndex(using='default'):
+    '''(string): int
+
+    builds the search index again from the events table, which repairs it
+    after writes that sent no signals; creates it if it's missing. returns
+    the number of events indexed
+
+    on postgres this REINDEXes, which blocks writes to events while it runs
+    '''
+    connection = connections[using]
+    if not hasSearchIndex(using):
+        createSearchIndex(using)
+    else:
+        with transaction.commit_on_success(using=using):
+            cursor = connection.cursor()
+            quote = connection.ops.quote_name
+            if connection.vendor == 'postgresql':
+                cursor.execute("REINDEX INDEX %s" % quote(SEARCH_INDEX))
+            else:
+                cursor.execute("DELETE FROM %s" % quote(SEARCH_INDEX))
+                fillSqliteIndex(connection)
+                # merges the index into one b-tree, for the fastest reads
+                cursor.execute("INSERT INTO %s (%s) VALUES ('optimize')" % (
+                    quote(SEARCH_INDEX), quote(SEARCH_INDEX)))
+    return Event.objects.using(using).count()
+
+def createSearchIndexAfterSyncdb(sender, created_models=(), verbosity=1,
+                                 db='default', **kwargs):
+    '''
+    post_syncdb handler; gives a new events table its search index. flush
+    sends it too, with every model, and leaves the sqlite index alone since
+    it isn't a model's table, so an existing index is emptied along with the
+    events
+    '''
+    if Event not in created_models or not isSupported(db):
+        return
+    if hasSearchIndex(db):
+        rebuildSearchIndex(db)
+        return
+    sql = createSearchIndex(db)
+    if verbosity >= 2:
+        print "Creating search index: %s" % sql
+
+### keeping the sqlite index up to date ###
+
+def indexEvents(eventIds, using='default'):
+    '''(int iterable, string): None
+
+    (re)indexes the given events, for writes that send no signals (a
+    statement per CHUNK_SIZE of them); nothing to do on postgres
+    '''
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        fillSqliteIndex(connection, eventIds)
+
+def unindexEvents(eventIds, using='default'):
+    '''(int iterable, string): None
+
+    takes the given events out of the index, for deletes that send no
+    signals; nothing to do on postgres
+    '''
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+    cursor = connection.cursor()
+    for chunk in chunks(eventIds):
+        cursor.execute("DELETE FROM %s WHERE rowid IN (%s)" % (
+            connection.ops.quote_name(SEARCH_INDEX),
+            ", ".join(["%s"] * len(chunk))), chunk)
+
+def searchedText(event):
+    return (event.title, event.description)
+
+def eventLoaded(sender, instance, **kwargs):
+    # the text it had when loaded or last saved; deferred fields aren't read
+    if not instance._deferred:
+        instance._searchedText = searchedText(instance)
+
+def eventSaved(sender, instance, created, raw=False, using='default',
+               **kwargs):
+    connection = connections[using]
+    if raw or connection.vendor != 'sqlite':
+        return
+    text = searchedText(instance)
+    # edits of an event's participants or time leave its text alone
+    if created or getattr(instance, '_searchedText', None) != text:
+        connection.cursor().execute(
+            "INSERT OR REPLACE INTO %s (rowid, title, description) "
+            "VALUES (%%s, %%s, %%s)" % connection.ops.quote_name(SEARCH_INDEX),
+            [instance.pk] + list(text))
+    instance._searchedText = text
+
+# deleting a user deletes the events they host, with pre_delete and
+# post_delete sent for every one; like sync and counters do, they're taken
+# out of the index together when the first of them is done
+_deletions = threading.local()
+
+def getPendingDeletions():
+    if not hasattr(_deletions, 'pending'):
+        _deletions.pending = set()
+    return _deletions.pending
+
+def forgetDeletions(**kwargs):
+    getPendingDeletions().clear()
+
+def eventDeleting(sender, instance, **kwargs):
+    getPendingDeletions().add(instance.pk)
+
+def eventDeleted(sender, instance, using='default', **kwargs):
+    pending = getPendingDeletions()
+    if instance.pk in pending:
+        unindexEvents(list(pending), using)
+        pending.clear()
+
+post_init.connect(eventLoaded, sender=Event)
+post_save.connect(eventSaved, sender=Event)
+pre_delete.connect(eventDeleting, sender=Event)
+post_delete.connect(eventDeleted, sender=Event)
+request_finished.connect(forgetDeletions)
+
+### searching ###
+
+def parseCursor(cursor):
+    '''(string): (string, int) or None
+
+    the score and eid of the last result of a page, as "<score>,<eid>"
+    '''
+    try:
+        score, eventId = cursor.split(',')
+        decimal.Decimal(score)
+        return score, int(eventId)
+    except (ValueError, decimal.InvalidOperation):
+        return None
+
+def isPrefix(terms):
+    # the last word can be the start of a word, for search as you type,
+    # unless it's a single letter, which starts too many
+    return len(terms[-1]) >= MIN_PREFIX_LENGTH
+
+def sqliteMatch(terms):
+    # every word has to be there
+    match = " ".join('"%s"' % term for term in terms)
+    return match + "*" if isPrefix(terms) else match
+
+def sqliteSearchSql(table, paged):
+    '''(string, bool): string
+
+    the query of a page of matches in the index table; its parameters are
+    the match, the score and eid after which the page starts if paged, and
+    the limit
+    '''
+    # bm25 is lower for better matches
+    sql = ("SELECT rowid, score FROM (SELECT rowid, bm25(%s, %r, 1.0) AS "
+           "score FROM %s WHERE %s MATCH %%s)" % (
+               table, SQLITE_TITLE_WEIGHT, table, table))
+    if paged:
+        sql += " WHERE score > %s OR (score = %s AND rowid > %s)"
+    return sql + " ORDER BY score, rowid LIMIT %s"
+
+def searchSqlite(connection, terms, after, limit):
+    params = [sqliteMatch(terms)]
+    if after is not None:
+        params += [float(after[0]), float(after[0]), after[1]]
+    cursor = connection.cursor()
+    cursor.execute(sqliteSearchSql(connection.ops.quote_name(SEARCH_INDEX),
+                                   after is not None), params + [limit])
+    return [(eventId, repr(score)) for eventId, score in cursor.fetchall()]
+
+def searchPostgres(connection, terms, after, limit):
+    query = " & ".join(terms)
+    if isPrefix(terms):
+        query += ":*"
+    # the rank is rounded so that it can be compared exactly with the one
+    # a cursor was made from, and negated so that lower is better, like bm25
+    sql = ("SELECT eid, score FROM (SELECT eid, round(-ts_rank_cd(%s, query)"
+           "::numeric, 9) AS score FROM %s, to_tsquery('%s', %%s) query "
+           "WHERE %s @@ query) ranked" % (
+               postgresVector(connection), eventTable(connection),
+               POSTGRES_CONFIG, postgresVector(connection)))
+    params = [query]
+    if after is not None:
+        sql += " WHERE score > %s OR (score = %s AND eid > %s)"
+        params += [decimal.Decimal(after[0]), decimal.Decimal(after[0]),
+                   after[1]]
+    sql += " ORDER BY score, eid LIMIT %s"
+    cursor = connection.cursor()
+    cursor.execute(sql, params + [limit])
+    return [(eventId, str(score)) for eventId, score in cursor.fetchall()]
+
+def searchEventIds(query, after=None, limit=DEFAULT_PAGE_SIZE,
+                   using='default'):
+    '''(string, (string, int), int, string): (int list, string)
+
+    the ids of up to limit events whose title or description has every word
+    of query, best matches first, starting after the (score, eid) of the
+    last result of the previous page; and the cursor of the next page, None
+    on the last one
+    '''
+    terms = parseTerms(query)
+    if not terms:
+        return [], None
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        rows = searchSqlite(connection, terms, after, limit + 1)
+    elif connection.vendor == 'postgresql':
+        rows = searchPostgres(connection, terms, after, limit + 1)
+    else:
+        raise NotImplementedError("search isn't supported for %s" %
+                                  connection.vendor)
+    nextCursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        nextCursor = "%s,%d" % (rows[-1][1], rows[-1][0])
+    return [eventId for eventId, score in rows], nextCursor
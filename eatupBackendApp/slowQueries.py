@@ -0,0 +1,290 @@
+from __future__ import with_statement
+
+import os, sys, fcntl, logging, datetime, threading
+from collections import Counter
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import django, annoying
+from django.db import transaction
+from annoying.functions import get_config
+from eatupBackendApp.metrics import getViewName
+from eatupBackendApp.queryStats import normalizeSql
+from eatupBackendApp.profiling import pathPrefixes, frameName
+
+logger = logging.getLogger(__name__)
+
+# bytes of the log before it's rotated (settings.SLOW_QUERY_LOG_MAX_BYTES),
+# and how many rotated ones are kept (settings.SLOW_QUERY_LOG_BACKUPS)
+DEFAULT_LOG_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_LOG_BACKUPS = 5
+
+# how much of a statement and its parameters is written down
+MAX_SQL_LENGTH = 10000
+MAX_PARAMS = 20
+MAX_PARAM_LENGTH = 200
+
+# query shapes this process has explained, up to MAX_EXPLAINED_SHAPES of them
+MAX_EXPLAINED_SHAPES = 10000
+EXPLAINED_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+
+_explainedLock = threading.Lock()
+_explained = set()
+
+# the view of the request this thread is serving, and whether it's writing
+# down a slow query (whose EXPLAIN mustn't be written down in turn)
+_state = threading.local()
+
+# frames in these files are the database layer, or helpers that query for
+# their callers, not the site of a query
+_skippedPrefixes = (
+    os.path.join(os.path.dirname(os.path.abspath(django.__file__)), ''),
+    os.path.join(os.path.dirname(os.path.abspath(annoying.__file__)), ''),
+    os.path.splitext(os.path.abspath(__file__))[0],
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backends', ''),
+)
+
+def getLogPath():
+    return get_config('SLOW_QUERY_LOG', None)
+
+def querySite():
+    '''(): string or None
+
+    "module/path.py:function:line" of the innermost caller outside django and
+    the database instrumentation
+    '''
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if not filename.startswith(_skippedPrefixes):
+            return frameName((filename, frame.f_lineno, frame.f_code.co_name),
+                             pathPrefixes())
+        frame = frame.f_back
+    return None
+
+def shortRepr(value):
+    text = repr(value)
+    if len(text) > MAX_PARAM_LENGTH:
+        text = text[:MAX_PARAM_LENGTH] + '...'
+    return text
+
+def shortParams(params):
+    '''(list or dict): string list
+
+    the reprs of the first MAX_PARAMS parameters
+    '''
+    if isinstance(params, dict):
+        params = sorted(params.items())
+    params = list(params)
+    shown = [shortRepr(param) for param in params[:MAX_PARAMS]]
+    if len(params) > MAX_PARAMS:
+        shown.append("... %d more" % (len(params) - MAX_PARAMS))
+    return shown
+
+def explain(connection, sql, params):
+    '''(DatabaseWrapper, string, list): string list or None
+
+    the database's plan for the statement, a line per row, without running
+    it; None for statements that can't be explained
+    '''
+    words = sql.split(None, 1)
+    if not words or words[0].upper() not in EXPLAINED_STATEMENTS:
+        return None
+    if connection.vendor == 'sqlite':
+        return explainOnSqlite(connection.settings_dict['NAME'], sql, params)
+    # a failed EXPLAIN mustn't break the transaction the statement ran in
+    savepoint = transaction.savepoint(using=connection.alias)
+    try:
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN " + sql, params)
+        rows = cursor.fetchall()
+    except Exception as e:
+        transaction.savepoint_rollback(savepoint, using=connection.alias)
+        return ["EXPLAIN failed: %s" % e]
+    transaction.savepoint_commit(savepoint, using=connection.alias)
+    return formatPlan(rows)
+
+def explainOnSqlite(name, sql, params):
+    # python's sqlite3 commits the open transaction before statements that
+    # don't write rows, EXPLAIN among them, so the plan comes from another
+    # connection; an in-memory database has no other one
+    if not name or name == ':memory:':
+        return None
+    import sqlite3
+    from django.db.backends.sqlite3.base import FORMAT_QMARK_REGEX
+    planConnection = sqlite3.connect(name)
+    try:
+        rows = planConnection.execute(
+            "EXPLAIN QUERY PLAN " +
+            FORMAT_QMARK_REGEX.sub('?', sql).replace('%%', '%'),
+            params).fetchall()
+    except Exception as e:
+        return ["EXPLAIN failed: %s" % e]
+    finally:
+        planConnection.close()
+    return formatPlan(rows)
+
+def formatPlan(rows):
+    return [u" ".join(unicode(column) for column in row) for row in rows]
+
+def isNewShape(shape):
+    with _explainedLock:
+        if shape in _explained or len(_explained) >= MAX_EXPLAINED_SHAPES:
+            return False
+        _explained.add(shape)
+        return True
+
+def recordSlowQuery(connection, sql, params, seconds, many=False):
+    '''(DatabaseWrapper, string, list, float, bool): None
+
+    writes a statement that took seconds to the slow query log, with its
+    parameters (of the first row, for executemany()), the view and the line
+    that ran it, and its plan if it's the first of its shape in this process
+    '''
+    path = getLogPath()
+    if not path or getattr(_state, 'recording', False):
+        return
+    _state.recording = True
+    try:
+        # the parameters are still placeholders here
+        shape = normalizeSql(sql.replace('%s', '?'))
+        entry = {
+            'time': datetime.datetime.utcnow().isoformat(),
+            'pid': os.getpid(),
+            'database': connection.alias,
+            'view': getattr(_state, 'view', None),
+            'site': querySite(),
+            'seconds': seconds,
+            'sql': sql[:MAX_SQL_LENGTH],
+            'shape': shape,
+        }
+        if many:
+            params = list(params)
+            entry['rows'] = len(params)
+            params = params[0] if params else []
+        entry['params'] = shortParams(params)
+        if not many and isNewShape(shape):
+            entry['plan'] = explain(connection, sql, params)
+        appendToLog(path, json.dumps(entry) + '\n',
+                    get_config('SLOW_QUERY_LOG_MAX_BYTES',
+                               DEFAULT_LOG_MAX_BYTES),
+                    get_config('SLOW_QUERY_LOG_BACKUPS', DEFAULT_LOG_BACKUPS))
+    except Exception:
+        # the log must not fail the statement
+        logger.warning("couldn't log a slow query", exc_info=True)
+    finally:
+        _state.recording = False
+
+### the log ###
+
+def rotatedPath(path, index):
+    return "%s.%d" % (path, index)
+
+def rotateLog(path, backups):
+    # path.1 is the newest of the rotated logs
+    for index in xrange(backups - 1, 0, -1):
+        if os.path.exists(rotatedPath(path, index)):
+            os.rename(rotatedPath(path, index), rotatedPath(path, index + 1))
+    if backups > 0:
+        os.rename(path, rotatedPath(path, 1))
+    else:
+        os.remove(path)
+
+def appendToLog(path, line, maxBytes, backups):
+    '''(string, string, int, int): None
+
+    appends line to the log at path, first rotating it if it would grow past
+    maxBytes; every process of the server shares the log, so both happen
+    under a lock on path.lock
+    '''
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+            if size and size + len(line) > maxBytes:
+                rotateLog(path, backups)
+            with open(path, 'a') as log:
+                log.write(line)
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+def logPaths(path):
+    '''(string): string list
+
+    the log at path and its rotated ones that exist, oldest first
+    '''
+    paths = []
+    index = 1
+    while os.path.exists(rotatedPath(path, index)):
+        paths.insert(0, rotatedPath(path, index))
+        index += 1
+    if os.path.exists(path):
+        paths.append(path)
+    return paths
+
+def summarizeSlowQueries(path):
+    '''(string): (dict list, int)
+
+    the query shapes in the log at path and its rotated ones, with how often
+    they were slow, their total, longest and average time, the views and
+    lines that ran them and their latest plan, by total time; and the number
+    of slow queries read
+    '''
+    shapes = {}
+    count = 0
+    for logPath in logPaths(path):
+        with open(logPath) as log:
+            for line in log:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # cut short by a full disk
+                    continue
+                summary = shapes.get(entry['shape'])
+                if summary is None:
+                    summary = shapes[entry['shape']] = {
+                        'shape': entry['shape'],
+                        'count': 0,
+                        'seconds': 0.0,
+                        'max_seconds': 0.0,
+                        'views': Counter(),
+                        'sites': Counter(),
+                        'plan': None,
+                    }
+                summary['count'] += 1
+                summary['seconds'] += entry['seconds']
+                summary['max_seconds'] = max(summary['max_seconds'],
+                                             entry['seconds'])
+                summary['views'][entry.get('view')] += 1
+                summary['sites'][entry.get('site')] += 1
+                if entry.get('plan'):
+                    summary['plan'] = entry['plan']
+                count += 1
+    for summary in shapes.itervalues():
+        summary['avg_seconds'] = summary['seconds'] / summary['count']
+    return (sorted(shapes.itervalues(),
+                   key=lambda summary: summary['seconds'], reverse=True),
+            count)
+
+### middleware ###
+
+class SlowQueryMiddleware(object):
+    '''
+    tells the slow query log which view is running
+    '''
+    def process_request(self, request):
+        _state.view = None
+
+    def process_view(self, request, viewFunc, viewArgs, viewKwargs):
+        _state.view = getViewName(viewFunc)
+
+    def process_response(self, request, response):
+        _state.view = None
+        return response
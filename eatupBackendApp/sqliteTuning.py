@@ -0,0 +1,133 @@
+import time, random, functools
+from django.db import transaction, DEFAULT_DB_ALIAS
+from annoying.functions import get_config
+from eatupBackendApp.transactionHooks import (transactionEnding,
+                                              transactionEnded)
+
+# defaults for settings.SQLITE_TUNING
+DEFAULT_SQLITE_TUNING = {
+    # readers no longer block writers (and vice versa) in WAL mode
+    'JOURNAL_MODE': 'WAL',
+    # in WAL mode NORMAL only syncs at checkpoints; a power loss can roll back
+    # the last few commits but never corrupts the database
+    'SYNCHRONOUS': 'NORMAL',
+    # bytes of the database file to memory-map (0 disables)
+    'MMAP_SIZE': 256 * 1024 * 1024,
+    # page cache size; negative values are in KiB rather than pages
+    'CACHE_SIZE': -16000,
+    # how long (in milliseconds) sqlite itself waits on a locked database
+    'BUSY_TIMEOUT': 5000,
+    'TEMP_STORE': 'MEMORY',
+    # retries (with exponential backoff) of whole transactions that still
+    # fail with "database is locked", eg. after a read lock couldn't be
+    # upgraded to a write lock
+    'RETRY_ATTEMPTS': 5,
+    'RETRY_BASE_DELAY': 0.02,
+}
+
+def getTuning():
+    tuning = dict(DEFAULT_SQLITE_TUNING)
+    tuning.update(get_config('SQLITE_TUNING', {}))
+    return tuning
+
+def tuneConnection(rawConnection, tuning, inMemory=False):
+    '''(DB-API connection, dict, bool): None
+
+    applies the given pragmas to a raw sqlite3 connection
+    '''
+    cursor = rawConnection.cursor()
+    try:
+        if tuning.get('BUSY_TIMEOUT') is not None:
+            cursor.execute("PRAGMA busy_timeout = %d" %
+                           int(tuning['BUSY_TIMEOUT']))
+        # journal mode and mmap don't apply to in-memory databases
+        if tuning.get('JOURNAL_MODE') and not inMemory:
+            cursor.execute("PRAGMA journal_mode = %s" % tuning['JOURNAL_MODE'])
+        if tuning.get('SYNCHRONOUS'):
+            cursor.execute("PRAGMA synchronous = %s" % tuning['SYNCHRONOUS'])
+        if tuning.get('MMAP_SIZE') is not None and not inMemory:
+            cursor.execute("PRAGMA mmap_size = %d" % int(tuning['MMAP_SIZE']))
+        if tuning.get('CACHE_SIZE') is not None:
+            cursor.execute("PRAGMA cache_size = %d" % int(tuning['CACHE_SIZE']))
+        if tuning.get('TEMP_STORE'):
+            cursor.execute("PRAGMA temp_store = %s" % tuning['TEMP_STORE'])
+    finally:
+        cursor.close()
+
+def applySqlitePragmas(sender, connection, **kwargs):
+    '''
+    connection_created handler; tunes every new sqlite connection
+    '''
+    if connection.vendor != 'sqlite':
+        return
+    tuning = getTuning()
+    if not tuning.get('ENABLED', True):
+        return
+    inMemory = connection.settings_dict['NAME'] in (':memory:', '')
+    tuneConnection(connection.connection, tuning, inMemory=inMemory)
+
+def isLockError(error):
+    message = str(error).lower()
+    return 'database is locked' in message or 'database is busy' in message \
+        or 'database table is locked' in message
+
+def runWithRetry(fn, attempts, baseDelay, onRetry=None):
+    '''(() -> 'a, int, float, (exception -> None)): 'a
+
+    calls fn, retrying it up to attempts times with jittered exponential
+    backoff whenever it fails with an sqlite lock error
+    '''
+    for attempt in xrange(attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if not isLockError(e) or attempt == attempts - 1:
+                raise
+            if onRetry is not None:
+                onRetry(e)
+            delay = baseDelay * (2 ** attempt)
+            time.sleep(delay + random.uniform(0, delay))
+
+def retryOnLock(using=None):
+    '''
+    decorator that runs the wrapped function in a single transaction, and
+    retries the whole transaction if the database is locked; every attempt
+    runs the transactionHooks.beforeCommit callbacks before it commits, and
+    its commit or rollback is reported to eatupBackendApp.transactionHooks,
+    whatever the database backend
+
+    example:
+        @json_response()
+        @retryOnLock()
+        def editEvent(request):
+            ...
+    '''
+    def decorator(func):
+        alias = using or DEFAULT_DB_ALIAS
+
+        def finishing(*args, **kwargs):
+            result = func(*args, **kwargs)
+            transactionEnding(alias)
+            return result
+        transactionalFunc = transaction.commit_on_success(using=using)(
+            finishing)
+
+        def attempt(*args, **kwargs):
+            # commit_on_success has committed when it returns and rolled
+            # back when it raises
+            try:
+                result = transactionalFunc(*args, **kwargs)
+            except:
+                transactionEnded(alias, False)
+                raise
+            transactionEnded(alias, True)
+            return result
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tuning = getTuning()
+            return runWithRetry(lambda: attempt(*args, **kwargs),
+                                tuning['RETRY_ATTEMPTS'],
+                                tuning['RETRY_BASE_DELAY'])
+        return wrapper
+    return decorator
@@ -0,0 +1,281 @@
+from __future__ import with_statement
+
+import os, re, stat, mimetypes, posixpath, urllib, threading
+from collections import OrderedDict
+from wsgiref.util import FileWrapper
+from django.http import (Http404, HttpResponse, HttpResponseNotModified,
+                         HttpResponseRedirect)
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.static import serve as djangoServe
+from django.conf import settings
+from annoying.functions import get_config
+from eatupBackendApp.metrics import recordCacheLookup, CACHE_BYTES
+
+# files whose names carry a content hash (ex: jquery-1.9.1.min.3f2a9c0d1b7e.js)
+# never change under the same url, so they can be cached forever
+HASHED_NAME_REGEX = re.compile(r"\.[0-9a-f]{12}\.[A-Za-z0-9]+$")
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+RANGE_REGEX = re.compile(r"^bytes=(?P<start>\d*)-(?P<end>\d*)$")
+
+STREAM_BLOCK_SIZE = 64 * 1024
+
+### in-memory cache for small, frequently requested files ###
+
+_cacheLock = threading.Lock()
+# maps full path -> (mtime, size, contents), ordered from least to most
+# recently used
+_fileCache = OrderedDict()
+_fileCacheBytes = [0]
+
+def _getCachedContents(fullpath, statobj):
+    '''(string, stat result): string or None
+
+    returns the contents of the given file if it is small enough to be held
+    in the in-memory cache, reading it from disk (and caching it) if the cached
+    copy is missing or stale
+    returns None if the file is too big to be cached
+    '''
+    maxFileSize = get_config('STATIC_SERVE_CACHE_MAX_FILE_SIZE', 64 * 1024)
+    maxTotalSize = get_config('STATIC_SERVE_CACHE_MAX_BYTES', 8 * 1024 * 1024)
+    if statobj.st_size > maxFileSize:
+        return None
+
+    with _cacheLock:
+        cached = _fileCache.pop(fullpath, None)
+        if cached is not None:
+            mtime, size, contents = cached
+            if mtime == statobj.st_mtime and size == statobj.st_size:
+                # re-insert to mark as most recently used
+                _fileCache[fullpath] = cached
+                recordCacheLookup('static', True)
+                return contents
+            _fileCacheBytes[0] -= size
+    recordCacheLookup('static', False)
+
+    with open(fullpath, 'rb') as f:
+        contents = f.read()
+
+    with _cacheLock:
+        if fullpath not in _fileCache:
+            _fileCache[fullpath] = (statobj.st_mtime, len(contents), contents)
+            _fileCacheBytes[0] += len(contents)
+        # evict least recently used files until we're back under budget
+        while _fileCacheBytes[0] > maxTotalSize and _fileCache:
+            evictedPath, (_, evictedSize, _) = _fileCache.popitem(last=False)
+            _fileCacheBytes[0] -= evictedSize
+        CACHE_BYTES.set(_fileCacheBytes[0], ('static',))
+    return contents
+
+def clearCache():
+    with _cacheLock:
+        _fileCache.clear()
+        _fileCacheBytes[0] = 0
+        CACHE_BYTES.set(0, ('static',))
+
+### helper functions ###
+
+def resolvePath(path):
+    '''(string): string
+
+    normalizes a url path the same way django.views.static.serve does,
+    stripping empty, '.' and '..' components
+    '''
+    path = posixpath.normpath(urllib.unquote(path)).lstrip('/')
+    newpath = ''
+    for part in path.split('/'):
+        if not part:
+            continue
+        drive, part = os.path.splitdrive(part)
+        head, part = os.path.split(part)
+        if part in (os.curdir, os.pardir):
+            continue
+        newpath = os.path.join(newpath, part).replace('\\', '/')
+    return newpath
+
+def acceptsGzip(request):
+    acceptEncoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    for coding in acceptEncoding.split(','):
+        parts = coding.strip().split(';')
+        if parts[0].strip().lower() not in ('gzip', '*'):
+            continue
+        # honor explicit refusals such as "gzip;q=0"
+        if any(p.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00',
+                                              'q=0.000') for p in parts[1:]):
+            continue
+        return True
+    return False
+
+def parseRange(rangeHeader, size):
+    '''(string, int): (int, int) or None, bool
+
+    parses a single "bytes=start-end" range header against a file of the given
+    size
+    returns two values:
+      - the inclusive (start, end) byte offsets to serve, or None to serve the
+        whole file (missing, malformed or multi-part ranges are ignored)
+      - whether the range is unsatisfiable
+    '''
+    match = RANGE_REGEX.match(rangeHeader.strip()) if rangeHeader else None
+    if match is None:
+        return None, False
+    rawStart, rawEnd = match.group('start'), match.group('end')
+    if rawStart == '' and rawEnd == '':
+        return None, False
+    if rawStart == '':
+        # suffix range, ie: the last N bytes
+        suffixLength = int(rawEnd)
+        if suffixLength == 0:
+            return None, True
+        return (max(size - suffixLength, 0), size - 1), False
+    start = int(rawStart)
+    end = int(rawEnd) if rawEnd != '' else size - 1
+    if start >= size or end < start:
+        return None, True
+    return (start, min(end, size - 1)), False
+
+def makeEtag(statobj):
+    return '"%x-%x"' % (int(statobj.st_mtime), statobj.st_size)
+
+def isNotModified(request, etag, statobj):
+    ifNoneMatch = request.META.get('HTTP_IF_NONE_MATCH')
+    if ifNoneMatch is not None:
+        candidates = [tag.strip() for tag in ifNoneMatch.split(',')]
+        return etag in candidates or '*' in candidates
+    ifModifiedSince = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if ifModifiedSince is not None:
+        modifiedSince = parse_http_date_safe(ifModifiedSince.split(';')[0])
+        if modifiedSince is not None:
+            return int(statobj.st_mtime) <= modifiedSince
+    return False
+
+def iterFileRange(fullpath, start, length):
+    with open(fullpath, 'rb') as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            block = f.read(min(STREAM_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+def setCachingHeaders(response, newpath, etag, statobj):
+    if HASHED_NAME_REGEX.search(newpath):
+        response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    else:
+        maxAge = get_config('STATIC_SERVE_MAX_AGE', 3600)
+        response['Cache-Control'] = "public, max-age=%d" % maxAge
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(statobj.st_mtime)
+
+### url-view functions ###
+
+def serveStatic(request, path, document_root=None, show_indexes=False):
+    '''(HttpRequest, string, string, bool): HttpResponse
+
+    production replacement for django.views.static.serve
+
+    - content-hashed filenames are served with immutable Cache-Control headers,
+      everything else gets a short max-age plus an ETag for revalidation
+    - a precompressed "<file>.gz" sidecar is served instead of the file itself
+      when the client accepts gzip
+    - single byte-range requests are answered with 206 Partial Content
+    - small files are held in an in-memory LRU cache
+    - if STATIC_SERVE_SENDFILE_HEADER is set to 'X-Sendfile' or
+      'X-Accel-Redirect', the file body is handed off to the front-end server
+    '''
+    newpath = resolvePath(path)
+    if newpath and path != newpath:
+        return HttpResponseRedirect(newpath)
+    fullpath = os.path.join(document_root, newpath)
+    if os.path.isdir(fullpath):
+        # directory listings are rare and uncacheable, let django handle them
+        return djangoServe(request, path, document_root=document_root,
+                           show_indexes=show_indexes)
+    try:
+        statobj = os.stat(fullpath)
+    except OSError:
+        raise Http404('"%s" does not exist' % newpath)
+    if not stat.S_ISREG(statobj.st_mode):
+        raise Http404('"%s" does not exist' % newpath)
+
+    mimetype, encoding = mimetypes.guess_type(fullpath)
+    mimetype = mimetype or 'application/octet-stream'
+
+    # pick the precompressed representation if there is one and the client
+    # wants it; ranges are always served against the identity representation
+    servedPath = fullpath
+    servedStat = statobj
+    contentEncoding = encoding
+    gzipPath = fullpath + '.gz'
+    hasGzipSidecar = encoding is None and os.path.isfile(gzipPath)
+    rangeHeader = request.META.get('HTTP_RANGE')
+    if hasGzipSidecar and rangeHeader is None and acceptsGzip(request):
+        servedPath = gzipPath
+        servedStat = os.stat(gzipPath)
+        contentEncoding = 'gzip'
+
+    etag = makeEtag(servedStat)
+    if contentEncoding == 'gzip' and servedPath != fullpath:
+        etag = etag[:-1] + '-gz"'
+
+    if isNotModified(request, etag, servedStat):
+        response = HttpResponseNotModified(mimetype=mimetype)
+        setCachingHeaders(response, newpath, etag, servedStat)
+        if hasGzipSidecar:
+            response['Vary'] = 'Accept-Encoding'
+        return response
+
+    sendfileHeader = get_config('STATIC_SERVE_SENDFILE_HEADER', None)
+    size = servedStat.st_size
+    byteRange, unsatisfiable = (None, False)
+    if sendfileHeader is None:
+        byteRange, unsatisfiable = parseRange(rangeHeader, size)
+
+    if unsatisfiable:
+        response = HttpResponse('', mimetype=mimetype, status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    if sendfileHeader is not None:
+        # let the front-end server stream the file (and handle ranges)
+        response = HttpResponse('', mimetype=mimetype)
+        if sendfileHeader == 'X-Accel-Redirect':
+            # paths are relative to the project root so that static and media
+            # files map to distinct internal locations
+            accelPrefix = get_config('STATIC_SERVE_ACCEL_PREFIX', '/protected/')
+            relativePath = os.path.relpath(servedPath, 
+                                           settings.PROJECT_BASE_PATH)
+            response[sendfileHeader] = (accelPrefix.rstrip('/') + '/' +
+                                        relativePath.replace(os.sep, '/'))
+        else:
+            response[sendfileHeader] = servedPath
+    elif byteRange is not None:
+        start, end = byteRange
+        length = end - start + 1
+        cached = _getCachedContents(servedPath, servedStat)
+        if cached is not None:
+            body = cached[start:end + 1]
+        else:
+            body = iterFileRange(servedPath, start, length)
+        response = HttpResponse(body, mimetype=mimetype, status=206)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        response['Content-Length'] = length
+    else:
+        cached = _getCachedContents(servedPath, servedStat)
+        if cached is not None:
+            body = cached
+        else:
+            body = FileWrapper(open(servedPath, 'rb'), STREAM_BLOCK_SIZE)
+        response = HttpResponse(body, mimetype=mimetype)
+        response['Content-Length'] = size
+
+    setCachingHeaders(response, newpath, etag, servedStat)
+    response['Accept-Ranges'] = 'bytes'
+    if contentEncoding:
+        response['Content-Encoding'] = contentEncoding
+    if hasGzipSidecar:
+        response['Vary'] = 'Accept-Encoding'
+    return response
@@ -0,0 +1,273 @@
+import datetime, threading
+from django.db.models.signals import (m2m_changed, post_save, pre_delete,
+                                      post_delete)
+from django.core.signals import request_finished
+from django.db import transaction
+from django.utils import timezone
+from annoying.functions import get_config
+from eatupBackendApp.models import (AppUser, Event, DumbLocation, EventChange,
+                                    ChangeLogEntry)
+from eatupBackendApp.feed import chunks, eventIdsOfUsers
+from eatupBackendApp.transactionHooks import afterCommit, beforeCommit
+
+Participation = Event.participants.through
+
+# tombstones older than this many days are pruned
+# (settings.SYNC_TOMBSTONE_DAYS); clients that haven't synced for longer get
+# a full download instead of a delta
+DEFAULT_TOMBSTONE_DAYS = 30
+
+# watermarks are handed out this many seconds in the past
+# (settings.SYNC_WATERMARK_LAG), so that changes stamped just before a sync
+# but committed just after it are picked up by the next one. the rows are
+# stamped when they're written, which can be well before the commit (a
+# write waits up to the busy timeout for the lock, and the view goes on
+# after it); so a retryOnLock transaction whose stamps are older than half
+# the lag when it's about to commit stamps its rows again, and the other
+# half is left for the commit itself
+DEFAULT_WATERMARK_LAG = 5
+
+def getWatermarkLag():
+    return get_config('SYNC_WATERMARK_LAG', DEFAULT_WATERMARK_LAG)
+
+### writing ###
+
+# the stamps given by the transactions open on this thread, by database
+# alias, with the events stamped with each
+_stamps = threading.local()
+
+def getStamps():
+    if not hasattr(_stamps, 'byAlias'):
+        _stamps.byAlias = {}
+    return _stamps.byAlias
+
+def rememberStamp(now, eventIds, using='default'):
+    '''(datetime, int iterable, string): None
+
+    notes that the change log rows of the events were stamped with now, so
+    that they can be stamped again if the transaction is slow to commit
+    '''
+    if not eventIds or not transaction.is_managed(using=using):
+        # nothing stamped, or already committed
+        return
+    stamps = getStamps()
+    if using not in stamps:
+        stamps[using] = {}
+        beforeCommit(lambda: restampIfStale(using), using)
+        forget = lambda: stamps.pop(using, None)
+        afterCommit(forget, forget, using)
+    stamps[using].setdefault(now, set()).update(eventIds)
+
+def restampIfStale(using='default'):
+    '''(string): None
+
+    stamps the change log rows of the transaction again with the current
+    time if they were stamped more than half the watermark lag ago
+    '''
+    now = timezone.now()
+    limit = datetime.timedelta(seconds=getWatermarkLag() / 2.0)
+    for stamp, eventIds in getStamps().get(using, {}).items():
+        if now - stamp <= limit:
+            continue
+        for chunk in chunks(eventIds):
+            EventChange.objects.using(using).filter(
+                eid__in=chunk, changed_at=stamp).update(changed_at=now)
+
+def touchEvents(eventIds, now=None, using='default'):
+    '''(int iterable, datetime, string): None
+
+    stamps the change log of the given events with now: the rows of their
+    current participants are bumped (or created), and the rows of users who
+    no longer take part in them become tombstones
+
+    runs a fixed number of queries per CHUNK_SIZE events
+    '''
+    now = now or timezone.now()
+    eventIds = set(eventIds)
+    changes = EventChange.objects.using(using)
+    for chunk in chunks(eventIds):
+        members = set(Participation.objects.using(using)
+                      .filter(event__in=chunk)
+                      .values_list('appuser_id', 'event_id'))
+        existing = list(changes.filter(eid__in=chunk)
+                        .values_list('pk', 'user_id', 'eid', 'removed'))
+        left = [pk for pk, userId, eventId, removed in existing
+                if not removed and (userId, eventId) not in members]
+        rejoined = [pk for pk, userId, eventId, removed in existing
+                    if removed and (userId, eventId) in members]
+        changes.filter(eid__in=chunk, removed=False).update(changed_at=now)
+        for pkChunk in chunks(left):
+            changes.filter(pk__in=pkChunk).update(removed=True)
+        for pkChunk in chunks(rejoined):
+            changes.filter(pk__in=pkChunk).update(removed=False,
+                                                  changed_at=now)
+        existingKeys = set((userId, eventId) for pk, userId, eventId, removed
+                           in existing)
+        changes.bulk_create([
+            EventChange(user_id=userId, eid=eventId, changed_at=now)
+            for userId, eventId in sorted(members - existingKeys)])
+        # everybody who takes part, or took part until now
+        appendToLog(members | set((userId, eventId) for pk, userId, eventId, 
+                                  removed in existing if not removed), now,
+                    using)
+    rememberStamp(now, eventIds, using)
+
+def removeEvents(eventIds, now=None):
+    '''(int iterable, datetime): None
+
+    turns every change log row of the given (deleted) events into a tombstone
+    '''
+    now = now or timezone.now()
+    eventIds = set(eventIds)
+    for chunk in chunks(eventIds):
+        live = EventChange.objects.filter(eid__in=chunk, removed=False)
+        appendToLog(live.values_list('user_id', 'eid'), now)
+        live.update(removed=True, changed_at=now)
+    rememberStamp(now, eventIds)
+
+def appendToLog(userEventPairs, now=None, using='default'):
+    '''((int, int) iterable, datetime, string): None
+
+    tells the users, through the change log, that the events changed
+    '''
+    now = now or timezone.now()
+    ChangeLogEntry.objects.using(using).bulk_create([
+        ChangeLogEntry(uid=userId, eid=eventId, created_at=now)
+        for userId, eventId in sorted(userEventPairs)])
+
+def pruneTombstones(now=None, using='default'):
+    '''(datetime, string): int
+
+    deletes tombstones older than SYNC_TOMBSTONE_DAYS, returns how many
+    '''
+    cutoff = (now or timezone.now()) - datetime.timedelta(
+        days=get_config('SYNC_TOMBSTONE_DAYS', DEFAULT_TOMBSTONE_DAYS))
+    tombstones = EventChange.objects.using(using).filter(
+        removed=True, changed_at__lt=cutoff)
+    count = tombstones.count()
+    tombstones.delete()
+    return count
+
+### signal handlers ###
+
+def participantsChanged(sender, instance, action, pk_set, **kwargs):
+    # like in eatupBackendApp.feed, instance is either an event or a user
+    fromEvent = isinstance(instance, Event)
+    if action == 'pre_clear':
+        if not fromEvent:
+            instance._syncEventIds = eventIdsOfUsers([instance.pk])
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if fromEvent:
+            touchEvents([instance.pk])
+        elif action == 'post_clear':
+            touchEvents(getattr(instance, '_syncEventIds', ()))
+        else:
+            touchEvents(pk_set)
+
+def eventSaved(sender, instance, created, raw=False, **kwargs):
+    # a new event has no participants to tell yet
+    if not created and not raw:
+        touchEvents([instance.pk])
+
+# deleting a user deletes the events they host, and deleting an event deletes
+# its locations, with pre_delete and post_delete sent for every row; so that
+# this takes a fixed number of queries, the events are tombstoned together
+# when the first of them is done, and their locations are left alone. the
+# post_delete of the locations may come before or after that of their event,
+# so the deleted events are remembered until the next deletion or request
+_deletions = threading.local()
+
+def getDeletions():
+    if not hasattr(_deletions, 'pending'):
+        _deletions.pending = set()
+        _deletions.done = set()
+    return _deletions
+
+def forgetDeletions(**kwargs):
+    deletions = getDeletions()
+    deletions.pending.clear()
+    deletions.done.clear()
+
+def eventDeleting(sender, instance, **kwargs):
+    deletions = getDeletions()
+    if not deletions.pending:
+        deletions.done.clear()
+    deletions.pending.add(instance.pk)
+
+def eventDeleted(sender, instance, **kwargs):
+    deletions = getDeletions()
+    if instance.pk in deletions.pending:
+        removeEvents(deletions.pending)
+        deletions.done |= deletions.pending
+        deletions.pending.clear()
+
+def locationSaved(sender, instance, raw=False, **kwargs):
+    if instance.eventHere_id is not None and not raw:
+        touchEvents([instance.eventHere_id])
+
+def locationDeleted(sender, instance, **kwargs):
+    if instance.eventHere_id is None:
+        return
+    deletions = getDeletions()
+    if instance.eventHere_id in deletions.pending or \
+            instance.eventHere_id in deletions.done:
+        return
+    touchEvents([instance.eventHere_id])
+
+def userSaved(sender, instance, created, raw=False, **kwargs):
+    # events embed their participants' names
+    if not created and not raw:
+        touchEvents(eventIdsOfUsers([instance.pk]))
+
+def userDeleting(sender, instance, **kwargs):
+    instance._syncEventIds = eventIdsOfUsers([instance.pk])
+
+def userDeleted(sender, instance, **kwargs):
+    # their participations go without m2m_changed
+    touchEvents(getattr(instance, '_syncEventIds', ()))
+
+m2m_changed.connect(participantsChanged, sender=Participation)
+post_save.connect(eventSaved, sender=Event)
+pre_delete.connect(eventDeleting, sender=Event)
+post_delete.connect(eventDeleted, sender=Event)
+post_save.connect(locationSaved, sender=DumbLocation)
+post_delete.connect(locationDeleted, sender=DumbLocation)
+post_save.connect(userSaved, sender=AppUser)
+pre_delete.connect(userDeleting, sender=AppUser)
+post_delete.connect(userDeleted, sender=AppUser)
+request_finished.connect(forgetDeletions)
+
+### reading ###
+
+def getWatermark(now=None):
+    '''(datetime): datetime
+
+    the watermark to hand out with a sync that starts now
+    '''
+    return (now or timezone.now()) - datetime.timedelta(
+        seconds=getWatermarkLag())
+
+def isTooOld(since, now=None):
+    '''(datetime): bool
+
+    whether tombstones from since on may already have been pruned, so that a
+    delta would miss removals
+    '''
+    cutoff = (now or timezone.now()) - datetime.timedelta(
+        days=get_config('SYNC_TOMBSTONE_DAYS', DEFAULT_TOMBSTONE_DAYS))
+    return since < cutoff
+
+def getChangedEventIds(user, since):
+    '''(AppUser, datetime): (int list, int list)
+
+    returns the ids of the user's events that changed after since, and of the
+    events the user left or that were deleted after since; one range scan of
+    the (user, changed_at) index
+    '''
+    changedIds, removedIds = [], []
+    for eventId, removed in (EventChange.objects
+                             .filter(user=user, changed_at__gt=since)
+                             .order_by('changed_at')
+                             .values_list('eid', 'removed')):
+        (removedIds if removed else changedIds).append(eventId)
+    return changedIds, removedIds
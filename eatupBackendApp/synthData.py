@@ -0,0 +1,229 @@
+from __future__ import with_statement
+
+import random, datetime
+from django.db import connections, transaction, reset_queries
+from django.core.management.color import no_style
+from django.utils import timezone
+from eatupBackendApp.models import (AppUser, Event, DumbLocation, FeedEntry,
+                                    EventChange)
+from eatupBackendApp.feed import refreshEventFeeds
+from eatupBackendApp.sync import touchEvents
+from eatupBackendApp.counters import recomputeCounters
+from eatupBackendApp.search import indexEvents
+
+# generated users get facebook-like uids starting here, so that they never
+# collide with hand-made test users
+BASE_UID = 100000000000
+
+# rows per bulk INSERT
+BATCH_SIZE = 500
+
+FIRST_NAMES = ["Alex", "Sam", "Jordan", "Taylor", "Casey", "Riley", "Morgan",
+               "Jamie", "Avery", "Quinn", "Isaac", "Mei", "Ana", "Kofi", "Noor",
+               "Ravi", "Lena", "Omar", "Yuki", "Sofia"]
+LAST_NAMES = ["Lim", "Smith", "Garcia", "Chen", "Okafor", "Patel", "Kim",
+              "Nguyen", "Cohen", "Silva", "Novak", "Haddad", "Tanaka", "Brown"]
+EVENT_TITLES = ["Lunch", "Dinner", "Brunch", "Coffee", "Late night food",
+                "Dim sum", "Pizza", "Ramen run", "Potluck", "BBQ"]
+PLACE_NAMES = ["Sushi Place", "Taco Truck", "The Diner", "Noodle Bar",
+               "Food Court", "Pho House", "Curry Corner", "Bagel Shop",
+               "Falafel Stand", "Dumpling House"]
+
+def powerLawFriendships(numUsers, avgFriends, rng):
+    '''(int, int, Random): (int, int) set
+
+    builds an undirected friend graph over user indices 0..numUsers-1 by
+    preferential attachment (Barabasi-Albert): every new user befriends
+    avgFriends / 2 existing users, picked with probability proportional to
+    their current number of friends, so degrees follow a power law with a
+    few very popular users
+
+    every edge is returned once, as (smaller index, larger index)
+    '''
+    edgesPerUser = max(avgFriends // 2, 1)
+    edges = set()
+    # every user appears here once per friend, so a uniform pick from it is
+    # a pick weighted by degree
+    endpoints = []
+    for user in xrange(numUsers):
+        if user <= edgesPerUser:
+            # fully connect the seed users
+            targets = set(xrange(user))
+        else:
+            targets = set()
+            while len(targets) < edgesPerUser:
+                targets.add(endpoints[rng.randrange(len(endpoints))])
+        for target in targets:
+            edges.add((target, user))
+            endpoints.append(target)
+            endpoints.append(user)
+    return edges
+
+def nextPk(model, using='default'):
+    maxPk = (model.objects.using(using).order_by('-pk')
+             .values_list('pk', flat=True)[:1])
+    return (maxPk[0] + 1) if maxPk else 1
+
+def resetSequences(using, models):
+    # rows were inserted with explicit primary keys, so databases with real
+    # sequences (postgres) need them moved past the new rows
+    connection = connections[using]
+    statements = connection.ops.sequence_reset_sql(no_style(), models)
+    if statements:
+        cursor = connection.cursor()
+        for sql in statements:
+            cursor.execute(sql)
+
+def generateDataset(numUsers=100000, avgFriends=20, eventsPerUser=0.5,
+                    avgParticipants=6, maxLocations=3, seed=0, using='default',
+                    buildFeeds=True, log=None):
+    '''(int, int, float, int, int, int, string, bool, (string -> None)): dict
+
+    bulk-inserts a reproducible synthetic dataset: numUsers AppUsers with a
+    power-law friend graph, numUsers * eventsPerUser Events hosted by random
+    users (popular users host more) with participants drawn mostly from the
+    host's friends, and 1 to maxLocations DumbLocations per event, plus 
+    their counters and change log, and the friends feeds of all of them
+    unless buildFeeds is False
+
+    the same arguments always generate the same data; returns the number of
+    rows created per table
+    '''
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+
+    log("building friend graph for %d users" % numUsers)
+    edges = powerLawFriendships(numUsers, avgFriends, rng)
+    friendsOf = [[] for user in xrange(numUsers)]
+    for a, b in edges:
+        friendsOf[a].append(b)
+        friendsOf[b].append(a)
+    # the graph is built from a set; sort so that the picks below don't
+    # depend on set ordering
+    for friends in friendsOf:
+        friends.sort()
+
+    firstUid = max(nextPk(AppUser, using), BASE_UID)
+    uids = [firstUid + user for user in xrange(numUsers)]
+    firstEid = nextPk(Event, using)
+    numEvents = int(numUsers * eventsPerUser)
+    now = timezone.now().replace(microsecond=0)
+    counts = {}
+
+    def bulkInsert(model, rows, label):
+        model.objects.using(using).bulk_create(rows, batch_size=BATCH_SIZE)
+        counts[label] = counts.get(label, 0) + len(rows)
+        # don't keep every INSERT around when DEBUG is on
+        reset_queries()
+
+    with transaction.commit_on_success(using=using):
+        log("inserting users")
+        users = []
+        for user in xrange(numUsers):
+            users.append(AppUser(
+                uid=uids[user], first_name=rng.choice(FIRST_NAMES),
+                last_name=rng.choice(LAST_NAMES),
+                prof_pic="http://graph.facebook.com/%d/picture" % uids[user]))
+            if len(users) >= BATCH_SIZE:
+                bulkInsert(AppUser, users, 'users')
+                users = []
+        bulkInsert(AppUser, users, 'users')
+
+        log("inserting %d friendships" % len(edges))
+        # friends is a symmetrical m2m, so django stores both directions
+        Friendship = AppUser.friends.through
+        rows = []
+        for a, b in sorted(edges):
+            rows.append(Friendship(from_appuser_id=uids[a],
+                                   to_appuser_id=uids[b]))
+            rows.append(Friendship(from_appuser_id=uids[b],
+                                   to_appuser_id=uids[a]))
+            if len(rows) >= BATCH_SIZE:
+                bulkInsert(Friendship, rows, 'friendships')
+                rows = []
+        bulkInsert(Friendship, rows, 'friendships')
+        counts['friendships'] //= 2
+
+        log("inserting %d events" % numEvents)
+        Participant = Event.participants.through
+        events, participants, locations = [], [], []
+        for i in xrange(numEvents):
+            eid = firstEid + i
+            # a random friend of a random user is more likely to be a popular
+            # user, so popular users host more events
+            host = rng.choice(rng.choice(friendsOf)) if edges else \
+                rng.randrange(numUsers)
+            events.append(Event(
+                eid=eid, title=rng.choice(EVENT_TITLES),
+                date_time=now + datetime.timedelta(
+                    minutes=rng.randint(-30 * 24 * 60, 30 * 24 * 60)),
+                description="synthetic event %d" % i,
+                host_id=uids[host]))
+
+            guests = set([host])
+            numGuests = min(int(rng.expovariate(1.0 / avgParticipants)) + 1,
+                            len(friendsOf[host]) + 1)
+            while len(guests) < numGuests:
+                # mostly friends of the host, sometimes anybody
+                if rng.random() < 0.9:
+                    guests.add(rng.choice(friendsOf[host]))
+                else:
+                    guests.add(rng.randrange(numUsers))
+            for guest in sorted(guests):
+                participants.append(Participant(event_id=eid,
+                                                appuser_id=uids[guest]))
+
+            for j in xrange(rng.randint(1, maxLocations)):
+                locations.append(DumbLocation(
+                    friendly_name=rng.choice(PLACE_NAMES), eventHere_id=eid))
+
+            if len(events) >= BATCH_SIZE:
+                bulkInsert(Event, events, 'events')
+                bulkInsert(Participant, participants, 'participants')
+                bulkInsert(DumbLocation, locations, 'locations')
+                events, participants, locations = [], [], []
+        bulkInsert(Event, events, 'events')
+        bulkInsert(Participant, participants, 'participants')
+        bulkInsert(DumbLocation, locations, 'locations')
+
+        resetSequences(using, [Event, DumbLocation])
+
+    # bulk inserts send no signals, so fill in the counters, the change log,
+    # the search index and the friends feeds directly
+    log("counting")
+    with transaction.commit_on_success(using=using):
+        recomputeCounters(using)
+    log("indexing events for search")
+    with transaction.commit_on_success(using=using):
+        indexEvents(xrange(firstEid, firstEid + numEvents), using)
+    log("building event change log")
+    for start in xrange(firstEid, firstEid + numEvents, 5000):
+        with transaction.commit_on_success(using=using):
+            touchEvents(xrange(start, min(start + 5000, firstEid + numEvents)),
+                        using=using)
+        reset_queries()
+    counts['event changes'] = EventChange.objects.using(using).filter(
+        eid__gte=firstEid).count()
+
+    if buildFeeds:
+        log("building feeds")
+        for start in xrange(firstEid, firstEid + numEvents, 5000):
+            with transaction.commit_on_success(using=using):
+                refreshEventFeeds(xrange(start, min(start + 5000, 
+                                                    firstEid + numEvents)),
+                                  using=using)
+            reset_queries()
+        counts['feed entries'] = FeedEntry.objects.using(using).filter(
+            event__gte=firstEid).count()
+
+    return counts
+
+def deleteGeneratedData(using='default'):
+    '''
+    removes every generated user (and, through cascades, their events,
+    participations, friendships and locations)
+    '''
+    with transaction.commit_on_success(using=using):
+        Event.objects.using(using).filter(host__uid__gte=BASE_UID).delete()
+        AppUser.objects.using(using).filter(uid__gte=BASE_UID).delete()
+    reset_queries()
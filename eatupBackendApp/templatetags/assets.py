@@ -0,0 +1,39 @@
+from __future__ import with_statement
+
+import os, threading
+from django import template
+from django.conf import settings
+from eatupBackendApp.assetBuild import loadManifest, MANIFEST_NAME
+
+register = template.Library()
+
+_manifestLock = threading.Lock()
+# (manifest mtime, {source path: output path})
+_manifestCache = [None, {}]
+
+def getAssetPath(path):
+    '''(string): string
+
+    maps a static source path to its content-hashed build output, reloading
+    the manifest whenever buildassets rewrites it
+    returns the path unchanged if it hasn't been built
+    '''
+    try:
+        mtime = os.stat(os.path.join(settings.STATIC_ROOT, 
+                                     MANIFEST_NAME)).st_mtime
+    except OSError:
+        return path
+    with _manifestLock:
+        if _manifestCache[0] != mtime:
+            files = loadManifest(settings.STATIC_ROOT)
+            _manifestCache[0] = mtime
+            _manifestCache[1] = dict((source, entry['output'])
+                                     for source, entry in files.iteritems())
+        return _manifestCache[1].get(path, path)
+
+@register.simple_tag
+def asset_url(path):
+    '''
+    usage: <script src="{% asset_url "scripts/app.js" %}"></script>
+    '''
+    return settings.STATIC_URL + getAssetPath(path)
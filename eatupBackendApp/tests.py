@@ -5,7 +5,34 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import os, sys, shutil, tempfile, json, random, datetime, time, threading
+import urllib2, sqlite3, socket, signal, subprocess
+from StringIO import StringIO
+from django.contrib import admin
+from django.db import models
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.core.signals import request_finished
+from django.db.backends.sqlite3.base import (
+    DatabaseWrapper as SQLiteDatabaseWrapper)
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.timezone import utc
+from eatupBackendApp import (staticServe, assetBuild, dbRouter, queryStats,
+                             synthData, loadTest, indexes, feed, friendGraph,
+                             attending, sync, schema, changeFeed,
+                             bulkDelete, friendSync, counters, profiling,
+                             metrics, slowQueries, search, jsonRows,
+                             transactionHooks)
+from eatupBackendApp.admin import EventAdmin
+from eatupBackendApp.sqliteTuning import retryOnLock
+from eatupBackendApp.models import (AppUser, Event, DumbLocation, FeedEntry,
+                                    PulledFeedUser, EventChange, ChangeLogEntry)
+from annoying import fields as annoyingFields
+import eatupBackendProj
 
 
 class SimpleTest(TestCase):
@@ -14,3 +41,2237 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class StaticServeTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.root = tempfile.mkdtemp()
+        self.contents = 'var x = 1;' * 20
+        with open(os.path.join(self.root, 'app.js'), 'wb') as f:
+            f.write(self.contents)
+        with open(os.path.join(self.root, 'app.js.gz'), 'wb') as f:
+            f.write('GZ')
+        with open(os.path.join(self.root, 'app.0123456789ab.js'), 'wb') as f:
+            f.write(self.contents)
+        staticServe.clearCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def serve(self, path, **headers):
+        request = self.factory.get('/static/' + path, **headers)
+        return staticServe.serveStatic(request, path, document_root=self.root)
+
+    def test_hashed_names_are_immutable(self):
+        response = self.serve('app.0123456789ab.js')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertNotIn('immutable', self.serve('app.js')['Cache-Control'])
+
+    def test_gzip_sidecar_is_chosen_by_accept_encoding(self):
+        response = self.serve('app.js', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response.content, 'GZ')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+        response = self.serve('app.js', HTTP_ACCEPT_ENCODING='identity')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, self.contents)
+
+    def test_range_requests(self):
+        response = self.serve('app.js', HTTP_RANGE='bytes=4-8')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, self.contents[4:9])
+        self.assertEqual(response['Content-Range'], 
+                         'bytes 4-8/%d' % len(self.contents))
+
+        response = self.serve('app.js', HTTP_RANGE='bytes=-3')
+        self.assertEqual(response.content, self.contents[-3:])
+
+        response = self.serve('app.js', HTTP_RANGE='bytes=9999-')
+        self.assertEqual(response.status_code, 416)
+
+    def test_conditional_requests(self):
+        etag = self.serve('app.js')['ETag']
+        response = self.serve('app.js', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_sendfile_handoff(self):
+        with override_settings(STATIC_SERVE_SENDFILE_HEADER='X-Sendfile'):
+            response = self.serve('app.js')
+        self.assertEqual(response['X-Sendfile'], 
+                         os.path.join(self.root, 'app.js'))
+        self.assertEqual(response.content, '')
+
+
+class AssetBuildTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'scripts'))
+        with open(os.path.join(self.root, 'scripts', 'app.js'), 'wb') as f:
+            f.write("// comment\nvar a = 1 ,\n    b = /re\\/x/g;\n"
+                    "a++\nb = 'not // a comment'\n")
+        with open(os.path.join(self.root, 'site.css'), 'wb') as f:
+            f.write("/* comment */\na :hover {\n  color: red;\n}\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_minifiers(self):
+        self.assertEqual(assetBuild.minifyJs("return /a b/.test(x) // c\n"),
+                         "return/a b/.test(x)\n")
+        self.assertEqual(assetBuild.minifyJs("a++\nb"), "a++\nb\n")
+        self.assertEqual(assetBuild.minifyJs("var x = y /* c */ / 2;"),
+                         "var x=y/2;\n")
+        self.assertEqual(assetBuild.minifyCss("a :hover {\n  color: red;\n}"),
+                         "a :hover{color:red}\n")
+
+    def test_incremental_build(self):
+        summary = assetBuild.buildAssets(self.root, processes=1)
+        self.assertEqual(sorted(summary['built']), 
+                         ['scripts/app.js', 'site.css'])
+        manifest = assetBuild.loadManifest(self.root)
+        output = manifest['scripts/app.js']['output']
+        self.assertTrue(staticServe.HASHED_NAME_REGEX.search(output))
+        self.assertTrue(os.path.exists(os.path.join(self.root, output)))
+        self.assertTrue(os.path.exists(os.path.join(self.root, 
+                                                    output + '.gz')))
+
+        summary = assetBuild.buildAssets(self.root, processes=1)
+        self.assertEqual(summary['built'], [])
+
+        # a changed source replaces its old output
+        with open(os.path.join(self.root, 'site.css'), 'ab') as f:
+            f.write("b { margin: 0 }\n")
+        summary = assetBuild.buildAssets(self.root, processes=1)
+        self.assertEqual(summary['built'], ['site.css'])
+        oldOutput = manifest['site.css']['output']
+        self.assertFalse(os.path.exists(os.path.join(self.root, oldOutput)))
+
+
+class PooledBackendTest(TestCase):
+    def setUp(self):
+        self.dbDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dbDir)
+
+    def makeWrapper(self, name, **poolSettings):
+        from eatupBackendApp.backends.sqlite3_pooled.base import DatabaseWrapper
+        settingsDict = {
+            'ENGINE': 'eatupBackendApp.backends.sqlite3_pooled',
+            'NAME': os.path.join(self.dbDir, name),
+            'OPTIONS': {}, 'USER': '', 'PASSWORD': '', 'HOST': '', 'PORT': '',
+            'TIME_ZONE': 'UTC', 'POOL': poolSettings,
+        }
+        return DatabaseWrapper(settingsDict, alias='pooltest')
+
+    def simulateRequests(self, wrapper, count):
+        for i in xrange(count):
+            wrapper.cursor().execute("SELECT 1")
+            # what django's request_finished handler does
+            wrapper.close()
+
+    def test_no_reconnects_across_requests(self):
+        wrapper = self.makeWrapper('a.db')
+        self.simulateRequests(wrapper, 10000)
+        stats = wrapper.getPool().getStats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 9999)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['in_use'], 0)
+
+    def test_max_age_and_health_check(self):
+        wrapper = self.makeWrapper('b.db', MAX_AGE=-1)
+        self.simulateRequests(wrapper, 3)
+        stats = wrapper.getPool().getStats()
+        self.assertEqual(stats['created'], 3)
+        self.assertEqual(stats['expired'], 3)
+
+        wrapper = self.makeWrapper('c.db', HEALTH_CHECK_INTERVAL=-1)
+        self.simulateRequests(wrapper, 1)
+        # break the idle connection behind the pool's back
+        wrapper.getPool().idle[0][0].close()
+        self.simulateRequests(wrapper, 1)
+        stats = wrapper.getPool().getStats()
+        self.assertEqual(stats['failed_health_checks'], 1)
+        self.assertEqual(stats['created'], 2)
+
+    def test_pool_is_bounded(self):
+        from eatupBackendApp.backends.pool import ConnectionPool, PoolExhausted
+        pool = ConnectionPool(maxSize=2, checkoutTimeout=0.01)
+        connect = lambda: object()
+        first, second = pool.checkout(connect), pool.checkout(connect)
+        self.assertRaises(PoolExhausted, pool.checkout, connect)
+        pool.checkin(first)
+        self.assertTrue(pool.checkout(connect) is first)
+
+
+class SqliteTuningTest(TestCase):
+    def test_lock_errors_are_retried(self):
+        from django.db import DatabaseError
+        from eatupBackendApp.sqliteTuning import runWithRetry
+        calls = []
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise DatabaseError("database is locked")
+            return 'done'
+        self.assertEqual(runWithRetry(flaky, 5, 0), 'done')
+        self.assertEqual(len(calls), 3)
+
+        def broken():
+            calls.append(1)
+            raise DatabaseError("no such table: foo")
+        del calls[:]
+        self.assertRaises(DatabaseError, runWithRetry, broken, 5, 0)
+        self.assertEqual(len(calls), 1)
+
+
+class ReadReplicaRouterTest(TestCase):
+    def setUp(self):
+        self.router = dbRouter.ReadReplicaRouter()
+        self.middleware = dbRouter.ReplicaPinningMiddleware()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        dbRouter.endRequest()
+
+    def startRequest(self, path):
+        self.middleware.process_request(self.factory.get(path))
+
+    @override_settings(DATABASE_REPLICAS=['replica1', 'replica2'],
+                       DATABASE_REPLICA_SELECTION='round-robin')
+    def test_info_reads_go_to_replicas_until_a_write(self):
+        self.startRequest('/info/user/')
+        replica = self.router.db_for_read(AppUser)
+        self.assertIn(replica, ['replica1', 'replica2'])
+        # a request sticks to one replica
+        self.assertEqual(self.router.db_for_read(Event), replica)
+        self.assertEqual(self.router.db_for_write(Event), 'default')
+        # and reads its own writes afterwards
+        self.assertEqual(self.router.db_for_read(Event), 'default')
+        dbRouter.endRequest()
+
+        self.startRequest('/info/event/')
+        self.assertNotEqual(self.router.db_for_read(Event), replica)
+
+    @override_settings(DATABASE_REPLICAS=['replica1'])
+    def test_other_requests_use_the_primary(self):
+        self.startRequest('/edit/event/')
+        self.assertEqual(self.router.db_for_read(Event), 'default')
+        dbRouter.endRequest()
+        # outside of a request (shell, management commands)
+        self.assertEqual(self.router.db_for_read(Event), 'default')
+
+    @override_settings(DATABASE_REPLICAS=['replica1', 'replica2'],
+                       DATABASE_REPLICA_SELECTION='least-connections')
+    def test_least_connections(self):
+        busy = dbRouter.chooseReplica(['replica1', 'replica2'])
+        try:
+            self.startRequest('/info/user/')
+            self.assertNotEqual(self.router.db_for_read(AppUser), busy)
+        finally:
+            dbRouter.releaseReplica(busy)
+
+
+class QueryStatsTest(TestCase):
+    def setUp(self):
+        queryStats.resetViewStats()
+
+    def tearDown(self):
+        queryStats.resetViewStats()
+
+    def test_normalize_sql(self):
+        self.assertEqual(
+            queryStats.normalizeSql(
+                "SELECT * FROM t WHERE id IN (1, 2,3) AND name = 'it''s'"),
+            "SELECT * FROM t WHERE id IN (...) AND name = ?")
+        self.assertEqual(queryStats.normalizeSql("SELECT a1 FROM t2 WHERE x=5"),
+                         "SELECT a1 FROM t2 WHERE x=?")
+
+    def test_summarize_finds_repeated_shapes(self):
+        queries = [{'sql': "SELECT * FROM e WHERE id = %d" % i, 'time': '0.001'}
+                   for i in xrange(4)]
+        queries.append({'sql': "SELECT * FROM u", 'time': '0.002'})
+        summary = queryStats.summarizeQueries(queries, threshold=3)
+        self.assertEqual(summary['count'], 5)
+        self.assertAlmostEqual(summary['time'], 0.006)
+        self.assertEqual(summary['repeated'],
+                         {"SELECT * FROM e WHERE id = ?": 4})
+
+    @override_settings(QUERY_STATS_SAMPLE_RATE=1.0)
+    def test_middleware_headers_and_view_stats(self):
+        response = self.client.get('/info/user/', {'uid': '12345'})
+        self.assertEqual(response['X-Query-Count'], '1')
+        self.assertIn('X-Query-Time-Ms', response)
+        self.assertNotIn('X-Query-Repeated', response)
+        stats = queryStats.getViewStats()
+        self.assertEqual(stats['eatupBackendApp.views.getUser']['requests'], 1)
+
+    @override_settings(QUERY_STATS_SAMPLE_RATE=0.0)
+    def test_unsampled_requests_are_untouched(self):
+        response = self.client.get('/info/user/', {'uid': '12345'})
+        self.assertNotIn('X-Query-Count', response)
+
+
+class SynthDataTest(TestCase):
+    def test_friend_graph_is_seeded_and_skewed(self):
+        import random
+        edges = synthData.powerLawFriendships(2000, 10, random.Random(1))
+        self.assertEqual(edges,
+                         synthData.powerLawFriendships(2000, 10, 
+                                                       random.Random(1)))
+        degrees = {}
+        for a, b in edges:
+            self.assertTrue(a < b)
+            degrees[a] = degrees.get(a, 0) + 1
+            degrees[b] = degrees.get(b, 0) + 1
+        self.assertEqual(len(degrees), 2000)
+        # a power law has hubs far above the median degree
+        median = sorted(degrees.values())[1000]
+        self.assertTrue(max(degrees.values()) > 5 * median)
+
+    def test_generate_dataset(self):
+        counts = synthData.generateDataset(numUsers=300, avgFriends=6,
+                                           eventsPerUser=0.5, seed=3)
+        self.assertEqual(counts['users'], 300)
+        self.assertEqual(AppUser.objects.count(), 300)
+        self.assertEqual(Event.objects.count(), 150)
+        self.assertEqual(DumbLocation.objects.count(), counts['locations'])
+        self.assertEqual(AppUser.friends.through.objects.count(),
+                         2 * counts['friendships'])
+        # every host takes part in their own event
+        event = Event.objects.all()[0]
+        self.assertIn(event.host, event.participants.all())
+
+
+class LoadTestTest(TestCase):
+    def test_every_route_runs_without_errors(self):
+        synthData.generateDataset(numUsers=100, avgFriends=4, seed=0)
+        report = loadTest.runLoadTest(numRequests=3, seed=0)
+        self.assertEqual(sorted(report['routes']), sorted(loadTest.ROUTES))
+        for route, stats in report['routes'].iteritems():
+            self.assertEqual((route, stats['errors']), (route, 0))
+            self.assertEqual(stats['requests'], 3)
+            self.assertTrue(stats['p50_ms'] <= stats['p99_ms'])
+        # deletes only removed what the run created
+        self.assertEqual(AppUser.objects.count(), 100)
+
+    def test_compare_reports(self):
+        before = {'routes': {'info/user': {'rps': 100.0, 'p50_ms': 10.0,
+                                           'p99_ms': 20.0}}}
+        after = {'routes': {'info/user': {'rps': 150.0, 'p50_ms': 5.0,
+                                          'p99_ms': 20.0}}}
+        self.assertEqual(loadTest.compareReports(before, after),
+                         {'info/user': {'rps': 0.5, 'p50_ms': -0.5,
+                                        'p99_ms': 0.0}})
+
+
+class QueryBudgetTest(TestCase):
+    '''
+    every view must run a fixed number of queries, however many friends,
+    events, participants and locations are involved
+
+    each view is run against fixtures of several sizes; the test fails, 
+    showing the SQL, if the query count changes with the size or goes over 
+    the view's budget
+    '''
+    # django deletes and updates related rows in chunks of 100, so the
+    # fixtures stay below 100 rows per relation
+    SIZES = (2, 4, 8)
+
+    def setUp(self):
+        self.debugCursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+
+    def tearDown(self):
+        connection.use_debug_cursor = self.debugCursor
+
+    def buildFixture(self, size):
+        '''
+        makes a user with size friends who hosts size events, each with size
+        participants and size locations, and returns its uid
+        '''
+        baseUid = size * 1000
+        friends = [AppUser(uid=baseUid + i, first_name="friend", 
+                           last_name=str(i)) for i in xrange(1, size + 1)]
+        AppUser.objects.bulk_create(friends)
+        user = AppUser.objects.create(uid=baseUid, first_name="host",
+                                      last_name=str(size))
+        user.friends.add(*friends)
+        for i in xrange(size):
+            event = Event.objects.create(title="event %d" % i, host=user,
+                                         date_time="2013-04-01T12:00:00Z")
+            event.participants.add(user, *friends[:size - 1])
+            DumbLocation.objects.bulk_create([
+                DumbLocation(friendly_name="place %d" % j, eventHere=event)
+                for j in xrange(size)])
+        return user
+
+    def countQueries(self, path, params):
+        # the test client resets connection.queries when a request starts
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('error', response.content)
+        return [query['sql'] for query in connection.queries]
+
+    def assertQueryBudget(self, budget, makeRequest):
+        '''
+        makeRequest(size) builds the fixture for size and returns (path, 
+        params) of the request to check
+        '''
+        counts = {}
+        for size in self.SIZES:
+            path, params = makeRequest(size)
+            queries = self.countQueries(path, params)
+            counts[size] = len(queries)
+            if len(queries) > budget or \
+                    len(queries) != counts[self.SIZES[0]]:
+                self.fail("%s ran %d queries with fixture size %d "
+                          "(budget %d, sizes so far: %r):\n%s" % (
+                    path, len(queries), size, budget, counts,
+                    "\n".join(queries)))
+
+    @override_settings(QUERY_STATS_SAMPLE_RATE=0.0)
+    def test_info_user(self):
+        self.assertQueryBudget(4, lambda size: (
+            '/info/user/', {'uid': self.buildFixture(size).uid}))
+
+    @override_settings(QUERY_STATS_SAMPLE_RATE=0.0)
+    def test_info_event(self):
+        def makeRequest(size):
+            user = self.buildFixture(size)
+            return '/info/event/', {'eid': user.hosting.all()[0].eid}
+        self.assertQueryBudget(3, makeRequest)
+
+    @override_settings(QUERY_STATS_SAMPLE_RATE=0.0)
+    def test_info_userevents(self):
+        self.assertQueryBudget(4, lambda size: (
+            '/info/userevents/', {'uid': self.buildFixture(size).uid}))
+
+    @override_settings(QUERY_STATS_SAMPLE_RATE=0.0)
+    def test_info_userevents_since(self):
+        self.assertQueryBudget(4, lambda size: (
+            '/info/userevents/', {'uid': self.buildFixture(size).uid,
+                                  'since': '0'}))
+
+    @override_settings(QUERY_STATS_SAMPLE_RATE=0.0)
+    def test_info_feed(self):
+        def makeRequest(size):
+            user = self.buildFixture(size)
+            # see the host's events through one of the friends' feeds
+            friend = user.friends.all()[0]
+            return '/info/feed/', {'uid': friend.uid, 'since': '0'}
+        self.assertQueryBudget(6, makeRequest)
+
+    @override_settings(QUERY_STATS_SAMPLE_RATE=0.0)
+    def test_info_search(self):
+        def makeRequest(size):
+            self.buildFixture(size)
+            return '/info/search/', {'q': 'event', 'limit': size}
+        self.assertQueryBudget(4, makeRequest)
+
+    @override_settings(QUERY_STATS_SAMPLE_RATE=0.0)
+    def test_create_user(self):
+        def makeRequest(size):
+            user = self.buildFixture(size)
+            events = [event.eid for event in user.hosting.all()]
+            friends = [friend.uid for friend in user.friends.all()]
+            return '/create/user/', {
+                'uid': user.uid + 999, 'first_name': 'new', 
+                'last_name': 'user', 'participating[]': events,
+                'friends[]': friends}
+        self.assertQueryBudget(38, makeRequest)
+
+    @override_settings(QUERY_STATS_SAMPLE_RATE=0.0)
+    def test_edit_user(self):
+        def makeRequest(size):
+            user = self.buildFixture(size)
+            friends = [friend.uid for friend in user.friends.all()]
+            return '/edit/user/', {'uid': user.uid, 'first_name': 'edited', 
+                                   'friends[]': friends[::-1]}
+        self.assertQueryBudget(11, makeRequest)
+
+    @override_settings(QUERY_STATS_SAMPLE_RATE=0.0)
+    def test_sync_friends(self):
+        def makeRequest(size):
+            user = self.buildFixture(size)
+            friends = [friend.uid for friend in user.friends.all()]
+            newFriends = [AppUser(uid=user.uid + 500 + i, first_name="new",
+                                  last_name=str(i)) for i in xrange(size)]
+            AppUser.objects.bulk_create(newFriends)
+            # keep half, add as many, and some that don't exist
+            return '/sync/friends/', {
+                'uid': user.uid, 
+                'friends[]': friends[:size / 2] + 
+                             [friend.uid for friend in newFriends] +
+                             [user.uid + 900 + i for i in xrange(size)]}
+        self.assertQueryBudget(38, makeRequest)
+
+    @override_settings(QUERY_STATS_SAMPLE_RATE=0.0)
+    def test_create_event(self):
+        def makeRequest(size):
+            user = self.buildFixture(size)
+            friends = [friend.uid for friend in user.friends.all()]
+            return '/create/event/', {
+                'host': user.uid, 'title': 'new', 
+                'date_time_raw': '1364817600000', 'participants[]': friends,
+                'locations[]': ['place %d' % i for i in xrange(size)]}
+        self.assertQueryBudget(33, makeRequest)
+
+    @override_settings(QUERY_STATS_SAMPLE_RATE=0.0)
+    def test_edit_event(self):
+        def makeRequest(size):
+            user = self.buildFixture(size)
+            friends = [friend.uid for friend in user.friends.all()]
+            return '/edit/event/', {
+                'eid': user.hosting.all()[0].eid, 'title': 'edited',
+                'participants[]': friends[::-1],
+                'locations[]': ['new place %d' % i for i in xrange(size)]}
+        self.assertQueryBudget(44, makeRequest)
+
+    @override_settings(QUERY_STATS_SAMPLE_RATE=0.0)
+    def test_delete_event(self):
+        def makeRequest(size):
+            user = self.buildFixture(size)
+            return '/delete/event/', {'eid': user.hosting.all()[0].eid}
+        self.assertQueryBudget(14, makeRequest)
+
+    @override_settings(QUERY_STATS_SAMPLE_RATE=0.0)
+    def test_delete_user(self):
+        # one of them reads the user's friends for the friend graph, when
+        # it's loaded
+        self.assertQueryBudget(36, lambda size: (
+            '/delete/user/', {'uid': self.buildFixture(size).uid}))
+
+
+class IndexesTest(TestCase):
+    def test_syncdb_creates_the_index_set(self):
+        for spec, existing in indexes.checkIndexes():
+            self.assertNotEqual(existing, None, spec)
+
+    def test_missing_index_is_found_and_created(self):
+        spec = indexes.IndexSpec('eatup_test_title', Event, ('title',))
+        self.assertEqual(indexes.checkIndexes(specs=[spec]), [(spec, None)])
+        self.assertEqual(indexes.createMissingIndexes(specs=[spec]),
+                         [spec.createSql(connection)])
+        self.assertEqual(indexes.checkIndexes(specs=[spec]),
+                         [(spec, 'eatup_test_title')])
+
+    def test_explain_uses_indexes(self):
+        for description, queryset in indexes.getHotQueries():
+            plan = indexes.explainQuery(queryset)
+            self.assertFalse(indexes.hasFullScan(plan), 
+                             "%s:\n%s" % (description, plan))
+        self.assertTrue(indexes.hasFullScan("SCAN TABLE eatupBackendApp_event"))
+        self.assertTrue(indexes.hasFullScan("Seq Scan on event  (cost=0.00..1)"))
+
+
+class FeedTest(TestCase):
+    def setUp(self):
+        self.alice = AppUser.objects.create(uid=1, first_name="alice")
+        self.bob = AppUser.objects.create(uid=2, first_name="bob")
+        self.carol = AppUser.objects.create(uid=3, first_name="carol")
+        self.alice.friends.add(self.bob, self.carol)
+        self.dinner = Event.objects.create(title="dinner", host=self.bob,
+                                           date_time="2013-04-02T19:00:00Z")
+        self.lunch = Event.objects.create(title="lunch", host=self.carol,
+                                          date_time="2013-04-02T12:00:00Z")
+
+    def feedOf(self, user):
+        return feed.getFeedEventIds(user, since="2013-01-01T00:00:00Z")[0]
+
+    def test_fan_out_on_join_and_leave(self):
+        self.dinner.participants.add(self.bob)
+        self.assertEqual(self.feedOf(self.alice), [self.dinner.eid])
+        # bob's feed has nothing: alice isn't at dinner
+        self.assertEqual(self.feedOf(self.bob), [])
+
+        self.lunch.participants.add(self.carol)
+        self.assertEqual(self.feedOf(self.alice), 
+                         [self.lunch.eid, self.dinner.eid])
+
+        # through the reverse side of the relation
+        self.carol.participating.clear()
+        self.assertEqual(self.feedOf(self.alice), [self.dinner.eid])
+        self.dinner.participants.remove(self.bob)
+        self.assertEqual(self.feedOf(self.alice), [])
+
+    def test_friendships_and_edits(self):
+        self.dinner.participants.add(self.bob, self.carol)
+        self.bob.friends.add(self.carol)
+        self.assertEqual(self.feedOf(self.bob), [self.dinner.eid])
+
+        self.dinner.date_time = "2013-04-02T09:00:00Z"
+        self.dinner.save()
+        self.assertEqual(
+            FeedEntry.objects.get(user=self.alice, event=self.dinner).date_time,
+            Event.objects.get(pk=self.dinner.pk).date_time)
+
+        self.alice.friends.clear()
+        self.assertEqual(self.feedOf(self.alice), [])
+        self.carol.delete()
+        self.assertEqual(self.feedOf(self.bob), [])
+
+    @override_settings(FEED_FANOUT_LIMIT=1)
+    def test_popular_users_are_merged_on_read(self):
+        # alice has two friends, which is over the limit
+        self.lunch.participants.add(self.alice)
+        self.assertTrue(PulledFeedUser.objects.filter(user=self.alice).exists())
+        self.assertFalse(FeedEntry.objects.filter(event=self.lunch).exists())
+        self.assertEqual(self.feedOf(self.bob), [self.lunch.eid])
+
+    def test_feed_view(self):
+        self.dinner.participants.add(self.bob)
+        self.lunch.participants.add(self.carol)
+        response = self.client.get('/info/feed/', {'uid': 1, 'since': '0',
+                                                   'limit': '1'})
+        data = json.loads(response.content)
+        self.assertEqual([event['eid'] for event in data['events']],
+                         [self.lunch.eid])
+        # upcoming events only by default
+        response = self.client.get('/info/feed/', {'uid': 1})
+        self.assertEqual(json.loads(response.content)['events'], [])
+
+    def test_pages_split_ties(self):
+        self.dinner.participants.add(self.bob)
+        self.lunch.participants.add(self.carol)
+        # events at the same time, some of them across page boundaries
+        tied = []
+        for i in xrange(5):
+            event = Event.objects.create(title="tie %d" % i, host=self.bob,
+                                         date_time="2013-04-02T15:00:00Z")
+            event.participants.add(self.bob if i % 2 else self.carol)
+            tied.append(event.eid)
+        expected = [self.lunch.eid] + tied + [self.dinner.eid]
+        self.assertEqual(self.feedOf(self.alice), expected)
+
+        seen = []
+        params = {'uid': 1, 'since': '0', 'limit': 2}
+        for page in xrange(5):
+            data = json.loads(self.client.get('/info/feed/', params).content)
+            seen.extend(event['eid'] for event in data['events'])
+            if data['next'] is None:
+                break
+            params['after'] = data['next']
+        self.assertEqual(page, 3)
+        self.assertEqual(seen, expected)
+
+        params['after'] = 'x,1'
+        self.assertIn('error', self.client.get('/info/feed/', params).content)
+
+
+class FriendGraphTest(TestCase):
+    def setUp(self):
+        friendGraph.resetGraph()
+        rng = random.Random(1)
+        pairs = synthData.powerLawFriendships(200, 6, rng)
+        self.friendsOf = {}
+        for a, b in pairs:
+            self.friendsOf.setdefault(a, set()).add(b)
+            self.friendsOf.setdefault(b, set()).add(a)
+        self.graph = friendGraph.FriendGraph.fromEdges(
+            (a, b) for a, friends in self.friendsOf.items() for b in friends)
+
+    def tearDown(self):
+        friendGraph.resetGraph()
+
+    def bruteForceCounts(self, uid):
+        counts = {}
+        for friend in self.friendsOf.get(uid, ()):
+            for other in self.friendsOf[friend]:
+                if other != uid and other not in self.friendsOf[uid]:
+                    counts[other] = counts.get(other, 0) + 1
+        return counts
+
+    def bruteForceSuggestions(self, uid, limit):
+        counts = self.bruteForceCounts(uid)
+        return sorted(counts.items(), key=lambda (other, n): (-n, other))[:limit]
+
+    def assertMatchesBruteForce(self, uids):
+        for uid in uids:
+            for useNumpy in (True, False):
+                self.assertEqual(self.graph.mutualFriendCounts(uid, useNumpy),
+                                 self.bruteForceCounts(uid))
+                self.assertEqual(self.graph.suggestions(uid, 5, useNumpy),
+                                 self.bruteForceSuggestions(uid, 5))
+
+    def test_counts_match_brute_force(self):
+        self.assertEqual(self.graph.numEdges(),
+                         sum(map(len, self.friendsOf.values())) // 2)
+        self.assertMatchesBruteForce(range(200) + [1000])
+
+    def test_overlay_and_compact(self):
+        changes = [(0, 150, True), (3, 7, True), (0, 1, False),
+                   (3, 7, False), (150, 199, True), (500, 0, True)]
+        for a, b, added in changes:
+            if added:
+                self.graph.addFriendship(a, b)
+                self.friendsOf.setdefault(a, set()).add(b)
+                self.friendsOf.setdefault(b, set()).add(a)
+            else:
+                self.graph.removeFriendship(a, b)
+                self.friendsOf[a].discard(b)
+                self.friendsOf[b].discard(a)
+        # adding and then removing 3-7 cancelled out
+        self.assertFalse(self.graph.added.get(3))
+        for uid in (0, 3, 150, 199, 500):
+            self.assertEqual(self.graph.friendsOf(uid), self.friendsOf[uid])
+        self.assertMatchesBruteForce([0, 1, 3, 7, 150, 199, 500])
+
+        self.graph = self.graph.compact()
+        self.assertEqual(self.graph.overlaySize, 0)
+        self.assertMatchesBruteForce([0, 1, 3, 7, 150, 199, 500])
+
+    def test_suggestions_view(self):
+        alice = AppUser.objects.create(uid=1, first_name="alice")
+        bob = AppUser.objects.create(uid=2, first_name="bob")
+        carol = AppUser.objects.create(uid=3, first_name="carol",
+                                       last_name="c")
+        alice.friends.add(bob)
+        bob.friends.add(carol)
+        response = self.client.get('/info/suggestions/', {'uid': 1})
+        data = json.loads(response.content)
+        self.assertEqual(data['suggestions'], [{
+            "uid": 3, "first_name": "carol", "last_name": "c",
+            "prof_pic": carol.prof_pic, "mutual_friends": 1}])
+        response = self.client.get('/info/suggestions/', {'uid': 9})
+        self.assertIn('error', json.loads(response.content))
+
+
+class FriendGraphTransactionTest(TransactionTestCase):
+    # real commits and rollbacks, which a TestCase never makes
+    def setUp(self):
+        friendGraph.resetGraph()
+
+    def tearDown(self):
+        friendGraph.resetGraph()
+
+    def test_signals_keep_graph_current(self):
+        alice = AppUser.objects.create(uid=1, first_name="alice")
+        bob = AppUser.objects.create(uid=2, first_name="bob")
+        carol = AppUser.objects.create(uid=3, first_name="carol")
+        dave = AppUser.objects.create(uid=4, first_name="dave")
+        alice.friends.add(bob)
+        bob.friends.add(carol)
+        graph = friendGraph.getGraph()
+        self.assertEqual(graph.suggestions(1), [(3, 1)])
+
+        carol.friends.add(dave)
+        dave.friends.add(alice)
+        self.assertEqual(graph.suggestions(1), [(3, 2)])
+        bob.friends.remove(carol)
+        self.assertEqual(graph.suggestions(1), [(3, 1)])
+        carol.friends.clear()
+        self.assertEqual(graph.suggestions(1), [])
+        self.assertEqual(graph.suggestions(3), [])
+        alice.friends.add(carol)
+        bob.delete()
+        self.assertEqual(graph.friendsOf(1), set([3, 4]))
+        self.assertEqual(graph.suggestions(1), [])
+        # and the graph agrees with the database
+        friendGraph.resetGraph()
+        self.assertEqual(friendGraph.getGraph().friendsOf(1), set([3, 4]))
+
+    def test_rolled_back_changes_never_reach_graph(self):
+        alice, bob, carol = [AppUser.objects.create(uid=uid, first_name=name)
+                             for uid, name in [(1, "alice"), (2, "bob"),
+                                               (3, "carol")]]
+        alice.friends.add(carol)
+        graph = friendGraph.getGraph()
+
+        class Failed(Exception):
+            pass
+        try:
+            with transaction.commit_on_success():
+                alice.friends.add(bob)
+                carol.friends.clear()
+                # the same transaction sees its own changes, the graph not yet
+                self.assertEqual(graph.friendsOf(1), set([3]))
+                raise Failed()
+        except Failed:
+            pass
+        self.assertEqual(sorted(alice.friends.values_list('uid', flat=True)),
+                         [3])
+        self.assertTrue(friendGraph.getGraph() is graph)
+        self.assertEqual(graph.friendsOf(1), set([3]))
+
+        # nor those of views retried or failed under retryOnLock
+        @retryOnLock()
+        def addAndFail():
+            bob.friends.add(carol)
+            # read again from the database inside the transaction, which
+            # sees the change
+            friendGraph.resetGraph()
+            self.assertEqual(friendGraph.getGraph().friendsOf(2), set([3]))
+            raise Failed()
+        self.assertRaises(Failed, addAndFail)
+        self.assertEqual(friendGraph.getGraph().friendsOf(2), set())
+        self.assertEqual(friendGraph.getGraph().friendsOf(3), set([1]))
+
+        with transaction.commit_on_success():
+            alice.friends.add(bob)
+        self.assertEqual(friendGraph.getGraph().friendsOf(1), set([2, 3]))
+
+    def test_plain_backend(self):
+        # with DATABASE_POOL=0 the backend reports no commits or rollbacks
+        pooled = connections['default']
+        pooled.cursor()
+        plain = SQLiteDatabaseWrapper(pooled.settings_dict, 'default')
+        # the in-memory test database
+        plain.connection = pooled.connection
+        connections['default'] = plain
+        try:
+            for uid, name in [(1, "alice"), (2, "bob"), (3, "carol")]:
+                AppUser.objects.create(uid=uid, first_name=name,
+                                       last_name="x")
+            graph = friendGraph.getGraph()
+            self.client.get('/edit/user/', {'uid': 1, 'friends[]': [2, 3]})
+            self.assertTrue(friendGraph.getGraph() is graph)
+            self.assertEqual(graph.friendsOf(1), set([2, 3]))
+
+            # other transactions, which nothing reports, can only be found
+            # unfinished when the request is over
+            with transaction.commit_on_success():
+                AppUser.objects.get(uid=2).friends.remove(3)
+            request_finished.send(sender=self.__class__)
+            self.assertFalse(friendGraph.getGraph() is graph)
+            self.assertEqual(friendGraph.getGraph().friendsOf(3), set([1]))
+        finally:
+            connections['default'] = pooled
+
+
+class FriendsAttendingTest(TestCase):
+    def setUp(self):
+        friendGraph.resetGraph()
+
+    def tearDown(self):
+        friendGraph.resetGraph()
+
+    def test_friends_attending_view(self):
+        viewer = AppUser.objects.create(uid=1, first_name="viewer")
+        friends = [AppUser.objects.create(uid=uid) for uid in (2, 3, 4)]
+        stranger = AppUser.objects.create(uid=5)
+        viewer.friends.add(*friends)
+        dinner = Event.objects.create(title="dinner", host=stranger,
+                                      date_time="2013-04-02T19:00:00Z")
+        dinner.participants.add(friends[2], stranger, friends[0])
+        lunch = Event.objects.create(title="lunch", host=stranger,
+                                     date_time="2013-04-02T12:00:00Z")
+        lunch.participants.add(stranger)
+        response = self.client.get('/info/friendsattending/', {
+            'uid': 1, 'eids[]': [dinner.eid, lunch.eid, 999, dinner.eid]})
+        self.assertEqual(json.loads(response.content)['events'], [
+            {"eid": dinner.eid, "participants_count": 3, "friends_count": 2,
+             "friends": [2, 4]},
+            {"eid": lunch.eid, "participants_count": 1, "friends_count": 0,
+             "friends": []}])
+
+        # friendships made after the graph was loaded count too
+        stranger.friends.add(viewer)
+        response = self.client.get('/info/friendsattending/', {
+            'uid': 1, 'eids[]': [lunch.eid]})
+        self.assertEqual(json.loads(response.content)['events'][0]['friends'],
+                         [5])
+        # and so do those the process' friend graph never heard of, like the
+        # writes of other processes
+        friendGraph.getGraph()
+        AppUser.friends.through.objects.filter(from_appuser=1,
+                                               to_appuser=4).delete()
+        response = self.client.get('/info/friendsattending/', {
+            'uid': 1, 'eids[]': [dinner.eid]})
+        self.assertEqual(json.loads(response.content)['events'][0]['friends'],
+                         [2, 5])
+        response = self.client.get('/info/friendsattending/', {'uid': 1})
+        self.assertIn('error', json.loads(response.content))
+
+
+@override_settings(SYNC_WATERMARK_LAG=0)
+class SyncTest(TestCase):
+    def setUp(self):
+        self.alice = AppUser.objects.create(uid=1, first_name="alice")
+        self.bob = AppUser.objects.create(uid=2, first_name="bob")
+        self.dinner = Event.objects.create(title="dinner", host=self.alice,
+                                           date_time="2013-04-02T19:00:00Z")
+        self.lunch = Event.objects.create(title="lunch", host=self.bob,
+                                          date_time="2013-04-02T12:00:00Z")
+        self.dinner.participants.add(self.alice, self.bob)
+        self.lunch.participants.add(self.alice, self.bob)
+
+    def sync(self, user, since=None):
+        params = {'uid': user.uid}
+        if since is not None:
+            params['since'] = since
+        return json.loads(self.client.get('/info/userevents/',
+                                          params).content)
+
+    def advance(self, data):
+        # let the clock move past the watermark, which has second precision
+        EventChange.objects.update(changed_at=datetime.datetime(
+            2000, 1, 1, tzinfo=utc))
+        return data['watermark']
+
+    def test_deltas(self):
+        full = self.sync(self.alice)
+        self.assertTrue(full['full'])
+        self.assertEqual(len(full['events']), 2)
+        watermark = self.advance(full)
+
+        delta = self.sync(self.alice, watermark)
+        self.assertEqual((delta['full'], delta['events'], delta['removed']),
+                         (False, [], []))
+
+        self.dinner.title = "late dinner"
+        self.dinner.save()
+        delta = self.sync(self.alice, watermark)
+        self.assertEqual([event['title'] for event in delta['events']],
+                         ["late dinner"])
+        watermark = self.advance(delta)
+
+        # leaving an event leaves a tombstone, and the other participants
+        # see the participant list change
+        self.lunch.participants.remove(self.alice)
+        self.assertEqual(self.sync(self.alice, watermark)['removed'],
+                         [self.lunch.eid])
+        self.assertEqual([event['eid'] for event in 
+                          self.sync(self.bob, watermark)['events']],
+                         [self.lunch.eid])
+        watermark = self.advance(delta)
+
+        dinnerId = self.dinner.eid
+        self.dinner.delete()
+        delta = self.sync(self.bob, watermark)
+        self.assertEqual((delta['events'], delta['removed']),
+                         ([], [dinnerId]))
+
+        # too old to trust the tombstones
+        self.assertTrue(self.sync(self.bob, '1000')['full'])
+
+    def test_locations_and_users(self):
+        watermark = self.advance(self.sync(self.bob))
+        self.client.get('/edit/event/', {'eid': self.dinner.eid,
+                                         'locations[]': ['somewhere']})
+        self.assertEqual([event['eid'] for event in
+                          self.sync(self.bob, watermark)['events']],
+                         [self.dinner.eid])
+        watermark = self.advance(self.sync(self.bob))
+
+        # events show their participants' names
+        self.alice.first_name = "alicia"
+        self.alice.save()
+        self.assertEqual(sorted(event['eid'] for event in
+                                self.sync(self.bob, watermark)['events']),
+                         sorted([self.dinner.eid, self.lunch.eid]))
+        watermark = self.advance(self.sync(self.bob))
+
+        # alice's events go with her
+        self.alice.delete()
+        delta = self.sync(self.bob, watermark)
+        self.assertEqual(([event['eid'] for event in delta['events']],
+                          delta['removed']),
+                         ([self.lunch.eid], [self.dinner.eid]))
+
+    def test_prune_tombstones(self):
+        self.lunch.participants.remove(self.alice)
+        self.assertEqual(sync.pruneTombstones(), 0)
+        self.assertEqual(sync.pruneTombstones(
+            now=timezone.now() + datetime.timedelta(days=31)), 1)
+
+    @override_settings(SYNC_WATERMARK_LAG=5)
+    def test_slow_transactions_stamp_their_changes_again(self):
+        longAgo = timezone.now() - datetime.timedelta(minutes=1)
+        justNow = timezone.now()
+
+        @retryOnLock()
+        def slowEdit():
+            sync.touchEvents([self.dinner.pk], now=longAgo)
+            sync.touchEvents([self.lunch.pk], now=justNow)
+        slowEdit()
+        stamps = dict(EventChange.objects.values_list('eid', 'changed_at'))
+        self.assertTrue(stamps[self.dinner.pk] > justNow)
+        self.assertEqual(stamps[self.lunch.pk], justNow)
+
+
+# python's sqlite driver commits before PRAGMA statements, so this can't run
+# inside a TestCase's transaction
+class SchemaTest(TransactionTestCase):
+    def test_upgrade_schema(self):
+        self.assertEqual(schema.getMissingColumns(Event), [])
+        field = Event._meta.get_field('updated_at')
+        self.assertIn('ADD COLUMN', schema.addColumnSql(Event, field))
+        self.assertTrue(schema.addColumnSql(
+            Event, Event._meta.get_field('participant_count'))
+            .endswith("integer NOT NULL DEFAULT 0"))
+        self.assertRaises(ValueError, schema.addColumnSql, Event,
+                          Event._meta.get_field('title'))
+
+        # rows from before change tracking are stamped
+        user = AppUser.objects.create(uid=1, first_name="alice")
+        event = Event.objects.create(title="dinner", host=user,
+                                     date_time="2013-04-02T19:00:00Z")
+        Event.objects.update(updated_at=None)
+        messages = []
+        schema.upgradeSchema(log=messages.append)
+        self.assertEqual(messages, ["stamped 1 Event rows"])
+        self.assertIsNotNone(Event.objects.get(pk=event.pk).updated_at)
+
+
+class FakeWaiter(object):
+    def __init__(self, uid, cursor, deadline=None):
+        self.uid = uid
+        self.cursor = cursor
+        self.deadline = deadline or time.time() + 30
+        self.response = None
+
+    def respond(self, data):
+        self.response = data
+
+
+class ChangeFeedTest(TestCase):
+    def setUp(self):
+        self.alice = AppUser.objects.create(uid=1, first_name="alice")
+        self.bob = AppUser.objects.create(uid=2, first_name="bob")
+        self.dinner = Event.objects.create(title="dinner", host=self.alice,
+                                           date_time="2013-04-02T19:00:00Z")
+
+    def test_log_and_view(self):
+        head = json.loads(self.client.get('/changes/', {'uid': 2}).content)
+        self.dinner.participants.add(self.alice, self.bob)
+        self.assertEqual(sorted(ChangeLogEntry.objects.values_list(
+            'uid', 'eid')), [(1, self.dinner.eid), (2, self.dinner.eid)])
+
+        data = json.loads(self.client.get('/changes/', {
+            'uid': 2, 'cursor': head['cursor']}).content)
+        self.assertEqual((data['events'], data['expired']),
+                         ([self.dinner.eid], False))
+        # leaving tells the user who left too
+        self.dinner.participants.remove(self.bob)
+        data = json.loads(self.client.get('/changes/', {
+            'uid': 2, 'cursor': data['cursor']}).content)
+        self.assertEqual(data['events'], [self.dinner.eid])
+
+        self.assertEqual(changeFeed.pruneChangeLog(), 0)
+        self.assertEqual(changeFeed.pruneChangeLog(
+            now=timezone.now() + datetime.timedelta(days=8)), 3)
+        data = json.loads(self.client.get('/changes/', {
+            'uid': 2, 'cursor': data['cursor']}).content)
+        self.assertFalse(data['expired'])
+        data = json.loads(self.client.get('/changes/', {
+            'uid': 2, 'cursor': 0}).content)
+        self.assertTrue(data['expired'])
+
+    def test_feed_wakes_waiters(self):
+        feed = changeFeed.ChangeFeed(bufferSize=2)
+        bob = FakeWaiter(2, feed.head)
+        feed.wait(bob)
+        self.assertIsNone(bob.response)
+        self.assertEqual(feed.numWaiting(), 1)
+        self.assertEqual(feed.poll(), 0)
+
+        self.dinner.participants.add(self.bob)
+        self.assertEqual(feed.poll(), 1)
+        self.assertEqual(bob.response['events'], [self.dinner.eid])
+        self.assertEqual(feed.numWaiting(), 0)
+
+        # a later request with the old cursor is answered from memory
+        late = FakeWaiter(2, bob.cursor)
+        feed.wait(late)
+        self.assertEqual(late.response['events'], [self.dinner.eid])
+
+        # and once the buffer has moved on, from the database
+        self.dinner.participants.add(self.alice)
+        feed.poll()
+        self.assertGreater(feed.bufferStart, bob.cursor)
+        late = FakeWaiter(2, bob.cursor)
+        feed.wait(late)
+        self.assertEqual(late.response['events'], [self.dinner.eid])
+
+        idle = FakeWaiter(2, feed.head, deadline=time.time() - 1)
+        feed.wait(idle)
+        feed.expire(time.time())
+        self.assertEqual(idle.response['events'], [])
+
+    def test_late_commits_are_delivered(self):
+        feed = changeFeed.ChangeFeed()
+        now = timezone.now()
+        first = ChangeLogEntry.objects.create(uid=1, eid=1, created_at=now)
+        ChangeLogEntry.objects.create(uid=1, eid=2, created_at=now)
+        feed.head = first.pk
+        # as if the first entry's transaction hadn't committed yet
+        feed.head = first.pk + 1
+        feed.gaps = {first.pk: time.time()}
+        alice = FakeWaiter(1, feed.head)
+        feed.wait(alice)
+        feed.poll()
+        self.assertEqual(alice.response['events'], [1])
+        self.assertEqual(feed.gaps, {})
+
+    def test_server(self):
+        feed = changeFeed.ChangeFeed()
+        server = changeFeed.ChangeFeedServer('127.0.0.1', 0, feed,
+                                             pollInterval=0.05)
+        port = server.socket.getsockname()[1]
+        responses = []
+
+        def longPoll():
+            url = 'http://127.0.0.1:%d/changes/?uid=2&cursor=%d&timeout=5' % (
+                port, feed.head)
+            responses.append(json.loads(urllib2.urlopen(url).read()))
+        client = threading.Thread(target=longPoll)
+        client.start()
+        try:
+            deadline = time.time() + 5
+            while not feed.numWaiting() and time.time() < deadline:
+                server.serveOnce()
+            self.dinner.participants.add(self.bob)
+            while client.is_alive() and time.time() < deadline:
+                server.serveOnce()
+        finally:
+            client.join(5)
+            server.close()
+        self.assertEqual(responses[0]['events'], [self.dinner.eid])
+
+
+class AdminTest(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        self.alice = AppUser.objects.create(uid=1, first_name="alice")
+        self.bob = AppUser.objects.create(uid=2, first_name="bob")
+        self.events = []
+        for day in xrange(1, 8):
+            event = Event.objects.create(
+                title="dinner %d" % day, host=self.alice,
+                date_time=datetime.datetime(2013, 4, day, 19, tzinfo=utc))
+            event.participants.add(self.alice, self.bob)
+            DumbLocation.objects.create(friendly_name="place %d" % day,
+                                        eventHere=event)
+            self.events.append(event)
+        self.eventAdmin = admin.site._registry[Event]
+        self.eventAdmin.list_per_page = 3
+
+    def tearDown(self):
+        self.eventAdmin.list_per_page = EventAdmin.list_per_page
+
+    def test_keyset_pages(self):
+        url = '/admin/eatupBackendApp/event/'
+        pages = []
+        connection.use_debug_cursor = True
+        try:
+            while url is not None:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                cl = response.context['cl']
+                pages.append([(event.eid, event.participant_count,
+                               event.location_count)
+                              for event in cl.result_list])
+                for query in connection.queries:
+                    self.assertNotIn('COUNT(*) FROM "eatupBackendApp_event"',
+                                     query['sql'])
+                if cl.next_page_url is not None:
+                    url = '/admin/eatupBackendApp/event/' + cl.next_page_url
+                else:
+                    url = None
+        finally:
+            connection.use_debug_cursor = False
+        eventIds = [event.eid for event in reversed(self.events)]
+        self.assertEqual(pages, [[(eventId, 2, 1) for eventId in eventIds[:3]],
+                                 [(eventId, 2, 1) for eventId in eventIds[3:6]],
+                                 [(eventIds[6], 2, 1)]])
+
+        # sorted by a column, pages go by offset
+        response = self.client.get('/admin/eatupBackendApp/event/', 
+                                   {'o': '2', 'p': '1'})
+        self.assertEqual([event.eid for event in 
+                          response.context['cl'].result_list],
+                         [event.eid for event in self.events[3:6]])
+        self.assertEqual(unicode(response.context['cl'].result_count), u"7+")
+
+    def test_bulk_delete_actions(self):
+        changelist = '/admin/eatupBackendApp/event/'
+        selected = [self.events[0].eid, self.events[1].eid]
+        data = {'action': 'purge_past_events', 'index': 0,
+                '_selected_action': selected}
+        response = self.client.post(changelist, data)
+        self.assertContains(response, "Yes, I'm sure")
+        self.assertEqual(Event.objects.count(), 7)
+
+        data['post'] = 'yes'
+        response = self.client.post(changelist, data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Event.objects.count(), 5)
+        self.assertFalse(Event.participants.through.objects.filter(
+            event__in=selected).exists())
+        self.assertFalse(DumbLocation.objects.filter(
+            eventHere__in=selected).exists())
+        self.assertEqual(EventChange.objects.filter(
+            eid__in=selected, removed=False).count(), 0)
+        self.assertEqual(EventChange.objects.filter(
+            eid__in=selected, removed=True).count(), 4)
+
+        location = self.events[2].locations.get()
+        self.client.post('/admin/eatupBackendApp/dumblocation/', {
+            'action': 'delete_locations', 'index': 0, 'post': 'yes',
+            '_selected_action': [location.pk]})
+        self.assertFalse(DumbLocation.objects.filter(pk=location.pk).exists())
+
+    def test_event_page_links_to_its_locations(self):
+        event = self.events[0]
+        for i in xrange(300):
+            DumbLocation.objects.create(friendly_name="stop %d" % i,
+                                        eventHere=event)
+        response = self.client.get('/admin/eatupBackendApp/event/%d/' %
+                                   event.eid)
+        url = '/admin/eatupBackendApp/dumblocation/?eventHere__eid__exact=%d' \
+            % event.eid
+        self.assertContains(response, '<a href="%s">301 locations</a>' % url)
+        self.assertNotContains(response, "stop 1")
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(location.eventHere_id for location in
+                             response.context['cl'].result_list),
+                         set([event.eid]))
+        self.assertContains(self.client.get('/admin/eatupBackendApp/event/'
+                                            'add/'), "once the event is saved")
+
+    def test_dependents_cover_every_relation(self):
+        related = set((relation.model, relation.field.name) for relation in
+                      Event._meta.get_all_related_objects(include_hidden=True))
+        self.assertEqual(related, set(bulkDelete.EVENT_DEPENDENTS))
+
+
+class FriendSyncTest(TestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol, self.dave = [
+            AppUser.objects.create(uid=uid, first_name=name) for uid, name in
+            enumerate(["alice", "bob", "carol", "dave"], 1)]
+        self.alice.friends.add(self.bob, self.carol)
+        self.dinner = Event.objects.create(title="dinner", host=self.dave,
+                                           date_time="2013-04-02T19:00:00Z")
+        self.dinner.participants.add(self.dave)
+        self.commit()
+
+    def commit(self):
+        # what the backend does when the transaction commits, which it never
+        # does in a TestCase
+        transactionHooks.transactionEnded('default', True)
+
+    def friendsOf(self, user):
+        return sorted(AppUser.objects.get(pk=user.pk).friends
+                      .values_list('uid', flat=True))
+
+    def test_set_friends(self):
+        graph = friendGraph.getGraph()
+        try:
+            friends, added, removed = friendSync.setFriends(
+                self.alice, [3, 4, 4, 1, 999])
+            self.commit()
+            self.assertEqual((friends, added, removed), 
+                             (set([3, 4]), set([4]), set([2])))
+            # both directions of the relation
+            self.assertEqual(self.friendsOf(self.alice), [3, 4])
+            self.assertEqual(self.friendsOf(self.bob), [])
+            self.assertEqual(self.friendsOf(self.dave), [1])
+            # the feed and the friend graph heard about it
+            self.assertEqual(feed.getFeedEventIds(self.alice, 
+                                                  "2013-01-01T00:00:00Z")[0],
+                             [self.dinner.eid])
+            self.assertEqual(sorted(graph.friendsOf(1)), [3, 4])
+            self.assertEqual(sorted(graph.friendsOf(2)), [])
+        finally:
+            friendGraph.resetGraph()
+
+    def test_one_sided_rows_are_repaired(self):
+        Friendship = AppUser.friends.through
+        Friendship.objects.filter(from_appuser=self.carol).delete()
+        Friendship.objects.create(from_appuser=self.dave, 
+                                  to_appuser=self.alice)
+        friendSync.setFriends(self.alice, [2, 3])
+        self.assertEqual(self.friendsOf(self.carol), [1])
+        self.assertEqual(self.friendsOf(self.dave), [])
+
+    @override_settings(FEED_FANOUT_LIMIT=3)
+    def test_feeds_match_a_full_refresh(self):
+        rng = random.Random(7)
+        users = [self.alice, self.bob, self.carol, self.dave] + [
+            AppUser.objects.create(uid=uid, first_name="user %d" % uid)
+            for uid in xrange(5, 12)]
+        uids = [user.uid for user in users]
+        for i in xrange(6):
+            event = Event.objects.create(title="event %d" % i, 
+                                         host=rng.choice(users),
+                                         date_time="2013-04-02T19:00:00Z")
+            event.participants.add(*rng.sample(users, 3))
+        for step in xrange(12):
+            user = rng.choice(users)
+            if step % 3 == 0:
+                user.friends.add(*rng.sample(users, 2))
+            elif step % 3 == 1:
+                user.friends.remove(*rng.sample(users, 2))
+            else:
+                friendSync.setFriends(user, rng.sample(uids, rng.randint(0, 6)))
+            entries = set(FeedEntry.objects.values_list('user', 'event'))
+            pulled = set(PulledFeedUser.objects.values_list('user', flat=True))
+            feed.refreshEventFeeds(Event.objects.values_list('eid', flat=True))
+            self.assertEqual(
+                (entries, pulled),
+                (set(FeedEntry.objects.values_list('user', 'event')),
+                 set(PulledFeedUser.objects.values_list('user', flat=True))),
+                "after step %d" % step)
+
+    def test_view(self):
+        response = self.client.post('/sync/friends/', {
+            'uid': 1, 'friends[]': ['2', '4', '12345']})
+        self.assertEqual(json.loads(response.content), {
+            'status': 'ok', 'uid': 1, 'friends_count': 2, 'added': 1,
+            'removed': 1, 'ignored': 1})
+        response = self.client.post('/sync/friends/', {'uid': 1, 
+                                                       'friends': ''})
+        self.assertEqual(json.loads(response.content)['removed'], 2)
+        self.assertEqual(self.friendsOf(self.alice), [])
+        for params in ({'uid': 1}, {'uid': 77, 'friends[]': ['2']},
+                       {'uid': 1, 'friends[]': ['bob']}):
+            response = self.client.post('/sync/friends/', params)
+            self.assertIn('error', json.loads(response.content))
+
+
+class CounterTest(TestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol = [
+            AppUser.objects.create(uid=uid, first_name=name, last_name="user")
+            for uid, name in enumerate(["alice", "bob", "carol"], 1)]
+
+    def counts(self):
+        return (list(Event.objects.order_by('eid').values_list(
+                    'eid', 'participant_count', 'location_count')),
+                list(AppUser.objects.order_by('uid').values_list(
+                    'uid', 'hosting_count', 'friend_count')))
+
+    def test_counters_follow_writes(self):
+        rng = random.Random(3)
+        users = [self.alice, self.bob, self.carol] + [
+            AppUser.objects.create(uid=uid, first_name="user %d" % uid)
+            for uid in xrange(4, 10)]
+        events = []
+        for step in xrange(60):
+            users = list(AppUser.objects.all())
+            user = rng.choice(users)
+            events = list(Event.objects.all())
+            locations = list(DumbLocation.objects.all())
+            action = step % 12 if events else 0
+            if action == 0:
+                event = Event.objects.create(
+                    title="event %d" % step, host=user,
+                    date_time="2013-04-02T19:00:00Z")
+                event.participants.add(*rng.sample(users, 3))
+                DumbLocation.objects.create(friendly_name="place",
+                                            eventHere=event)
+            elif action == 1:
+                rng.choice(events).participants.remove(*rng.sample(users, 3))
+            elif action == 2:
+                user.participating.add(*rng.sample(events, 
+                                                   min(2, len(events))))
+            elif action == 3:
+                user.participating.remove(rng.choice(events))
+            elif action == 4:
+                rng.choice([user.participating, 
+                            rng.choice(events).participants]).clear()
+            elif action == 5:
+                user.friends.add(*rng.sample(users, 2))
+            elif action == 6:
+                user.friends.remove(*rng.sample(users, 2))
+            elif action == 7:
+                friendSync.setFriends(user, rng.sample(
+                    [other.uid for other in users], rng.randint(0, 4)))
+            elif action == 8:
+                # a new host, and a location that moves
+                event = rng.choice(events)
+                event.host = user
+                event.save()
+                if locations:
+                    location = rng.choice(locations)
+                    location.eventHere = rng.choice(events)
+                    location.save()
+            elif action == 9:
+                rng.choice(events).delete()
+                if locations:
+                    rng.choice(locations).delete()
+            elif action == 10:
+                bulkDelete.deleteLocations([location.pk for location in
+                                            rng.sample(locations, min(
+                                                2, len(locations)))])
+                bulkDelete.deleteEvents([rng.choice(events).eid])
+            elif action == 11 and len(users) > 4:
+                user.delete()
+            counts = self.counts()
+            self.assertEqual(counters.recomputeCounters(), 0, 
+                             "after step %d" % step)
+            self.assertEqual(self.counts(), counts)
+
+    def test_stale_instance_keeps_counts(self):
+        dinner = Event.objects.create(title="dinner", host=self.alice,
+                                      date_time="2013-04-02T19:00:00Z")
+        stale = Event.objects.get(pk=dinner.pk)
+        dinner.participants.add(self.alice, self.bob)
+        self.assertEqual(dinner.participant_count, 2)
+        stale.title = "supper"
+        stale.save()
+        self.assertEqual(Event.objects.get(pk=dinner.pk).participant_count, 2)
+        self.assertEqual(AppUser.objects.get(pk=1).hosting_count, 1)
+
+    def test_views_and_json(self):
+        response = self.client.get('/create/event/', {
+            'host': 1, 'title': 'dinner', 'date_time_raw': '1364817600000',
+            'participants[]': ['2', '3'], 'locations[]': ['here', 'there']})
+        eid = json.loads(response.content)['eid']
+        response = self.client.get('/edit/user/', {'uid': 1, 
+                                                   'friends[]': ['2', '3']})
+        self.assertEqual(json.loads(response.content)['status'], 'ok')
+        eventDict = json.loads(self.client.get('/info/event/', 
+                                               {'eid': eid}).content)
+        self.assertEqual((eventDict['participant_count'], 
+                          eventDict['location_count']), (3, 2))
+        userDict = json.loads(self.client.get('/info/user/', 
+                                              {'uid': 1}).content)
+        self.assertEqual((userDict['hosting_count'], 
+                          userDict['friend_count']), (1, 2))
+        self.client.get('/edit/event/', {'eid': eid, 'locations[]': ['here']})
+        self.client.get('/delete/user/', {'uid': 2})
+        self.assertEqual(self.counts(), ([(eid, 2, 1)], 
+                                         [(1, 1, 1), (3, 0, 1)]))
+
+    def test_recompute_repairs_drift(self):
+        self.alice.friends.add(self.bob)
+        AppUser.objects.filter(pk=1).update(friend_count=7, hosting_count=-1)
+        messages = []
+        self.assertEqual(counters.recomputeCounters(log=messages.append), 2)
+        self.assertEqual(messages, ["fixed AppUser.hosting_count of 1 rows",
+                                    "fixed AppUser.friend_count of 1 rows"])
+        self.assertEqual(self.counts()[1], [(1, 0, 1), (2, 0, 1), (3, 0, 0)])
+
+
+class JsonBlob(models.Model):
+    data = annoyingFields.JSONField(blank=True, null=True)
+
+    class Meta:
+        app_label = 'eatupBackendApp'
+        # only ever built in memory
+        managed = False
+
+
+class CountingJson(object):
+    '''
+    the json module, counting the documents it decodes
+    '''
+    def __init__(self):
+        self.decoded = 0
+
+    def __getattr__(self, name):
+        return getattr(json, name)
+
+    def loads(self, *args, **kwargs):
+        self.decoded += 1
+        return json.loads(*args, **kwargs)
+
+
+class JSONFieldTest(TestCase):
+    def setUp(self):
+        self.json = CountingJson()
+        self.realJson = annoyingFields.json
+        annoyingFields.json = self.json
+        self.field = JsonBlob._meta.get_field('data')
+
+    def tearDown(self):
+        annoyingFields.json = self.realJson
+
+    def prepSave(self, blob):
+        return self.field.get_db_prep_save(self.field.pre_save(blob, False),
+                                           connection=connection)
+
+    def test_decodes_on_first_access_only(self):
+        blob = JsonBlob(1, '{"a": [1, 2]}')
+        self.assertEqual(self.json.decoded, 0)
+        # untouched, the loaded string is saved as it is
+        self.assertEqual(self.prepSave(blob), '{"a": [1, 2]}')
+        self.assertEqual(blob.data, {"a": [1, 2]})
+        self.assertIs(blob.data, blob.data)
+        self.assertEqual(self.json.decoded, 1)
+
+    def test_read_values_are_saved_as_loaded(self):
+        blob = JsonBlob(1, '{"b":  [1, 2],"a": 1}')
+        self.assertEqual(blob.data["b"], [1, 2])
+        self.assertEqual(self.prepSave(blob), '{"b":  [1, 2],"a": 1}')
+        # changed in place and back again
+        blob.data["b"].append(3)
+        self.assertEqual(json.loads(self.prepSave(blob)),
+                         {"a": 1, "b": [1, 2, 3]})
+        blob.data["b"].pop()
+        self.assertEqual(self.prepSave(blob), '{"b":  [1, 2],"a": 1}')
+        # an assigned value is always encoded
+        blob.data = {"b": [1, 2], "a": 1}
+        self.assertEqual(json.loads(self.prepSave(blob)),
+                         {"a": 1, "b": [1, 2]})
+        self.assertNotEqual(self.prepSave(blob), '{"b":  [1, 2],"a": 1}')
+
+    def test_changes_are_encoded(self):
+        blob = JsonBlob(1, '{"a": 1}')
+        blob.data['b'] = 2
+        self.assertEqual(json.loads(self.prepSave(blob)), {"a": 1, "b": 2})
+        blob.data = [3]
+        self.assertEqual(self.prepSave(blob), '[3]')
+        blob.data = '{"c": 4}'
+        self.assertEqual(blob.data, {"c": 4})
+
+    def test_empty_and_invalid_values(self):
+        self.assertIsNone(JsonBlob(1, None).data)
+        self.assertIsNone(JsonBlob(1, "").data)
+        self.assertIsNone(self.prepSave(JsonBlob(1, "")))
+        self.assertEqual(JsonBlob(1, "not json").data, "not json")
+        self.assertEqual(self.prepSave(JsonBlob(1, "not json")), "not json")
+
+
+class AutoParent(models.Model):
+    name = models.CharField(max_length=32)
+
+    class Meta:
+        app_label = 'eatupBackendApp'
+
+
+class AutoProfile(models.Model):
+    # keyed by the parent, like the docstring's example
+    parent = annoyingFields.AutoOneToOneField(AutoParent, primary_key=True,
+                                              related_name='profile')
+    theme = models.CharField(max_length=32, default="light")
+
+    class Meta:
+        app_label = 'eatupBackendApp'
+
+
+class AutoNote(models.Model):
+    parent = annoyingFields.AutoOneToOneField(AutoParent, related_name='note')
+    text = models.CharField(max_length=32, blank=True)
+
+    class Meta:
+        app_label = 'eatupBackendApp'
+
+
+class AutoOneToOneFieldTest(TestCase):
+    def setUp(self):
+        self.parents = [AutoParent.objects.create(name=str(i)) 
+                        for i in xrange(6)]
+        for parent in self.parents[:2]:
+            AutoProfile.objects.create(parent=parent, theme="dark")
+            AutoNote.objects.create(parent=parent, text="hi")
+
+    def test_created_on_first_access(self):
+        parent = AutoParent.objects.get(pk=self.parents[3].pk)
+        with self.assertNumQueries(2):
+            profile = parent.profile
+        with self.assertNumQueries(0):
+            self.assertIs(parent.profile, profile)
+            self.assertIs(profile.parent, parent)
+        self.assertEqual(AutoProfile.objects.get(pk=parent.pk).theme, "light")
+        with self.assertNumQueries(2):
+            self.assertIsNotNone(parent.note.pk)
+
+    def test_losing_a_race_reads_the_winner(self):
+        parent = self.parents[0]
+        descriptor = AutoParent.profile
+        self.assertEqual(descriptor.create(parent).theme, "dark")
+        self.assertEqual(AutoParent.note.create(parent).text, "hi")
+        self.assertEqual(AutoProfile.objects.count(), 2)
+
+    def test_prefetch_creates_missing_in_bulk(self):
+        for name, queries in (('profile', 3), ('note', 4)):
+            # the parents, the related rows, one insert, and reading back the
+            # automatic keys of the new notes
+            with self.assertNumQueries(queries):
+                parents = list(AutoParent.objects.order_by('pk')
+                               .prefetch_related(name))
+                values = [getattr(parent, name) for parent in parents]
+            self.assertEqual([value.parent_id for value in values],
+                             [parent.pk for parent in self.parents])
+        self.assertEqual(AutoProfile.objects.count(), 6)
+        # nothing left to create
+        with self.assertNumQueries(3):
+            list(AutoParent.objects.prefetch_related('profile', 'note'))
+
+    def test_select_related_creates_missing(self):
+        parents = list(AutoParent.objects.order_by('pk')
+                       .select_related('profile'))
+        with self.assertNumQueries(0):
+            self.assertEqual(parents[0].profile.theme, "dark")
+        with self.assertNumQueries(1):
+            self.assertEqual(parents[4].profile.theme, "light")
+
+
+class ProfilingTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        AppUser.objects.create(uid=1, first_name="alice")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def profiles(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_only_sampled_requests_are_profiled(self):
+        with self.settings(PROFILE_DIR=self.directory, PROFILE_SAMPLE_RATE=0.0,
+                           PROFILE_HEADER_TOKEN='secret'):
+            response = self.client.get('/info/user/', {'uid': 1})
+            self.assertNotIn('X-Profile-File', response)
+            self.client.get('/info/user/', {'uid': 1}, HTTP_X_PROFILE='guess')
+            self.assertEqual(self.profiles(), [])
+            response = self.client.get('/info/user/', {'uid': 1}, 
+                                       HTTP_X_PROFILE='secret')
+            self.assertEqual(self.profiles(), [response['X-Profile-File']])
+            self.assertTrue(response['X-Profile-File'].startswith(
+                'eatupBackendApp.views.getUser.'))
+        with self.settings(PROFILE_DIR=self.directory, PROFILE_SAMPLE_RATE=1.0,
+                           PROFILE_HEADER_TOKEN=''):
+            self.client.get('/info/user/', {'uid': 1}, HTTP_X_PROFILE='')
+            self.assertEqual(len(self.profiles()), 2)
+
+    def test_directory_is_capped(self):
+        with self.settings(PROFILE_DIR=self.directory, PROFILE_SAMPLE_RATE=1.0):
+            first = self.client.get('/info/user/', {'uid': 1})
+            size = os.path.getsize(os.path.join(self.directory, 
+                                                first['X-Profile-File']))
+            with self.settings(PROFILE_DIR_MAX_BYTES=size * 2.5):
+                for i in xrange(4):
+                    last = self.client.get('/info/user/', {'uid': 1})
+        profiles = self.profiles()
+        self.assertTrue(1 <= len(profiles) <= 3, profiles)
+        self.assertNotIn(first['X-Profile-File'], profiles)
+        self.assertIn(last['X-Profile-File'], profiles)
+
+    def test_summary(self):
+        with self.settings(PROFILE_DIR=self.directory, PROFILE_SAMPLE_RATE=1.0):
+            for i in xrange(2):
+                self.client.get('/info/user/', {'uid': 1})
+            self.client.get('/info/event/', {'eid': 1})
+        stacks, count = profiling.summarizeProfiles(
+            self.directory, 'eatupBackendApp.views.getUser')
+        self.assertEqual(count, 2)
+        self.assertTrue(stacks)
+        for stack, micros in stacks.iteritems():
+            frames = stack.split(';')
+            self.assertEqual(frames[0], 'eatupBackendApp.views.getUser')
+            self.assertGreater(micros, 0)
+        # the view's own frame is under the view's name
+        self.assertTrue(any('eatupBackendApp/views.py:getUser:' in stack
+                            for stack in stacks))
+
+        output = StringIO()
+        errors = StringIO()
+        call_command('profilesummary', directory=self.directory, stdout=output,
+                     stderr=errors)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(errors.getvalue(), 
+                         "%d stacks from 3 profiles\n" % len(lines))
+        for line in lines:
+            stack, micros = line.rsplit(' ', 1)
+            self.assertTrue(stack.startswith('eatupBackendApp.views.get'))
+            int(micros)
+
+TEST_JOBS = metrics.Counter('test_jobs_total', "Jobs done.", ('queue',))
+TEST_QUEUE_LENGTH = metrics.Gauge('test_queue_length', "Jobs waiting.")
+TEST_JOB_SECONDS = metrics.Histogram('test_job_seconds', "Job latency.",
+                                     ('queue',), buckets=(0.1, 1))
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        metrics.resetValues()
+
+    def tearDown(self):
+        metrics.resetValues()
+        shutil.rmtree(self.directory)
+
+    def scrape(self, **extra):
+        response = self.client.get('/metrics', **extra)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        return response.content.splitlines()
+
+    def test_exposition_format(self):
+        with self.settings(METRICS_DIR=None):
+            TEST_JOBS.inc(('mail',))
+            TEST_JOBS.inc(('mail',), 2)
+            TEST_JOBS.inc(('a\\b "c"\n',))
+            TEST_QUEUE_LENGTH.set(7)
+            for seconds in (0.05, 0.1, 0.5, 3):
+                TEST_JOB_SECONDS.observe(seconds, ('mail',))
+            self.assertRaises(ValueError, TEST_JOBS.inc, ('mail',), -1)
+            self.assertRaises(ValueError, TEST_JOBS.inc, ())
+            lines = self.scrape()
+        self.assertIn('# HELP test_jobs_total Jobs done.', lines)
+        self.assertIn('# TYPE test_jobs_total counter', lines)
+        self.assertIn('test_jobs_total{queue="mail"} 3.0', lines)
+        self.assertIn(r'test_jobs_total{queue="a\\b \"c\"\n"} 1.0', lines)
+        self.assertIn('# TYPE test_queue_length gauge', lines)
+        self.assertIn('test_queue_length 7.0', lines)
+        self.assertIn('# TYPE test_job_seconds histogram', lines)
+        histogram = [line for line in lines
+                     if line.startswith('test_job_seconds_')]
+        self.assertEqual(histogram, [
+            'test_job_seconds_bucket{queue="mail",le="0.1"} 2.0',
+            'test_job_seconds_bucket{queue="mail",le="1.0"} 3.0',
+            'test_job_seconds_bucket{queue="mail",le="+Inf"} 4.0',
+            'test_job_seconds_sum{queue="mail"} 3.65',
+            'test_job_seconds_count{queue="mail"} 4.0',
+        ])
+
+    def test_processes_are_added_up(self):
+        with self.settings(METRICS_DIR=self.directory):
+            TEST_JOBS.inc(('mail',), 2)
+            TEST_QUEUE_LENGTH.set(3)
+            TEST_JOB_SECONDS.observe(0.5, ('mail',))
+            pid = os.fork()
+            if pid == 0:
+                # a worker that has come and gone: its counts stay, its gauge
+                # doesn't
+                try:
+                    TEST_JOBS.inc(('mail',), 5)
+                    TEST_QUEUE_LENGTH.set(100)
+                    TEST_JOB_SECONDS.observe(2, ('mail',))
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+            self.assertEqual(len([filename
+                                  for filename in os.listdir(self.directory)
+                                  if metrics.pidOfFilename(filename)]), 2)
+            lines = self.scrape()
+            # the worker's file is gone, its numbers are in the archive
+            self.assertFalse(os.path.exists(os.path.join(
+                self.directory, metrics.valuesFilename(pid))))
+            self.assertTrue(os.path.exists(os.path.join(
+                self.directory, metrics.ARCHIVE_FILENAME)))
+            self.assertEqual(self.scrape(), lines)
+        self.assertIn('test_jobs_total{queue="mail"} 7.0', lines)
+        self.assertIn('test_queue_length{pid="%d"} 3.0' % os.getpid(), lines)
+        self.assertEqual([line for line in lines
+                          if line.startswith('test_queue_length{')],
+                         ['test_queue_length{pid="%d"} 3.0' % os.getpid()])
+        self.assertIn('test_job_seconds_bucket{queue="mail",le="1.0"} 1.0',
+                      lines)
+        self.assertIn('test_job_seconds_bucket{queue="mail",le="+Inf"} 2.0',
+                      lines)
+        self.assertIn('test_job_seconds_sum{queue="mail"} 2.5', lines)
+
+    def test_values_file_grows_and_is_reopened(self):
+        path = os.path.join(self.directory, metrics.valuesFilename(1))
+        values = metrics.MmapValues(path)
+        keys = [('counter', 'test_big_total', ('n',), (str(i) * 20,), '')
+                for i in xrange(3000)]
+        for i, key in enumerate(keys):
+            values.add(key, i)
+            values.add(key, 1)
+        self.assertGreater(os.path.getsize(path), metrics.INITIAL_FILE_SIZE)
+        values.close()
+        self.assertEqual(dict(metrics.readValuesFile(path)),
+                         dict((key, i + 1.0) for i, key in enumerate(keys)))
+        gauge = ('gauge', 'test_level', (), (), '')
+        values = metrics.MmapValues(path)
+        values.set(gauge, 7)
+        values.close()
+        # by a later process with the same pid, which has its own gauges
+        reopened = metrics.MmapValues(path)
+        reopened.add(keys[5], 10)
+        reopened.close()
+        self.assertEqual(dict(metrics.readValuesFile(path))[keys[5]], 16.0)
+        self.assertEqual(dict(metrics.readValuesFile(path))[gauge], 0.0)
+
+    def test_views_are_measured(self):
+        AppUser.objects.create(uid=1, first_name="alice", last_name="a")
+        with self.settings(METRICS_DIR=self.directory, METRICS_TOKEN='secret'):
+            response = self.client.get('/info/user/', {'uid': 1})
+            self.client.get('/info/user/', {'uid': 2})
+            self.client.get('/info/user/')
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            lines = self.scrape(HTTP_AUTHORIZATION='Bearer secret')
+        view = 'view="eatupBackendApp.views.getUser"'
+        self.assertIn('eatup_view_seconds_count{%s} 3.0' % view, lines)
+        self.assertIn('eatup_view_db_seconds_count{%s} 3.0' % view, lines)
+        self.assertIn('eatup_view_errors_total{%s,kind="error"} 2.0' % view,
+                      lines)
+        sizes = [line for line in lines
+                 if line.startswith('eatup_view_response_bytes_sum{%s}' % view)]
+        self.assertEqual(len(sizes), 1)
+        self.assertGreater(float(sizes[0].rsplit(' ', 1)[1]),
+                           len(response.content))
+        queries = [line for line in lines
+                   if line.startswith('eatup_db_queries_total{')]
+        self.assertTrue(queries)
+
+    def test_queries_are_timed_on_any_backend(self):
+        # with DATABASE_POOL=0 too
+        path = os.path.join(self.directory, 'plain.db')
+        wrapper = SQLiteDatabaseWrapper({'NAME': path, 'OPTIONS': {}},
+                                        'plain')
+        with self.settings(METRICS_DIR=None):
+            before = metrics.getDbSeconds()
+            # the statement that opens the connection is timed as well
+            wrapper.cursor().execute("SELECT 1")
+            wrapper.cursor().execute("SELECT 2")
+            lines = self.scrape()
+        wrapper.close()
+        self.assertGreater(metrics.getDbSeconds(), before)
+        self.assertIn('eatup_db_queries_total{database="plain"} 2.0', lines)
+
+
+class SlowQueryTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = os.path.join(self.directory, 'logs', 'slow.log')
+        slowQueries._explained.clear()
+        AppUser.objects.create(uid=1, first_name="alice", last_name="a")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def entries(self):
+        with open(self.log) as log:
+            return [json.loads(line) for line in log]
+
+    def test_slow_queries_are_logged_with_plans(self):
+        with self.settings(SLOW_QUERY_THRESHOLD=None, SLOW_QUERY_LOG=self.log):
+            self.client.get('/info/user/', {'uid': 1})
+        self.assertFalse(os.path.exists(self.log))
+        with self.settings(SLOW_QUERY_THRESHOLD=0.0, SLOW_QUERY_LOG=self.log):
+            self.client.get('/info/user/', {'uid': 1})
+            first = self.entries()
+            self.client.get('/info/user/', {'uid': 1})
+            second = self.entries()[len(first):]
+        self.assertTrue(first)
+        users = [entry for entry in first
+                 if entry['view'] == 'eatupBackendApp.views.getUser' and
+                 'eatupBackendApp_appuser' in entry['sql']]
+        self.assertTrue(users)
+        entry = users[0]
+        self.assertTrue(entry['site'].startswith('eatupBackendApp/'),
+                        entry['site'])
+        self.assertIn('1', entry['params'][0])
+        self.assertIn('?', entry['shape'])
+        # the test database is in memory, where there's no connection to
+        # explain on (see test_explain)
+        self.assertIn('plan', entry)
+        # a shape is only explained once per process
+        self.assertEqual(len(second), len(first))
+        self.assertFalse([entry for entry in second if 'plan' in entry])
+        # nor are the EXPLAIN statements logged
+        self.assertFalse([entry for entry in first + second
+                          if 'EXPLAIN' in entry['sql']])
+
+    def test_plain_backend(self):
+        # with DATABASE_POOL=0
+        path = os.path.join(self.directory, 'plain.db')
+        wrapper = SQLiteDatabaseWrapper({'NAME': path, 'OPTIONS': {}},
+                                        'plain')
+        with self.settings(SLOW_QUERY_THRESHOLD=0.0, SLOW_QUERY_LOG=self.log):
+            wrapper.cursor().execute("SELECT %s", [42])
+        wrapper.close()
+        entries = [entry for entry in self.entries()
+                   if entry['database'] == 'plain']
+        self.assertEqual([entry['sql'] for entry in entries], ["SELECT %s"])
+
+    def test_explain(self):
+        path = os.path.join(self.directory, 'plans.db')
+        connection = sqlite3.connect(path)
+        connection.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, name)")
+        connection.execute("CREATE INDEX t_name ON t (name)")
+        connection.close()
+        wrapper = SQLiteDatabaseWrapper({'NAME': path, 'OPTIONS': {}},
+                                        'plans')
+        wrapper.cursor().execute("BEGIN")
+        wrapper.cursor().execute("INSERT INTO t (name) VALUES (%s)", ['a'])
+        plan = slowQueries.explain(
+            wrapper, "SELECT id FROM t WHERE name = %s AND id > %s", ['a', 0])
+        self.assertTrue(any('t_name' in line for line in plan), plan)
+        self.assertTrue(slowQueries.explain(wrapper, "SELECT x FROM t", [])[0]
+                        .startswith("EXPLAIN failed"))
+        self.assertEqual(slowQueries.explain(wrapper, "PRAGMA user_version",
+                                             []), None)
+        # the statement's transaction is still open
+        wrapper.connection.rollback()
+        self.assertEqual(list(wrapper.cursor().execute(
+            "SELECT COUNT(*) FROM t")), [(0,)])
+        wrapper.close()
+
+    def test_log_is_rotated(self):
+        line = json.dumps({'shape': 'x', 'seconds': 1.0}) + '\n'
+        for i in xrange(10):
+            slowQueries.appendToLog(self.log, line, len(line) * 3, 2)
+        self.assertEqual(slowQueries.logPaths(self.log),
+                         [self.log + '.2', self.log + '.1', self.log])
+        self.assertEqual(sum(len(open(path).readlines()) for path in
+                             slowQueries.logPaths(self.log)), 7)
+
+    def test_summary(self):
+        os.makedirs(os.path.dirname(self.log))
+        with open(self.log, 'w') as log:
+            for shape, seconds, view in [('A', 1.0, 'a'), ('B', 0.5, 'b'),
+                                         ('A', 3.0, 'a'), ('B', 0.6, 'c')]:
+                log.write(json.dumps({'shape': shape, 'seconds': seconds,
+                                      'view': view, 'site': 'x.py:f:1',
+                                      'plan': ['SCAN ' + shape]}) + '\n')
+            log.write('{"shape": "cut sh')
+        summaries, count = slowQueries.summarizeSlowQueries(self.log)
+        self.assertEqual(count, 4)
+        self.assertEqual([summary['shape'] for summary in summaries],
+                         ['A', 'B'])
+        self.assertEqual(summaries[0]['seconds'], 4.0)
+        self.assertEqual(summaries[0]['max_seconds'], 3.0)
+        self.assertEqual(summaries[0]['avg_seconds'], 2.0)
+
+        output = StringIO()
+        errors = StringIO()
+        call_command('slowqueries', log=self.log, limit=1, stdout=output,
+                     stderr=errors)
+        self.assertEqual(errors.getvalue(),
+                         "2 query shapes from 4 slow queries\n")
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0],
+                         "1. 4.000s in 2 queries (3.000s max, 2.000s average)")
+        self.assertIn("   views: a (2)", lines)
+        self.assertIn("     SCAN A", lines)
+        self.assertNotIn("   B", lines)
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.host = AppUser.objects.create(uid=1, first_name="alice",
+                                           last_name="a")
+
+    def makeEvent(self, title, description=""):
+        return Event.objects.create(title=title, description=description,
+                                    host=self.host,
+                                    date_time="2013-04-01T12:00:00Z")
+
+    def search(self, query, **params):
+        params['q'] = query
+        response = json.loads(self.client.get('/info/search/',
+                                              params).content)
+        return response
+
+    def searchIds(self, query):
+        return search.searchEventIds(query, limit=100)[0]
+
+    def test_ranked_matches(self):
+        inTitle = self.makeEvent("Dinner at Joe's", "bring wine")
+        inDescription = self.makeEvent("Friday plans",
+                                       "a long dinner, then a movie")
+        both = self.makeEvent("Pizza dinner", "dinner with pizza")
+        self.makeEvent("Lunch", "sandwiches")
+        self.assertEqual(self.searchIds("dinner"),
+                         [both.eid, inTitle.eid, inDescription.eid])
+        # stemmed, case-insensitive, every word, the last one as a prefix
+        self.assertEqual(self.searchIds("DINNERS"),
+                         [both.eid, inTitle.eid, inDescription.eid])
+        self.assertEqual(self.searchIds("dinner piz"), [both.eid])
+        self.assertEqual(self.searchIds("dinner p"), [])
+        self.assertEqual(self.searchIds('dinner "movie" OR -x'), [])
+        self.assertEqual(self.searchIds('"movie" (dinner'),
+                         [inDescription.eid])
+        self.assertEqual(self.searchIds("  ?! "), [])
+
+        response = self.search("wine")
+        self.assertEqual(response['q'], "wine")
+        self.assertEqual([event['eid'] for event in response['events']],
+                         [inTitle.eid])
+        self.assertEqual(response['events'][0]['title'], "Dinner at Joe's")
+        self.assertEqual(response['next'], None)
+
+    def test_kept_in_sync(self):
+        event = self.makeEvent("Brunch", "pancakes")
+        other = self.makeEvent("Brunch again", "waffles")
+        event = Event.objects.get(pk=event.pk)
+        event.title = "Breakfast"
+        event.save()
+        self.assertEqual(self.searchIds("brunch"), [other.eid])
+        self.assertEqual(self.searchIds("breakfast pancakes"), [event.eid])
+
+        self.client.get('/edit/event/', {'eid': other.eid,
+                                         'description': 'crepes'})
+        self.assertEqual(self.searchIds("crepes"), [other.eid])
+        self.assertEqual(self.searchIds("waffles"), [])
+
+        self.client.get('/delete/event/', {'eid': other.eid})
+        self.assertEqual(self.searchIds("brunch"), [])
+        bulkDelete.deleteEvents([event.pk])
+        self.assertEqual(self.searchIds("breakfast"), [])
+
+    def test_pages(self):
+        events = [self.makeEvent("Dinner %d" % i,
+                                 "dinner " * (i % 3) + "food")
+                  for i in xrange(7)]
+        expected = self.searchIds("dinner")
+        self.assertEqual(sorted(expected), sorted(event.eid
+                                                  for event in events))
+        seen = []
+        after = None
+        for page in xrange(4):
+            params = {'limit': 2}
+            if after is not None:
+                params['after'] = after
+            response = self.search("dinner", **params)
+            seen.extend(event['eid'] for event in response['events'])
+            after = response['next']
+            if after is None:
+                break
+        self.assertEqual(page, 3)
+        self.assertEqual(seen, expected)
+
+        self.assertIn('error', self.search("dinner", after="x,1"))
+        self.assertIn('error', self.search("dinner", limit=0))
+        self.assertIn('error', self.client.get('/info/search/').content)
+
+    @override_settings(DATABASE_REPLICAS=['replica1'])
+    def test_reads_from_one_replica(self):
+        event = self.makeEvent("Tapas", "small plates")
+        # there's no replica1 here, so note the alias each read is sent to
+        # and then read from the primary
+        aliases = []
+        def onAlias(function):
+            def wrapper(*args):
+                aliases.append(args[-1])
+                return function(*(args[:-1] + ('default',)))
+            return wrapper
+        originals = (search.isSupported, search.searchEventIds,
+                     jsonRows.getJsonDictsInBulk)
+        search.isSupported, search.searchEventIds, \
+            jsonRows.getJsonDictsInBulk = map(onAlias, originals)
+        try:
+            response = self.search("tapas")
+        finally:
+            search.isSupported, search.searchEventIds, \
+                jsonRows.getJsonDictsInBulk = originals
+        self.assertEqual([e['eid'] for e in response['events']], [event.eid])
+        self.assertEqual(aliases, ['replica1'] * 3)
+
+    def test_rebuild(self):
+        event = self.makeEvent("Potluck", "bring a dish")
+        # writes that send no signals leave the index behind
+        Event.objects.filter(pk=event.pk).update(title="Barbecue")
+        self.assertEqual(self.searchIds("barbecue"), [])
+        output = StringIO()
+        call_command('rebuildsearchindex', stdout=output)
+        self.assertEqual(output.getvalue().split(' in ')[0],
+                         "indexed 1 events")
+        self.assertEqual(self.searchIds("barbecue"), [event.eid])
+        self.assertEqual(self.searchIds("potluck"), [])
+
+
+class JsonRowsTest(TestCase):
+    def setUp(self):
+        self.users = [AppUser.objects.create(uid=i, first_name="user %d" % i,
+                                             last_name=u"\u00e9 %d" % i,
+                                             prof_pic="http://x/%d.jpg" % i)
+                      for i in xrange(1, 5)]
+        self.users[0].friends.add(self.users[1], self.users[2])
+        self.events = []
+        for i in xrange(3):
+            event = Event.objects.create(title="event %d" % i,
+                                         description="about %d" % i,
+                                         host=self.users[i],
+                                         date_time="2013-04-0%dT12:30:00Z" %
+                                                   (i + 1))
+            event.participants.add(*self.users[:i + 2])
+            DumbLocation.objects.bulk_create([
+                DumbLocation(friendly_name="place %d.%d" % (i, j),
+                             eventHere=event)
+                for j in xrange(i)])
+            self.events.append(event)
+        # rows from before created_at was tracked
+        Event.objects.filter(pk=self.events[2].pk).update(created_at=None)
+
+    def assertSameJson(self, rowDicts, instances):
+        expected = [instance.getDictForJson() for instance in instances]
+        # the json module is the judge: equal text once keys are sorted
+        self.assertEqual(json.dumps(rowDicts, sort_keys=True),
+                         json.dumps(expected, sort_keys=True))
+
+    def test_same_json_as_instances(self):
+        events = Event.objects.order_by('eid')
+        self.assertSameJson(jsonRows.getJsonDicts(events),
+                            Event.jsonQuerySet(events))
+        users = AppUser.objects.order_by('uid')
+        self.assertSameJson(jsonRows.getJsonDicts(users),
+                            AppUser.jsonQuerySet(users))
+        self.assertSameJson([jsonRows.getJsonDict(Event, self.events[1].pk)],
+                            [Event.objects.get(pk=self.events[1].pk)])
+        self.assertEqual(jsonRows.getJsonDict(Event, 1000), None)
+
+    def test_in_bulk_keeps_order(self):
+        eventIds = [self.events[2].pk, 1000, self.events[0].pk]
+        self.assertEqual(
+            [event['eid'] for event in
+             jsonRows.getJsonDictsInBulk(Event, eventIds)],
+            [self.events[2].pk, self.events[0].pk])
+
+    def test_rows_are_compact(self):
+        spec = jsonRows.getSpec(Event)
+        rows = spec.fetch(Event.objects.order_by('eid'))
+        self.assertEqual([len(row.participants) for row in rows], [2, 3, 4])
+        self.assertEqual([len(row.locations) for row in rows], [0, 1, 2])
+        self.assertEqual(rows[1].locations[0].friendly_name, "place 1.0")
+        # plain tuples, without a dictionary per row
+        self.assertEqual(type(rows[0]).__slots__, ())
+        self.assertEqual(type(rows[0].participants[0]).__slots__, ())
+
+
+# runs eatupBackendProj.prefork with an application that answers with the pid
+# of the worker that served the request
+PREFORK_DRIVER = """
+import os, sys
+from eatupBackendProj import prefork
+
+def application(environ, startResponse):
+    startResponse('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid())]
+
+prefork.loadApplication = lambda: application
+prefork.main(sys.argv[1:])
+"""
+
+def childrenOf(pid):
+    '''(int): int set
+
+    the pids of the live (not yet exited) child processes of pid, from /proc
+    '''
+    children = set()
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # the command name in parentheses may have spaces of its own
+        state, parent = stat.rsplit(')', 1)[1].split()[:2]
+        if int(parent) == pid and state != 'Z':
+            children.add(int(name))
+    return children
+
+
+class PreforkTest(TestCase):
+    def setUp(self):
+        if not os.path.isdir('/proc'):
+            self.skipTest("needs /proc to find the workers")
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        self.port = probe.getsockname()[1]
+        probe.close()
+        self.metricsDir = tempfile.mkdtemp()
+        self.master = None
+
+    def tearDown(self):
+        if self.master is not None and self.master.poll() is None:
+            # after a failure; workers outlive a killed master
+            workers = self.workers()
+            self.master.kill()
+            self.master.wait()
+            for pid in workers:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        shutil.rmtree(self.metricsDir)
+
+    def start(self, *options):
+        projectDir = os.path.dirname(os.path.dirname(
+            os.path.abspath(eatupBackendProj.__file__)))
+        env = dict(os.environ, METRICS_DIR=self.metricsDir,
+                   PYTHONPATH=projectDir)
+        self.master = subprocess.Popen(
+            [sys.executable, '-c', PREFORK_DRIVER,
+             '--bind', '127.0.0.1:%d' % self.port,
+             '--graceful-timeout', '5'] + list(options),
+            cwd=projectDir, env=env, stderr=open(os.devnull, 'w'))
+
+    def waitFor(self, condition, timeout=15):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            value = condition()
+            if value:
+                return value
+            self.assertIsNone(self.master.poll(), "the master exited")
+            time.sleep(0.1)
+        self.fail("timed out")
+
+    def workers(self):
+        return childrenOf(self.master.pid)
+
+    def servedBy(self):
+        '''(): int
+
+        the pid of the worker that answers a request
+        '''
+        url = 'http://127.0.0.1:%d/' % self.port
+        def get():
+            try:
+                return int(urllib2.urlopen(url, timeout=5).read())
+            except (urllib2.URLError, socket.error):
+                # not listening yet
+                return None
+        return self.waitFor(get)
+
+    def stop(self):
+        self.master.send_signal(signal.SIGTERM)
+        self.waitFor(lambda: self.master.poll() is not None)
+        self.assertEqual(self.master.returncode, 0)
+
+    def test_load_application_does_the_first_requests_work(self):
+        from django.core.urlresolvers import get_resolver
+        from eatupBackendProj import prefork
+        application = prefork.loadApplication()
+        self.assertIsNotNone(application._request_middleware)
+        self.assertTrue(get_resolver(None)._reverse_dict)
+
+    def test_workers_are_recycled_after_max_requests(self):
+        self.start('--workers', '1', '--max-requests', '2')
+        first = self.servedBy()
+        self.assertEqual(self.servedBy(), first)
+        second = self.servedBy()
+        self.assertNotEqual(second, first)
+        self.assertEqual(self.servedBy(), second)
+        # which has been replaced in turn
+        workers = self.waitFor(lambda: len(self.workers()) == 1 and
+                               not self.workers() & set([first, second]) and
+                               self.workers())
+        self.assertEqual(set([self.servedBy()]), workers)
+        self.stop()
+
+    def test_hup_replaces_every_worker(self):
+        self.start('--workers', '2')
+        old = self.waitFor(lambda: len(self.workers()) == 2 and
+                           self.workers())
+        self.servedBy()
+        self.master.send_signal(signal.SIGHUP)
+        new = self.waitFor(lambda: len(self.workers()) == 2 and
+                           not self.workers() & old and self.workers())
+        self.assertIn(self.servedBy(), new)
+        self.stop()
+
+    def test_ttin_and_ttou_scale_workers(self):
+        self.start('--workers', '2')
+        original = self.waitFor(lambda: len(self.workers()) == 2 and
+                                self.workers())
+        self.master.send_signal(signal.SIGTTIN)
+        grown = self.waitFor(lambda: len(self.workers()) == 3 and
+                             self.workers())
+        self.assertTrue(original < grown)
+        for i in xrange(3):
+            self.master.send_signal(signal.SIGTTOU)
+            time.sleep(1)
+        # never fewer than one worker
+        remaining = self.waitFor(lambda: len(self.workers()) == 1 and
+                                 self.workers())
+        self.assertTrue(remaining < grown)
+        self.assertIn(self.servedBy(), remaining)
+        self.stop()
@@ -0,0 +1,93 @@
+import threading
+from django.core.signals import request_finished
+from django.db import transaction
+
+# callbacks waiting for the transaction open on a connection to end, for
+# in-memory state (like the friend graph) that mustn't take in writes which
+# are then rolled back. whatever ends a transaction reports it: retryOnLock
+# (eatupBackendApp/sqliteTuning.py), which every write view runs under, on
+# any backend, and the pooled backends (eatupBackendApp/backends) for every
+# commit and rollback. callbacks still waiting when a request finishes, eg.
+# after a commit_on_success of the admin's on a plain backend, can't tell
+# how their transaction ended and get onUnknown. retryOnLock also runs the
+# callbacks given to beforeCommit inside the transaction, just before it
+# commits
+
+_pending = threading.local()
+
+def getPending(using):
+    if not hasattr(_pending, 'byAlias'):
+        _pending.byAlias = {}
+    return _pending.byAlias.setdefault(using, [])
+
+def getPendingBeforeCommit(using):
+    if not hasattr(_pending, 'beforeCommitByAlias'):
+        _pending.beforeCommitByAlias = {}
+    return _pending.beforeCommitByAlias.setdefault(using, [])
+
+def beforeCommit(callback, using='default'):
+    '''(() -> None, string): None
+
+    calls callback inside the transaction open on the connection, just
+    before retryOnLock commits it; dropped if the transaction is rolled back
+    or ended by anything else. outside of a managed transaction there's
+    nothing left to commit, and callback isn't called
+    '''
+    if transaction.is_managed(using=using):
+        getPendingBeforeCommit(using).append(callback)
+
+def transactionEnding(using):
+    '''(string): None
+
+    runs the callbacks given to beforeCommit; called by retryOnLock before
+    it commits
+    '''
+    pending = getPendingBeforeCommit(using)
+    callbacks = list(pending)
+    del pending[:]
+    for callback in callbacks:
+        callback()
+
+def afterCommit(onCommit, onRollback, using='default', onUnknown=None):
+    '''(() -> None, () -> None, string, () -> None): None
+
+    calls onCommit once the writes made so far on the connection are
+    committed, or onRollback if they're rolled back, or onUnknown (by
+    default onRollback) if the request finishes without either being
+    reported; outside of a managed transaction django has already committed
+    them, so onCommit is called right away
+    '''
+    if not transaction.is_managed(using=using):
+        onCommit()
+    else:
+        getPending(using).append((onCommit, onRollback,
+                                  onUnknown or onRollback))
+
+def transactionEnded(using, committed):
+    '''(string, bool): None
+
+    runs the callbacks waiting on the connection; called by whatever ended
+    the transaction
+    '''
+    del getPendingBeforeCommit(using)[:]
+    pending = getPending(using)
+    if not pending:
+        return
+    callbacks = list(pending)
+    del pending[:]
+    for onCommit, onRollback, onUnknown in callbacks:
+        if committed:
+            onCommit()
+        else:
+            onRollback()
+
+def forgetPending(**kwargs):
+    for pending in getattr(_pending, 'beforeCommitByAlias', {}).values():
+        del pending[:]
+    for pending in getattr(_pending, 'byAlias', {}).values():
+        callbacks = list(pending)
+        del pending[:]
+        for onCommit, onRollback, onUnknown in callbacks:
+            onUnknown()
+
+request_finished.connect(forgetPending)
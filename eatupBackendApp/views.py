@@ -1,13 +1,18 @@
-import os, re, time, datetime, urllib, math, requests
+import os, re, time, datetime, calendar, urllib, math, requests
 from django.conf import settings
+from django.db import router
 from django.http import (HttpResponse, HttpResponseBadRequest, 
                          HttpResponseServerError, HttpResponseForbidden, 
                          HttpResponseRedirect, HttpResponseNotFound)
 from eatupBackendApp.models import Event, AppUser, Location, DumbLocation
 from eatupBackendApp.json_response import json_response
+from eatupBackendApp.sqliteTuning import retryOnLock
+from eatupBackendApp import (feed, friendGraph, attending, sync, changeFeed,
+                             friendSync, counters, search, jsonRows)
 import eatupBackendApp.imageUtil as imageUtil
 from annoying.functions import get_object_or_None 
 from django.shortcuts import render
+from django.utils import timezone
 from django.utils.timezone import utc
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.simplejson import dumps
@@ -60,14 +65,15 @@ def jsonDictOfSpecificObj(modelClass, pk, errorMsg="invalid"):
     '''(models.Model subclass, <primary key type>, string): dict
     
     finds the model object with the specific given primary key and returns its
-    JSON-friendly dictionary representation
+    JSON-friendly dictionary representation (read as rows, see 
+    eatupBackendApp/jsonRows.py)
     returns an error dictionary if no such object exists
     '''
-    foundObj = get_object_or_None(modelClass, pk=pk)
-    if foundObj is None:
+    jsonDict = jsonRows.getJsonDict(modelClass, pk)
+    if jsonDict is None:
         return createErrorDict(errorMsg)
     else:
-        return foundObj.getDictForJson()
+        return jsonDict
     
 def getDictArray(reqDict, name):
     '''(request dictionary, string): dictionary list, bool
@@ -224,16 +230,18 @@ def idsToObjects(parsedIdList, objType, objName="object"):
     ''' (<id type> list, models.Model subclass, string): model instance list
     
     takes a list of already-parsed ids (ie: already converted from strings)
-    and creates a list of model objects with those ids
+    and creates a list of model objects with those ids, in the same order,
+    using a single query
     returns two values as a tuple: 
     - the list of objects, if they are all found (None otherwise)
     - None if no error occurs, otherwise an error message
     '''
+    foundObjs = objType.objects.in_bulk(parsedIdList)
     objects = []
     for parsedId in parsedIdList:
-        foundObj, error = idToObject(parsedId, objType, objName)
-        if (error): 
-            return None, error
+        foundObj = foundObjs.get(parsedId)
+        if foundObj is None:
+            return (None, 'invalid %s ID %r' % (objName, parsedId))
         objects.append(foundObj)
     return (objects, None)       
     
@@ -278,6 +286,13 @@ def parseTimestamp(timestampStr):
         
     return newDateTime, None
     
+def toTimestamp(dateTime):
+    '''(datetime): int
+
+    the inverse of parseTimestamp: a javascript (millisecond) timestamp
+    '''
+    return calendar.timegm(dateTime.utctimetuple()) * 1000
+    
 def getUpdatedLocations(newLocationsData, allowCreation=False, 
                         allowEditing=True, parentEvent=None):   
     # for every location data, update locations as needed and store the 
@@ -343,16 +358,207 @@ def getUserEvents(request):
     if requestedUser is None:
         return createErrorDict('user does not exist')
     
-    outputJsonDicts = []
-    for participatingEvent in requestedUser.participating.all():
-        outputJsonDicts.append(participatingEvent.getDictForJson())
+    # taken before reading anything, so that nothing changed during this 
+    # request is missed by the next one
+    watermark = sync.getWatermark()
+    
+    # with a watermark from an earlier call, only send what changed since
+    if 'since' in request.REQUEST:
+        since, error = parseTimestamp(request.REQUEST['since'])
+        if error: return createErrorDict(error)
+        if not sync.isTooOld(since):
+            changedIds, removedIds = sync.getChangedEventIds(requestedUser, 
+                                                             since)
+            return {
+                "uid": uid,
+                "events": jsonRows.getJsonDictsInBulk(Event, changedIds),
+                "removed": removedIds,
+                "full": False,
+                "watermark": toTimestamp(watermark)
+            }
+    
+    # read as rows rather than model instances, which for users in many 
+    # events is most of the time and memory of this view
+    outputJsonDicts = jsonRows.getJsonDicts(requestedUser.participating.all())
         
     return {
         "uid": uid,
-        "events": outputJsonDicts
+        "events": outputJsonDicts,
+        "removed": [],
+        "full": True,
+        "watermark": toTimestamp(watermark)
     }    
     
     
+@json_response()    
+def getFeed(request):
+    if 'uid' not in request.REQUEST:
+        return createErrorDict('missing id argument')
+    
+    uid = parseLongOrNone(request.REQUEST['uid'])
+    if uid is None:
+        return createErrorDict('invalid user')
+        
+    requestedUser = get_object_or_None(AppUser, uid=uid)
+    if requestedUser is None:
+        return createErrorDict('user does not exist')
+    
+    # only upcoming events unless told otherwise
+    if 'since' in request.REQUEST:
+        since, error = parseTimestamp(request.REQUEST['since'])
+        if error: return createErrorDict(error)
+    else:
+        since = timezone.now()
+    
+    # the "next" of the previous page, which takes over from since
+    after = None
+    if 'after' in request.REQUEST:
+        after = feed.parseCursor(request.REQUEST['after'])
+        if after is None:
+            return createErrorDict('invalid cursor')
+        
+    limit = parseIntOrNone(request.REQUEST.get('limit', 
+                                               feed.DEFAULT_PAGE_SIZE))
+    if limit is None or limit <= 0:
+        return createErrorDict('invalid limit')
+    limit = min(limit, feed.MAX_PAGE_SIZE)
+    
+    eventIds, nextCursor = feed.getFeedEventIds(requestedUser, since, limit,
+                                                after)
+    return {
+        "uid": uid,
+        "events": jsonRows.getJsonDictsInBulk(Event, eventIds),
+        "next": nextCursor
+    }
+    
+@json_response()    
+def getSuggestions(request):
+    if 'uid' not in request.REQUEST:
+        return createErrorDict('missing id argument')
+    
+    uid = parseLongOrNone(request.REQUEST['uid'])
+    if uid is None:
+        return createErrorDict('invalid user')
+    if not AppUser.objects.filter(uid=uid).exists():
+        return createErrorDict('user does not exist')
+        
+    limit = parseIntOrNone(request.REQUEST.get('limit', 
+                                               friendGraph.DEFAULT_SUGGESTIONS))
+    if limit is None or limit <= 0:
+        return createErrorDict('invalid limit')
+    limit = min(limit, friendGraph.MAX_SUGGESTIONS)
+    
+    # ranked in memory; only the suggested users are read from the database
+    suggestions = friendGraph.getGraph().suggestions(uid, limit)
+    users = AppUser.objects.in_bulk([otherUid for otherUid, n in suggestions])
+    outputJsonDicts = []
+    for otherUid, mutualFriends in suggestions:
+        if otherUid in users:
+            user = users[otherUid]
+            outputJsonDicts.append({
+                "uid": user.uid,
+                "first_name": user.first_name,
+                "last_name": user.last_name,
+                "prof_pic": user.prof_pic,
+                "mutual_friends": mutualFriends,
+            })
+    return {
+        "uid": uid,
+        "suggestions": outputJsonDicts
+    }
+    
+@json_response()    
+def getFriendsAttending(request):
+    if 'uid' not in request.REQUEST:
+        return createErrorDict('missing id argument')
+    
+    uid = parseLongOrNone(request.REQUEST['uid'])
+    if uid is None:
+        return createErrorDict('invalid user')
+    if not AppUser.objects.filter(uid=uid).exists():
+        return createErrorDict('user does not exist')
+    
+    eids = []
+    seen = set()
+    for rawEventId in request.REQUEST.getlist('eids[]'):
+        eid = parseIntOrNone(rawEventId)
+        if eid is None:
+            return createErrorDict('invalid event')
+        if eid not in seen:
+            seen.add(eid)
+            eids.append(eid)
+    if not eids:
+        return createErrorDict('missing eids argument')
+    if len(eids) > attending.MAX_EVENTS:
+        return createErrorDict('too many events')
+    
+    attendance = attending.friendsAttending(uid, eids)
+    outputJsonDicts = []
+    for eid in eids:
+        if eid in attendance:
+            numParticipants, friendIds = attendance[eid]
+            outputJsonDicts.append({
+                "eid": eid,
+                "participants_count": numParticipants,
+                "friends_count": len(friendIds),
+                "friends": friendIds,
+            })
+    return {
+        "uid": uid,
+        "events": outputJsonDicts
+    }
+    
+@json_response()    
+def searchEvents(request):
+    if 'q' not in request.REQUEST:
+        return createErrorDict('missing q argument')
+    # info/ may read from a replica; the ids and their rows must come from
+    # the same one
+    using = router.db_for_read(Event)
+    if not search.isSupported(using):
+        return createErrorDict('search is not supported')
+    
+    # the "next" of the previous page
+    after = None
+    if 'after' in request.REQUEST:
+        after = search.parseCursor(request.REQUEST['after'])
+        if after is None:
+            return createErrorDict('invalid cursor')
+        
+    limit = parseIntOrNone(request.REQUEST.get('limit', 
+                                               search.DEFAULT_PAGE_SIZE))
+    if limit is None or limit <= 0:
+        return createErrorDict('invalid limit')
+    limit = min(limit, search.MAX_PAGE_SIZE)
+    
+    eventIds, nextCursor = search.searchEventIds(request.REQUEST['q'], after,
+                                                 limit, using)
+    return {
+        "q": request.REQUEST['q'],
+        "events": jsonRows.getJsonDictsInBulk(Event, eventIds, using),
+        "next": nextCursor
+    }
+    
+@json_response()    
+def getChanges(request):
+    # answers at once; the runchangefeed sidecar serves the same url as a
+    # long poll
+    if 'uid' not in request.REQUEST:
+        return createErrorDict('missing id argument')
+    
+    uid = parseLongOrNone(request.REQUEST['uid'])
+    if uid is None:
+        return createErrorDict('invalid user')
+    
+    if 'cursor' not in request.REQUEST:
+        return changeFeed.changesResponse(uid, [], changeFeed.getHead())
+    cursor = parseLongOrNone(request.REQUEST['cursor'])
+    if cursor is None:
+        return createErrorDict('invalid cursor')
+    
+    eventIds, nextCursor, expired = changeFeed.getChangesSince(uid, cursor)
+    return changeFeed.changesResponse(uid, eventIds, nextCursor, expired)
+    
 def updateAndSaveEvent(dataDict, creationMode=False):
     parsedEventId = parseIntOrNone(dataDict.get('eid'))
     if creationMode == False:
@@ -478,25 +684,34 @@ def updateAndSaveEvent(dataDict, creationMode=False):
     '''
     
     if newDumbLocations is not None:
-        for loc in newDumbLocations:
-            loc.save()
         newEvent.locations.clear()
-        newEvent.locations.add(*newDumbLocations)
         
         # clean up newly orphaned locations
         DumbLocation.objects.filter(eventHere=None).delete()
         
+        # insert the new locations with a single query
+        for loc in newDumbLocations:
+            loc.eventHere = newEvent
+        DumbLocation.objects.bulk_create(newDumbLocations)
+        # none of which is signalled either
+        counters.recount(Event, 'location_count', [newEvent.eid])
+        
     if newParticipants is not None:
         if newEvent.host not in newParticipants:
             newParticipants.append(newEvent.host)
         newEvent.participants.clear()
         newEvent.participants.add(*newParticipants)
+    elif newDumbLocations is not None:
+        # clear() and bulk_create() of the locations send no signals; changing
+        # the participants updates the change log anyway
+        sync.touchEvents([newEvent.eid])
     
     return {'status':'ok',
             'eid': newEvent.pk}
     
 @json_response() 
 @csrf_exempt
+@retryOnLock()
 def createEvent(request):
     # change this to POST if it turns out ios apps don't have to worry about
     # cross domain policy
@@ -506,6 +721,7 @@ def createEvent(request):
     return updateAndSaveEvent(dataDict, creationMode=True)
     
 @json_response()
+@retryOnLock()
 def editEvent(request):
     dataDict = request.REQUEST
     return updateAndSaveEvent(dataDict, creationMode=False)
@@ -580,16 +796,17 @@ def updateAndSaveUser(dataDict, creationMode=False):
     except Exception as e:
         return createErrorDict(str(e))    
     
-    # save the user
-    currUser.save()
+    # save the user; a new user is known not to exist yet, so skip the
+    # existence check and the clearing of its (empty) relations
+    currUser.save(force_insert=creationMode)
          
     if participatingGiven:
-        currUser.participating.clear()
+        if not creationMode:
+            currUser.participating.clear()
         currUser.participating.add(*newParticipating)
     
     if friendsGiven:
-        currUser.friends.clear()
-        currUser.friends.add(*newFriends)
+        friendSync.setFriends(currUser, [friend.pk for friend in newFriends])
         
     '''    
     # save profile picture
@@ -608,6 +825,7 @@ def updateAndSaveUser(dataDict, creationMode=False):
             'uid': currUser.pk}
     
 @json_response()   
+@retryOnLock()
 def createUser(request):
     dataDict = request.REQUEST
     
@@ -620,11 +838,45 @@ def createUser(request):
     return output
     
 @json_response()   
+@retryOnLock()
 def editUser(request):
     dataDict = request.REQUEST
     return updateAndSaveUser(dataDict, creationMode=False)    
     
 @json_response()   
+@retryOnLock()
+def syncFriends(request):
+    # the whole friend list at once (a facebook import): unlike edit/user,
+    # uids of users that don't exist are ignored, and only the difference
+    # with the current friends is written
+    dataDict = request.REQUEST
+    
+    if 'uid' not in dataDict:
+        return createErrorDict("facebook uid is required")
+    uid = parseLongOrNone(dataDict['uid'])
+    
+    user = get_object_or_None(AppUser, pk=uid)
+    if user is None:
+        return createErrorDict("cannot sync friends of nonexistant user")
+    if not isListInRequestDict(dataDict, "friends[]"):
+        return createErrorDict("friends list is required")
+    
+    friendIds, error = parseElems(dataDict.getlist('friends[]'), 
+                                  lambda s: long(s), elemName="friend ID")
+    if error: return createErrorDict(error)
+    
+    friends, added, removed = friendSync.setFriends(user, friendIds)
+    return {
+        "status": "ok",
+        "uid": user.pk,
+        "friends_count": len(friends),
+        "added": len(added),
+        "removed": len(removed),
+        "ignored": len(set(friendIds) - friends)
+    }
+    
+@json_response()   
+@retryOnLock()
 def deleteUser(request):
     dataDict = request.REQUEST
     
@@ -642,6 +894,7 @@ def deleteUser(request):
     }
     
 @json_response()   
+@retryOnLock()
 def deleteEvent(request):
     dataDict = request.REQUEST
     
@@ -0,0 +1,131 @@
+"""
+Throughput comparison between `manage.py runserver` and the pre-forking
+server in eatupBackendProj.prefork.
+
+Starts each server in turn on a local port, drives it with a number of
+concurrent client processes for a fixed duration and prints requests per
+second plus latency percentiles.
+
+usage:
+    python -m eatupBackendProj.benchserve --path /test --concurrency 16
+"""
+import os, sys, time, socket, signal, subprocess, urllib2, multiprocessing
+from optparse import OptionParser
+
+PROJECT_BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                 '..'))
+
+def waitForPort(port, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return True
+        except socket.error:
+            time.sleep(0.1)
+    return False
+
+def clientLoop(args):
+    '''
+    body of one client process: issues sequential requests until the deadline
+    and returns the list of latencies (in seconds) and the error count
+    '''
+    url, deadline = args
+    latencies = []
+    errors = 0
+    while time.time() < deadline:
+        startTime = time.time()
+        try:
+            urllib2.urlopen(url, timeout=10).read()
+        except Exception:
+            errors += 1
+            continue
+        latencies.append(time.time() - startTime)
+    return latencies, errors
+
+def percentile(sortedValues, fraction):
+    if not sortedValues:
+        return 0.0
+    index = min(int(round(fraction * (len(sortedValues) - 1))),
+                len(sortedValues) - 1)
+    return sortedValues[index]
+
+def runLoad(url, concurrency, duration):
+    # warm up (first request imports views, compiles templates, etc.)
+    for i in xrange(5):
+        try:
+            urllib2.urlopen(url, timeout=10).read()
+        except Exception:
+            pass
+    deadline = time.time() + duration
+    pool = multiprocessing.Pool(concurrency)
+    try:
+        results = pool.map(clientLoop, [(url, deadline)] * concurrency)
+    finally:
+        pool.close()
+        pool.join()
+    latencies = sorted(l for clientLatencies, _ in results
+                       for l in clientLatencies)
+    errors = sum(e for _, e in results)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / float(duration),
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+    }
+
+def benchServer(name, command, port, path, concurrency, duration):
+    env = dict(os.environ)
+    devnull = open(os.devnull, 'w')
+    process = subprocess.Popen(command, cwd=PROJECT_BASE_PATH, env=env,
+                               stdout=devnull, stderr=devnull)
+    try:
+        if not waitForPort(port):
+            raise RuntimeError("%s did not start listening on %d" % (name,
+                                                                     port))
+        result = runLoad("http://127.0.0.1:%d%s" % (port, path), concurrency,
+                         duration)
+    finally:
+        process.send_signal(signal.SIGINT)
+        process.wait()
+        devnull.close()
+    result['name'] = name
+    return result
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--path', dest='path', default='/test',
+                      help="url path to request (default: /test)")
+    parser.add_option('-c', '--concurrency', dest='concurrency', type='int',
+                      default=16)
+    parser.add_option('-d', '--duration', dest='duration', type='float',
+                      default=10.0, help="seconds per server")
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+                      default=multiprocessing.cpu_count())
+    parser.add_option('-t', '--threads', dest='threads', type='int',
+                      default=1)
+    parser.add_option('--port', dest='port', type='int', default=8765)
+    options, args = parser.parse_args(argv if argv is not None
+                                      else sys.argv[1:])
+
+    servers = [
+        ('runserver', [sys.executable, 'manage.py', 'runserver',
+                       '127.0.0.1:%d' % options.port, '--noreload']),
+        ('prefork', [sys.executable, '-m', 'eatupBackendProj.prefork',
+                     '--bind', '127.0.0.1:%d' % options.port,
+                     '--workers', str(options.workers),
+                     '--threads', str(options.threads)]),
+    ]
+    print "%-10s %9s %8s %8s %8s %8s" % ('server', 'req/s', 'errors',
+                                         'p50 ms', 'p95 ms', 'p99 ms')
+    for name, command in servers:
+        result = benchServer(name, command, options.port, options.path,
+                             options.concurrency, options.duration)
+        print "%-10s %9.1f %8d %8.1f %8.1f %8.1f" % (
+            name, result['rps'], result['errors'], result['p50'] * 1000,
+            result['p95'] * 1000, result['p99'] * 1000)
+
+if __name__ == "__main__":
+    main()
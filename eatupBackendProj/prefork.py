@@ -0,0 +1,351 @@
+"""
+Pre-forking WSGI server for eatupBackendProj.
+
+The master process binds the listening socket, optionally imports the WSGI
+application once (so that forked workers share its memory pages), and then
+forks a pool of workers that all accept() on the shared socket. Each worker
+serves requests with a fixed number of threads and exits after
+--max-requests requests, at which point the master replaces it.
+
+Signals sent to the master:
+    HUP          graceful reload: start a fresh set of workers, then let the old
+                 ones finish their in-flight requests and exit. With --preload
+                 (the default) the application code itself is not re-imported;
+                 use --no-preload if reloads need to pick up new code.
+    TERM, INT    graceful shutdown
+    TTIN, TTOU   add or remove one worker
+
+usage:
+    python -m eatupBackendProj.prefork --bind 0.0.0.0:$PORT
+"""
+import os, sys, time, errno, signal, socket, select, threading, Queue
+import tempfile
+import multiprocessing
+from optparse import OptionParser
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "eatupBackendProj.settings")
+
+# how often (in seconds) workers check whether they've been asked to stop
+ACCEPT_TIMEOUT = 1.0
+
+# exit status used by workers that couldn't even start serving; the master
+# gives up instead of respawning them forever
+WORKER_BOOT_ERROR = 3
+
+### worker side ###
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        if self.server.accessLog:
+            WSGIRequestHandler.log_message(self, format, *args)
+
+class PreforkWorkerServer(WSGIServer):
+    '''
+    WSGIServer that serves off an already-bound socket inherited from the
+    master, handing accepted connections to a fixed pool of threads
+    '''
+    def __init__(self, listenSocket, app, threads=1, maxRequests=0,
+                 accessLog=False):
+        WSGIServer.__init__(self, listenSocket.getsockname(),
+                            QuietRequestHandler, bind_and_activate=False)
+        # swap the unbound socket TCPServer created for the shared one
+        self.socket.close()
+        self.socket = listenSocket
+        # handle_request() waits for connections for the socket's timeout,
+        # which is none at all for the master's non-blocking socket; accept()
+        # still fails right away when another worker got the connection
+        listenSocket.settimeout(ACCEPT_TIMEOUT)
+        self.server_address = listenSocket.getsockname()
+        host, self.server_port = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.setup_environ()
+        self.set_app(app)
+        self.timeout = ACCEPT_TIMEOUT
+        self.accessLog = accessLog
+        self.maxRequests = maxRequests
+        self.handledRequests = 0
+        self.alive = True
+        self.threads = threads
+        self.connectionQueue = Queue.Queue(maxsize=threads)
+        self.workerThreads = []
+        if threads > 1:
+            for i in xrange(threads):
+                thread = threading.Thread(target=self._processQueue)
+                thread.daemon = True
+                thread.start()
+                self.workerThreads.append(thread)
+
+    def _processQueue(self):
+        while True:
+            item = self.connectionQueue.get()
+            if item is None:
+                return
+            request, clientAddress = item
+            self._serve(request, clientAddress)
+
+    def _serve(self, request, clientAddress):
+        try:
+            self.finish_request(request, clientAddress)
+        except Exception:
+            self.handle_error(request, clientAddress)
+        finally:
+            self.shutdown_request(request)
+
+    def process_request(self, request, clientAddress):
+        self.handledRequests += 1
+        if self.maxRequests and self.handledRequests >= self.maxRequests:
+            # recycle this worker once the current request is done
+            self.alive = False
+        if self.threads > 1:
+            # blocks while every thread is busy, which leaves the connection
+            # in the shared accept queue for a less loaded worker
+            self.connectionQueue.put((request, clientAddress))
+        else:
+            self._serve(request, clientAddress)
+
+    def get_request(self):
+        request, clientAddress = self.socket.accept()
+        # the listening socket is non-blocking, connections shouldn't be
+        request.setblocking(1)
+        return request, clientAddress
+
+    def serveUntilStopped(self):
+        while self.alive:
+            try:
+                self.handle_request()
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+        # let the thread pool drain in-flight requests
+        for thread in self.workerThreads:
+            self.connectionQueue.put(None)
+        for thread in self.workerThreads:
+            thread.join()
+
+def loadApplication():
+    '''
+    imports the application and does the work Django would otherwise leave
+    to the first request of every worker: loading the models and the
+    middleware and importing the views through the URLconf; done in the
+    master before forking, the workers share the result copy-on-write
+    '''
+    from eatupBackendProj.wsgi import application
+    from django.core.urlresolvers import get_resolver
+    from django.db.models.loading import get_models
+    get_models()
+    application.load_middleware()
+    get_resolver(None)._populate()
+    return application
+
+def closeDatabaseConnections():
+    # connections opened before forking would be shared between processes
+    from django.db import connections
+    for connection in connections.all():
+        connection.close()
+
+def runWorker(listenSocket, app, options):
+    '''
+    body of a forked worker process; never returns
+    '''
+    exitCode = WORKER_BOOT_ERROR
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTTIN, signal.SIG_IGN)
+        signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+        if app is None:
+            app = loadApplication()
+        server = PreforkWorkerServer(listenSocket, app,
+                                     threads=options.threads,
+                                     maxRequests=options.max_requests,
+                                     accessLog=options.access_log)
+
+        def stop(signum, frame):
+            server.alive = False
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        exitCode = 1
+        server.serveUntilStopped()
+        exitCode = 0
+    except Exception:
+        import traceback
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exitCode)
+
+### master side ###
+
+class Master(object):
+    def __init__(self, listenSocket, options):
+        self.listenSocket = listenSocket
+        self.options = options
+        self.numWorkers = options.workers
+        self.app = None
+        # maps pid -> generation; workers from older generations are retired
+        self.workers = {}
+        # workers that have been sent TERM and are finishing their requests
+        self.retiring = set()
+        self.generation = 0
+        self.pendingSignals = []
+        self.stopping = False
+
+    def log(self, message):
+        sys.stderr.write("[prefork %d] %s\n" % (os.getpid(), message))
+
+    def spawnWorker(self):
+        pid = os.fork()
+        if pid == 0:
+            runWorker(self.listenSocket, self.app, self.options)
+        self.workers[pid] = self.generation
+        return pid
+
+    def currentWorkers(self):
+        return [pid for pid, generation in self.workers.iteritems()
+                if generation == self.generation and pid not in self.retiring]
+
+    def signalWorkers(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def retireWorkers(self, pids):
+        # only once: a signal interrupts the worker's wait for a connection,
+        # which SocketServer then restarts from the beginning, so signalling
+        # on every turn of the loop would keep it from ever noticing
+        pids = [pid for pid in pids if pid not in self.retiring]
+        self.retiring.update(pids)
+        self.signalWorkers(pids, signal.SIGTERM)
+
+    def reapWorkers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            self.workers.pop(pid, None)
+            self.retiring.discard(pid)
+            if os.WIFEXITED(status) and \
+                    os.WEXITSTATUS(status) == WORKER_BOOT_ERROR:
+                self.log("worker %d failed to boot, shutting down" % pid)
+                self.stopping = True
+
+    def manageWorkers(self):
+        current = self.currentWorkers()
+        while len(current) < self.numWorkers:
+            current.append(self.spawnWorker())
+        if len(current) > self.numWorkers:
+            self.retireWorkers(current[self.numWorkers:])
+        # retire workers left over from before a reload
+        old = [pid for pid, generation in self.workers.iteritems()
+               if generation != self.generation]
+        self.retireWorkers(old)
+
+    def handleSignal(self, signum, frame):
+        self.pendingSignals.append(signum)
+
+    def run(self):
+        # workers add up each other's metrics through files in METRICS_DIR
+        # (see eatupBackendApp.metrics)
+        if not os.environ.get('METRICS_DIR'):
+            os.environ['METRICS_DIR'] = tempfile.mkdtemp(
+                prefix='eatup-metrics-')
+        # the workers' metrics start from nothing, whether or not the
+        # application is preloaded
+        from eatupBackendApp.metrics import clearMetricsDir
+        clearMetricsDir()
+        if self.options.preload:
+            self.app = loadApplication()
+            closeDatabaseConnections()
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT,
+                       signal.SIGTTIN, signal.SIGTTOU, signal.SIGCHLD):
+            signal.signal(signum, self.handleSignal)
+
+        self.log("listening on %s:%d with %d workers x %d threads" % (
+            self.listenSocket.getsockname() + (self.numWorkers,
+                                               self.options.threads)))
+        self.manageWorkers()
+        while not self.stopping:
+            while self.pendingSignals:
+                signum = self.pendingSignals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.log("reloading workers")
+                    self.generation += 1
+                elif signum in (signal.SIGTERM, signal.SIGINT):
+                    self.stopping = True
+                elif signum == signal.SIGTTIN:
+                    self.numWorkers += 1
+                elif signum == signal.SIGTTOU:
+                    self.numWorkers = max(self.numWorkers - 1, 1)
+            self.reapWorkers()
+            if self.stopping:
+                break
+            self.manageWorkers()
+            time.sleep(0.5)
+        self.shutdown()
+
+    def shutdown(self):
+        self.log("shutting down")
+        self.signalWorkers(self.workers.keys(), signal.SIGTERM)
+        deadline = time.time() + self.options.graceful_timeout
+        while self.workers and time.time() < deadline:
+            self.reapWorkers()
+            time.sleep(0.1)
+        self.signalWorkers(self.workers.keys(), signal.SIGKILL)
+        self.reapWorkers()
+
+def createListenSocket(bind, backlog):
+    host, port = bind.rsplit(':', 1)
+    listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listenSocket.bind((host, int(port)))
+    listenSocket.listen(backlog)
+    listenSocket.setblocking(0)
+    return listenSocket
+
+def parseOptions(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('-b', '--bind', dest='bind',
+                      default="0.0.0.0:%s" % os.environ.get('PORT', '8000'),
+                      help="host:port to listen on (default: 0.0.0.0:$PORT)")
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+                      default=multiprocessing.cpu_count(),
+                      help="number of worker processes (default: one per core)")
+    parser.add_option('-t', '--threads', dest='threads', type='int',
+                      default=int(os.environ.get('WEB_THREADS', 1)),
+                      help="threads per worker (default: 1)")
+    parser.add_option('--max-requests', dest='max_requests', type='int',
+                      default=int(os.environ.get('WEB_MAX_REQUESTS', 0)),
+                      help="recycle a worker after this many requests "
+                           "(default: 0, never)")
+    parser.add_option('--backlog', dest='backlog', type='int', default=2048)
+    parser.add_option('--graceful-timeout', dest='graceful_timeout',
+                      type='float', default=30.0,
+                      help="seconds to wait for workers on shutdown")
+    parser.add_option('--no-preload', dest='preload', action='store_false',
+                      default=True,
+                      help="import the application in each worker instead of "
+                           "once in the master")
+    parser.add_option('--access-log', dest='access_log', action='store_true',
+                      default=False)
+    options, args = parser.parse_args(argv)
+    if options.workers < 1 or options.threads < 1:
+        parser.error("--workers and --threads must be at least 1")
+    return options
+
+def main(argv=None):
+    options = parseOptions(argv if argv is not None else sys.argv[1:])
+    listenSocket = createListenSocket(options.bind, options.backlog)
+    Master(listenSocket, options).run()
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,15 @@ DATABASES = {
     }
 }
 
+# pragmas applied to every new sqlite connection, see 
+# eatupBackendApp.sqliteTuning.DEFAULT_SQLITE_TUNING for the full list
+SQLITE_TUNING = {
+    'JOURNAL_MODE': 'WAL',
+    'SYNCHRONOUS': 'NORMAL',
+    'MMAP_SIZE': 256 * 1024 * 1024,
+    'BUSY_TIMEOUT': 5000,
+}
+
 # the absolute path of the root directory containing manage.py for this project
 _settingsFileDirPath = os.path.abspath(os.path.dirname(__file__))
 _projectBasePathRelative = os.path.join(_settingsFileDirPath, '..')
@@ -75,6 +84,21 @@ STATIC_ROOT = os.path.join(PROJECT_BASE_PATH, 'collectedStatic')
 # Example: "http://media.lawrence.com/static/"
 STATIC_URL = '/static/'
 
+# max-age (in seconds) for static files whose names don't carry a content hash;
+# hashed filenames are always served as immutable
+STATIC_SERVE_MAX_AGE = 3600
+
+# files up to this size are kept in each process's in-memory cache, up to a
+# total of STATIC_SERVE_CACHE_MAX_BYTES
+STATIC_SERVE_CACHE_MAX_FILE_SIZE = 64 * 1024
+STATIC_SERVE_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+# set to 'X-Sendfile' (apache/lighttpd) or 'X-Accel-Redirect' (nginx) to let
+# the front-end server stream file bodies; for X-Accel-Redirect, 
+# STATIC_SERVE_ACCEL_PREFIX is the internal location mapped to PROJECT_BASE_PATH
+STATIC_SERVE_SENDFILE_HEADER = os.environ.get('STATIC_SERVE_SENDFILE_HEADER')
+STATIC_SERVE_ACCEL_PREFIX = '/protected/'
+
 # Additional locations of static files
 STATICFILES_DIRS = (
     # Put strings here, like "/home/html/static" or "C:/www/django/static".
@@ -101,16 +125,90 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'eatupBackendApp.dbRouter.ReplicaPinningMiddleware',
+    'eatupBackendApp.queryStats.QueryStatsMiddleware',
+    'eatupBackendApp.slowQueries.SlowQueryMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
-    'eatupBackendApp.middleware.DisableCSRF'
+    'eatupBackendApp.middleware.DisableCSRF',
+    # last, since it runs the view itself
+    'eatupBackendApp.profiling.ProfilingMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
+# fraction of requests whose SQL queries are counted and timed by 
+# QueryStatsMiddleware; results are at /admin/querystats/
+QUERY_STATS_SAMPLE_RATE = float(os.environ.get('QUERY_STATS_SAMPLE_RATE', 
+                                               1.0 if DEBUG else 0.01))
+# queries of the same shape repeated this often in one request are reported 
+# as N+1 patterns
+QUERY_STATS_NPLUSONE_THRESHOLD = 3
+
+# ProfilingMiddleware runs the views of this fraction of requests, and of any
+# request with an "X-Profile: <PROFILE_HEADER_TOKEN>" header (when that is 
+# set), under cProfile, and keeps the newest PROFILE_DIR_MAX_BYTES of their 
+# pstats files in PROFILE_DIR; `manage.py profilesummary` merges them
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.0))
+PROFILE_HEADER_TOKEN = os.environ.get('PROFILE_HEADER_TOKEN', '')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 
+                             os.path.join(PROJECT_BASE_PATH, 'profiles'))
+PROFILE_DIR_MAX_BYTES = 100 * 1024 * 1024
+
+# every process keeps the numbers of eatupBackendApp.metrics (shown at 
+# /metrics) in a memory-mapped file of its own in METRICS_DIR, so that any
+# worker of the pre-forking server can add them all up; unset, each process
+# only shows its own. a scrape adds the counters and histograms of exited
+# processes to one archive file there, and deletes their files.
+# eatupBackendProj.prefork uses a new temporary one when it isn't set, and
+# empties it on start when it is. set METRICS_TOKEN to make scrapers send 
+# "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_DIR = os.environ.get('METRICS_DIR') or None
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# statements that take SLOW_QUERY_THRESHOLD seconds or more (None for none)
+# are written to SLOW_QUERY_LOG with their parameters, view and calling line,
+# the first of every query shape in a process with its EXPLAIN plan; the log
+# is rotated at SLOW_QUERY_LOG_MAX_BYTES, keeping SLOW_QUERY_LOG_BACKUPS old
+# ones, and `manage.py slowqueries` ranks them. statements are timed on any
+# database backend, with or without DATABASE_POOL (see
+# eatupBackendApp/backends/instrumentation.py)
+SLOW_QUERY_THRESHOLD = float(os.environ.get('SLOW_QUERY_THRESHOLD', 0.5))
+SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG',
+                                os.path.join(PROJECT_BASE_PATH, 'logs',
+                                             'slowqueries.log'))
+SLOW_QUERY_LOG_MAX_BYTES = 10 * 1024 * 1024
+SLOW_QUERY_LOG_BACKUPS = 5
+
+# users with more friends than this don't have their events copied into
+# every friend's feed (info/feed/); the feed merges them in when read instead
+FEED_FANOUT_LIMIT = 1000
+
+# seconds before a process reloads its in-memory friend graph (behind
+# info/suggestions/) from the database, to see friendships other processes
+# changed; its own changes are applied as they happen
+FRIEND_GRAPH_MAX_AGE = 300
+
+# delta syncs of info/userevents/?since=: days tombstones of left and deleted
+# events are kept (older watermarks get a full download), and seconds 
+# watermarks are set back to cover changes still being committed. rows are
+# stamped when written, not when committed: a write view (retryOnLock)
+# whose stamps are older than half the lag when it's about to commit
+# stamps them again, so the lag only has to cover the commit itself and
+# must stay well above how long one can take. other transactions (the
+# admin's, management commands run in one) aren't covered and may take
+# up to the lag between their first write and their commit
+SYNC_TOMBSTONE_DAYS = 30
+SYNC_WATERMARK_LAG = 5
+
+# the change log behind changes/ (and the `manage.py runchangefeed` long-poll
+# sidecar): days entries are kept, and seconds a long poll waits by default
+CHANGE_LOG_DAYS = 7
+CHANGE_FEED_TIMEOUT = 30
+
 ROOT_URLCONF = 'eatupBackendProj.urls'
 
 # Python dotted path to the WSGI application used by Django's runserver.
@@ -175,5 +273,40 @@ LOGGING = {
 import dj_database_url
 DATABASES['default'] =  dj_database_url.config()
 
+# read replicas, as a comma-separated list of database urls in
+# $REPLICA_DATABASE_URLS; info/* requests read from them, see 
+# eatupBackendApp.dbRouter
+DATABASE_REPLICAS = []
+for _i, _url in enumerate(filter(None, 
+        os.environ.get('REPLICA_DATABASE_URLS', '').split(','))):
+    _alias = 'replica%d' % (_i + 1)
+    DATABASES[_alias] = dj_database_url.parse(_url.strip())
+    DATABASE_REPLICAS.append(_alias)
+
+# 'round-robin' or 'least-connections'
+DATABASE_REPLICA_SELECTION = os.environ.get('DATABASE_REPLICA_SELECTION', 
+                                            'round-robin')
+DATABASE_REPLICA_READ_PREFIXES = ('/info/',)
+DATABASE_ROUTERS = ['eatupBackendApp.dbRouter.ReadReplicaRouter']
+
+# keep database connections open across requests instead of reconnecting on
+# every one (set DATABASE_POOL=0 to disable); see eatupBackendApp/backends
+POOLED_DATABASE_ENGINES = {
+    'django.db.backends.postgresql_psycopg2': 
+        'eatupBackendApp.backends.postgresql_pooled',
+    'django.db.backends.sqlite3': 'eatupBackendApp.backends.sqlite3_pooled',
+}
+if os.environ.get('DATABASE_POOL', '1') != '0':
+    for _database in DATABASES.values():
+        _engine = _database.get('ENGINE')
+        _database['ENGINE'] = POOLED_DATABASE_ENGINES.get(_engine, _engine)
+        _database['POOL'] = {
+            # per worker process; keep it >= the number of threads per worker
+            'MAX_SIZE': int(os.environ.get('DATABASE_POOL_SIZE', 4)),
+            'MAX_AGE': int(os.environ.get('DATABASE_POOL_MAX_AGE', 600)),
+            'HEALTH_CHECK_INTERVAL': 1,
+            'CHECKOUT_TIMEOUT': 10,
+        }
+
 # Honor the 'X-Forwarded-Proto' header for request.is_secure()
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
@@ -15,6 +15,12 @@ urlpatterns = patterns('',
     url(r'^info/user/', 'eatupBackendApp.views.getUser', name='get_user'),
     url(r'^info/event/', 'eatupBackendApp.views.getEvent', name='get_event'),
     url(r'^info/userevents/', 'eatupBackendApp.views.getUserEvents', name='get_user_events'),
+    url(r'^info/feed/', 'eatupBackendApp.views.getFeed', name='get_feed'),
+    url(r'^info/suggestions/', 'eatupBackendApp.views.getSuggestions', name='get_suggestions'),
+    url(r'^info/friendsattending/', 'eatupBackendApp.views.getFriendsAttending', name='get_friends_attending'),
+    # events whose title or description has every word of q, best first
+    url(r'^info/search/', 'eatupBackendApp.views.searchEvents', name='search_events'),
+    url(r'^changes/', 'eatupBackendApp.views.getChanges', name='get_changes'),
     url(r'^create/event/', 'eatupBackendApp.views.createEvent', name='create_event'),
     url(r'^create/user/', 'eatupBackendApp.views.createUser', name='create_user'),
     url(r'^delete/event/', 'eatupBackendApp.views.deleteEvent', name='delete_event'),
@@ -26,21 +32,34 @@ urlpatterns = patterns('',
     
     url(r'^edit/user/', 'eatupBackendApp.views.editUser', name='edit_user'),
     
+    # replaces a user's whole friend list, ignoring unknown uids
+    url(r'^sync/friends/', 'eatupBackendApp.views.syncFriends', 
+        name='sync_friends'),
+    
     # Uncomment the admin/doc line below to enable admin documentation:
     url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
 
+    # per-view SQL statistics collected by QueryStatsMiddleware (staff only)
+    url(r'^admin/querystats/$', 'eatupBackendApp.queryStats.showQueryStats',
+        name='query_stats'),
+
+    # every worker's metrics, in the Prometheus text format
+    url(r'^metrics$', 'eatupBackendApp.metrics.showMetrics', name='metrics'),
+
     # Uncomment the next line to enable the admin:
     url(r'^admin/', include(admin.site.urls)),
 )
 
 # this pattern allows django to serve media files in production
 urlpatterns += patterns('',
-    url(r'^media/profilePics/(?P<path>.*)$', 'django.views.static.serve',
+    url(r'^media/profilePics/(?P<path>.*)$', 
+        'eatupBackendApp.staticServe.serveStatic',
         {'document_root': settings.PROFILE_PICS_ROOT, 'show_indexes': True}),
 )
 
-# this pattern allows django to serve static files in production
+# this pattern allows django to serve static files in production, with
+# caching headers, precompressed sidecars and range support
 urlpatterns += patterns('', 
-    url(r'^static/(?P<path>.*)$', 'django.views.static.serve',
+    url(r'^static/(?P<path>.*)$', 'eatupBackendApp.staticServe.serveStatic',
         {'document_root': settings.STATIC_ROOT }),
 )
\ No newline at end of file